@@ -8,7 +8,15 @@
 # ----------------------------------------------------------------------------
 
 import logging
+import h5py
+import numpy as np
 import pandas as pd
+from biom import load_table
+from qurro._table_utils import (
+    SparseTable,
+    as_sparse_table,
+    restore_table_type,
+)
 
 
 def ensure_df_headers_unique(df, df_name):
@@ -138,61 +146,84 @@ def biom_table_to_sparse_df(table, min_row_ct=2, min_col_ct=1):
     return table_sdf
 
 
+def biom_table_to_sparse_table(table, min_row_ct=2, min_col_ct=1):
+    """Loads a BIOM table as a SparseTable. Also calls validate_df().
+
+       This is what Qurro uses internally; unlike biom_table_to_sparse_df(),
+       this just wraps the BIOM table's underlying csr_matrix (without
+       creating a pandas object holding all of the count data).
+
+       If the table is already a SparseTable (e.g. as returned by
+       load_matching_table()), it's just validated.
+    """
+    if isinstance(table, SparseTable):
+        table_st = table
+    else:
+        logging.debug("Creating a SparseTable from BIOM table.")
+        table_st = SparseTable.from_biom(table)
+    validate_df(table_st, "BIOM table", min_row_ct, min_col_ct)
+    logging.debug("Converted BIOM table to SparseTable.")
+    return table_st
+
+
 def remove_empty_samples_and_features(
-    table_sdf, sample_metadata_df, feature_ranks_df
+    table, sample_metadata_df, feature_ranks_df
 ):
     """Removes empty samples and features from the table, sample metadata, and
        feature ranks DataFrames.
 
        This should be called *after* matching the table with the sample
        metadata and feature ranks -- we assume that the columns of the
-       table DataFrame are equivalent to the indices of the sample metadata
+       table are equivalent to the indices of the sample metadata
        DataFrame, and that the indices (rows) of the table are also equivalent
        to the indices of the feature ranks DataFrame.
 
+       The table can be either a SparseTable or a DataFrame; the output table
+       will be of the same type as the input table.
+
        This will raise a ValueError if the input table is empty (i.e. all
        samples/features would be removed).
     """
     logging.debug("Attempting to remove empty samples and features.")
+    table_st, was_converted = as_sparse_table(table)
 
-    # Filter out empty samples (columns) and features (rows) from the table
-    # This approach based on https://stackoverflow.com/a/21165116/10730311.
-    neq_0 = table_sdf != 0
-    filtered_table = table_sdf.loc[
-        neq_0.any(axis="columns"), neq_0.any(axis="index")
-    ]
+    # Since SparseTables don't store explicit zeros, a feature (row) or sample
+    # (column) is empty iff it doesn't have any stored entries.
+    stats = table_st.stats()
+    nonempty_features = stats.feature_nnz > 0
+    nonempty_samples = stats.sample_nnz > 0
 
     # If the table only contains zeros, then attempting to drop all empty
-    # samples and/or features results in a 0x0 DataFrame. We raise a ValueError
-    # in this case.
-    if filtered_table.empty:
+    # samples and/or features would result in a 0x0 table. We raise a
+    # ValueError in this case.
+    if not nonempty_features.any():
         raise ValueError("The table is empty.")
 
     # Let user know about which samples/features may have been dropped, if any.
     # And, if we filtered out any samples or features, filter the sample
-    # metadata and feature ranks (respectively) to match (this is just done by
-    # aligning them to the filtered table).
+    # metadata and feature ranks (respectively) to match.
+    filtered_table = table
     filtered_metadata = sample_metadata_df
     filtered_ranks = feature_ranks_df
 
-    sample_diff = len(table_sdf.columns) - len(filtered_table.columns)
+    sample_diff = len(nonempty_samples) - nonempty_samples.sum()
+    feature_diff = len(nonempty_features) - nonempty_features.sum()
+    if sample_diff > 0 or feature_diff > 0:
+        # (The output table's stats are derived from table_st's, so later
+        # steps like add_sample_presence_count() don't need to recompute
+        # them.)
+        filtered_table = restore_table_type(
+            table_st.remove_empty(), was_converted
+        )
+
     if sample_diff > 0:
-        # As with match_table_and_data, we have to transpose the sample
-        # metadata in order to align it with the table (since samples are
-        # stored as columns in the table but as indices in the sample metadata)
-        sm_t = sample_metadata_df.T
-        filtered_metadata = filtered_table.align(
-            sm_t, join="inner", axis="columns"
-        )[1].T
+        filtered_metadata = sample_metadata_df.loc[filtered_table.columns]
         print("Removed {} empty sample(s).".format(sample_diff))
     else:
         logging.debug("Couldn't find any empty samples.")
 
-    feature_diff = len(table_sdf.index) - len(filtered_table.index)
     if feature_diff > 0:
-        filtered_ranks = filtered_table.align(
-            feature_ranks_df, join="inner", axis="index"
-        )[1]
+        filtered_ranks = feature_ranks_df.loc[filtered_table.index]
         print("Removed {} empty feature(s).".format(feature_diff))
     else:
         logging.debug("Couldn't find any empty features.")
@@ -213,11 +244,11 @@ def print_if_dropped(
 
        Parameters
        ----------
-       df_old: pd.DataFrame (or pd.SparseDataFrame)
+       df_old: pd.DataFrame (or pd.SparseDataFrame, or SparseTable)
             "Unfiltered" DataFrame -- used as the reference when trying to
             determine if df_new has been filtered.
 
-       df_new: pd.DataFrame (or pd.SparseDataFrame)
+       df_new: pd.DataFrame (or pd.SparseDataFrame, or SparseTable)
             A potentially-filtered DataFrame.
 
        axis_num: int
@@ -239,7 +270,22 @@ def print_if_dropped(
             filter_basis_name could be "BIOM table".
     """
 
-    dropped_item_ct = df_old.shape[axis_num] - df_new.shape[axis_num]
+    print_dropped_count(
+        df_old.shape[axis_num] - df_new.shape[axis_num],
+        item_name,
+        df_name,
+        filter_basis_name,
+    )
+
+
+def print_dropped_count(
+    dropped_item_ct, item_name, df_name, filter_basis_name
+):
+    """Prints a message if dropped_item_ct is positive.
+
+       This is what print_if_dropped() uses; the parameters other than
+       dropped_item_ct are the same as for that function.
+    """
     if dropped_item_ct > 0:
         print(
             "{} {}(s) in the {} were not present in the {}.".format(
@@ -252,6 +298,106 @@ def print_if_dropped(
         )
 
 
+def check_ranked_features_in_table(feature_ranks, ranked_feature_positions):
+    """Raises a ValueError if any ranked features aren't in the BIOM table.
+
+       ranked_feature_positions should be the positions of the ranked
+       features in the BIOM table, as given by Index.get_indexer() (so -1
+       indicates a feature that isn't in the table).
+    """
+    unsupported_feature_ct = np.sum(ranked_feature_positions < 0)
+    if unsupported_feature_ct > 0:
+        # making this error message as pretty as possible
+        word = "were"
+        if unsupported_feature_ct == 1:
+            word = "was"
+        raise ValueError(
+            "Of the {} ranked features, {} {} not present in "
+            "the input BIOM table.".format(
+                feature_ranks.shape[0], unsupported_feature_ct, word
+            )
+        )
+
+
+def check_any_samples_shared(shared_sample_ct):
+    """Raises a ValueError if no samples are shared between the sample
+       metadata and BIOM table.
+    """
+    # Allow for dropped samples (e.g. negative controls), but ensure that at
+    # least one sample is supported by the BIOM table.
+    if shared_sample_ct < 1:
+        raise ValueError(
+            "No samples are shared between the sample metadata file and BIOM "
+            "table."
+        )
+
+
+def load_matching_table(table_loc, feature_ranks, sample_metadata):
+    """Loads only the parts of a BIOM table that Qurro will use.
+
+       match_table_and_data() removes every feature in the BIOM table that
+       isn't in the feature ranks, and every sample that isn't in the sample
+       metadata. For large BIOM tables in the HDF5 format, it's a lot faster
+       (and uses a lot less memory) to avoid loading these features and
+       samples in the first place: so this only reads the count data of the
+       remaining features and samples from the file.
+
+       (BIOM tables in other formats, e.g. JSON or TSV, don't support this, so
+       they're just loaded as usual.)
+
+       This raises the same errors (and prints the same messages about the
+       features and samples dropped from the BIOM table) as
+       match_table_and_data() would.
+
+       Parameters
+       ----------
+
+       table_loc: str
+            Path to the BIOM table.
+
+       feature_ranks: pd.DataFrame
+
+       sample_metadata: pd.DataFrame
+
+       Returns
+       -------
+
+       SparseTable or biom.Table
+            A SparseTable, if the BIOM table was in the HDF5 format (its
+            features and samples will be in the same order as in the file),
+            and a biom.Table otherwise. This can be passed to
+            generate.process_and_generate() in either case.
+    """
+    if not h5py.is_hdf5(table_loc):
+        logging.debug("BIOM table isn't in HDF5 format; loading all of it.")
+        return load_table(table_loc)
+
+    with h5py.File(table_loc, "r") as h5grp:
+        table_feature_ct, table_sample_ct = h5grp.attrs["shape"]
+        table = SparseTable.from_hdf5(
+            h5grp, feature_ranks.index, sample_metadata.index
+        )
+    logging.debug("Loaded matching parts of HDF5 BIOM table.")
+
+    check_ranked_features_in_table(
+        feature_ranks, table.feature_ids.get_indexer(feature_ranks.index)
+    )
+    print_dropped_count(
+        table_feature_ct - table.shape[0],
+        "feature",
+        "BIOM table",
+        "feature rankings",
+    )
+    check_any_samples_shared(table.shape[1])
+    print_dropped_count(
+        table_sample_ct - table.shape[1],
+        "sample",
+        "BIOM table",
+        "sample metadata file",
+    )
+    return table
+
+
 def match_table_and_data(table, feature_ranks, sample_metadata):
     """Matches feature rankings and then sample metadata to a table.
 
@@ -265,10 +411,10 @@ def match_table_and_data(table, feature_ranks, sample_metadata):
        Parameters
        ----------
 
-       table: pd.DataFrame (or pd.SparseDataFrame)
-            A DataFrame created from a BIOM table. The index of this DataFrame
-            should correspond to observations (i.e. features), and the columns
-            should correspond to samples.
+       table: SparseTable or pd.DataFrame (or pd.SparseDataFrame)
+            A representation of a BIOM table. The index of this table should
+            correspond to observations (i.e. features), and the columns should
+            correspond to samples.
 
             Note that the input BIOM table might contain features or samples
             that are not included in feature_ranks or sample_metadata,
@@ -291,9 +437,12 @@ def match_table_and_data(table, feature_ranks, sample_metadata):
        Returns
        -------
 
-       (m_table, m_sample_metadata): both pd.[Sparse]DataFrame
+       (m_table, m_sample_metadata): (SparseTable or pd.DataFrame,
+                                      pd.DataFrame)
             Versions of the input table and sample metadata only containing
-            samples shared by both datasets. The table will also only contain
+            samples shared by both datasets. (The output table will be a
+            SparseTable if the input table was a SparseTable, and a DataFrame
+            otherwise.) The table will also only contain
             features shared by both the table and the feature ranks.
 
             (None of the features in the feature ranks should be dropped during
@@ -310,84 +459,52 @@ def match_table_and_data(table, feature_ranks, sample_metadata):
        in the table, this will raise a ValueError.
     """
     logging.debug("Starting matching table with feature ranks.")
-    featurefiltered_table, m_feature_ranks = table.align(
-        feature_ranks, axis="index", join="inner"
+    table_st, was_converted = as_sparse_table(table)
+
+    # Look up where each ranked feature is in the table. (All of the IDs
+    # involved are unique, so this is just a hash table lookup per feature.)
+    # The features are kept in the same order they're in within the table.
+    ranked_feature_positions = table_st.feature_ids.get_indexer(
+        feature_ranks.index
     )
+    check_ranked_features_in_table(feature_ranks, ranked_feature_positions)
+    feature_positions = np.sort(ranked_feature_positions)
     logging.debug("Matching table with feature ranks done.")
-    # Ensure that every ranked feature was present in the BIOM table. Raise an
-    # error if this isn't the case.
-    if m_feature_ranks.shape[0] < feature_ranks.shape[0]:
-        unsupported_feature_ct = (
-            feature_ranks.shape[0] - m_feature_ranks.shape[0]
-        )
-        # making this error message as pretty as possible
-        word = "were"
-        if unsupported_feature_ct == 1:
-            word = "was"
-        raise ValueError(
-            "Of the {} ranked features, {} {} not present in "
-            "the input BIOM table.".format(
-                feature_ranks.shape[0], unsupported_feature_ct, word
-            )
-        )
-    print_if_dropped(
-        table,
-        featurefiltered_table,
-        0,
+    print_dropped_count(
+        table_st.shape[0] - len(feature_positions),
         "feature",
         "BIOM table",
         "feature rankings",
     )
 
-    # We transpose the sample metadata instead of the actual table because
-    # transposing in pandas, at least from some personal testing, can be really
-    # expensive for huge (EMP-scale) DataFrames. Since sample metadata will
-    # generally be smaller than the actual table, we transpose that.
-    #
-    # (The reason we have debug log messages around these statements is because
-    # of how expensive transposing can be -- this is a rudimentary way to check
-    # for bottlenecks when really large datasets are passed into Qurro.)
-    logging.debug(
-        "Temporarily transposing sample metadata to make matching easier."
-    )
-    sample_metadata_transposed = sample_metadata.T
-    logging.debug("Transposing done.")
-    logging.debug("Starting matching table with (tranposed) sample metadata.")
-    m_table, m_sample_metadata_transposed = featurefiltered_table.align(
-        sample_metadata_transposed, axis="columns", join="inner"
-    )
+    # Similarly, look up where each of the table's samples is in the sample
+    # metadata (-1 means that a sample isn't in the metadata).
+    logging.debug("Starting matching table with sample metadata.")
+    metadata_positions = sample_metadata.index.get_indexer(table_st.sample_ids)
+    sample_positions = np.flatnonzero(metadata_positions >= 0)
+    check_any_samples_shared(len(sample_positions))
+
+    # Now we can slice the rows and columns of the table at once, and take
+    # the matching rows of the sample metadata by position.
+    m_table = table_st.take(feature_positions, sample_positions)
+    m_sample_metadata = sample_metadata.iloc[
+        metadata_positions[sample_positions]
+    ]
     logging.debug("Matching table with sample metadata done.")
-    logging.debug("Transposing sample metadata again to reset it.")
-    m_sample_metadata = m_sample_metadata_transposed.T
-    logging.debug("Transposing done.")
-    # Allow for dropped samples (e.g. negative controls), but ensure that at
-    # least one sample is supported by the BIOM table.
-    #
-    # We only need to check m_sample_metadata.shape[0] here since it should be
-    # equal to m_table.shape[1] at this point (due to our use of .align()).
-    if m_sample_metadata.shape[0] < 1:
-        raise ValueError(
-            "No samples are shared between the sample metadata file and BIOM "
-            "table."
-        )
-    print_if_dropped(
-        sample_metadata,
-        m_sample_metadata,
-        0,
+    print_dropped_count(
+        sample_metadata.shape[0] - len(sample_positions),
         "sample",
         "sample metadata file",
         "BIOM table",
     )
-    print_if_dropped(
-        featurefiltered_table,
-        m_table,
-        1,
+    print_dropped_count(
+        table_st.shape[1] - len(sample_positions),
         "sample",
         "BIOM table",
         "sample metadata file",
     )
 
-    return m_table, m_sample_metadata
+    return restore_table_type(m_table, was_converted), m_sample_metadata
 
 
 def merge_feature_metadata(feature_ranks, feature_metadata=None):
@@ -440,40 +557,12 @@ def merge_feature_metadata(feature_ranks, feature_metadata=None):
     return output_feature_data, feature_metadata_cols
 
 
-def sparsify_count_dict(count_dict):
-    """Returns a "sparse" representation of a dict of counts data.
-
-       We expect that the input dict is of the format {feature ID: {sample ID:
-       count, sample 2 ID: count, ...}, ...}. In theory you could also totally
-       pass in a transposed dict here (where samples are the "outer layer" of
-       the dict), but the variable names would need to be flipped to make this
-       function make sense. (See #175 on GitHub for context.)
-
-       Anyway, this function returns the input dict, but without references to
-       0-count samples for a given feature. (Since we filter out empty
-       features, we expect that every feature should have at least one sample
-       with a nonzero count of that feature.)
-    """
-    logging.debug("Sparsifying count data.")
-    sparse_count_dict = {}
-    for feature_id, sample_counts in count_dict.items():
-        # This will be the new sample_counts dict for this feature ID, but only
-        # containing sample IDs with nonzero counts.
-        fdict = {}
-        for sample_id, count in sample_counts.items():
-            if count != 0:
-                fdict[sample_id] = count
-        sparse_count_dict[feature_id] = fdict
-    logging.debug("Done sparsifying count data.")
-    return sparse_count_dict
-
-
 def add_sample_presence_count(feature_data, table_sdf):
     """Adds a "qurro_spc" column to a DataFrame of feature information.
 
        The value in this column corresponds to the number of samples a given
-       feature is present in, as determined by the count data given in the
-       table_sdf argument.
+       feature is present in (i.e. has a nonzero count in), as determined by
+       the count data given in the table_sdf argument.
 
        Parameters
        ----------
@@ -483,7 +572,7 @@ def add_sample_presence_count(feature_data, table_sdf):
             point in Qurro this is called, this will likely include both
             feature ranking information and feature metadata information.
 
-       table_sdf: pd.SparseDataFrame
+       table_sdf: SparseTable or pd.DataFrame (or pd.SparseDataFrame)
             Representation of a BIOM table containing count data. The index
             contains feature IDs, and the columns contain sample IDs.
             This table should only contain samples that will be used in the
@@ -505,19 +594,12 @@ def add_sample_presence_count(feature_data, table_sdf):
                    (Assuming you've already called check_column_names() on this
                    data this shouldn't be a problem, but this checks anyway.)
     """
-    # Convert the table into a presence-absence representation (every count
-    # value > 0 is replaced with 1).
-    #
-    # When I was looking around for ways to do this, I googled "pandas
-    # dataframe presence absence" and one of the first hits was the docs for
-    # DF.where() (which led me to DF.mask). Nowhere on either of these pages
-    # is "presence" or "absence" mentioned. But, uh, thanks Google for reading
-    # my mind?
-    table_pa = table_sdf.mask(table_sdf > 0, 1)
-    # Sum each row of the presence-absence table, producing a series with
-    # qurro_spc values
-    spc_series = table_pa.sum(axis="columns")
-    spc_series.name = "qurro_spc"
+    table_st, _ = as_sparse_table(table_sdf)
+    spc_series = pd.Series(
+        table_st.stats().feature_nnz.astype(np.int64),
+        index=table_st.feature_ids,
+        name="qurro_spc",
+    )
 
     # Return merged copy of the feature data with the series named "qurro_spc"
     # Note the use of suffixes=(False, False) -- this will throw a ValueError
@@ -590,6 +672,44 @@ def check_column_names(sample_metadata, feature_ranks, feature_metadata=None):
         )
 
 
+def select_sample_metadata_columns(sample_metadata, columns=None):
+    """Limits the sample metadata to just the specified columns.
+
+       Column names are escaped in the same way as the sample metadata's
+       columns are (see escape_columns()), so the original names of columns
+       can be used. The output's columns are in the order given in columns
+       (so the first column given is what the sample plot will use by
+       default).
+
+       If columns is None or empty, the sample metadata is returned unchanged.
+
+       Raises
+       ------
+
+       ValueError
+            If any of the specified columns aren't in the sample metadata.
+    """
+    if not columns:
+        return sample_metadata
+    escaped_columns = list(dict.fromkeys(fix_id(str(c)) for c in columns))
+    missing_columns = [
+        c for c in escaped_columns if c not in sample_metadata.columns
+    ]
+    if len(missing_columns) > 0:
+        raise ValueError(
+            "The following sample metadata column(s) were specified, but "
+            "aren't present in the sample metadata: {}".format(
+                ", ".join(missing_columns)
+            )
+        )
+    logging.debug(
+        "Keeping {} of {} sample metadata columns.".format(
+            len(escaped_columns), len(sample_metadata.columns)
+        )
+    )
+    return sample_metadata[escaped_columns]
+
+
 def vibe_check(
     feature_ranks, table_sdf, safe_range=[-9007199254740991, 9007199254740991],
 ):
@@ -614,9 +734,9 @@ def vibe_check(
             to feature IDs and the columns correspond to ranking names.
             Critically, every entry in this should be numeric.
 
-       table_sdf: pd.DataFrame (or pd.SparseDataFrame)
-            DataFrame representation of a feature table. Similarly to the
-            feature rankings, every entry in this should be numeric.
+       table_sdf: SparseTable or pd.DataFrame (or pd.SparseDataFrame)
+            Representation of a feature table. Similarly to the feature
+            rankings, every entry in this should be numeric.
 
        safe_range: collection with exactly two entries
             The first entry in the safe_range specifies the minimum value we
@@ -664,11 +784,25 @@ def vibe_check(
         "log-ratios outside of the Qurro visualization interface."
     ).format(safe_range[0])
 
-    for (df, df_name) in (
-        (table_sdf, "feature table"),
-        (feature_ranks, "feature rankings data"),
+    # For the table, we can just use the smallest and largest entries (which
+    # account for implicit zeros) from its stats.
+    table_st, _ = as_sparse_table(table_sdf)
+    table_stats = table_st.stats()
+    ranks_vals = feature_ranks.values
+
+    for (too_large, too_small, df_name) in (
+        (
+            table_stats.max_value > safe_range[1],
+            table_stats.min_value < safe_range[0],
+            "feature table",
+        ),
+        (
+            (ranks_vals > safe_range[1]).any(),
+            (ranks_vals < safe_range[0]).any(),
+            "feature rankings data",
+        ),
     ):
-        if (df > safe_range[1]).any().any():
+        if too_large:
             raise OverflowError(upper_error.replace("THING", df_name))
-        if (df < safe_range[0]).any().any():
+        if too_small:
             raise OverflowError(lower_error.replace("THING", df_name))
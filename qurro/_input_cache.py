@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018--, Qurro development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from qurro._table_utils import SparseTable
+from qurro.__init__ import __version__
+
+# Bump this if the format of cache entries (or the output of
+# generate.match_input()) changes, so that old cache entries aren't used.
+CACHE_FORMAT_VERSION = 2
+
+# Default maximum size of an input cache directory, in bytes (1 GiB).
+DEFAULT_MAX_CACHE_SIZE = 1024 ** 3
+
+
+def hash_file(file_loc):
+    """Returns a hex SHA-256 digest of a file's contents."""
+    hasher = hashlib.sha256()
+    with open(file_loc, "rb") as file_obj:
+        for block in iter(lambda: file_obj.read(1024 * 1024), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def hash_df(df):
+    """Returns a hex SHA-256 digest of a DataFrame's contents."""
+    hasher = hashlib.sha256()
+    hasher.update(
+        json.dumps(
+            [
+                [str(c) for c in df.columns],
+                [str(dt) for dt in df.dtypes],
+                df.index.name,
+            ]
+        ).encode("utf-8")
+    )
+    hasher.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return hasher.hexdigest()
+
+
+class _TeeStream(object):
+    """Writes everything written to it to multiple streams."""
+
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, text):
+        for stream in self.streams:
+            stream.write(text)
+
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+
+@contextlib.contextmanager
+def record_output():
+    """Records everything printed within a with block (while still printing
+       it as usual).
+
+       This is used to save the messages printed while matching the input
+       (e.g. about features and samples being dropped), so that they can be
+       printed again when a cache entry is used.
+
+       Yields
+       ------
+       io.StringIO
+            Contains everything printed so far within the with block.
+    """
+    recorded = io.StringIO()
+    with contextlib.redirect_stdout(_TeeStream(sys.stdout, recorded)):
+        yield recorded
+
+
+def _numpy_to_python(obj):
+    """Lets json.dump() handle numpy scalars (e.g. in object columns)."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Can't serialize {}".format(repr(obj)))
+
+
+def _df_to_json(df):
+    """Converts a DataFrame to a JSON-serializable dict.
+
+       Unlike DataFrame.to_json(), this preserves the DataFrame's dtypes (and
+       the exact values of floats).
+    """
+    return {
+        "index": [str(i) for i in df.index],
+        "index_name": df.index.name,
+        "columns": [str(c) for c in df.columns],
+        "dtypes": [str(dt) for dt in df.dtypes],
+        "data": [df[c].tolist() for c in df.columns],
+    }
+
+
+def _df_from_json(df_json):
+    """Inverse of _df_to_json()."""
+    # The index is passed to the constructor (rather than set afterwards) so
+    # that DataFrames without any columns keep their rows
+    index = pd.Index(df_json["index"], name=df_json["index_name"])
+    df = pd.DataFrame(
+        {
+            i: pd.Series(col, index=index, dtype=dtype)
+            for i, (col, dtype) in enumerate(
+                zip(df_json["data"], df_json["dtypes"])
+            )
+        },
+        index=index,
+    )
+    df.columns = pd.Index(df_json["columns"])
+    return df
+
+
+class InputCache(object):
+    """An on-disk cache of the output of generate.match_input().
+
+       Loading a huge BIOM table, converting it to a SparseTable, validating
+       it, and matching it up with the feature ranks and sample metadata can
+       take a while -- and this is repeated every time Qurro is run on the
+       same inputs (e.g. when only changing the extreme feature count or
+       feature metadata). This cache stores the matched table, sample
+       metadata, and feature ranks, keyed by a hash of the inputs these
+       depend on; later runs with the same inputs can skip straight to
+       generate.finish_input().
+
+       Each cache entry is a subdirectory (named after the entry's key) of the
+       cache directory, containing:
+
+       table.npz: the matched table's CSR arrays (see SparseTable)
+       ranks.npz: the feature ranks' columns (as arrays "0", "1", ...)
+       meta.json: the table's IDs, the feature ranks' index/columns, the
+                  rank type, the sample metadata (stored as JSON, since its
+                  columns can have arbitrary types), and the messages printed
+                  while matching the input
+
+       The cache directory's total size is kept under a limit by evicting the
+       least recently used entries (based on their modification times, which
+       are updated whenever an entry is used).
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*input_hashes):
+        """Combines hashes of the inputs into a cache key.
+
+           The key also depends on the Qurro version and cache format, since
+           changes to these might change the output of match_input().
+        """
+        key_json = json.dumps(
+            [__version__, CACHE_FORMAT_VERSION] + list(input_hashes)
+        )
+        return hashlib.sha256(key_json.encode("utf-8")).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """Loads a cache entry.
+
+           Returns
+           -------
+           (m_table, m_sample_metadata, feature_ranks, rank_type, messages),
+           or None
+                messages is the text printed while matching the input (see
+                store()). None is returned if there isn't an entry for this
+                key (or if the entry couldn't be read, in which case it's
+                removed).
+        """
+        entry_dir = self._entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            logging.debug("No input cache entry found for key {}.".format(key))
+            return None
+        try:
+            with open(os.path.join(entry_dir, "meta.json"), "r") as meta_obj:
+                meta = json.load(meta_obj)
+            with np.load(os.path.join(entry_dir, "table.npz")) as table_npz:
+                matrix = (
+                    table_npz["data"],
+                    table_npz["indices"],
+                    table_npz["indptr"],
+                )
+                shape = tuple(table_npz["shape"])
+            with np.load(os.path.join(entry_dir, "ranks.npz")) as ranks_npz:
+                rank_columns = [
+                    ranks_npz[str(i)] for i in range(len(meta["rank_columns"]))
+                ]
+        except (OSError, ValueError, KeyError) as err:
+            logging.debug(
+                "Couldn't read input cache entry {} ({}); removing "
+                "it.".format(key, err)
+            )
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        m_table = SparseTable(
+            csr_matrix(matrix, shape=shape),
+            meta["feature_ids"],
+            meta["sample_ids"],
+        )
+        feature_ranks = pd.DataFrame(
+            dict(zip(meta["rank_columns"], rank_columns)),
+            columns=meta["rank_columns"],
+        )
+        feature_ranks.index = pd.Index(
+            meta["rank_index"], name=meta["rank_index_name"]
+        )
+        m_sample_metadata = _df_from_json(meta["sample_metadata"])
+        # Mark this entry as the most recently used one.
+        os.utime(entry_dir)
+        logging.debug("Loaded input cache entry {}.".format(key))
+        return (
+            m_table,
+            m_sample_metadata,
+            feature_ranks,
+            meta["rank_type"],
+            meta["messages"],
+        )
+
+    def store(
+        self,
+        key,
+        m_table,
+        m_sample_metadata,
+        feature_ranks,
+        rank_type,
+        messages="",
+    ):
+        """Stores a cache entry, then evicts old entries if needed.
+
+           messages should be the text printed while loading and matching the
+           input (see record_output()), so that later runs using this entry
+           can print the same messages about dropped samples/features.
+
+           The entry is written to a temporary directory first and then
+           renamed, so that partially written entries are never loaded.
+        """
+        entry_dir = self._entry_dir(key)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        try:
+            matrix = m_table.matrix
+            np.savez(
+                os.path.join(tmp_dir, "table.npz"),
+                data=matrix.data,
+                indices=matrix.indices,
+                indptr=matrix.indptr,
+                shape=np.array(matrix.shape),
+            )
+            np.savez(
+                os.path.join(tmp_dir, "ranks.npz"),
+                **{
+                    str(i): feature_ranks[c].values
+                    for i, c in enumerate(feature_ranks.columns)
+                }
+            )
+            meta = {
+                "feature_ids": [str(f) for f in m_table.feature_ids],
+                "sample_ids": [str(s) for s in m_table.sample_ids],
+                "rank_index": [str(f) for f in feature_ranks.index],
+                "rank_index_name": feature_ranks.index.name,
+                "rank_columns": [str(c) for c in feature_ranks.columns],
+                "rank_type": rank_type,
+                "sample_metadata": _df_to_json(m_sample_metadata),
+                "messages": messages,
+            }
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as meta_obj:
+                json.dump(meta, meta_obj, default=_numpy_to_python)
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(tmp_dir, entry_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        logging.debug("Stored input cache entry {}.".format(key))
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache is small enough.
+
+           Returns
+           -------
+           list of str
+                The keys of the removed entries.
+        """
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry_dir, f))
+                for f in os.listdir(entry_dir)
+            )
+            entries.append((os.path.getmtime(entry_dir), name, size))
+            total_size += size
+
+        evicted = []
+        for _, name, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(os.path.join(self.cache_dir, name))
+            total_size -= size
+            evicted.append(name)
+        if evicted:
+            logging.debug(
+                "Evicted {} input cache entr{}.".format(
+                    len(evicted), "y" if len(evicted) == 1 else "ies"
+                )
+            )
+        return evicted
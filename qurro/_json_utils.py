@@ -7,9 +7,25 @@
 # The full license is in the file LICENSE.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import base64
+import hashlib
 import json
 import copy
+import logging
 import os
+import shutil
+import zlib
+import numpy as np
+import pandas as pd
+
+# The directory (within a visualization) in which count shards are stored,
+# and the name of the JS function each count shard file calls. See
+# count_data.js.
+COUNT_SHARD_DIR = "count_shards"
+COUNT_SHARD_FUNC = "qurroAddCountShard"
+
+# The key used for compressed JSONs: see compress_json().
+COMPRESSED_JSON_KEY = "qurro_compressed_json"
 
 
 def extract_json_from_line(line):
@@ -53,6 +69,7 @@ def get_jsons(main_js_loc, as_dict=True, return_nones=False, json_prefix=""):
 
        as_dict: bool
           If True, this will load the JSONs as dicts by calling json.loads().
+          (Compressed JSONs -- see compress_json() -- will be decompressed.)
           If False, this will just return the strings.
 
        return_nones: bool
@@ -118,7 +135,7 @@ def get_jsons(main_js_loc, as_dict=True, return_nones=False, json_prefix=""):
             if s is None:
                 return None
             else:
-                return json.loads(s)
+                return decompress_json(json.loads(s))
 
         return (
             str_to_json(rank_plot_json_str),
@@ -189,6 +206,308 @@ def plot_jsons_equal(json1, json2):
     return json1_c == json2_c
 
 
+def encode_array(array, dtype):
+    """Returns a base64-encoded string of an array's little-endian bytes."""
+    return base64.b64encode(np.asarray(array, dtype=dtype).tobytes()).decode(
+        "ascii"
+    )
+
+
+def get_packed_count_json(table):
+    """Creates a compact "packed" count JSON for a table.
+
+       Rather than describing each feature's counts as a dict (in which each
+       sample ID is repeated once for every feature that is present in that
+       sample), this describes the table as a sparse matrix in compressed
+       sparse column (CSC) format -- where the matrix is oriented so that rows
+       correspond to samples and columns correspond to features. Each of the
+       matrix's arrays is stored as a base64-encoded string of its
+       little-endian bytes, which the JS code decodes into typed arrays.
+
+       Parameters
+       ----------
+
+       table: SparseTable
+            The table to encode. Rows correspond to features and columns
+            correspond to samples.
+
+       Returns
+       -------
+
+       dict
+            A JSON-serializable dict with the following keys:
+
+            "qurro_count_format": always "csc"
+            "feature_ids": list of all feature IDs in the table
+            "sample_ids": list of all sample IDs in the table
+            "indptr": Int32 array of length (# features) + 1. The nonzero
+                      counts of feature feature_ids[f] are stored in positions
+                      indptr[f] through indptr[f + 1] - 1 of indices and data.
+            "indices": Int32 array of sample positions (in sample_ids) of each
+                       nonzero count. These are sorted within each feature.
+            "data": array of the nonzero counts
+            "data_type": either "Int32" (if all counts are integers that fit in
+                         an Int32) or "Float64"; describes how "data" is
+                         encoded.
+
+       Raises
+       ------
+
+       ValueError: if the table has too many nonzero entries to be indexed
+                   using Int32s.
+    """
+    logging.debug("Encoding count data as a packed JSON.")
+    matrix = get_count_matrix(table)
+    data_type = get_count_data_type(matrix.data)
+    packed_json = {
+        "qurro_count_format": "csc",
+        "feature_ids": [str(fid) for fid in table.feature_ids],
+        "sample_ids": [str(sid) for sid in table.sample_ids],
+        "data_type": data_type,
+    }
+    packed_json.update(encode_count_arrays(matrix, data_type))
+    logging.debug("Done encoding count data as a packed JSON.")
+    return packed_json
+
+
+def get_count_matrix(table):
+    """Returns a table's CSR matrix, with its indices sorted within each row.
+
+       Raises
+       ------
+
+       ValueError: if the table has too many nonzero entries to be indexed
+                   using Int32s.
+    """
+    matrix = table.matrix
+    if matrix.nnz > np.iinfo(np.int32).max:
+        raise ValueError(
+            "The table has too many nonzero entries ({}) to be "
+            "visualized.".format(matrix.nnz)
+        )
+    if not matrix.has_sorted_indices:
+        matrix = matrix.sorted_indices()
+    return matrix
+
+
+def get_count_data_type(data):
+    """Returns "Int32" if all counts are integers that fit in an Int32, and
+       "Float64" otherwise.
+    """
+    int32_max = np.iinfo(np.int32).max
+    if np.all(np.mod(data, 1) == 0) and np.all(np.abs(data) <= int32_max):
+        return "Int32"
+    return "Float64"
+
+
+def encode_count_arrays(matrix, data_type):
+    """Encodes the indptr, indices, and data arrays of a CSR count matrix.
+
+       (Since rows correspond to features, this is the CSC matrix described in
+       get_packed_count_json().)
+    """
+    return {
+        "indptr": encode_array(matrix.indptr, "<i4"),
+        "indices": encode_array(matrix.indices, "<i4"),
+        "data": encode_array(
+            matrix.data, "<i4" if data_type == "Int32" else "<f8"
+        ),
+    }
+
+
+def get_sharded_count_json(table, shard_size):
+    """Splits up a table's count data into "shards" of features.
+
+       For very large tables, embedding all of the count data in main.js means
+       that the browser has to load all of it before anything can be shown --
+       even though only the counts of the currently selected features are
+       ever needed. The sharded count data format avoids this: main.js only
+       contains the feature and sample IDs, and the counts of each group of
+       shard_size consecutive features (in the order of the table's features)
+       are stored in a separate JS file (see write_count_shards()). The JS
+       code loads these files as needed.
+
+       Parameters
+       ----------
+
+       table: SparseTable
+            The table to encode.
+
+       shard_size: int
+            The (maximum) number of features to include in each shard. Must
+            be at least 1.
+
+       Returns
+       -------
+
+       (index_json, shards): (dict, generator of dict)
+            index_json is a JSON-serializable dict with the same
+            "feature_ids", "sample_ids", and "data_type" keys as in
+            get_packed_count_json(), but with "qurro_count_format" set to
+            "sharded" and with the following additional keys:
+
+            "shard_size": shard_size
+            "num_shards": the number of shards the counts are split into
+            "shard_dir": the directory (relative to main.js) that the shard
+                         files should be written to
+
+            shards yields one dict per shard (in order), each with "indptr",
+            "indices", and "data" keys defined as in get_packed_count_json()
+            -- just using only the features in this shard. (So, the first
+            element of each shard's indptr is 0.)
+
+       Raises
+       ------
+
+       ValueError: if shard_size is less than 1, or if the table has too many
+                   nonzero entries to be indexed using Int32s.
+    """
+    if shard_size < 1:
+        raise ValueError("The count shard size must be at least 1.")
+    matrix = get_count_matrix(table)
+    data_type = get_count_data_type(matrix.data)
+    num_features = matrix.shape[0]
+    num_shards = -(-num_features // shard_size)
+    index_json = {
+        "qurro_count_format": "sharded",
+        "feature_ids": [str(fid) for fid in table.feature_ids],
+        "sample_ids": [str(sid) for sid in table.sample_ids],
+        "data_type": data_type,
+        "shard_size": shard_size,
+        "num_shards": num_shards,
+        "shard_dir": COUNT_SHARD_DIR,
+    }
+
+    def iter_shards():
+        for start in range(0, num_features, shard_size):
+            yield encode_count_arrays(
+                matrix[start : start + shard_size], data_type
+            )
+
+    return index_json, iter_shards()
+
+
+def get_count_shard_filename(shard_index):
+    return "shard_{}.js".format(shard_index)
+
+
+def write_count_shards(output_dir, shards):
+    """Writes out count shards (see get_sharded_count_json()) to JS files.
+
+       Each shard is written to output_dir/COUNT_SHARD_DIR/shard_[i].js, where
+       i is the shard's position (starting at 0). These files each contain a
+       single line of the form
+
+       qurroAddCountShard([i], {shard JSON});
+
+       so that they can be loaded by adding a <script> tag to the page, which
+       (unlike using XMLHttpRequest or fetch()) works for pages opened from
+       file:// URLs.
+
+       If output_dir/COUNT_SHARD_DIR already exists, it's removed first (so
+       that shards left over from a previous visualization can't get mixed up
+       with the new ones).
+
+       Returns
+       -------
+
+       int
+            The number of shards written.
+    """
+    shard_dir = os.path.join(output_dir, COUNT_SHARD_DIR)
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir)
+    num_written = 0
+    for i, shard in enumerate(shards):
+        shard_loc = os.path.join(shard_dir, get_count_shard_filename(i))
+        with open(shard_loc, "w") as shard_file_obj:
+            shard_file_obj.write("{}({}, ".format(COUNT_SHARD_FUNC, i))
+            for chunk in iter_json_chunks(shard):
+                shard_file_obj.write(chunk)
+            shard_file_obj.write(");\n")
+        num_written += 1
+    logging.debug("Wrote {} count shard file(s).".format(num_written))
+    return num_written
+
+
+def compress_json(json_obj):
+    """Compresses a JSON, to make the visualization's files smaller.
+
+       The JSON text (see iter_json_chunks()) is compressed using zlib's
+       DEFLATE implementation, and the compressed bytes are base64-encoded.
+       The JS code decompresses these JSONs when the visualization is loaded
+       (see compression.js).
+
+       Parameters
+       ----------
+       json_obj: dict or iterable of str
+          The JSON to compress.
+
+       Returns
+       -------
+       (compressed_json, uncompressed_size): (dict, int)
+          compressed_json is a dict of the form
+          {COMPRESSED_JSON_KEY: "[base64-encoded compressed JSON text]"}, and
+          uncompressed_size is the length (in bytes) of the JSON text before
+          compression.
+    """
+    compressor = zlib.compressobj()
+    compressed_chunks = []
+    uncompressed_size = 0
+    for chunk in iter_json_chunks(json_obj):
+        chunk_bytes = chunk.encode("utf-8")
+        uncompressed_size += len(chunk_bytes)
+        compressed_chunks.append(compressor.compress(chunk_bytes))
+    compressed_chunks.append(compressor.flush())
+    compressed_json = {
+        COMPRESSED_JSON_KEY: base64.b64encode(
+            b"".join(compressed_chunks)
+        ).decode("ascii")
+    }
+    return compressed_json, uncompressed_size
+
+
+def decompress_json(json_obj):
+    """Inverse of compress_json(): returns the original JSON as a dict.
+
+       If json_obj isn't a compressed JSON, this just returns json_obj.
+    """
+    if isinstance(json_obj, dict) and list(json_obj) == [COMPRESSED_JSON_KEY]:
+        return json.loads(
+            zlib.decompress(
+                base64.b64decode(json_obj[COMPRESSED_JSON_KEY])
+            ).decode("utf-8")
+        )
+    return json_obj
+
+
+def encode_json(json_obj):
+    """Returns JSON text for either a dict or an iterable of JSON chunks.
+
+       If json_obj is a dict, this just calls json.dumps() on it (sorting the
+       keys). Otherwise, we assume json_obj is an iterable of strings that
+       together make up already-encoded JSON text, and we just join these
+       strings together.
+    """
+    if isinstance(json_obj, dict):
+        return json.dumps(json_obj, sort_keys=True)
+    return "".join(json_obj)
+
+
+def iter_json_chunks(json_obj):
+    """Yields chunks of JSON text for either a dict or an iterable of chunks.
+
+       This is the streaming counterpart of encode_json(): joining the output
+       of this function together gives the same text as encode_json() would.
+       Dicts are encoded piece by piece using json.JSONEncoder.iterencode(),
+       so the full JSON text for a dict never needs to be held in memory.
+    """
+    if isinstance(json_obj, dict):
+        return json.JSONEncoder(sort_keys=True).iterencode(json_obj)
+    return iter(json_obj)
+
+
 def try_to_replace_line_json(line, json_type, new_json, json_prefix=""):
     """Attempts to replace a JSON declaration if it's on the line.
 
@@ -208,9 +527,9 @@ def try_to_replace_line_json(line, json_type, new_json, json_prefix=""):
           One of "rank", "sample", or "count". Other values will result in a
           ValueError being thrown.
 
-       new_json: dict
+       new_json: dict or iterable of str
           A JSON to try replacing the current variable declaration (if present)
-          on the input line with.
+          on the input line with. See encode_json() for details.
 
        json_prefix: str (default value: "")
           An optional prefix that will be appended to any JSON names we try to
@@ -247,11 +566,7 @@ def try_to_replace_line_json(line, json_type, new_json, json_prefix=""):
 
     if line.lstrip().startswith(prefixToReplace):
         return (
-            (
-                line[: line.index("{")]
-                + json.dumps(new_json, sort_keys=True)
-                + ";\n"
-            ),
+            (line[: line.index("{")] + encode_json(new_json) + ";\n"),
             True,
         )
     return line, False
@@ -288,6 +603,9 @@ def replace_js_json_definitions(
        the way these variables are written to in the JS, it may cause the
        python tests to fail.
 
+       The count JSON can be passed either as a dict or as an iterable of
+       already-encoded chunks of JSON text (see encode_json()).
+
        The "verbose" flag just determines whether or not to print something
        when trying to go forward with a replacement.
     """
@@ -301,8 +619,10 @@ def replace_js_json_definitions(
     diff_rp = not plot_jsons_equal(curr_rank_plot_json, rank_plot_json)
     diff_sp = not plot_jsons_equal(curr_sample_plot_json, sample_plot_json)
     # Since the count JSON isn't a Vega-Lite JSON, we need to just compare it
-    # normally using the != operator.
-    diff_c = curr_count_json != count_json
+    # normally using the != operator. (If the count JSON was passed as
+    # already-encoded chunks of text, we don't bother decoding it to check
+    # this -- we just assume that it's different.)
+    diff_c = not isinstance(count_json, dict) or curr_count_json != count_json
 
     # If straight-up we know that all of the JSONs are equal, then we won't
     # write anything out. Just return 1 immediately.
@@ -325,7 +645,7 @@ def replace_js_json_definitions(
             )
         )
 
-    output_file_contents = ""
+    output_lines = []
     at_least_one_json_changed = False
     with open(input_file_loc, "r") as input_file_obj:
         # read in basic main.js contents. Replace everything after the {
@@ -347,14 +667,14 @@ def replace_js_json_definitions(
                 )
             if changed_yet:
                 at_least_one_json_changed = True
-            output_file_contents += output_line
+            output_lines.append(output_line)
 
     if at_least_one_json_changed:
         if output_file_loc is None:
             output_file_loc = input_file_loc
 
         with open(output_file_loc, "w") as output_file_obj:
-            output_file_obj.write(output_file_contents)
+            output_file_obj.writelines(output_lines)
         return 0
     # Let the caller know that nothing was written to the output file location.
     # If this was called on a JS test then this perfectly normal, but if this
@@ -362,6 +682,77 @@ def replace_js_json_definitions(
     return 1
 
 
+def write_main_js(
+    template_loc,
+    output_file_loc,
+    rank_plot_json,
+    sample_plot_json,
+    count_json,
+):
+    """Writes a main.js file for a new visualization, streaming the JSONs.
+
+       This is the visualization-generation counterpart of
+       replace_js_json_definitions(). Since we're always writing out a fresh
+       main.js from a template (i.e. support_files/main.js, where the JSON
+       declarations are all empty), there's no need to parse the existing
+       JSONs out of the template to check if they've changed. And instead of
+       building up the entire output file in memory, this writes each line of
+       the template -- and each chunk of each JSON (see iter_json_chunks()) --
+       directly to the output file. This keeps memory usage bounded even for
+       very large count JSONs.
+
+       Parameters
+       ----------
+       template_loc: str
+          The location of the template main.js file. This should contain a
+          one-line declaration of each of the three JSONs (see
+          try_to_replace_line_json()).
+
+       output_file_loc: str
+          The location to write the new main.js file to. This shouldn't be
+          the same as template_loc, since the template is read while the
+          output is being written.
+
+       rank_plot_json, sample_plot_json: dict
+          The Vega-Lite specifications for the rank and sample plots.
+
+       count_json: dict or iterable of str
+          The count JSON (e.g. the output of get_packed_count_json()).
+
+       Raises
+       ------
+       ValueError: if the template doesn't contain a declaration of each of
+                   the three JSONs.
+    """
+    json_defs = (
+        ("var rankPlotJSON = {", rank_plot_json),
+        ("var samplePlotJSON = {", sample_plot_json),
+        ("var countJSON = {", count_json),
+    )
+    num_replaced = 0
+    with open(template_loc, "r") as template_file_obj, open(
+        output_file_loc, "w"
+    ) as output_file_obj:
+        for line in template_file_obj:
+            for json_def, json_obj in json_defs:
+                if line.lstrip().startswith(json_def):
+                    output_file_obj.write(line[: line.index("{")])
+                    for chunk in iter_json_chunks(json_obj):
+                        output_file_obj.write(chunk)
+                    output_file_obj.write(";\n")
+                    num_replaced += 1
+                    break
+            else:
+                output_file_obj.write(line)
+
+    if num_replaced != len(json_defs):
+        raise ValueError(
+            "Wasn't able to find all JSON declarations in {}.".format(
+                template_loc
+            )
+        )
+
+
 def check_json_dataset_names(json_dict, *restricted_names):
     """Checks that certain dataset names aren't present in a Vega-Lite JSON.
 
@@ -382,3 +773,146 @@ def check_json_dataset_names(json_dict, *restricted_names):
             "Found the following disallowed dataset name(s) in a JSON: "
             "{}".format(intersection)
         )
+
+
+def df_to_dataset(df):
+    """Converts a DataFrame to a named inline Vega-Lite dataset.
+
+       The records in the dataset should be the same as those Altair's default
+       data transformer would create (it calls
+       altair.utils.sanitize_dataframe() and then
+       DataFrame.to_dict(orient="records")): infinite and missing values are
+       replaced with None, numpy scalars are replaced with python scalars,
+       etc. However, this works on the DataFrame one column at a time (rather
+       than one row at a time), which is a lot faster for large DataFrames.
+
+       Like Altair, we name the dataset based on a hash of its contents.
+       Unlike Altair (which hashes the JSON of the entire list of records,
+       which is slow), we just hash the JSON of each column -- so the name
+       will be different from the one Altair would assign.
+
+       Returns
+       -------
+
+       (dataset_name, records): (str, list of dict), or None
+            None is returned if the DataFrame contains things that this
+            function doesn't know how to convert exactly as Altair would
+            (columns with non-string names, or with dtypes other than
+            bool/integer/float/object). In this case, the caller should just
+            let Altair convert the DataFrame.
+    """
+    col_names = list(df.columns)
+    if len(set(col_names)) != len(col_names) or not all(
+        isinstance(c, str) for c in col_names
+    ):
+        return None
+
+    hasher = hashlib.md5(json.dumps(col_names).encode())
+    columns = []
+    for i in range(len(col_names)):
+        col = df.iloc[:, i]
+        dtype = col.dtype
+        if not isinstance(dtype, np.dtype):
+            # e.g. categorical or nullable integer columns
+            return None
+        if dtype == bool or np.issubdtype(dtype, np.integer):
+            values = col.tolist()
+            bad_positions = []
+        elif np.issubdtype(dtype, np.floating):
+            values = col.tolist()
+            bad_positions = np.flatnonzero(~np.isfinite(col.values))
+        elif dtype == object:
+            values = col.tolist()
+            # Altair converts numpy arrays in object columns to lists. We skip
+            # checking for these in the common case of a column of strings.
+            if pd.api.types.infer_dtype(values, skipna=True) != "string":
+                values = [
+                    v.tolist() if isinstance(v, np.ndarray) else v
+                    for v in values
+                ]
+            bad_positions = np.flatnonzero(pd.isnull(col.values))
+        else:
+            return None
+        for p in bad_positions:
+            values[p] = None
+        hasher.update(json.dumps(values).encode())
+        columns.append(values)
+
+    records = [dict(zip(col_names, row)) for row in zip(*columns)]
+    return "data-" + hasher.hexdigest(), records
+
+
+def get_dictionary_encoding(col):
+    """Dictionary-encodes a column of strings, if this would make it smaller.
+
+       Columns of sample metadata often contain the same few values over and
+       over (e.g. "Healthy" and "Sick"). Storing each value just once, and
+       replacing the values in the column with integer codes referring to
+       these stored values, can save a lot of space in such cases.
+
+       Parameters
+       ----------
+
+       col: pd.Series
+
+       Returns
+       -------
+
+       (codes, dictionary): (list, list of str), or None
+            codes contains, for each value in col, the position of this value
+            in dictionary (or None, if the value is missing). None is
+            returned if col isn't a column of strings, or if encoding it
+            wouldn't make its JSON representation any smaller.
+    """
+    if col.dtype != object:
+        return None
+    codes, uniques = pd.factorize(col.values)
+    if len(uniques) == 0 or pd.api.types.infer_dtype(uniques) != "string":
+        return None
+
+    # Compare the (approximate) sizes of the column's values, as JSON, with
+    # and without encoding. (Each unique value is stored once in the
+    # dictionary, followed by ", ".)
+    unique_sizes = pd.Series(uniques).str.len().values + 2
+    present_codes = codes[codes >= 0]
+    raw_size = np.dot(
+        np.bincount(present_codes, minlength=len(uniques)), unique_sizes
+    )
+    code_sizes = np.char.str_len(present_codes.astype(str))
+    encoded_size = np.sum(code_sizes) + np.sum(unique_sizes + 2)
+    if encoded_size >= raw_size:
+        return None
+
+    encoded_values = codes.astype(object)
+    encoded_values[codes < 0] = None
+    return encoded_values.tolist(), uniques.tolist()
+
+
+def dictionary_encode_columns(df, col_names):
+    """Calls get_dictionary_encoding() on some of the columns of a DataFrame.
+
+       Returns
+       -------
+
+       (encoded_df, dictionaries): (pd.DataFrame, dict)
+            encoded_df is a copy of df in which the columns that were
+            encoded contain integer codes. dictionaries maps the name of each
+            of these columns to the list of values that its codes refer to.
+    """
+    # (A shallow copy isn't enough: on older versions of pandas, assigning to
+    # its columns below would also change df.)
+    encoded_df = df.copy()
+    dictionaries = {}
+    for col_name in col_names:
+        encoding = get_dictionary_encoding(df[col_name])
+        if encoding is not None:
+            encoded_df[col_name] = pd.Series(
+                encoding[0], index=df.index, dtype=object
+            )
+            dictionaries[col_name] = encoding[1]
+    logging.debug(
+        "Dictionary-encoded {} of {} column(s).".format(
+            len(dictionaries), len(col_names)
+        )
+    )
+    return encoded_df, dictionaries
@@ -7,73 +7,143 @@
 # The full license is in the file LICENSE.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import logging
 import pandas as pd
 import numpy as np
-from io import StringIO
+from io import BytesIO, StringIO
 from ._df_utils import replace_nan
 
+# Ways read_metadata_file() can parse a metadata file. Using "pyarrow"
+# requires the pyarrow package to be installed.
+METADATA_ENGINES = ("pandas", "pyarrow")
 
-def get_q2_comment_lines(md_file_loc):
-    """Returns a list of line numbers in the file that start with "#q2:".
-
-       These lines should be skipped when parsing the file outside of Q2 (i.e.
-       in pandas). I guess we could also ostensibly use these lines' types here
-       eventually, but for now we just skip them.
-
-       Notes:
-        -The line numbers are 0-indexed (so they can easily be thrown in to
-         pandas.read_csv() as the skiprows parameter)
-        -This doesn't check check the first line of the file (assumed to be the
-         header)
-        -This stops checking lines once it gets to the first non-header line
-         that doesn't start with "#q2:". Currently, "#q2:types" is the only Q2
-         "comment directive" available, but ostensibly this could detect future
-         Q2 comment directives.
-        -This checks if md_file_loc is of type StringIO. If so, this will
-         handle it properly (iterating over it directly); otherwise, this
-         assumes that md_file_loc is an actual filename, and this will open
-         it using open().
-         (I realize that ideally this wouldn't have to do any type checking,
-         but it's either this or do a bunch of weird refactoring to get my test
-         code working.)
+
+def strip_values(values):
+    """Strips surrounding whitespace from each string in an array of metadata
+       values, and converts the resulting empty strings to NaNs.
+
+       Stripping whitespace mimics how QIIME 2 ignores this whitespace, and
+       converting ""s to NaNs is sorta the opposite of replace_nan(). This is
+       done in a single loop over the values, which is a lot faster than
+       calling .str.strip() and then .where() on a large DataFrame.
+
+       Non-string values (i.e. NaNs) are left as is.
     """
+    output = np.empty(len(values), dtype=object)
+    output[:] = [
+        (v.strip() or np.NaN) if type(v) == str else v for v in values
+    ]
+    return output
 
-    def iterate_over_file_obj_lines(file_obj):
-        q2_lines = []
-        line_num = 0
-        for line in file_obj:
-            # Don't check for a #q2: comment on the first line of the file,
-            # since the first line (should) define the file header.
-            if line_num > 0:
-                if line.startswith("#q2:"):
-                    q2_lines.append(line_num)
-                else:
-                    # We assume that all #q2: lines will occur at the start of
-                    # the file. Once we've reached a line that doesn't start
-                    # with "#q2:", we stop checking.
-                    break
-            line_num += 1
-        return q2_lines
 
-    if type(md_file_loc) == StringIO:
-        q2_lines = iterate_over_file_obj_lines(md_file_loc)
-        # HACK: Allow us to read through this StringIO again --
-        # https://stackoverflow.com/a/27261215/10730311
-        # Note that we're only ever bothering with StringIOs here during test
-        # code, so this weirdness should be ignored during normal operation of
-        # Qurro.
-        md_file_loc.seek(0)
-        return q2_lines
-    else:
-        with open(md_file_loc, "r") as md_file_obj:
-            return iterate_over_file_obj_lines(md_file_obj)
+def read_header_and_skip_q2_lines(file_obj):
+    """Reads the header line of a metadata file, and skips any "#q2:" lines
+       after it.
+
+       This only reads as many lines as it needs to: once this returns,
+       file_obj will be positioned at the start of the first line of data
+       (so it can be passed directly to pd.read_csv()).
+
+       The first line of the file is always treated as the header, even if
+       it starts with "#q2:". We assume that all "#q2:" lines occur right
+       after the header, so once we reach a line that doesn't start with
+       "#q2:" we stop checking.
+
+       Returns
+       -------
+
+       (header, q2_line_ct): (str, int)
+            The header line (including its trailing newline, if present), and
+            the number of "#q2:" lines that were skipped.
+    """
+    header = file_obj.readline()
+    q2_line_ct = 0
+    while True:
+        line_start = file_obj.tell()
+        line = file_obj.readline()
+        if not line.startswith("#q2:"):
+            file_obj.seek(line_start)
+            return header, q2_line_ct
+        q2_line_ct += 1
+
+
+def get_header_columns(header):
+    """Parses the header line of a metadata file into a pd.Index of column
+       names.
+
+       This uses pd.read_csv(), so duplicate or empty column names are
+       handled the same way as if the header had been read along with the
+       rest of the file.
+    """
+    return pd.read_csv(
+        StringIO(header), sep="\t", nrows=0, dtype=object
+    ).columns
 
 
-def read_metadata_file(md_file_loc):
-    """Reads in a metadata file using pandas.read_csv().
+def _read_metadata_values_pyarrow(md_file_loc, columns, skip_line_ct):
+    """Reads a metadata file's data (all as strings) using pyarrow's CSV
+       reader, which parses files using multiple threads.
+
+       (Values aren't converted to NaNs here -- read_metadata_file() takes
+       care of that.)
+
+       Returns
+       -------
+
+       dict or None
+            Maps each column name to a np.ndarray of that column's values.
+            None is returned if pyarrow couldn't parse the file. pyarrow is
+            stricter than pd.read_csv() -- for example, it doesn't allow rows
+            with missing trailing values -- so in this case the caller should
+            fall back to pd.read_csv().
+    """
+    try:
+        import pyarrow
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        raise ImportError(
+            "Reading metadata files using the pyarrow engine requires the "
+            "pyarrow package to be installed."
+        )
+
+    if type(md_file_loc) == StringIO:
+        md_file_loc = BytesIO(md_file_loc.getvalue().encode("utf-8"))
+    try:
+        table = pa_csv.read_csv(
+            md_file_loc,
+            read_options=pa_csv.ReadOptions(
+                column_names=list(columns),
+                skip_rows=skip_line_ct,
+                use_threads=True,
+            ),
+            parse_options=pa_csv.ParseOptions(delimiter="\t"),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={c: pyarrow.string() for c in columns},
+                strings_can_be_null=False,
+                quoted_strings_can_be_null=False,
+            ),
+        )
+    except pyarrow.ArrowInvalid as err:
+        logging.debug("pyarrow couldn't parse metadata file: {}".format(err))
+        return None
+    return {
+        col: table.column(i).to_numpy(zero_copy_only=False)
+        for i, col in enumerate(columns)
+    }
+
+
+def read_metadata_file(md_file_loc, engine="pandas"):
+    """Reads in a metadata file.
 
        This treats all metadata values (including the index column) as
-       strings, due to the use of dtype=object.
+       strings.
+
+       The file is only read once: "#q2:" lines after the header are skipped
+       while reading it (see read_header_and_skip_q2_lines()).
+
+       If engine is "pyarrow", the file will be parsed using pyarrow's
+       multithreaded CSV reader (which can be a lot faster for large files)
+       instead of pd.read_csv(). The output should be the same either way.
 
        NOTE THAT THIS WILL CONVERT empty cells in the TSV file to
        np.NaN values in the output DataFrame -- this is done to be
@@ -83,25 +153,51 @@ def read_metadata_file(md_file_loc):
        metadata_df = replace_nan(read_metadata_file(...)). (You can also just
        call read_metadata_file_sane(), which will do this for you.)
     """
-    q2_lines = get_q2_comment_lines(md_file_loc)
-    metadata_df = pd.read_csv(
-        md_file_loc,
-        sep="\t",
-        na_values=[""],
-        keep_default_na=False,
-        dtype=object,
-        skiprows=q2_lines,
+    if engine not in METADATA_ENGINES:
+        raise ValueError(
+            "Unrecognized metadata engine: {}. Must be one of {}.".format(
+                engine, ", ".join(METADATA_ENGINES)
+            )
+        )
+
+    # We allow StringIOs to make testing easier
+    if type(md_file_loc) == StringIO:
+        md_file_obj = md_file_loc
+    else:
+        md_file_obj = open(md_file_loc, "r", encoding="utf-8")
+    try:
+        header, q2_line_ct = read_header_and_skip_q2_lines(md_file_obj)
+        columns = get_header_columns(header)
+        raw_values = None
+        if engine == "pyarrow":
+            # pyarrow reads the file on its own, skipping the lines we've
+            # already looked at
+            raw_values = _read_metadata_values_pyarrow(
+                md_file_loc, columns, 1 + q2_line_ct
+            )
+        if raw_values is None:
+            raw_df = pd.read_csv(
+                md_file_obj,
+                sep="\t",
+                header=None,
+                names=columns,
+                na_values=[""],
+                keep_default_na=False,
+                dtype=object,
+            )
+            raw_values = {col: raw_df[col].values for col in columns}
+    finally:
+        if md_file_obj is not md_file_loc:
+            md_file_obj.close()
+
+    # Take care of leading/trailing whitespace, and convert the ""s resulting
+    # from this to NaNs. (Creating a new DataFrame from the stripped columns
+    # is faster than assigning them to an existing DataFrame one at a time.)
+    metadata_df = pd.DataFrame(
+        {col: strip_values(raw_values[col]) for col in columns},
+        columns=columns,
     )
 
-    # Take care of leading/trailing whitespace
-    for column in metadata_df.columns:
-        # Strip surrounding whitespace from each value
-        # This mimics how QIIME 2 ignores this whitespace
-        metadata_df[column] = metadata_df[column].str.strip()
-    # Sorta the opposite of replace_nan(). Find all of the ""s resulting from
-    # removing values with just-whitespace, and convert them to NaNs.
-    metadata_df.where(metadata_df != "", np.NaN, inplace=True)
-
     # If there are any NaNs in the first column (that will end up being the
     # index column), then the user supplied at least one empty ID
     # (remember that we just converted all ""s to NaNs).
@@ -57,4 +57,73 @@ EXTREME_FEATURE_COUNT = (
     "filtering step."
 )
 
+METADATA_ENGINE = (
+    "The library to use to parse the sample and feature metadata files. "
+    '"pyarrow" parses files using multiple threads, which can be faster for '
+    "very large metadata files; using it requires the pyarrow package to be "
+    "installed. Metadata files are read the same way regardless of this "
+    "option."
+)
+
+SAMPLE_METADATA_COLUMNS = (
+    "If specified, only these sample metadata columns will be included in "
+    "the visualization (the first column given will be shown in the sample "
+    "plot by default). This can make visualizations of samples with lots of "
+    "metadata columns a lot smaller."
+)
+
+MAX_OUTPUT_SIZE = (
+    "If specified, Qurro will estimate how large the visualization's data "
+    "will be (in bytes, without compression) based on the number of nonzero "
+    "counts for each feature and the sizes of the feature ranks and "
+    "metadata, and will then choose the largest extreme feature count that "
+    "keeps this estimated size below this number. The chosen extreme feature "
+    "count and estimated size will be printed. This can't be used along with "
+    "the extreme feature count option."
+)
+
+COUNT_SHARD_SIZE = (
+    "If specified, Qurro will store the visualization's feature count data in "
+    "separate files (each containing the counts of this many features) "
+    "rather than in one big file, and the visualization will only load the "
+    "files it needs to show the currently selected log-ratio. This can make "
+    "visualizations of huge datasets much faster to open. By default, all of "
+    "the count data is stored in one file."
+)
+
+COMPRESS_DATA = (
+    "If this flag is used, Qurro will compress the data stored in the "
+    "visualization. This makes the visualization's files a lot smaller (and "
+    "faster to share), but the data will need to be decompressed when the "
+    "visualization is opened. This requires a browser that supports the "
+    "DecompressionStream API (most browsers released since 2023 do). Debug "
+    "messages describe how much smaller compression made the data, and how "
+    "long it took."
+)
+
+WORKERS = (
+    "The number of processes to use when generating the visualization. If "
+    "this is greater than 1, the rank plot, sample plot, and count data are "
+    "generated at the same time (and Qurro's support files are copied to the "
+    "output directory at the same time as this), which can make Qurro faster "
+    "on multi-core machines. This doesn't change Qurro's output."
+)
+
+CACHE_DIR = (
+    "If specified, Qurro will cache processed versions of the input feature "
+    "ranks, BIOM table, and sample metadata (after they've been validated "
+    "and matched up with each other) in this directory. Later runs of Qurro "
+    "using the same cache directory and the same feature ranks, BIOM table, "
+    "and sample metadata (but possibly different feature metadata, extreme "
+    "feature counts, etc.) will reuse this processed data instead of "
+    "processing these inputs again."
+)
+
+CACHE_MAX_SIZE = (
+    "The maximum size (in megabytes) of the cache directory. If adding "
+    "something to the cache makes the directory larger than this, the least "
+    "recently used things in the cache will be removed. Only used if a cache "
+    "directory is specified."
+)
+
 DEBUG = "If this flag is used, Qurro will output debug messages."
@@ -35,3 +35,95 @@ QARCOAL_SMP_TO_USE = (
 QARCOAL_NUM = "Numerator string to search for in taxonomy."
 
 QARCOAL_DENOM = "Denominator string to search for in taxonomy."
+
+QARCOAL_BATCH_DESC = (
+    "Compute the log-ratios of many pairs of feature strings at once. Each "
+    "query's log-ratios are computed in the same way as in qarcoal, but the "
+    "feature table and taxonomy only need to be processed once. The output "
+    "contains one column of log-ratios per query; samples that qarcoal "
+    "would drop for a query (because they don't contain both numerator and "
+    "denominator features) have an empty value in this query's column."
+)
+
+QARCOAL_QUERIES = (
+    "Tab-separated file of queries: the first column contains the queries' "
+    'names, and the "numerator" and "denominator" columns contain each '
+    "query's numerator and denominator strings to search for in taxonomy."
+)
+
+QARCOAL_BATCH_SHARED_FEAT = (
+    QARCOAL_SHARED_FEAT + " This applies to every query."
+)
+
+QARCOAL_MATCH_MODE = (
+    "How the numerator and denominator strings are matched against taxonomy. "
+    '"regex" treats them as regular expressions; "literal" searches for them '
+    "as literal substrings, which is faster (especially for many queries); "
+    '"rank" only matches taxonomic ranks that are exactly equal to one of '
+    "the ranks in a string (ranks are separated by commas, semicolons, or "
+    'whitespace), so that e.g. "g__Staphylococcus" doesn\'t match '
+    '"g__Staphylococcus_A".'
+)
+
+QARCOAL_TAXONOMY_INDEX = (
+    "Location of a precompiled index of the taxonomy, which speeds up "
+    "searching it. If no index exists at this location (or if the index "
+    "there was built from a different taxonomy), an index will be built and "
+    "saved here, so that later runs can reuse it."
+)
+
+QARCOAL_STREAM = (
+    "Read the feature table in blocks of samples, rather than loading all of "
+    "it at once, and write log-ratios to the output file as they're "
+    "computed. This lets Qarcoal handle tables that are too large to fit in "
+    "memory. The table must be in the HDF5 BIOM format."
+)
+
+QARCOAL_SAMPLE_BLOCK_SIZE = (
+    "When streaming, the number of samples to read from the feature table "
+    "at once. Larger blocks are faster to process, but use more memory."
+)
+
+QARCOAL_WORKERS = (
+    "When streaming, the number of processes to use for reading and "
+    "processing blocks of samples in parallel."
+)
+
+QARCOAL_PAIRWISE_DESC = (
+    "Compute the log-ratios of the top pairs of taxa at a taxonomy level "
+    "(e.g. genera). Feature counts are aggregated to the chosen taxonomy "
+    "level, and summary statistics of the log-ratios of every pair of taxa "
+    "are computed; the pairs with the largest values of a statistic are "
+    "then selected, and their log-ratios are computed in each sample."
+)
+
+QARCOAL_LEVEL = (
+    "Taxonomy level to aggregate feature counts to, where 0 is the first "
+    "level (levels are separated by semicolons). For example, in "
+    "Greengenes- or SILVA-style taxonomies, 5 is the genus level. Features "
+    'without a name at this level (e.g. a genus of "g__") are ignored.'
+)
+
+QARCOAL_TOP_K = "Maximum number of pairs of taxa to compute log-ratios for."
+
+QARCOAL_SORT_BY = (
+    "Statistic to select the top pairs of taxa by (pairs with the largest "
+    'values are selected). "mean" is the mean log-ratio across samples '
+    "(each pair of taxa is oriented so that this is positive); "
+    '"std" is the standard deviation of the log-ratios; and "n_samples" is '
+    "the number of samples containing both taxa."
+)
+
+QARCOAL_MIN_SAMPLES = (
+    "Only pairs of taxa that are both present in at least this many samples "
+    "will be selected."
+)
+
+QARCOAL_WRITE_LOG_RATIOS = (
+    "Also write the selected pairs' log-ratios in every sample, as a "
+    "(samples x pairs) NumPy array, to log_ratios.npy in the output "
+    "directory. Log-ratios are computed a chunk of pairs at a time and "
+    "written to a memory-mapped file, so this works even if the array is "
+    "larger than the available memory. The sample IDs corresponding to the "
+    "array's rows are written to sample_ids.txt."
+)
@@ -8,10 +8,20 @@
 # ----------------------------------------------------------------------------
 
 import logging
+from io import StringIO
 import skbio
+import numpy as np
 import pandas as pd
 from qurro._df_utils import escape_columns
-from qurro._metadata_utils import get_q2_comment_lines
+from qurro._metadata_utils import (
+    read_header_and_skip_q2_lines,
+    get_header_columns,
+)
+from qurro._table_utils import as_sparse_table, restore_table_type
+
+# Number of features whose differentials are parsed at once by
+# differentials_to_df().
+DIFFERENTIALS_CHUNK_SIZE = 100000
 
 
 def read_rank_file(file_loc):
@@ -56,55 +66,179 @@ def ordination_to_df(ordination_file_loc):
     return rename_loadings(ordination.features)
 
 
-def differentials_to_df(differentials_loc):
-    """Converts a differential rank TSV file to a DataFrame."""
+def _to_float_or_nan(value):
+    """Calls float() on a value, returning NaN if this fails."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def differentials_to_floats(raw_values, feature_ids):
+    """Converts an array of differentials (as strings) to floats.
+
+       Parameters
+       ----------
+
+       raw_values: np.ndarray
+            A 2-D object array of differentials, with one row per feature.
+
+       feature_ids: np.ndarray
+            The IDs of the features corresponding to the rows of raw_values.
+
+       Returns
+       -------
+
+       np.ndarray
+            A 2-D float array of the differentials.
+
+       Raises
+       ------
+
+       ValueError
+            If any of the differentials are missing, nonnumeric, NaN, or
+            infinite. The error message names the first feature with such a
+            differential.
+    """
+    try:
+        # This calls float() on each value, so it accepts the same strings
+        # as float() does.
+        values = raw_values.astype(float)
+    except (TypeError, ValueError):
+        # At least one value isn't numeric. Treat these values as NaNs, so
+        # they'll be caught by the check below.
+        values = np.vectorize(_to_float_or_nan, otypes=[float])(raw_values)
+
+    bad_rows = ~np.isfinite(values).all(axis=1)
+    if bad_rows.any():
+        raise ValueError(
+            "Missing / nonnumeric differential(s) found for feature "
+            "{}".format(feature_ids[np.argmax(bad_rows)])
+        )
+    return values
+
+
+def differentials_to_df(
+    differentials_loc, chunk_size=DIFFERENTIALS_CHUNK_SIZE
+):
+    """Converts a differential rank TSV file to a DataFrame.
+
+       The file is parsed chunk_size features at a time, and each chunk's
+       differentials are converted to floats (see differentials_to_floats())
+       before the next chunk is parsed. This way, only one chunk of the file
+       is ever stored as strings in memory.
+
+       Raises
+       ------
 
+       ValueError
+            If any differentials are missing, nonnumeric, NaN, or infinite.
+    """
     # As of QIIME 2 2019.7, differentials exported from QIIME 2 can have q2
-    # comments! So we need to detect these.
-    q2_lines = get_q2_comment_lines(differentials_loc)
-    differentials = pd.read_csv(
-        differentials_loc,
-        sep="\t",
-        na_filter=False,
-        dtype=object,
-        skiprows=q2_lines,
+    # comments! So we need to skip these. (Like read_metadata_file(), we
+    # allow StringIOs to make testing easier.)
+    if type(differentials_loc) == StringIO:
+        diff_file_obj = differentials_loc
+    else:
+        diff_file_obj = open(differentials_loc, "r", encoding="utf-8")
+    try:
+        header, _ = read_header_and_skip_q2_lines(diff_file_obj)
+        columns = get_header_columns(header)
+        # We read in the feature IDs (the first column) as strings, along with
+        # everything else. This saves us from situations where feature IDs
+        # would otherwise be read as numbers or something that would mess
+        # things up -- read_metadata_file() does the same sorta thing.
+        chunks = pd.read_csv(
+            diff_file_obj,
+            sep="\t",
+            header=None,
+            names=columns,
+            na_filter=False,
+            dtype=object,
+            chunksize=chunk_size,
+        )
+        feature_id_chunks = []
+        value_chunks = []
+        for chunk in chunks:
+            feature_ids = chunk.iloc[:, 0].values
+            value_chunks.append(
+                differentials_to_floats(chunk.iloc[:, 1:].values, feature_ids)
+            )
+            feature_id_chunks.append(feature_ids)
+    finally:
+        if diff_file_obj is not differentials_loc:
+            diff_file_obj.close()
+
+    logging.debug(
+        "Read differentials in {} chunk(s).".format(len(value_chunks))
     )
-    # Delay setting index column so we can first load it as an object (this
-    # saves us from situations where the index col would otherwise be read as a
-    # number or something that would mess things up -- read_metadata_file()
-    # does the same sorta thing)
-    differentials.set_index(differentials.columns[0], inplace=True)
+    if len(value_chunks) == 0:
+        value_chunks.append(np.empty((0, len(columns) - 1)))
+        feature_id_chunks.append(np.empty(0, dtype=object))
     # Also, we don't bother naming the differentials index (yet). This is
     # actually needed to make some of the tests pass (which is dumb, I know,
     # but if I pass check_names=False to assert_frame_equal then the test
     # doesn't check column names, and I want it to do that...)
-    differentials.index.rename(None, inplace=True)
-
-    # This is slow but it should at least *work as intended.*
-    # If there are any non-numeric differentials, or any NaN differentials, or
-    # any infinity/-infinity differentials (???), then we should raise an
-    # error. This code should do that.
-    for feature_row in differentials.itertuples():
-        for differential in feature_row[1:]:
-            try:
-                fd = float(differential)
-                if pd.isna(fd) or fd == float("inf") or fd == float("-inf"):
-                    raise ValueError
-            except ValueError:
-                raise ValueError(
-                    "Missing / nonnumeric differential(s) found for feature "
-                    "{}".format(feature_row[0])
-                )
-
-    # Now, we should be able to do this freely.
-    for column in differentials.columns:
-        differentials[column] = differentials[column].astype(float)
-    return differentials
-
-
-def filter_unextreme_features(
-    table: pd.SparseDataFrame, ranks: pd.DataFrame, extreme_feature_count: int
-) -> None:
+    return pd.DataFrame(
+        np.concatenate(value_chunks),
+        index=pd.Index(np.concatenate(feature_id_chunks), dtype=object),
+        columns=columns[1:],
+    )
+
+
+def get_extreme_feature_mask(ranks, extreme_feature_count):
+    """Identifies the features at either "end" of each ranking.
+
+       For each ranking (column) in ranks, this finds the features with the
+       extreme_feature_count largest and extreme_feature_count smallest
+       values -- the same features that calling
+       ranks.nlargest(extreme_feature_count, ranking) and
+       ranks.nsmallest(extreme_feature_count, ranking) would find. (So ties
+       are broken by keeping the features that occur first in ranks. Unlike
+       nlargest() and nsmallest(), features with NaN values are never
+       considered extreme.) This is done for all rankings at once, by
+       partitioning each ranking around its extreme_feature_count-th
+       largest/smallest value rather than sorting it.
+
+       Returns
+       -------
+
+       keep_mask: np.ndarray
+            A boolean array with one element per feature (row) in ranks, which
+            is True if the feature is extreme in at least one ranking.
+    """
+    # Each row of this array is one ranking's values. (Partitioning along
+    # contiguous rows is a lot faster than along columns.)
+    values = np.array(ranks.values.T, dtype=float, order="C")
+    num_features = values.shape[1]
+    k = min(extreme_feature_count, num_features)
+    keep_mask = np.zeros(num_features, dtype=bool)
+    if k < 1:
+        return keep_mask
+    is_valid = ~np.isnan(values)
+
+    # We find the smallest values, then the smallest negated values (i.e. the
+    # largest values). NaNs are replaced with inf so that they're never
+    # picked.
+    for sign in (1, -1):
+        signed = np.where(is_valid, sign * values, np.inf)
+        thresholds = np.partition(signed, k - 1, axis=1)[:, k - 1 : k]
+        beyond = signed < thresholds
+        ties = (signed == thresholds) & is_valid
+        # Of the features tied at a ranking's threshold, keep just enough of
+        # them (the first ones) to get to k features.
+        num_ties_needed = k - beyond.sum(axis=1)
+        too_many = ties.sum(axis=1) > num_ties_needed
+        if too_many.any():
+            ties[too_many] &= (
+                np.cumsum(ties[too_many], axis=1)
+                <= num_ties_needed[too_many, np.newaxis]
+            )
+        keep_mask |= (beyond | ties).any(axis=0)
+    return keep_mask
+
+
+def filter_unextreme_features(table, ranks, extreme_feature_count):
     """Returns copies of the table and ranks with "unextreme" features removed.
 
        This assumes that the table and ranks have already been matched (i.e.
@@ -115,10 +249,10 @@ def filter_unextreme_features(
        Parameters
        ----------
 
-       table: pd.SparseDataFrame
-            A SparseDataFrame representation of a BIOM table. This can be
-            generated easily from a biom.Table object using
-            qurro._df_utils.biom_table_to_sparse_df().
+       table: SparseTable or pd.DataFrame (or pd.SparseDataFrame)
+            A representation of a BIOM table. This can be generated easily
+            from a biom.Table object using
+            qurro._df_utils.biom_table_to_sparse_table().
 
        ranks: pandas.DataFrame
             A DataFrame where the index consists of ranked features' IDs, and
@@ -134,8 +268,10 @@ def filter_unextreme_features(
        Returns
        -------
 
-       (table, ranks): (pandas.SparseDataFrame, pandas.DataFrame)
-            Filtered copies of the input table and ranks DataFrames.
+       (table, ranks): (SparseTable or pandas.DataFrame, pandas.DataFrame)
+            Filtered copies of the input table and ranks. The output table
+            will be a SparseTable if the input table was a SparseTable, and a
+            DataFrame otherwise.
 
        Behavior
        --------
@@ -197,24 +333,22 @@ def filter_unextreme_features(
     )
     logging.debug("Input table has shape {}.".format(table.shape))
     logging.debug("Input feature ranks have shape {}.".format(ranks.shape))
-    # We store these features in a set to avoid duplicates -- Python does the
-    # hard work here for us
-    features_to_preserve = set()
-    for ranking in ranks.columns:
-        upper_extrema = ranks.nlargest(extreme_feature_count, ranking).index
-        lower_extrema = ranks.nsmallest(extreme_feature_count, ranking).index
-        features_to_preserve |= set(upper_extrema)
-        features_to_preserve |= set(lower_extrema)
-
-    # Now, we actually filter the feature ranks and table. We do this using
-    # .loc[]. I benchmarked it, and .loc was about 1.77x as fast as .filter --
-    # >>> df = pd.SparseDataFrame(np.zeros(34000000).reshape(17000, 2000))
-    # >>> %timeit df.loc[set([16990, 8983, 8982])]
-    # 460 ms +/- 17.6 ms per loop
-    # >>> %timeit df.filter(items=set([16990, 8983, 8982]), axis="index")
-    # 818 ms +/- 25.6 ms per loop
-    filtered_ranks = ranks.loc[features_to_preserve]
-    filtered_table = table.loc[features_to_preserve]
+    keep_mask = get_extreme_feature_mask(ranks, extreme_feature_count)
+
+    # Now, we actually filter the feature ranks and table. The ranks are
+    # filtered using a boolean mask, so the features' order is preserved. The
+    # table is filtered by slicing the rows of its sparse matrix directly; if
+    # its features are in a different order than the ranks', its rows are
+    # also reordered, so that both outputs list features in the same order.
+    filtered_ranks = ranks[keep_mask]
+    table_st, was_converted = as_sparse_table(table)
+    if table_st.feature_ids.equals(ranks.index):
+        filtered_table_st = table_st.filter(feature_mask=keep_mask)
+    else:
+        filtered_table_st = table_st.take(
+            table_st.feature_ids.get_indexer(filtered_ranks.index)
+        )
+    filtered_table = restore_table_type(filtered_table_st, was_converted)
 
     filtered_feature_ct = filtered_ranks.shape[0]
     print(
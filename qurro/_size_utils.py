@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018--, Qurro development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+# Estimates how large a Qurro visualization's data will be, and picks an
+# extreme feature count that keeps this data under a given size.
+
+import json
+import logging
+import numpy as np
+import pandas as pd
+from qurro._json_utils import get_count_data_type, dictionary_encode_columns
+
+# Rough size (in bytes) of everything in main.js that doesn't depend on the
+# input data: the template code, the Vega-Lite specs without any data, etc.
+FIXED_OUTPUT_SIZE = 6000
+
+# Each record in the rank plot's data has these fields, in addition to the
+# rankings and feature metadata fields. (See generate.gen_rank_plot().)
+RANK_PLOT_EXTRA_FIELDS = ("Feature ID", "qurro_classification", "qurro_spc")
+
+
+def get_json_value_sizes(series):
+    """Estimates the size of the JSON representation of each value in a Series.
+
+       Returns
+       -------
+
+       np.ndarray
+            The estimated number of bytes taken up by each value.
+    """
+    if len(series) == 0:
+        return np.zeros(0, dtype=int)
+    if series.dtype != object and np.issubdtype(series.dtype, np.number):
+        values = series.values.astype(float)
+        sizes = np.char.str_len(values.astype(str))
+        # Altair converts NaN and infinite values to null
+        sizes[~np.isfinite(values)] = 4
+        return sizes.astype(int)
+    return np.fromiter(
+        (
+            4
+            if v is None or (isinstance(v, float) and np.isnan(v))
+            else len(json.dumps(v, default=str))
+            for v in series.tolist()
+        ),
+        dtype=int,
+        count=len(series),
+    )
+
+
+def get_record_sizes(df, extra_field_names=()):
+    """Estimates the size of each row of a DataFrame, as a JSON record.
+
+       This is how the data for the rank and sample plots is stored in
+       main.js: see _json_utils.df_to_dataset().
+
+       Parameters
+       ----------
+
+       df: pd.DataFrame
+
+       extra_field_names: iterable of str
+            The names of fields that will be added to each record later on.
+            The sizes of these fields' values aren't included in the output,
+            but the sizes of their names are.
+
+       Returns
+       -------
+
+       np.ndarray
+            The estimated number of bytes taken up by each row.
+    """
+    # Opening and closing brackets, and the ", " separating this record from
+    # the next one
+    sizes = np.full(len(df.index), 4, dtype=int)
+    for col in list(df.columns) + list(extra_field_names):
+        # The field name (in quotes), followed by ": " and then ", "
+        sizes += len(json.dumps(str(col))) + 4
+    for i in range(len(df.columns)):
+        sizes += get_json_value_sizes(df.iloc[:, i])
+    return sizes
+
+
+def estimate_feature_sizes(table, feature_ranks, feature_metadata=None):
+    """Estimates how much each feature adds to the size of the visualization.
+
+       This accounts for each feature's record in the rank plot's data, and
+       for each feature's ID and nonzero counts in the count data.
+
+       Parameters
+       ----------
+
+       table: SparseTable
+            The BIOM table, matched with the feature ranks.
+
+       feature_ranks: pd.DataFrame
+
+       feature_metadata: pd.DataFrame or None
+
+       Returns
+       -------
+
+       np.ndarray
+            The estimated number of bytes each feature in feature_ranks (in
+            the same order as feature_ranks' index) takes up.
+    """
+    feature_ids = feature_ranks.index
+    rank_data = feature_ranks
+    if feature_metadata is not None:
+        rank_data = feature_ranks.join(
+            feature_metadata.reindex(feature_ids), rsuffix="_fm"
+        )
+    sizes = get_record_sizes(rank_data, RANK_PLOT_EXTRA_FIELDS)
+
+    feature_nnz = (
+        pd.Series(table.feature_nnz(), index=table.feature_ids)
+        .reindex(feature_ids)
+        .fillna(0)
+        .values.astype(int)
+    )
+    id_sizes = np.fromiter(
+        (len(json.dumps(str(fid))) for fid in feature_ids),
+        dtype=int,
+        count=len(feature_ids),
+    )
+    # Rank plot values for each feature: the feature ID, "None" as the
+    # feature's classification, and its sample presence count
+    sizes += (
+        id_sizes + len('"None"') + np.char.str_len(feature_nnz.astype(str))
+    )
+
+    # Count data for each feature: the feature ID (in the list of feature
+    # IDs, followed by ", "), then a position in indptr and each nonzero
+    # count's sample index and value. These arrays are base64-encoded, which
+    # takes up 4 bytes per 3 bytes of data.
+    count_size = (
+        8 if get_count_data_type(table.matrix.data) == "Float64" else 4
+    )
+    sizes += id_sizes + 2
+    sizes += np.ceil((4 + feature_nnz * (4 + count_size)) * 4 / 3).astype(int)
+    return sizes
+
+
+def estimate_fixed_size(sample_metadata):
+    """Estimates the size of the parts of the visualization that don't depend
+       on the number of features: the sample plot's data, the list of sample
+       IDs in the count data, and FIXED_OUTPUT_SIZE.
+    """
+    # The sample plot's data is dictionary-encoded: see
+    # generate.gen_sample_plot().
+    encoded_metadata, dictionaries = dictionary_encode_columns(
+        sample_metadata, sample_metadata.columns
+    )
+    sample_sizes = get_record_sizes(
+        encoded_metadata, ("Sample ID", "qurro_balance")
+    )
+    # Each sample's record also contains its ID and a null balance, and its
+    # ID is also in the count data's list of sample IDs (followed by ", ")
+    id_sizes = sum(len(json.dumps(str(sid))) for sid in sample_metadata.index)
+    return int(
+        FIXED_OUTPUT_SIZE
+        + sample_sizes.sum()
+        + len(json.dumps(dictionaries))
+        + 4 * len(sample_metadata.index)
+        + 2 * id_sizes
+        + 2 * len(sample_metadata.index)
+    )
+
+
+def get_extreme_ranks(feature_ranks):
+    """Finds the smallest extreme feature count that would keep each feature.
+
+       For a feature f, this is the smallest extreme feature count k for
+       which f would be one of the k largest or k smallest features in at
+       least one ranking. (So the features that
+       _rank_utils.filter_unextreme_features() keeps when given an extreme
+       feature count of k are the ones whose "extreme rank" is at most k.)
+       Ties are broken in the same way as filter_unextreme_features() breaks
+       them, by favoring the features that occur first in feature_ranks.
+
+       Returns
+       -------
+
+       np.ndarray
+            The extreme rank of each feature in feature_ranks. Features that
+            would never be kept (because all of their ranks are NaN) have an
+            extreme rank of (# features) + 1.
+    """
+    values = np.array(feature_ranks.values.T, dtype=float, order="C")
+    num_features = values.shape[1]
+    extreme_ranks = np.full(num_features, num_features + 1, dtype=int)
+    positions = np.empty(num_features, dtype=int)
+    for ranking in values:
+        is_valid = ~np.isnan(ranking)
+        for sign in (1, -1):
+            # A stable sort means that tied features are ordered by their
+            # positions in feature_ranks.
+            order = np.argsort(
+                np.where(is_valid, sign * ranking, np.inf), kind="stable"
+            )
+            positions[order] = np.arange(1, num_features + 1)
+            extreme_ranks = np.minimum(
+                extreme_ranks, np.where(is_valid, positions, num_features + 1)
+            )
+    return extreme_ranks
+
+
+def choose_extreme_feature_count(
+    table, sample_metadata, feature_ranks, feature_metadata, max_output_size
+):
+    """Picks the largest extreme feature count that keeps the visualization's
+       estimated size under max_output_size.
+
+       The size being estimated is that of the visualization's data (main.js,
+       and count shards if present), without any compression.
+
+       Parameters
+       ----------
+
+       table: SparseTable
+            The BIOM table, matched with the feature ranks and sample
+            metadata.
+
+       sample_metadata: pd.DataFrame
+            The sample metadata, matched with the BIOM table.
+
+       feature_ranks: pd.DataFrame
+
+       feature_metadata: pd.DataFrame or None
+
+       max_output_size: int
+            The maximum size of the visualization's data, in bytes.
+
+       Returns
+       -------
+
+       (extreme_feature_count, estimated_size): (int or None, int)
+            extreme_feature_count is None if no filtering is needed (i.e. the
+            visualization should fit into max_output_size without any
+            filtering).
+
+       Raises
+       ------
+
+       ValueError
+            If max_output_size is too small for even an extreme feature count
+            of 1 to work.
+    """
+    logging.debug("Estimating the size of the visualization's data.")
+    feature_sizes = estimate_feature_sizes(
+        table, feature_ranks, feature_metadata
+    )
+    fixed_size = estimate_fixed_size(sample_metadata)
+    total_size = fixed_size + int(feature_sizes.sum())
+    if total_size <= max_output_size:
+        print(
+            "The visualization's data should take up about {:,} bytes, which "
+            "is within the maximum output size of {:,} bytes. No feature "
+            "filtering is needed.".format(total_size, max_output_size)
+        )
+        return None, total_size
+
+    # sizes[k] is the estimated size when using an extreme feature count of k
+    extreme_ranks = get_extreme_ranks(feature_ranks)
+    num_features = len(feature_sizes)
+    sizes = fixed_size + np.cumsum(
+        np.bincount(
+            extreme_ranks, weights=feature_sizes, minlength=num_features + 2
+        )
+    )
+    # filter_unextreme_features() doesn't do any filtering if (extreme
+    # feature count * 2) is at least the number of features
+    max_efc = (num_features - 1) // 2
+    efc = int(np.searchsorted(sizes[: max_efc + 1], max_output_size, "right"))
+    efc -= 1
+    if efc < 1:
+        raise ValueError(
+            "Even with an extreme feature count of 1, the visualization's "
+            "data would take up about {:,} bytes, which is larger than the "
+            "maximum output size of {:,} bytes.".format(
+                int(sizes[1]), max_output_size
+            )
+        )
+    estimated_size = int(sizes[efc])
+    print(
+        "Chose an extreme feature count of {}, based on the maximum output "
+        "size of {:,} bytes. The visualization's data should take up about "
+        "{:,} bytes (without this filtering, it would take up about {:,} "
+        "bytes).".format(efc, max_output_size, estimated_size, total_size)
+    )
+    return efc, estimated_size
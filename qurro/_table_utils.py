@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018--, Qurro development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import logging
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, csc_matrix, issparse
+
+# When reading only some rows (or columns) of a BIOM table's count data from
+# an HDF5 file, neighboring runs of wanted rows separated by at most this many
+# unwanted entries are read with a single HDF5 read (and the unwanted entries
+# are then discarded). Lots of tiny reads are much slower than a few larger
+# ones.
+HDF5_MAX_READ_GAP = 65536
+
+
+class SparseTable(object):
+    """A compact representation of a feature table.
+
+       The counts are stored in a scipy.sparse.csr_matrix, where rows
+       correspond to features and columns correspond to samples (the same
+       orientation as a BIOM table). Feature and sample IDs are stored as
+       pandas Indexes alongside the matrix.
+
+       Compared to a pd.SparseDataFrame, this is a lot cheaper to slice and
+       summarize: every operation Qurro needs to do on the table (matching,
+       filtering, removing empty samples/features, computing sample presence
+       counts, ...) can be done directly on the CSR arrays without densifying
+       anything.
+
+       For convenience, this class also exposes .index, .columns, and .shape
+       attributes that mirror those of a DataFrame. This lets helper functions
+       like _df_utils.validate_df() and _df_utils.print_if_dropped() work on
+       SparseTables as-is.
+    """
+
+    def __init__(self, matrix, feature_ids, sample_ids):
+        """Creates a SparseTable.
+
+           Parameters
+           ----------
+
+           matrix: scipy.sparse matrix or array-like
+                A (# features) x (# samples) matrix of counts. This is
+                converted to a csr_matrix if it isn't one already. Explicitly
+                stored zeros are removed (without modifying the input matrix),
+                so that the number of stored entries in a row/column always
+                matches the number of nonzero entries in it.
+
+           feature_ids: list-like
+                IDs of the features (rows) in the matrix.
+
+           sample_ids: list-like
+                IDs of the samples (columns) in the matrix.
+
+           Raises
+           ------
+
+           ValueError: if the lengths of feature_ids or sample_ids don't match
+                       the matrix's shape.
+        """
+        if issparse(matrix):
+            matrix = matrix.tocsr()
+        else:
+            matrix = csr_matrix(matrix)
+
+        if matrix.nnz > 0 and not np.all(matrix.data):
+            # Copy before removing zeros so that we don't accidentally modify
+            # the caller's matrix (e.g. a BIOM table's underlying data).
+            matrix = matrix.copy()
+            matrix.eliminate_zeros()
+
+        self.matrix = matrix
+        self.feature_ids = pd.Index(feature_ids)
+        self.sample_ids = pd.Index(sample_ids)
+        # Computed (and then cached) by stats()
+        self._stats = None
+
+        if len(self.feature_ids) != matrix.shape[0]:
+            raise ValueError(
+                "Number of feature IDs ({}) doesn't match the number of rows "
+                "in the table ({}).".format(
+                    len(self.feature_ids), matrix.shape[0]
+                )
+            )
+        if len(self.sample_ids) != matrix.shape[1]:
+            raise ValueError(
+                "Number of sample IDs ({}) doesn't match the number of "
+                "columns in the table ({}).".format(
+                    len(self.sample_ids), matrix.shape[1]
+                )
+            )
+
+    @classmethod
+    def from_biom(cls, table):
+        """Creates a SparseTable from a biom.Table."""
+        return cls(
+            table.matrix_data,
+            table.ids(axis="observation"),
+            table.ids(axis="sample"),
+        )
+
+    @classmethod
+    def from_hdf5(cls, h5grp, feature_ids=None, sample_ids=None):
+        """Creates a SparseTable from part of an HDF5 BIOM table.
+
+           Only the counts of the requested features and samples are read
+           from the file. The BIOM format stores the count data in both
+           feature- and sample-major orders, so this reads whichever of these
+           requires reading fewer entries.
+
+           Parameters
+           ----------
+
+           h5grp: h5py.File or h5py.Group
+                An open HDF5 BIOM table.
+
+           feature_ids: list-like or None
+                IDs of the features to load. IDs not present in the table are
+                ignored. If None, all features are loaded.
+
+           sample_ids: list-like or None
+                Same as feature_ids, but for samples.
+
+           Returns
+           -------
+
+           SparseTable
+                Features and samples are in the same order as in the file.
+        """
+        file_feature_ids = read_hdf5_ids(h5grp, "observation")
+        file_sample_ids = read_hdf5_ids(h5grp, "sample")
+        feature_mask = np.ones(len(file_feature_ids), dtype=bool)
+        sample_mask = np.ones(len(file_sample_ids), dtype=bool)
+        if feature_ids is not None:
+            feature_mask = file_feature_ids.isin(feature_ids)
+        if sample_ids is not None:
+            sample_mask = file_sample_ids.isin(sample_ids)
+
+        observation_indptr = h5grp["observation/matrix/indptr"][:]
+        sample_indptr = h5grp["sample/matrix/indptr"][:]
+        shape = (feature_mask.sum(), sample_mask.sum())
+        if (
+            np.diff(observation_indptr)[feature_mask].sum()
+            <= np.diff(sample_indptr)[sample_mask].sum()
+        ):
+            arrays = _read_hdf5_matrix(
+                h5grp["observation/matrix"],
+                observation_indptr,
+                feature_mask,
+                sample_mask,
+            )
+            matrix = csr_matrix(arrays, shape=shape)
+        else:
+            arrays = _read_hdf5_matrix(
+                h5grp["sample/matrix"],
+                sample_indptr,
+                sample_mask,
+                feature_mask,
+            )
+            matrix = csc_matrix(arrays, shape=shape).tocsr()
+        logging.debug(
+            "Read {} x {} subset of {} x {} HDF5 BIOM table.".format(
+                shape[0],
+                shape[1],
+                len(file_feature_ids),
+                len(file_sample_ids),
+            )
+        )
+        return cls(
+            matrix,
+            file_feature_ids[feature_mask],
+            file_sample_ids[sample_mask],
+        )
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """Creates a SparseTable from a pd.DataFrame or pd.SparseDataFrame.
+
+           The index of the DataFrame should contain feature IDs, and the
+           columns should contain sample IDs.
+        """
+        if isinstance(df, pd.SparseDataFrame):
+            matrix = df.to_coo()
+        else:
+            matrix = df.values
+        return cls(matrix, df.index, df.columns)
+
+    @property
+    def index(self):
+        return self.feature_ids
+
+    @property
+    def columns(self):
+        return self.sample_ids
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    def take(self, feature_positions=None, sample_positions=None):
+        """Returns a new SparseTable containing only some rows and columns.
+
+           Parameters
+           ----------
+
+           feature_positions: array-like of int, or None
+                Positions (not IDs!) of the features to keep, in the order they
+                should appear in the output. If None, all features are kept.
+
+           sample_positions: array-like of int, or None
+                Same as feature_positions, but for samples.
+        """
+        matrix = self.matrix
+        feature_ids = self.feature_ids
+        sample_ids = self.sample_ids
+        if feature_positions is not None:
+            feature_positions = np.asarray(feature_positions, dtype=np.intp)
+            matrix = matrix[feature_positions]
+            feature_ids = feature_ids[feature_positions]
+        if sample_positions is not None:
+            sample_positions = np.asarray(sample_positions, dtype=np.intp)
+            matrix = matrix[:, sample_positions]
+            sample_ids = sample_ids[sample_positions]
+        return SparseTable(matrix, feature_ids, sample_ids)
+
+    def filter(self, feature_mask=None, sample_mask=None):
+        """Like take(), but accepts boolean masks instead of positions."""
+        feature_positions = sample_positions = None
+        if feature_mask is not None:
+            feature_positions = np.flatnonzero(feature_mask)
+        if sample_mask is not None:
+            sample_positions = np.flatnonzero(sample_mask)
+        return self.take(feature_positions, sample_positions)
+
+    def remove_empty(self):
+        """Returns a new SparseTable without any empty features or samples.
+
+           Since removing empty features and samples doesn't change any of
+           the other features' or samples' statistics, the output's stats()
+           are derived from this table's (instead of being recomputed).
+        """
+        stats = self.stats()
+        nonempty_features = stats.feature_nnz > 0
+        nonempty_samples = stats.sample_nnz > 0
+        filtered_table = self.filter(nonempty_features, nonempty_samples)
+        filtered_table._stats = stats.filter(
+            nonempty_features, nonempty_samples
+        )
+        return filtered_table
+
+    def stats(self):
+        """Returns a TableStats summarizing this table.
+
+           This is computed the first time it's needed, and then cached.
+           (SparseTables aren't modified in place by any of Qurro's code, so
+           this is safe.)
+        """
+        if self._stats is None:
+            self._stats = TableStats.from_matrix(self.matrix)
+        return self._stats
+
+    def feature_nnz(self):
+        """Returns an array of the number of nonzero entries per feature."""
+        return self.stats().feature_nnz
+
+    def sample_nnz(self):
+        """Returns an array of the number of nonzero entries per sample."""
+        return self.stats().sample_nnz
+
+    def to_dataframe(self):
+        """Returns a dense pd.DataFrame version of this table.
+
+           This is mostly useful for testing and for small tables: for large
+           tables this will use a lot of memory.
+        """
+        return pd.DataFrame(
+            self.matrix.toarray(),
+            index=self.feature_ids,
+            columns=self.sample_ids,
+        )
+
+
+class TableStats(object):
+    """Summary statistics of a SparseTable's counts.
+
+       These are all computed together from the table's CSR arrays, so that
+       the functions in _df_utils that need them (vibe_check(),
+       remove_empty_samples_and_features(), add_sample_presence_count(), ...)
+       don't each have to make their own pass over the table.
+
+       Attributes
+       ----------
+
+       feature_nnz: np.ndarray
+            The number of nonzero entries for each feature (i.e. the number of
+            samples each feature is "present" in).
+
+       sample_nnz: np.ndarray
+            The number of nonzero entries for each sample.
+
+       feature_min, feature_max: np.ndarray
+            The smallest and largest nonzero entries for each feature. These
+            are NaN for empty features.
+
+       has_implicit_zeros: bool
+            True if any entries of the table are zero.
+    """
+
+    def __init__(
+        self,
+        feature_nnz,
+        sample_nnz,
+        feature_min,
+        feature_max,
+        has_implicit_zeros,
+    ):
+        self.feature_nnz = feature_nnz
+        self.sample_nnz = sample_nnz
+        self.feature_min = feature_min
+        self.feature_max = feature_max
+        self.has_implicit_zeros = has_implicit_zeros
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """Computes the statistics of a csr_matrix without explicit zeros."""
+        data = matrix.data
+        indptr = matrix.indptr
+        feature_nnz = np.diff(indptr)
+        sample_nnz = np.bincount(matrix.indices, minlength=matrix.shape[1])
+
+        # For the per-row minimums and maximums, we use reduceat() -- but only
+        # with the starting positions of nonempty rows, since reduceat()
+        # doesn't handle empty rows nicely (and each nonempty row's entries
+        # extend up to the next nonempty row's start).
+        feature_min = np.full(matrix.shape[0], np.nan)
+        feature_max = np.full(matrix.shape[0], np.nan)
+        nonempty_features = feature_nnz > 0
+        if nonempty_features.any():
+            starts = indptr[:-1][nonempty_features]
+            feature_min[nonempty_features] = np.minimum.reduceat(data, starts)
+            feature_max[nonempty_features] = np.maximum.reduceat(data, starts)
+
+        return cls(
+            feature_nnz,
+            sample_nnz,
+            feature_min,
+            feature_max,
+            len(data) < matrix.shape[0] * matrix.shape[1],
+        )
+
+    @property
+    def min_value(self):
+        """The smallest entry in the table (or NaN, if the table has no
+           entries at all).
+        """
+        if self.has_implicit_zeros:
+            return np.nanmin(np.append(self.feature_min, 0))
+        if np.isnan(self.feature_min).all():
+            return np.nan
+        return np.nanmin(self.feature_min)
+
+    @property
+    def max_value(self):
+        """The largest entry in the table (or NaN, if the table has no entries
+           at all).
+        """
+        if self.has_implicit_zeros:
+            return np.nanmax(np.append(self.feature_max, 0))
+        if np.isnan(self.feature_max).all():
+            return np.nan
+        return np.nanmax(self.feature_max)
+
+    def filter(self, nonempty_features, nonempty_samples):
+        """Returns the statistics of a table with only some features and
+           samples.
+
+           NOTE that this is only valid if all of the removed features and
+           samples are empty: otherwise, removing features would change the
+           sample statistics (and vice versa).
+        """
+        return TableStats(
+            self.feature_nnz[nonempty_features],
+            self.sample_nnz[nonempty_samples],
+            self.feature_min[nonempty_features],
+            self.feature_max[nonempty_features],
+            # The removed features and samples were empty, so the remaining
+            # ones contain the same number of nonzero entries
+            np.sum(self.feature_nnz)
+            < np.sum(nonempty_features) * np.sum(nonempty_samples),
+        )
+
+
+def as_sparse_table(table):
+    """Converts a table to a SparseTable, if it isn't one already.
+
+       Returns
+       -------
+
+       (sparse_table, was_converted): (SparseTable, bool)
+            was_converted will be True if the input was a DataFrame (and thus
+            needed to be converted). Callers can use this to decide whether to
+            convert their output back to a DataFrame, which keeps the behavior
+            of the public functions in _df_utils the same for DataFrame inputs.
+    """
+    if isinstance(table, SparseTable):
+        return table, False
+    logging.debug("Converting DataFrame table to a SparseTable.")
+    return SparseTable.from_dataframe(table), True
+
+
+def restore_table_type(table, was_converted):
+    """Inverse of as_sparse_table(): returns a DataFrame if needed."""
+    if was_converted:
+        return table.to_dataframe()
+    return table
+
+
+def read_hdf5_ids(h5grp, axis, start=0, stop=None):
+    """Reads the IDs along an axis ("observation" or "sample") of an HDF5 BIOM
+       table, returning them as a pd.Index of strs.
+
+       If start and/or stop are given, only the IDs at positions start,
+       start + 1, ..., stop - 1 are read.
+
+       h5py < 3.0 doesn't have Dataset.asstr(), so (like biom does) we read
+       the raw values and decode any bytes ourselves.
+    """
+    ids = h5grp[axis]["ids"]
+    if ids.size == 0:
+        return pd.Index([], dtype=object)
+    return pd.Index(
+        [
+            i.decode("utf-8") if isinstance(i, bytes) else i
+            for i in ids[start:stop]
+        ],
+        dtype=object,
+    )
+
+
+def read_hdf5_sample_block(h5grp, start, sample_mask):
+    """Reads the counts of a contiguous block of samples from an HDF5 BIOM
+       table.
+
+       Only the block's part of the table's sample-major data is read, so
+       the memory needed doesn't depend on the number of samples in the
+       table.
+
+       Parameters
+       ----------
+
+       h5grp: h5py.File or h5py.Group
+            An open HDF5 BIOM table.
+
+       start: int
+            The position (in the table) of the first sample in the block.
+
+       sample_mask: np.ndarray of bool
+            Which samples in the block to read. The block contains the
+            samples at positions start, start + 1, ...,
+            start + len(sample_mask) - 1.
+
+       Returns
+       -------
+
+       scipy.sparse.csr_matrix
+            Samples x features: one row per sample selected by sample_mask
+            (in the same order as in the table), and one column per feature
+            in the table.
+    """
+    matrix_grp = h5grp["sample/matrix"]
+    feature_ct = int(h5grp.attrs["shape"][0])
+    # _read_hdf5_matrix() reads entries based on the values in indptr, so we
+    # can just give it the part of indptr describing this block.
+    indptr = matrix_grp["indptr"][start : start + len(sample_mask) + 1]
+    arrays = _read_hdf5_matrix(
+        matrix_grp, indptr, sample_mask, np.ones(feature_ct, dtype=bool)
+    )
+    return csr_matrix(arrays, shape=(int(sample_mask.sum()), feature_ct))
+
+
+def _read_hdf5_matrix(matrix_grp, indptr, major_mask, minor_mask):
+    """Reads some of the data of a compressed sparse matrix in an HDF5 file.
+
+       Parameters
+       ----------
+
+       matrix_grp: h5py.Group
+            Contains "data", "indices", and "indptr" datasets (e.g. the
+            "observation/matrix" group of an HDF5 BIOM table).
+
+       indptr: np.ndarray
+            The contents of matrix_grp["indptr"].
+
+       major_mask: np.ndarray of bool
+            Which rows (for CSR data) or columns (for CSC data) to read.
+
+       minor_mask: np.ndarray of bool
+            Which columns (for CSR data) or rows (for CSC data) to keep.
+
+       Returns
+       -------
+
+       (data, indices, indptr)
+            The arrays of a compressed sparse matrix containing just the
+            selected rows and columns.
+    """
+    major_positions = np.flatnonzero(major_mask)
+    out_indptr = np.zeros(len(major_positions) + 1, dtype=np.int64)
+    if len(major_positions) == 0:
+        return (
+            np.zeros(0, dtype=matrix_grp["data"].dtype),
+            np.zeros(0, dtype=np.int32),
+            out_indptr,
+        )
+
+    # Maps each minor position in the file to its position in the output (or
+    # to -1, if it isn't being kept)
+    minor_map = np.full(len(minor_mask), -1, dtype=np.int64)
+    minor_map[minor_mask] = np.arange(minor_mask.sum())
+
+    # Group the wanted major positions into blocks that are close enough
+    # together to be read at once
+    starts = indptr[major_positions]
+    ends = indptr[major_positions + 1]
+    block_breaks = np.flatnonzero(starts[1:] - ends[:-1] > HDF5_MAX_READ_GAP)
+    block_firsts = np.concatenate([[0], block_breaks + 1])
+    block_lasts = np.concatenate([block_breaks, [len(major_positions) - 1]])
+
+    data_blocks = []
+    index_blocks = []
+    major_blocks = []
+    for first, last in zip(block_firsts, block_lasts):
+        first_major = major_positions[first]
+        last_major = major_positions[last]
+        lo = indptr[first_major]
+        hi = indptr[last_major + 1]
+        data = matrix_grp["data"][lo:hi]
+        indices = matrix_grp["indices"][lo:hi]
+        # The major position of each entry read, relative to first_major
+        entry_majors = np.repeat(
+            np.arange(last_major - first_major + 1),
+            np.diff(indptr[first_major : last_major + 2]),
+        )
+        new_indices = minor_map[indices]
+        keep = major_mask[first_major + entry_majors] & (new_indices >= 0)
+        data_blocks.append(data[keep])
+        index_blocks.append(new_indices[keep])
+        major_blocks.append(entry_majors[keep] + first_major)
+
+    data = np.concatenate(data_blocks)
+    indices = np.concatenate(index_blocks).astype(np.int32)
+    # Positions of each kept entry's row/column in the output
+    out_majors = np.searchsorted(major_positions, np.concatenate(major_blocks))
+    np.cumsum(
+        np.bincount(out_majors, minlength=len(major_positions)),
+        out=out_indptr[1:],
+    )
+    return data, indices, out_indptr
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018--, Qurro development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+# A precompiled index of a taxonomy, used to quickly find the features whose
+# taxonomy matches a Qarcoal numerator/denominator string.
+
+import logging
+import os
+import re
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from qurro._input_cache import hash_df
+
+# How numerator/denominator strings can be matched against taxonomy strings:
+#
+# regex: the taxonomy contains a match for the string, treated as a regular
+#        expression (this is what Qarcoal has always done)
+# literal: the taxonomy contains the string as a literal substring
+# rank: one of the taxonomy's ranks is exactly equal to one of the ranks in
+#       the string (like the "rank" search type in Qurro's visualizations)
+MATCH_MODES = ("regex", "literal", "rank")
+
+# Bump this if the format of saved indexes changes.
+INDEX_FORMAT_VERSION = 1
+
+# Separates taxonomy strings when they're concatenated for the suffix array.
+# Literal queries containing this character fall back to a linear scan.
+TEXT_SEPARATOR = "\x00"
+
+
+def split_ranks(text):
+    """Splits text into "ranks," in the same way as the JS code's
+       textToRankArray() does: commas, semicolons, and whitespace all separate
+       ranks, and empty ranks are ignored.
+    """
+    return [r for r in re.split(r"[,;\s]", text.strip()) if r != ""]
+
+
+def build_suffix_array(codes):
+    """Builds the suffix array of a sequence of character codes.
+
+       This uses prefix doubling: in each round, suffixes are sorted by their
+       first 2k characters using the ranks of their first k characters. Each
+       round is a single np.argsort(), so this takes O(n log^2 n) time
+       without any per-character Python loops.
+
+       Parameters
+       ----------
+
+       codes: np.ndarray of integers
+
+       Returns
+       -------
+
+       np.ndarray
+            The start positions of all suffixes of codes, in lexicographic
+            order of the suffixes (a suffix that is a prefix of another
+            suffix comes first, like in Python's string ordering).
+    """
+    n = len(codes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    rank = np.unique(codes, return_inverse=True)[1].astype(np.int64)
+    order = np.argsort(rank, kind="stable")
+    k = 1
+    while rank[order[-1]] < n - 1 and k < n:
+        # Suffixes that end within k characters sort before the others, since
+        # their second key is 0 (and every other suffix's is rank + 1).
+        # Sorting by (rank, second) is done by sorting a single combined key,
+        # which is a lot faster than np.lexsort(). (Ranks are less than n, so
+        # this can't overflow unless n is over 3 billion.)
+        key = rank * (n + 1)
+        key[: n - k] += rank[k:] + 1
+        order = np.argsort(key, kind="stable")
+        sorted_key = key[order]
+        is_new = np.ones(n, dtype=bool)
+        is_new[1:] = sorted_key[1:] != sorted_key[:-1]
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.cumsum(is_new) - 1
+        k *= 2
+    return order.astype(np.int64)
+
+
+class TaxonomyIndex(object):
+    """A searchable index of a taxonomy.
+
+       Taxonomies usually contain far fewer distinct taxonomy strings than
+       features, so the index stores each distinct string (a "taxon") once,
+       along with the taxon of each feature. Queries are evaluated against
+       the distinct taxa, and then mapped back to features.
+
+       Two structures are built (lazily, the first time they're needed) to
+       avoid scanning every taxon for each query:
+
+       - A suffix array of the taxa (concatenated with TEXT_SEPARATOR).
+         Literal substring queries are answered by binary searching this
+         array, which takes O(m log n) time for a query of length m (plus
+         the time needed to output the matches). No regexes are compiled.
+
+       - Per-level inverted indexes of the taxa's ranks: for each level of
+         the taxonomy (levels are separated by semicolons), this maps each
+         rank found at this level to the taxa containing it. Rank queries are
+         just dict lookups.
+
+       Indexes can be saved to disk with save() and reloaded with load(), so
+       that they only need to be built once per taxonomy.
+    """
+
+    def __init__(self, feature_ids, taxon_codes, taxa, taxonomy_hash=None):
+        """Initializes a TaxonomyIndex.
+
+           Parameters
+           ----------
+
+           feature_ids: list-like of str
+                The IDs of the features in the taxonomy.
+
+           taxon_codes: np.ndarray of ints
+                For each feature, its position in taxa (or -1 if it doesn't
+                have a taxonomy string).
+
+           taxa: list of str
+                The distinct taxonomy strings.
+
+           taxonomy_hash: str or None
+                A hash of the taxonomy this index was built from (see
+                hash_taxonomy()). This is only needed for indexes that are
+                saved and reused; see load_or_build_taxonomy_index().
+        """
+        self.feature_ids = pd.Index(feature_ids)
+        self.taxon_codes = np.asarray(taxon_codes, dtype=np.int64)
+        self.taxa = list(taxa)
+        self.taxonomy_hash = taxonomy_hash
+        self._text = None
+        self._starts = None
+        self._suffix_array = None
+        self._rank_index = None
+
+    @classmethod
+    def from_taxonomy(cls, taxonomy, taxonomy_hash=None):
+        """Creates a TaxonomyIndex from a taxonomy.
+
+           Parameters
+           ----------
+
+           taxonomy: pd.DataFrame
+                Indexed by feature ID, with a Taxon column.
+
+           taxonomy_hash: str or None
+                See __init__().
+        """
+        taxon_codes, taxa = pd.factorize(taxonomy["Taxon"])
+        return cls(
+            taxonomy.index, taxon_codes, [str(t) for t in taxa], taxonomy_hash
+        )
+
+    @property
+    def text(self):
+        """The taxa, concatenated with TEXT_SEPARATOR. (This is only built
+           the first time a literal query needs it.)
+        """
+        if self._text is None:
+            self._text = TEXT_SEPARATOR.join(self.taxa)
+            # Start position of each taxon in the concatenated text
+            lengths = np.array([len(t) for t in self.taxa], dtype=np.int64)
+            self._starts = np.concatenate(
+                [[0], np.cumsum(lengths + 1)[:-1]]
+            ).astype(np.int64)
+        return self._text
+
+    @property
+    def suffix_array(self):
+        if self._suffix_array is None:
+            logging.debug(
+                "Building suffix array of {} taxa.".format(len(self.taxa))
+            )
+            codes = np.frombuffer(
+                self.text.encode("utf-32-le"), dtype="<u4"
+            ).astype(np.int64)
+            self._suffix_array = build_suffix_array(codes)
+        return self._suffix_array
+
+    @property
+    def rank_index(self):
+        """A list of dicts: the i-th dict maps each rank at the i-th level of
+           the taxonomy to a np.ndarray of the positions of the taxa with this
+           rank at this level.
+        """
+        if self._rank_index is None:
+            logging.debug(
+                "Building rank index of {} taxa.".format(len(self.taxa))
+            )
+            level_postings = []
+            for t, taxon in enumerate(self.taxa):
+                for level, level_text in enumerate(taxon.split(";")):
+                    if level == len(level_postings):
+                        level_postings.append(defaultdict(list))
+                    for rank in split_ranks(level_text):
+                        postings = level_postings[level][rank]
+                        # Don't add a taxon twice if a rank occurs multiple
+                        # times at the same level
+                        if not postings or postings[-1] != t:
+                            postings.append(t)
+            self._rank_index = [
+                {r: np.array(p, dtype=np.int64) for r, p in lp.items()}
+                for lp in level_postings
+            ]
+        return self._rank_index
+
+    def _literal_taxon_mask(self, query):
+        mask = np.zeros(len(self.taxa), dtype=bool)
+        if query == "":
+            mask[:] = True
+            return mask
+        if TEXT_SEPARATOR in query:
+            mask[:] = [query in t for t in self.taxa]
+            return mask
+
+        text = self.text
+        sa = self.suffix_array
+        m = len(query)
+        # Find the range of suffixes that start with the query.
+        lo, hi = 0, len(sa)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if text[sa[mid] : sa[mid] + m] < query:
+                lo = mid + 1
+            else:
+                hi = mid
+        first = lo
+        hi = len(sa)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if text[sa[mid] : sa[mid] + m] <= query:
+                lo = mid + 1
+            else:
+                hi = mid
+        positions = sa[first:lo]
+        mask[np.searchsorted(self._starts, positions, side="right") - 1] = True
+        return mask
+
+    def _rank_taxon_mask(self, query, level=None):
+        mask = np.zeros(len(self.taxa), dtype=bool)
+        if level is None:
+            levels = self.rank_index
+        elif level < len(self.rank_index):
+            levels = [self.rank_index[level]]
+        else:
+            levels = []
+        for rank in split_ranks(query):
+            for level_index in levels:
+                if rank in level_index:
+                    mask[level_index[rank]] = True
+        return mask
+
+    def taxon_mask(self, query, match_mode="regex", level=None):
+        """Finds the taxa that match a query.
+
+           Parameters
+           ----------
+
+           query: str
+
+           match_mode: str
+                One of MATCH_MODES.
+
+           level: int or None
+                Only used if match_mode is "rank". If this is specified, only
+                ranks at this level of the taxonomy (0 = the first level)
+                will be matched.
+
+           Returns
+           -------
+
+           np.ndarray of bools
+                True for each taxon (in self.taxa) that matches the query.
+
+           Raises
+           ------
+
+           ValueError
+                If match_mode isn't one of MATCH_MODES.
+        """
+        if match_mode == "regex":
+            return (
+                pd.Series(self.taxa, dtype=object)
+                .str.contains(query, regex=True)
+                .values.astype(bool)
+            )
+        elif match_mode == "literal":
+            return self._literal_taxon_mask(query)
+        elif match_mode == "rank":
+            return self._rank_taxon_mask(query, level)
+        raise ValueError(
+            "Unrecognized match mode: {}. Must be one of {}.".format(
+                match_mode, ", ".join(MATCH_MODES)
+            )
+        )
+
+    def level_names(self, level):
+        """Returns the name of each taxon at a level of the taxonomy.
+
+           Levels are separated by semicolons (0 = the first level), and
+           names are stripped of surrounding whitespace.
+
+           Returns
+           -------
+
+           list
+                For each taxon (in self.taxa), its name at this level, or
+                None if it doesn't have a name at this level. Taxa that have
+                fewer levels, an empty name, or a name consisting only of a
+                rank prefix (e.g. "g__") don't have a name at this level.
+        """
+        names = []
+        for taxon in self.taxa:
+            levels = taxon.split(";")
+            name = levels[level].strip() if level < len(levels) else ""
+            if name == "" or name.endswith("__"):
+                name = None
+            names.append(name)
+        return names
+
+    def get_taxon_codes(self, feature_ids):
+        """Returns the taxon code of each of a list of features.
+
+           Features without a taxonomy string, or that aren't in the
+           taxonomy, have a code of -1.
+        """
+        positions = self.feature_ids.get_indexer(feature_ids)
+        return np.where(positions >= 0, self.taxon_codes[positions], -1)
+
+    def feature_mask(self, query, taxon_codes, match_mode="regex", level=None):
+        """Finds the features that match a query.
+
+           Parameters
+           ----------
+
+           query, match_mode, level:
+                See taxon_mask().
+
+           taxon_codes: np.ndarray of ints
+                The output of get_taxon_codes() for some features.
+
+           Returns
+           -------
+
+           np.ndarray of bools
+                True for each feature whose taxonomy matches the query. This
+                is in the same order as taxon_codes.
+        """
+        # Appending False means that a code of -1 maps to False
+        return np.append(self.taxon_mask(query, match_mode, level), False)[
+            taxon_codes
+        ]
+
+    def save(self, index_loc):
+        """Saves this index (including its suffix array and rank index) to a
+           .npz file.
+        """
+        level_ct = len(self.rank_index)
+        rank_entries = [
+            (level, rank, postings)
+            for level in range(level_ct)
+            for rank, postings in self.rank_index[level].items()
+        ]
+        # Passing a file object (rather than a path) to np.savez() keeps it
+        # from adding a .npz extension to index_loc.
+        with open(index_loc, "wb") as index_obj:
+            np.savez(
+                index_obj,
+                format_version=np.array(INDEX_FORMAT_VERSION),
+                taxonomy_hash=np.array(self.taxonomy_hash or ""),
+                feature_ids=np.array(
+                    [str(f) for f in self.feature_ids], dtype=str
+                ),
+                taxon_codes=self.taxon_codes,
+                taxa=np.array(self.taxa, dtype=str),
+                suffix_array=self.suffix_array,
+                rank_levels=np.array(
+                    [e[0] for e in rank_entries], dtype=np.int64
+                ),
+                ranks=np.array([e[1] for e in rank_entries], dtype=str),
+                rank_indptr=np.cumsum(
+                    [0] + [len(e[2]) for e in rank_entries], dtype=np.int64
+                ),
+                rank_postings=np.concatenate(
+                    [np.zeros(0, dtype=np.int64)]
+                    + [e[2] for e in rank_entries]
+                ),
+            )
+        logging.debug("Saved taxonomy index to {}.".format(index_loc))
+
+    @classmethod
+    def load(cls, index_loc):
+        """Loads an index saved by save().
+
+           Raises
+           ------
+
+           ValueError
+                If the index was saved in a different format.
+        """
+        with np.load(index_loc) as index_npz:
+            if int(index_npz["format_version"]) != INDEX_FORMAT_VERSION:
+                raise ValueError(
+                    "The taxonomy index {} was saved in an incompatible "
+                    "format.".format(index_loc)
+                )
+            index = cls(
+                index_npz["feature_ids"].tolist(),
+                index_npz["taxon_codes"],
+                index_npz["taxa"].tolist(),
+                str(index_npz["taxonomy_hash"]) or None,
+            )
+            index._suffix_array = index_npz["suffix_array"]
+            rank_levels = index_npz["rank_levels"]
+            ranks = index_npz["ranks"].tolist()
+            rank_indptr = index_npz["rank_indptr"]
+            rank_postings = index_npz["rank_postings"]
+        level_ct = int(rank_levels.max()) + 1 if len(rank_levels) > 0 else 0
+        index._rank_index = [{} for _ in range(level_ct)]
+        for e, (level, rank) in enumerate(zip(rank_levels, ranks)):
+            index._rank_index[level][rank] = rank_postings[
+                rank_indptr[e] : rank_indptr[e + 1]
+            ]
+        logging.debug("Loaded taxonomy index from {}.".format(index_loc))
+        return index
+
+
+def hash_taxonomy(taxonomy):
+    """Returns a hex SHA-256 digest of a taxonomy's feature IDs and taxa."""
+    return hash_df(taxonomy[["Taxon"]].astype(object))
+
+
+def load_or_build_taxonomy_index(index_loc, taxonomy):
+    """Loads a saved TaxonomyIndex of a taxonomy, or builds and saves one.
+
+       If there isn't an index at index_loc, or if the index there was built
+       from a different taxonomy (or saved in an old format), a new index is
+       built from the taxonomy and saved to index_loc.
+    """
+    # Only indexes that are saved need a hash of their taxonomy, so this is
+    # the only place where it's computed
+    taxonomy_hash = hash_taxonomy(taxonomy)
+    if os.path.exists(index_loc):
+        try:
+            index = TaxonomyIndex.load(index_loc)
+        except (OSError, ValueError, KeyError) as err:
+            logging.debug(
+                "Couldn't read taxonomy index {} ({}).".format(index_loc, err)
+            )
+        else:
+            if index.taxonomy_hash == taxonomy_hash:
+                return index
+            logging.debug(
+                "Taxonomy index {} was built from a different "
+                "taxonomy.".format(index_loc)
+            )
+    index = TaxonomyIndex.from_taxonomy(taxonomy, taxonomy_hash)
+    index.save(index_loc)
+    return index
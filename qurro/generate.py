@@ -15,28 +15,54 @@
 # ----------------------------------------------------------------------------
 
 import os
+import copy
+import functools
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 
 from distutils.dir_util import copy_tree
 import pandas as pd
 import altair as alt
 from qurro._rank_utils import filter_unextreme_features
+from qurro._size_utils import choose_extreme_feature_count
 from qurro._json_utils import (
-    replace_js_json_definitions,
+    write_main_js,
     check_json_dataset_names,
+    get_packed_count_json,
+    get_sharded_count_json,
+    write_count_shards,
+    compress_json,
+    df_to_dataset,
+    dictionary_encode_columns,
+    plot_jsons_equal,
+    COMPRESSED_JSON_KEY,
 )
 from qurro._df_utils import (
     replace_nan,
     validate_df,
     check_column_names,
-    biom_table_to_sparse_df,
+    biom_table_to_sparse_table,
     vibe_check,
     remove_empty_samples_and_features,
     match_table_and_data,
     merge_feature_metadata,
-    sparsify_count_dict,
     add_sample_presence_count,
+    select_sample_metadata_columns,
 )
+from qurro._input_cache import record_output
+
+# Names of the selections that let users pan/zoom the rank and sample plots.
+# We name these explicitly because Altair's default names (e.g. "selector001")
+# include a counter that is incremented every time Altair creates a selection,
+# which would make the output depend on what else has been run in the current
+# process (see issue #164 on Qurro's GitHub page for context).
+RANK_PLOT_SCALES_SELECTION = "qurro_rank_plot_scales"
+SAMPLE_PLOT_SCALES_SELECTION = "qurro_sample_plot_scales"
+
+# Ways of creating the rank and sample plot JSONs: see gen_spec().
+SPEC_MODES = ("fast", "altair", "check")
 
 
 def process_and_generate(
@@ -46,7 +72,13 @@ def process_and_generate(
     biom_table,
     output_dir,
     feature_metadata=None,
+    *,
     extreme_feature_count=None,
+    count_shard_size=None,
+    compress_data=False,
+    workers=1,
+    max_output_size=None,
+    sample_metadata_columns=None
 ):
     """Just calls process_input() and gen_visualization()."""
     U, V, ranking_ids, feature_metadata_cols, processed_table = process_input(
@@ -54,7 +86,9 @@ def process_and_generate(
         sample_metadata,
         biom_table,
         feature_metadata,
-        extreme_feature_count,
+        extreme_feature_count=extreme_feature_count,
+        max_output_size=max_output_size,
+        sample_metadata_columns=sample_metadata_columns,
     )
     return gen_visualization(
         V,
@@ -64,6 +98,102 @@ def process_and_generate(
         processed_table,
         U,
         output_dir,
+        count_shard_size=count_shard_size,
+        compress_data=compress_data,
+        workers=workers,
+    )
+
+
+def process_cached_and_generate(
+    load_input,
+    input_cache,
+    cache_key,
+    output_dir,
+    feature_metadata=None,
+    *,
+    extreme_feature_count=None,
+    count_shard_size=None,
+    compress_data=False,
+    workers=1,
+    max_output_size=None,
+    sample_metadata_columns=None
+):
+    """Like process_and_generate(), but caches the output of match_input().
+
+       Parameters
+       ----------
+
+       load_input: function
+            Should return a tuple of (feature ranks, rank type, sample
+            metadata, BIOM table), as would be passed to
+            process_and_generate(). This is only called if the input cache
+            doesn't have an entry for cache_key -- so, for example, this can
+            load the BIOM table from a file.
+
+       input_cache: _input_cache.InputCache
+            The cache to use.
+
+       cache_key: str
+            The cache key for the inputs load_input() would return (see
+            _input_cache.InputCache.make_key()).
+
+       The other parameters are the same as for process_and_generate().
+    """
+    cached_input = input_cache.load(cache_key)
+    if cached_input is None:
+        # Save the messages about dropped samples/features with the matched
+        # input, so that runs using this cache entry can repeat them
+        with record_output() as messages:
+            (
+                feature_ranks,
+                rank_type,
+                sample_metadata,
+                biom_table,
+            ) = load_input()
+            check_input(feature_ranks, sample_metadata, feature_metadata)
+            m_table, m_sample_metadata = match_input(
+                feature_ranks, sample_metadata, biom_table
+            )
+        input_cache.store(
+            cache_key,
+            m_table,
+            m_sample_metadata,
+            feature_ranks,
+            rank_type,
+            messages.getvalue(),
+        )
+    else:
+        logging.debug("Using cached input; skipping matching.")
+        (
+            m_table,
+            m_sample_metadata,
+            feature_ranks,
+            rank_type,
+            messages,
+        ) = cached_input
+        print(messages, end="")
+        check_input(feature_ranks, m_sample_metadata, feature_metadata)
+
+    U, V, ranking_ids, feature_metadata_cols, processed_table = finish_input(
+        m_table,
+        m_sample_metadata,
+        feature_ranks,
+        feature_metadata,
+        extreme_feature_count=extreme_feature_count,
+        max_output_size=max_output_size,
+        sample_metadata_columns=sample_metadata_columns,
+    )
+    return gen_visualization(
+        V,
+        rank_type,
+        ranking_ids,
+        feature_metadata_cols,
+        processed_table,
+        U,
+        output_dir,
+        count_shard_size=count_shard_size,
+        compress_data=compress_data,
+        workers=workers,
     )
 
 
@@ -72,7 +202,10 @@ def process_input(
     sample_metadata,
     biom_table,
     feature_metadata=None,
+    *,
     extreme_feature_count=None,
+    max_output_size=None,
+    sample_metadata_columns=None
 ):
     """Validates/processes the input files and parameter(s) to Qurro.
 
@@ -86,8 +219,8 @@ def process_input(
           missing values are represented consistently with a None (which
           will be represented as a null in JSON/JavaScript).
 
-       3. Converts the BIOM table to a SparseDataFrame by calling
-          biom_table_to_sparse_df().
+       3. Converts the BIOM table to a SparseTable by calling
+          biom_table_to_sparse_table().
 
        4. Runs vibe_check() on the feature ranks and BIOM table to ensure
           that numbers are within the range of safe IEEE 754 numbers for
@@ -96,14 +229,19 @@ def process_input(
        5. Matches up the table with the feature ranks and sample metadata by
           calling match_table_and_data().
 
-       6. Calls filter_unextreme_features() using the provided
+       6. If sample_metadata_columns is provided, limits the sample metadata
+          to just these columns by calling select_sample_metadata_columns().
+
+       7. Calls filter_unextreme_features() using the provided
           extreme_feature_count. (If it's None, then nothing will be done.)
+          If max_output_size is provided instead, the extreme feature count
+          is chosen by _size_utils.choose_extreme_feature_count().
 
-       7. Calls remove_empty_samples_and_features() to filter empty samples
+       8. Calls remove_empty_samples_and_features() to filter empty samples
           (and features). This is purposefully done *after*
           filter_unextreme_features() is called.
 
-       8. Calls merge_feature_metadata() on the feature ranks and feature
+       9. Calls merge_feature_metadata() on the feature ranks and feature
           metadata. (If feature metadata is None, nothing will be done.)
 
        Returns
@@ -122,12 +260,45 @@ def process_input(
        feature_metadata_cols: list
             The feature metadata columns' names in output_ranks.
 
-       output_table: pd.SparseDataFrame
+       output_table: SparseTable
             The BIOM table, post matching with the feature ranks and sample
             metadata and with empty samples removed.
     """
 
     logging.debug("Starting processing input.")
+    check_filtering_options(extreme_feature_count, max_output_size)
+    check_input(feature_ranks, sample_metadata, feature_metadata)
+    m_table, m_sample_metadata = match_input(
+        feature_ranks, sample_metadata, biom_table
+    )
+    return finish_input(
+        m_table,
+        m_sample_metadata,
+        feature_ranks,
+        feature_metadata,
+        extreme_feature_count=extreme_feature_count,
+        max_output_size=max_output_size,
+        sample_metadata_columns=sample_metadata_columns,
+    )
+
+
+def check_filtering_options(extreme_feature_count, max_output_size):
+    """Raises a ValueError if both an extreme feature count and a maximum
+       output size are given.
+
+       This only depends on the parameters, so the scripts call this before
+       loading any input (rather than waiting for finish_input() to catch
+       it).
+    """
+    if extreme_feature_count is not None and max_output_size is not None:
+        raise ValueError(
+            "Only one of the extreme feature count and the maximum output "
+            "size can be specified."
+        )
+
+
+def check_input(feature_ranks, sample_metadata, feature_metadata=None):
+    """Does step 1 (validating DataFrames/column names) of process_input()."""
 
     validate_df(feature_ranks, "feature ranks", 2, 1)
     validate_df(sample_metadata, "sample metadata", 1, 1)
@@ -143,24 +314,76 @@ def process_input(
 
     check_column_names(sample_metadata, feature_ranks, feature_metadata)
 
+
+def match_input(feature_ranks, sample_metadata, biom_table):
+    """Does steps 2 through 5 of process_input() (aside from calling
+       replace_nan() on the feature metadata).
+
+       The output of this only depends on the feature ranks, sample metadata,
+       and BIOM table -- so it can be cached across runs of Qurro that only
+       change the feature metadata or extreme feature count (see
+       _input_cache.py).
+
+       Returns
+       -------
+       (m_table, m_sample_metadata): (SparseTable, pd.DataFrame)
+            The BIOM table and sample metadata, matched up with each other
+            and with the feature ranks.
+    """
     # Replace NaN values (which both _metadata_utils.read_metadata_file() and
     # qiime2.Metadata use to represent missing values, i.e. ""s) with None --
     # this is generally easier for us to handle in the JS side of things (since
     # it'll just be consistently converted to null by json.dumps()).
     sample_metadata = replace_nan(sample_metadata)
-    if feature_metadata is not None:
-        feature_metadata = replace_nan(feature_metadata)
 
-    table = biom_table_to_sparse_df(biom_table)
+    table = biom_table_to_sparse_table(biom_table)
 
     # Check that the solely-numeric data only contains "safe" numbers
     vibe_check(feature_ranks, table)
 
     # Match up the table with the feature ranks and sample metadata.
-    m_table, m_sample_metadata = match_table_and_data(
-        table, feature_ranks, sample_metadata
+    return match_table_and_data(table, feature_ranks, sample_metadata)
+
+
+def finish_input(
+    m_table,
+    m_sample_metadata,
+    feature_ranks,
+    feature_metadata=None,
+    *,
+    extreme_feature_count=None,
+    max_output_size=None,
+    sample_metadata_columns=None
+):
+    """Does the rest of process_input(), given the output of match_input().
+
+       Returns the same things as process_input().
+
+       Raises
+       ------
+
+       ValueError
+            If both extreme_feature_count and max_output_size are provided,
+            or if any of the sample_metadata_columns aren't in the sample
+            metadata.
+    """
+    check_filtering_options(extreme_feature_count, max_output_size)
+    if feature_metadata is not None:
+        feature_metadata = replace_nan(feature_metadata)
+
+    m_sample_metadata = select_sample_metadata_columns(
+        m_sample_metadata, sample_metadata_columns
     )
 
+    if max_output_size is not None:
+        extreme_feature_count, _ = choose_extreme_feature_count(
+            m_table,
+            m_sample_metadata,
+            feature_ranks,
+            feature_metadata,
+            max_output_size,
+        )
+
     # Note that although we always call filter_unextreme_features(), filtering
     # isn't necessarily always done (whether or not depends on the value of
     # extreme_feature_count and the contents of the table/ranks).
@@ -191,7 +414,294 @@ def process_input(
     )
 
 
-def gen_rank_plot(V, rank_type, ranking_ids, feature_metadata_cols, table_sdf):
+def scales_selection(name):
+    """Returns a selection that makes a chart's x and y scales interactive.
+
+       This is equivalent to what alt.Chart.interactive() adds to a chart,
+       except that the selection is given a fixed name.
+    """
+    return alt.selection_interval(
+        bind="scales", encodings=["x", "y"], name=name
+    )
+
+
+def get_field(name, field_types, channel=alt.Tooltip):
+    """Returns an encoding field definition for a chart.
+
+       If field_types is None, this just returns name (so Altair will infer the
+       type of this field from the chart's data). Otherwise, this explicitly
+       gives the field the type stored for it in field_types.
+    """
+    if field_types is None:
+        return name
+    return channel(field=name, type=field_types[name])
+
+
+def make_rank_chart(
+    data,
+    default_rank_col,
+    feature_metadata_cols,
+    ranking_ids,
+    field_types=None,
+):
+    """Creates the alt.Chart for the rank plot.
+
+       If data isn't a DataFrame, then field_types should be a dict mapping
+       the names of the fields whose types Altair would otherwise infer from
+       the data to their Vega-Lite types: see gen_spec().
+    """
+    color_type = alt.Undefined
+    if field_types is not None:
+        color_type = field_types["qurro_classification"]
+    return (
+        alt.Chart(
+            data,
+            title="Features",
+            background="#FFFFFF",
+            autosize=alt.AutoSizeParams(resize=True),
+        )
+        .mark_bar()
+        .transform_window(
+            sort=[alt.SortField(field=default_rank_col, order="ascending")],
+            # We don't use an alt.WindowFieldDef here because python gets
+            # confused when you use "as" as an actual argument name. So we just
+            # use this syntax.
+            window=[{"op": "row_number", "as": "qurro_x"}],
+        )
+        .encode(
+            # type="ordinal" needed on the scale here to make bars adjacent;
+            # see https://stackoverflow.com/a/55544817/10730311.
+            x=alt.X(
+                "qurro_x",
+                title="Feature Rankings",
+                type="ordinal",
+                scale=alt.Scale(paddingOuter=1, paddingInner=0, rangeStep=1),
+                axis=alt.Axis(ticks=False, labelAngle=0),
+            ),
+            y=alt.Y(default_rank_col, type="quantitative"),
+            color=alt.Color(
+                "qurro_classification",
+                title="Log-Ratio Classification",
+                type=color_type,
+                scale=alt.Scale(
+                    domain=["None", "Numerator", "Denominator", "Both"],
+                    range=["#e0e0e0", "#f00", "#00f", "#949"],
+                ),
+            ),
+            tooltip=[
+                alt.Tooltip(
+                    field="qurro_x",
+                    title="Current Ranking",
+                    type="quantitative",
+                ),
+                alt.Tooltip(
+                    field="qurro_classification",
+                    title="Log-Ratio Classification",
+                    type="nominal",
+                ),
+                alt.Tooltip(
+                    field="qurro_spc",
+                    title="Sample Presence Count",
+                    type="quantitative",
+                ),
+                get_field("Feature ID", field_types),
+                *(get_field(c, field_types) for c in feature_metadata_cols),
+                *(get_field(c, field_types) for c in ranking_ids),
+            ],
+        )
+        .configure_axis(
+            # Done in order to differentiate "None"-classification features
+            # from grid lines
+            gridColor="#f2f2f2",
+            labelBound=True,
+        )
+        .add_selection(scales_selection(RANK_PLOT_SCALES_SELECTION))
+    )
+
+
+def make_sample_chart(data, default_metadata_col, field_types=None):
+    """Creates the alt.Chart for the sample plot.
+
+       (All of the fields used in this chart have explicitly specified types,
+       so field_types isn't used.)
+    """
+    return (
+        alt.Chart(
+            data,
+            title="Samples",
+            background="#FFFFFF",
+            autosize=alt.AutoSizeParams(resize=True),
+        )
+        .mark_circle()
+        .encode(
+            alt.X(
+                default_metadata_col,
+                type="nominal",
+                axis=alt.Axis(labelAngle=-45),
+                scale=alt.Scale(zero=False),
+            ),
+            alt.Y(
+                "qurro_balance:Q",
+                title="Current Natural Log-Ratio",
+                type="quantitative",
+                scale=alt.Scale(zero=False),
+            ),
+            color=alt.Color(default_metadata_col, type="nominal"),
+            tooltip=["Sample ID:N", "qurro_balance:Q"],
+        )
+        .configure_range(
+            ramp=alt.SchemeConfig(scheme="blues"),
+            category=alt.SchemeConfig(scheme="tableau10"),
+        )
+        .configure_axis(labelBound=True)
+        .add_selection(scales_selection(SAMPLE_PLOT_SCALES_SELECTION))
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def get_spec_template(make_chart, chart_args, field_types):
+    """Returns the Vega-Lite spec of a chart without any data.
+
+       (The chart's data is just a reference to a nonexistent dataset named
+       "qurro_placeholder".) Altair validates this spec, which is fast since
+       there's no data in it. The output of this function is cached, so
+       callers shouldn't modify it.
+
+       field_types should be a tuple of (field name, Vega-Lite type) pairs.
+    """
+    return make_chart(
+        alt.NamedData(name="qurro_placeholder"),
+        *chart_args,
+        field_types=dict(field_types)
+    ).to_dict()
+
+
+def gen_fast_spec(data, make_chart, chart_args, inferred_fields):
+    """Creates a chart's Vega-Lite spec without having Altair process the data.
+
+       Returns None if this isn't possible for this data (in which case Altair
+       should just be used): see _json_utils.df_to_dataset().
+    """
+    dataset = df_to_dataset(data)
+    if dataset is None:
+        return None
+    field_types = []
+    for field in inferred_fields:
+        # If a field name would be interpreted by Altair as something other
+        # than just a field name (e.g. "sum(x)" or "x:Q"), play it safe.
+        if alt.utils.parse_shorthand(field) != {"field": field}:
+            return None
+        field_types.append((field, alt.utils.infer_vegalite_type(data[field])))
+    spec = copy.deepcopy(
+        get_spec_template(make_chart, chart_args, tuple(field_types))
+    )
+    # Add in the data in the same way Altair does: as a named dataset. (This
+    # replaces the template's placeholder data.)
+    dataset_name, records = dataset
+    spec["data"] = {"name": dataset_name}
+    spec.setdefault("datasets", {})[dataset_name] = records
+    return spec
+
+
+def gen_spec(
+    data, make_chart, chart_args, inferred_fields=(), spec_mode="fast"
+):
+    """Creates the Vega-Lite spec of a chart with a given DataFrame of data.
+
+       Calling make_chart(data, *chart_args).to_dict() would do this, but
+       Altair is slow for large DataFrames: it copies and converts the
+       DataFrame to records row by row, hashes the JSON of all of these
+       records to name the dataset, and validates the spec against the
+       Vega-Lite JSON schema. The "fast" way of doing this gets the spec of
+       the chart without any data (from a cached, validated template), then
+       adds in the data (converted to records column by column: see
+       _json_utils.df_to_dataset()) itself.
+
+       Parameters
+       ----------
+
+       data: pd.DataFrame
+            The chart's data.
+
+       make_chart: function
+            Creates the alt.Chart: see make_rank_chart() and
+            make_sample_chart().
+
+       chart_args: tuple
+            Other arguments to pass to make_chart(). Should be hashable.
+
+       inferred_fields: list
+            The names of fields in the chart whose Vega-Lite types aren't
+            specified by make_chart(), and thus are inferred from the data.
+
+       spec_mode: str
+            One of SPEC_MODES. If "fast", this creates the spec in the fast
+            way described above (unless this isn't possible for this data,
+            in which case Altair is used). If "altair", this just uses
+            Altair. If "check", this creates the spec both ways and checks
+            that they're the same (other than the dataset names: see
+            _json_utils.plot_jsons_equal()), then returns the spec Altair
+            created. This is slow, but useful for testing.
+
+       Returns
+       -------
+
+       dict
+            The chart's Vega-Lite spec.
+
+       Raises
+       ------
+
+       ValueError
+            If spec_mode isn't one of SPEC_MODES, or if spec_mode is "check"
+            and the two ways of creating the spec produce different specs.
+    """
+    if spec_mode not in SPEC_MODES:
+        raise ValueError(
+            "spec_mode must be one of {}; got {}.".format(
+                SPEC_MODES, spec_mode
+            )
+        )
+    fast_spec = None
+    if spec_mode != "altair":
+        start_time = time.time()
+        fast_spec = gen_fast_spec(
+            data, make_chart, chart_args, inferred_fields
+        )
+        if fast_spec is None:
+            logging.debug("Can't create this spec quickly; using Altair.")
+        else:
+            logging.debug(
+                "Created spec without Altair in {:.3f} seconds.".format(
+                    time.time() - start_time
+                )
+            )
+            if spec_mode == "fast":
+                return fast_spec
+
+    start_time = time.time()
+    altair_spec = make_chart(data, *chart_args).to_dict()
+    logging.debug(
+        "Created spec using Altair in {:.3f} seconds.".format(
+            time.time() - start_time
+        )
+    )
+    if fast_spec is not None and not plot_jsons_equal(fast_spec, altair_spec):
+        raise ValueError(
+            "The spec created without Altair differs from the spec created "
+            "using Altair."
+        )
+    return altair_spec
+
+
+def gen_rank_plot(
+    V,
+    rank_type,
+    ranking_ids,
+    feature_metadata_cols,
+    table_sdf,
+    spec_mode="fast",
+):
     """Uses Altair to generate a JSON Vega-Lite spec for the rank plot.
 
     Parameters
@@ -217,13 +727,16 @@ def gen_rank_plot(V, rank_type, ranking_ids, feature_metadata_cols, table_sdf):
         IDs of the "feature metadata" columns in V (if there wasn't any
         feature metadata provided, this can just be an empty list).
 
-    table_sdf: pd.SparseDataFrame
+    table_sdf: SparseTable
         A representation of the input BIOM table containing count data. This
         is used to calculate qurro_spc (the number of samples a feature is
         present in) for each feature in V. This should ONLY contain samples
         that will be used in the Qurro visualization -- the presence of extra
         samples will mess up _df_utils.add_sample_presence_count().
 
+    spec_mode: str
+        How to create the Vega-Lite spec: see gen_spec().
+
     Returns
     -------
 
@@ -264,71 +777,16 @@ def gen_rank_plot(V, rank_type, ranking_ids, feature_metadata_cols, table_sdf):
     rank_data.reset_index(inplace=True)
 
     # Now, we can actually create the rank plot.
-    rank_chart = (
-        alt.Chart(
-            rank_data,
-            title="Features",
-            background="#FFFFFF",
-            autosize=alt.AutoSizeParams(resize=True),
-        )
-        .mark_bar()
-        .transform_window(
-            sort=[alt.SortField(field=default_rank_col, order="ascending")],
-            # We don't use an alt.WindowFieldDef here because python gets
-            # confused when you use "as" as an actual argument name. So we just
-            # use this syntax.
-            window=[{"op": "row_number", "as": "qurro_x"}],
-        )
-        .encode(
-            # type="ordinal" needed on the scale here to make bars adjacent;
-            # see https://stackoverflow.com/a/55544817/10730311.
-            x=alt.X(
-                "qurro_x",
-                title="Feature Rankings",
-                type="ordinal",
-                scale=alt.Scale(paddingOuter=1, paddingInner=0, rangeStep=1),
-                axis=alt.Axis(ticks=False, labelAngle=0),
-            ),
-            y=alt.Y(default_rank_col, type="quantitative"),
-            color=alt.Color(
-                "qurro_classification",
-                title="Log-Ratio Classification",
-                scale=alt.Scale(
-                    domain=["None", "Numerator", "Denominator", "Both"],
-                    range=["#e0e0e0", "#f00", "#00f", "#949"],
-                ),
-            ),
-            tooltip=[
-                alt.Tooltip(
-                    field="qurro_x",
-                    title="Current Ranking",
-                    type="quantitative",
-                ),
-                alt.Tooltip(
-                    field="qurro_classification",
-                    title="Log-Ratio Classification",
-                    type="nominal",
-                ),
-                alt.Tooltip(
-                    field="qurro_spc",
-                    title="Sample Presence Count",
-                    type="quantitative",
-                ),
-                "Feature ID",
-                *feature_metadata_cols,
-                *ranking_ids,
-            ],
-        )
-        .configure_axis(
-            # Done in order to differentiate "None"-classification features
-            # from grid lines
-            gridColor="#f2f2f2",
-            labelBound=True,
-        )
-        .interactive()
+    rank_chart_json = gen_spec(
+        rank_data,
+        make_rank_chart,
+        (default_rank_col, tuple(feature_metadata_cols), tuple(ranking_ids)),
+        # These are the fields whose types Altair would infer from the data
+        ["qurro_classification", "Feature ID"]
+        + list(feature_metadata_cols)
+        + list(ranking_ids),
+        spec_mode,
     )
-
-    rank_chart_json = rank_chart.to_dict()
     rank_ordering = "qurro_rank_ordering"
     fm_col_ordering = "qurro_feature_metadata_ordering"
     dataset_name_for_rank_type = "qurro_rank_type"
@@ -346,7 +804,7 @@ def gen_rank_plot(V, rank_type, ranking_ids, feature_metadata_cols, table_sdf):
     return rank_chart_json
 
 
-def gen_sample_plot(metadata):
+def gen_sample_plot(metadata, spec_mode="fast"):
     """Uses Altair to generate a JSON Vega-Lite spec for the sample plot.
 
     Parameters
@@ -359,11 +817,20 @@ def gen_sample_plot(metadata):
         This should have already been matched with the BIOM table, had empty
         samples removed, etc.
 
+    spec_mode: str
+        How to create the Vega-Lite spec: see gen_spec().
+
     Returns
     -------
 
     sample_chart_json: dict
         A dict version of the alt.Chart for the sample plot.
+
+        Metadata columns that take up less space when dictionary-encoded
+        (see _json_utils.get_dictionary_encoding()) are stored as integer
+        codes in the sample plot's data; the
+        "qurro_sample_metadata_dictionaries" dataset maps each of these
+        columns' names to the list of values that its codes refer to.
     """
     sample_metadata = metadata.copy()
 
@@ -382,48 +849,30 @@ def gen_sample_plot(metadata):
     sample_metadata.rename_axis("Sample ID", axis="index", inplace=True)
     sample_metadata.reset_index(inplace=True)
 
-    # Create sample plot chart Vega-Lite spec using Altair.
-    sample_chart = (
-        alt.Chart(
-            sample_metadata,
-            title="Samples",
-            background="#FFFFFF",
-            autosize=alt.AutoSizeParams(resize=True),
-        )
-        .mark_circle()
-        .encode(
-            alt.X(
-                default_metadata_col,
-                type="nominal",
-                axis=alt.Axis(labelAngle=-45),
-                scale=alt.Scale(zero=False),
-            ),
-            alt.Y(
-                "qurro_balance:Q",
-                title="Current Natural Log-Ratio",
-                type="quantitative",
-                scale=alt.Scale(zero=False),
-            ),
-            color=alt.Color(default_metadata_col, type="nominal"),
-            tooltip=["Sample ID:N", "qurro_balance:Q"],
-        )
-        .configure_range(
-            ramp=alt.SchemeConfig(scheme="blues"),
-            category=alt.SchemeConfig(scheme="tableau10"),
-        )
-        .configure_axis(labelBound=True)
-        .interactive()
+    # Store repetitive metadata columns as integer codes referring to a list
+    # of each column's values. The JS code decodes each column when it's
+    # first used in the sample plot.
+    sample_metadata, dictionaries = dictionary_encode_columns(
+        sample_metadata, metadata.columns
+    )
+
+    # Create sample plot chart Vega-Lite spec.
+    sample_chart_dict = gen_spec(
+        sample_metadata,
+        make_sample_chart,
+        (default_metadata_col,),
+        spec_mode=spec_mode,
     )
 
     # Replace the "mark": "circle" definition with a more explicit one. This
     # will be useful when adding attributes to the boxplot mark in the
     # visualization. (We have to resort to this hack because I haven't been
     # able to successfully use alt.MarkDef in the alt.Chart definition above.)
-    sample_chart_dict = sample_chart.to_dict()
     sample_chart_dict["mark"] = {"type": "circle"}
 
     sm_fields = "qurro_sample_metadata_fields"
-    check_json_dataset_names(sample_chart_dict, sm_fields)
+    sm_dictionaries = "qurro_sample_metadata_dictionaries"
+    check_json_dataset_names(sample_chart_dict, sm_fields, sm_dictionaries)
     # Specify an alphabetical ordering for the sample metadata field names.
     # This will be used for populating the x-axis / color field selectors in
     # Qurro's sample plot controls.
@@ -440,48 +889,117 @@ def gen_sample_plot(metadata):
     sorted_md_cols = list(sorted(sample_metadata.columns, key=str.lower))
     sorted_md_cols.remove("qurro_balance")
     sample_chart_dict["datasets"][sm_fields] = sorted_md_cols
+    sample_chart_dict["datasets"][sm_dictionaries] = dictionaries
     return sample_chart_dict
 
 
-def gen_visualization(
+def compress_json_and_log(json_obj, json_name):
+    """Calls _json_utils.compress_json(), logging how well this worked.
+
+       Returns the compressed JSON.
+    """
+    start_time = time.time()
+    compressed_json, uncompressed_size = compress_json(json_obj)
+    compressed_size = len(compressed_json[COMPRESSED_JSON_KEY])
+    logging.debug(
+        "Compressed the {} JSON from {:,} to {:,} bytes ({:.1%} of the "
+        "original size) in {:.3f} seconds.".format(
+            json_name,
+            uncompressed_size,
+            compressed_size,
+            compressed_size / max(uncompressed_size, 1),
+            time.time() - start_time,
+        )
+    )
+    return compressed_json
+
+
+def gen_rank_plot_json(
     V,
     rank_type,
     ranking_ids,
     feature_metadata_cols,
     processed_table,
-    df_sample_metadata,
-    output_dir,
+    compress_data=False,
+    spec_mode="fast",
 ):
-    """Creates a Qurro visualization from already-processed-and-validated data.
-
-       Returns
-       -------
-
-       index_path: str
-            A path to the index.html file for the output visualization. This is
-            needed when calling q2templates.render().
-    """
-
+    """Calls gen_rank_plot(), and compresses its output if requested."""
     # https://altair-viz.github.io/user_guide/faq.html#disabling-maxrows
+    # (This is done here, rather than just once in gen_visualization(),
+    # because this might be run in a separate process.)
     alt.data_transformers.enable("default", max_rows=None)
-
     logging.debug("Generating rank plot JSON.")
     rank_plot_json = gen_rank_plot(
-        V, rank_type, ranking_ids, feature_metadata_cols, processed_table
+        V,
+        rank_type,
+        ranking_ids,
+        feature_metadata_cols,
+        processed_table,
+        spec_mode,
     )
+    if compress_data:
+        rank_plot_json = compress_json_and_log(rank_plot_json, "rank plot")
+    return rank_plot_json
+
+
+def gen_sample_plot_json(
+    df_sample_metadata, compress_data=False, spec_mode="fast"
+):
+    """Calls gen_sample_plot(), and compresses its output if requested."""
+    alt.data_transformers.enable("default", max_rows=None)
     logging.debug("Generating sample plot JSON.")
-    sample_plot_json = gen_sample_plot(df_sample_metadata)
-    logging.debug("Generating count data JSON.")
-    count_json = sparsify_count_dict(processed_table.T.to_dict())
-    logging.debug("Finished generating all JSONs.")
+    sample_plot_json = gen_sample_plot(df_sample_metadata, spec_mode)
+    if compress_data:
+        sample_plot_json = compress_json_and_log(
+            sample_plot_json, "sample plot"
+        )
+    return sample_plot_json
+
+
+def gen_count_json(
+    processed_table, output_dir, count_shard_size=None, compress_data=False
+):
+    """Generates the count JSON, compressing it if requested.
+
+       If count_shard_size is not None, this also writes out the count shards
+       to output_dir (which should already exist), and returns the index JSON
+       of the sharded count data: see _json_utils.get_sharded_count_json().
+    """
+    logging.debug("Generating count JSON.")
+    count_shards = None
+    if count_shard_size is None:
+        count_json = get_packed_count_json(processed_table)
+    else:
+        count_json, count_shards = get_sharded_count_json(
+            processed_table, count_shard_size
+        )
+    if compress_data:
+        count_json = compress_json_and_log(count_json, "count")
+        if count_shards is not None:
+            count_shards = (compress_json(shard)[0] for shard in count_shards)
+    if count_shards is not None:
+        write_count_shards(output_dir, count_shards)
+    return count_json
 
-    # Copy support_files/ for the Qurro visualization to the output directory
+
+def get_support_files_loc():
+    """Returns the location of Qurro's support_files/ directory."""
     # First, identify the location of this particular file (generate.py).
     curr_loc = os.path.dirname(os.path.realpath(__file__))
     # Next, join curr_loc with support_files/, since support_files/ is located
     # within the same directory as this fiile (generate.py).
-    support_files_loc = os.path.join(curr_loc, "support_files")
-    # Finally, actually do the copying (saving the index path for future use)
+    return os.path.join(curr_loc, "support_files")
+
+
+def copy_support_files(output_dir):
+    """Copies support_files/ for a Qurro visualization to output_dir.
+
+       Returns
+       -------
+
+       index_path: str
+            A path to the index.html file for the output visualization.
+    """
     # We explictly ignore files starting with a period, like .DS_STORE. It's ok
     # if these files make their way into the output directory -- they shouldn't
     # mess anything up -- but there's no need to include them.
@@ -493,19 +1011,153 @@ def gen_visualization(
     # NOTE: Use of copy_tree() instead of shutil.copytree() (which throws an
     # error if output_dir already exists) is based on how
     # emperor.core.copy_support_files() works.
-    copy_tree(support_files_loc, output_dir)
-    index_path = os.path.join(output_dir, "index.html")
+    copy_tree(get_support_files_loc(), output_dir)
+    logging.debug("Copied support files.")
+    return os.path.join(output_dir, "index.html")
+
+
+# Inputs shared with gen_visualization()'s worker processes, set by
+# _init_visualization_worker().
+_worker_state = {}
+
+
+def _init_visualization_worker(log_level, tasks):
+    """Sets up a worker process for gen_visualization().
+
+       tasks maps task names to (function, args) tuples. These are passed in
+       once, when the worker starts, rather than with each task -- so the
+       table, ranks, and metadata are inherited by forked workers instead of
+       being pickled for each task.
+
+       The worker's logging is set to log_level, so that --debug messages
+       are still shown if the worker didn't inherit the parent process'
+       logging configuration.
+    """
+    logging.basicConfig()
+    logging.getLogger().setLevel(log_level)
+    _worker_state["tasks"] = tasks
+
+
+def _run_visualization_task(name):
+    func, args = _worker_state["tasks"][name]
+    return func(*args)
+
+
+def gen_visualization(
+    V,
+    rank_type,
+    ranking_ids,
+    feature_metadata_cols,
+    processed_table,
+    df_sample_metadata,
+    output_dir,
+    count_shard_size=None,
+    compress_data=False,
+    workers=1,
+    spec_mode="fast",
+):
+    """Creates a Qurro visualization from already-processed-and-validated data.
+
+       If count_shard_size is not None, the count data will be split up into
+       separate files of (at most) this many features each, which the
+       visualization will load only as needed: see
+       _json_utils.get_sharded_count_json(). Otherwise, all of the count data
+       will be stored in main.js.
+
+       If compress_data is True, the plot and count JSONs (including count
+       shards, if present) will be stored compressed: see
+       _json_utils.compress_json(). The visualization decompresses these
+       JSONs when it's loaded. This makes the visualization a lot smaller,
+       at the cost of some extra time spent compressing/decompressing.
+
+       If workers is greater than 1, the rank plot JSON, sample plot JSON, and
+       count JSON will be generated concurrently in up to this many separate
+       processes (since generating these is mostly CPU-bound), while
+       support_files/ is copied to output_dir in a separate thread (since this
+       is mostly I/O-bound). The output is the same as if workers was 1, in
+       which case everything is done one step at a time.
+
+       spec_mode determines how the rank and sample plot JSONs are created:
+       see gen_spec().
+
+       Returns
+       -------
+
+       index_path: str
+            A path to the index.html file for the output visualization. This is
+            needed when calling q2templates.render().
+    """
+    tasks = {
+        "rank": (
+            gen_rank_plot_json,
+            (
+                V,
+                rank_type,
+                ranking_ids,
+                feature_metadata_cols,
+                processed_table,
+                compress_data,
+                spec_mode,
+            ),
+        ),
+        "sample": (
+            gen_sample_plot_json,
+            (df_sample_metadata, compress_data, spec_mode),
+        ),
+        "count": (
+            gen_count_json,
+            (processed_table, output_dir, count_shard_size, compress_data),
+        ),
+    }
+
+    if workers > 1:
+        logging.debug(
+            "Generating the visualization using {} worker(s).".format(workers)
+        )
+        # Count shards are written to output_dir as they're generated, so
+        # output_dir needs to exist before we start.
+        os.makedirs(output_dir, exist_ok=True)
+        log_level = logging.getLogger().getEffectiveLevel()
+        with ThreadPoolExecutor(max_workers=1) as thread_pool:
+            with Pool(
+                min(workers, len(tasks)),
+                initializer=_init_visualization_worker,
+                initargs=(log_level, tasks),
+            ) as pool:
+                copy_future = thread_pool.submit(
+                    copy_support_files, output_dir
+                )
+                results = {
+                    name: pool.apply_async(_run_visualization_task, (name,))
+                    for name in tasks
+                }
+                rank_plot_json = results["rank"].get()
+                sample_plot_json = results["sample"].get()
+                count_json = results["count"].get()
+                index_path = copy_future.result()
+    else:
+        rank_plot_json = gen_rank_plot_json(*tasks["rank"][1])
+        sample_plot_json = gen_sample_plot_json(*tasks["sample"][1])
+        index_path = copy_support_files(output_dir)
+        count_json = gen_count_json(*tasks["count"][1])
+    logging.debug("Finished generating plot JSONs.")
 
     # Write the plot and count JSONs to main.js so that they're loaded when
-    # this Qurro visualization starts up
-    exit_code = replace_js_json_definitions(
+    # this Qurro visualization starts up. We use the original main.js in
+    # support_files/ as a template, and stream the output (overwriting the
+    # copy of main.js in output_dir).
+    write_main_js(
+        os.path.join(get_support_files_loc(), "main.js"),
         os.path.join(output_dir, "main.js"),
         rank_plot_json,
         sample_plot_json,
         count_json,
     )
-    if exit_code != 0:
-        raise ValueError("Wasn't able to replace JSONs and write to main.js.")
+    logging.debug(
+        "main.js is {:,} bytes.".format(
+            os.path.getsize(os.path.join(output_dir, "main.js"))
+        )
+    )
 
     logging.debug("Finished writing the visualization contents.")
 
@@ -6,9 +6,35 @@
 # The full license is in the file LICENSE.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 import logging
+import os
+import uuid
 import q2templates
-from qurro.generate import process_and_generate
-from qurro._df_utils import escape_columns
+from qurro.generate import (
+    check_filtering_options,
+    process_and_generate,
+    process_cached_and_generate,
+)
+from qurro._input_cache import InputCache, hash_df, hash_file
+from qurro._df_utils import escape_columns, load_matching_table
+
+
+def get_artifact_uuid(file_loc):
+    """Returns the UUID of the QIIME 2 artifact a file is in.
+
+       QIIME 2 extracts an artifact's data to a directory named
+       [UUID]/data/, and views of single-file formats (e.g. BIOMV210Format)
+       point to the file in this directory. Since artifacts can't be changed,
+       the UUID identifies the file's contents.
+
+       Returns None if file_loc isn't in an artifact's data directory.
+    """
+    data_dir = os.path.dirname(os.path.abspath(str(file_loc)))
+    if os.path.basename(data_dir) != "data":
+        return None
+    try:
+        return str(uuid.UUID(os.path.basename(os.path.dirname(data_dir))))
+    except ValueError:
+        return None
 
 
 def create_q2_visualization(
@@ -19,6 +45,13 @@ def create_q2_visualization(
     sample_metadata,
     feature_metadata,
     extreme_feature_count,
+    count_shard_size,
+    compress_data,
+    workers,
+    max_output_size,
+    sample_metadata_columns,
+    cache_dir,
+    cache_max_size,
     debug,
 ):
 
@@ -28,6 +61,7 @@ def create_q2_visualization(
     if debug:
         logging.basicConfig(level=logging.DEBUG)
     logging.debug("Starting create_q2_visualization().")
+    check_filtering_options(extreme_feature_count, max_output_size)
     df_feature_metadata = None
     if feature_metadata is not None:
         df_feature_metadata = escape_columns(
@@ -40,15 +74,54 @@ def create_q2_visualization(
 
     feature_ranks = escape_columns(feature_ranks, "feature ranks")
 
-    index_path = process_and_generate(
-        feature_ranks,
-        rank_type,
-        df_sample_metadata,
-        table,
-        output_dir,
-        df_feature_metadata,
-        extreme_feature_count,
-    )
+    output_params = {
+        "extreme_feature_count": extreme_feature_count,
+        "count_shard_size": count_shard_size,
+        "compress_data": compress_data,
+        "workers": workers,
+        "max_output_size": max_output_size,
+        "sample_metadata_columns": sample_metadata_columns,
+    }
+    # The table is passed in as the BIOM file in its artifact, so (as in the
+    # standalone script) we only need to load the parts of it that match the
+    # feature ranks and sample metadata -- and only on a cache miss.
+    table_loc = str(table)
+
+    def load_input():
+        return (
+            feature_ranks,
+            rank_type,
+            df_sample_metadata,
+            load_matching_table(table_loc, feature_ranks, df_sample_metadata),
+        )
+
+    if cache_dir is None:
+        index_path = process_and_generate(
+            *load_input(), output_dir, df_feature_metadata, **output_params
+        )
+    else:
+        # The table is identified by its artifact's UUID, so we don't need to
+        # read it to get the cache key. (The feature ranks and sample
+        # metadata have already been loaded by QIIME 2, so we hash them.)
+        table_uuid = get_artifact_uuid(table_loc)
+        if table_uuid is None:
+            table_id = hash_file(table_loc)
+        else:
+            table_id = "artifact:" + table_uuid
+        cache_key = InputCache.make_key(
+            rank_type,
+            hash_df(feature_ranks),
+            table_id,
+            hash_df(df_sample_metadata),
+        )
+        index_path = process_cached_and_generate(
+            load_input,
+            InputCache(cache_dir, cache_max_size * 1024 ** 2),
+            cache_key,
+            output_dir,
+            df_feature_metadata,
+            **output_params
+        )
     # render the visualization using q2templates.render().
     # TODO: do we need to specify plot_name in the context in this way? I'm not
     # sure where it is being used in the first place, honestly.
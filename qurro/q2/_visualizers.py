@@ -8,7 +8,7 @@
 import qiime2
 import skbio
 import pandas as pd
-import biom
+from q2_types.feature_table import BIOMV210Format
 from .._rank_utils import rename_loadings
 from ._visualizer_utils import create_q2_visualization
 
@@ -16,10 +16,17 @@ from ._visualizer_utils import create_q2_visualization
 def differential_plot(
     output_dir: str,
     ranks: pd.DataFrame,
-    table: biom.Table,
+    table: BIOMV210Format,
     sample_metadata: qiime2.Metadata,
     feature_metadata: qiime2.Metadata = None,
     extreme_feature_count: int = None,
+    count_shard_size: int = None,
+    compress_data: bool = False,
+    workers: int = 1,
+    max_output_size: int = None,
+    sample_metadata_columns: list = None,
+    cache_dir: str = None,
+    cache_max_size: int = 1024,
     debug: bool = False,
 ) -> None:
     """Generates a Qurro visualization using differentials.
@@ -37,6 +44,13 @@ def differential_plot(
         sample_metadata,
         feature_metadata,
         extreme_feature_count,
+        count_shard_size,
+        compress_data,
+        workers,
+        max_output_size,
+        sample_metadata_columns,
+        cache_dir,
+        cache_max_size,
         debug,
     )
 
@@ -44,10 +58,17 @@ def differential_plot(
 def loading_plot(
     output_dir: str,
     ranks: skbio.OrdinationResults,
-    table: biom.Table,
+    table: BIOMV210Format,
     sample_metadata: qiime2.Metadata,
     feature_metadata: qiime2.Metadata = None,
     extreme_feature_count: int = None,
+    count_shard_size: int = None,
+    compress_data: bool = False,
+    workers: int = 1,
+    max_output_size: int = None,
+    sample_metadata_columns: list = None,
+    cache_dir: str = None,
+    cache_max_size: int = 1024,
     debug: bool = False,
 ) -> None:
     """Generates a Qurro visualization using feature loadings in a biplot."""
@@ -60,5 +81,12 @@ def loading_plot(
         sample_metadata,
         feature_metadata,
         extreme_feature_count,
+        count_shard_size,
+        compress_data,
+        workers,
+        max_output_size,
+        sample_metadata_columns,
+        cache_dir,
+        cache_max_size,
         debug,
     )
@@ -12,16 +12,39 @@ import importlib
 import qiime2.plugin
 import qiime2.sdk
 from qurro import __version__
-from qurro.qarcoal import qarcoal
+from qurro.qarcoal import (
+    qarcoal,
+    qarcoal_batch,
+    qarcoal_pairwise,
+    PAIR_SORT_KEYS,
+)
+from qurro._taxonomy_index import MATCH_MODES
 from ._visualizers import differential_plot, loading_plot
 from qurro._parameter_descriptions import (
     TABLE,
     EXTREME_FEATURE_COUNT,
+    COUNT_SHARD_SIZE,
+    COMPRESS_DATA,
+    WORKERS,
+    MAX_OUTPUT_SIZE,
+    SAMPLE_METADATA_COLUMNS,
+    CACHE_DIR,
+    CACHE_MAX_SIZE,
     DEBUG,
     Q2_SAMPLE_METADATA,
     Q2_FEATURE_METADATA,
 )
-from qiime2.plugin import Metadata, Properties, Int, Bool, Str, Citations
+from qiime2.plugin import (
+    Metadata,
+    Properties,
+    Int,
+    Bool,
+    Str,
+    List,
+    Range,
+    Choices,
+    Citations,
+)
 from ._type import LogRatios, LogRatiosDirFmt, LogRatiosFormat
 from qurro import _qarcoal_param_descriptions as QPD
 from q2_types.feature_data import Taxonomy
@@ -67,6 +90,13 @@ params = {
     "sample_metadata": Metadata,
     "feature_metadata": Metadata,
     "extreme_feature_count": Int,
+    "count_shard_size": Int % Range(1, None),
+    "compress_data": Bool,
+    "workers": Int % Range(1, None),
+    "max_output_size": Int % Range(1, None),
+    "sample_metadata_columns": List[Str],
+    "cache_dir": Str,
+    "cache_max_size": Int % Range(0, None),
     "debug": Bool,
 }
 
@@ -74,6 +104,13 @@ param_descs = {
     "sample_metadata": Q2_SAMPLE_METADATA,
     "feature_metadata": Q2_FEATURE_METADATA,
     "extreme_feature_count": EXTREME_FEATURE_COUNT,
+    "count_shard_size": COUNT_SHARD_SIZE,
+    "compress_data": COMPRESS_DATA,
+    "workers": WORKERS,
+    "max_output_size": MAX_OUTPUT_SIZE,
+    "sample_metadata_columns": SAMPLE_METADATA_COLUMNS,
+    "cache_dir": CACHE_DIR,
+    "cache_max_size": CACHE_MAX_SIZE,
     "debug": DEBUG
     + (
         " Note that you'll also need to use the --verbose option to see these "
@@ -122,6 +159,7 @@ qarcoal_params = {
     "denom_string": Str,
     "samples_to_use": Metadata,
     "allow_shared_features": Bool,
+    "match_mode": Str % Choices(MATCH_MODES),
 }
 
 qarcoal_param_descs = {
@@ -129,6 +167,7 @@ qarcoal_param_descs = {
     "denom_string": QPD.QARCOAL_DENOM,
     "samples_to_use": QPD.QARCOAL_SMP_TO_USE,
     "allow_shared_features": QPD.QARCOAL_SHARED_FEAT,
+    "match_mode": QPD.QARCOAL_MATCH_MODE,
 }
 
 plugin.methods.register_function(
@@ -149,6 +188,72 @@ plugin.methods.register_function(
 )
 
 
+qarcoal_batch_params = {
+    "queries": Metadata,
+    "samples_to_use": Metadata,
+    "allow_shared_features": Bool,
+    "match_mode": Str % Choices(MATCH_MODES),
+}
+
+qarcoal_batch_param_descs = {
+    "queries": QPD.QARCOAL_QUERIES,
+    "samples_to_use": QPD.QARCOAL_SMP_TO_USE,
+    "allow_shared_features": QPD.QARCOAL_BATCH_SHARED_FEAT,
+    "match_mode": QPD.QARCOAL_MATCH_MODE,
+}
+
+plugin.methods.register_function(
+    function=qarcoal_batch,
+    inputs={
+        "table": FeatureTable[Frequency],
+        "taxonomy": FeatureData[Taxonomy],
+    },
+    parameters=qarcoal_batch_params,
+    parameter_descriptions=qarcoal_batch_param_descs,
+    input_descriptions={
+        "table": QPD.QARCOAL_TBL,
+        "taxonomy": QPD.QARCOAL_TAXONOMY,
+    },
+    outputs=[("qarcoal_log_ratios", SampleData[LogRatios])],
+    description=QPD.QARCOAL_BATCH_DESC,
+    name="Compute many feature log-ratios based on taxonomy searching.",
+)
+
+
+qarcoal_pairwise_params = {
+    "level": Int % Range(0, None),
+    "top_k": Int % Range(1, None),
+    "sort_by": Str % Choices(PAIR_SORT_KEYS),
+    "min_samples": Int % Range(1, None),
+    "samples_to_use": Metadata,
+}
+
+qarcoal_pairwise_param_descs = {
+    "level": QPD.QARCOAL_LEVEL,
+    "top_k": QPD.QARCOAL_TOP_K,
+    "sort_by": QPD.QARCOAL_SORT_BY,
+    "min_samples": QPD.QARCOAL_MIN_SAMPLES,
+    "samples_to_use": QPD.QARCOAL_SMP_TO_USE,
+}
+
+plugin.methods.register_function(
+    function=qarcoal_pairwise,
+    inputs={
+        "table": FeatureTable[Frequency],
+        "taxonomy": FeatureData[Taxonomy],
+    },
+    parameters=qarcoal_pairwise_params,
+    parameter_descriptions=qarcoal_pairwise_param_descs,
+    input_descriptions={
+        "table": QPD.QARCOAL_TBL,
+        "taxonomy": QPD.QARCOAL_TAXONOMY,
+    },
+    outputs=[("qarcoal_log_ratios", SampleData[LogRatios])],
+    description=QPD.QARCOAL_PAIRWISE_DESC,
+    name="Compute log-ratios of the top pairs of taxa at a taxonomy level.",
+)
+
+
 # this line may be necessary to register transformers
 # found in songbird's plugin_setup file as well as Q2 forum post
 # https://github.com/biocore/songbird/blob/master/songbird/q2/plugin_setup.py
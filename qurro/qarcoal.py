@@ -9,89 +9,333 @@
 # Generates table of sample-level Numerator:Denominator log-ratios.
 # ----------------------------------------------------------------------------
 
+import logging
+import os
+import tempfile
+from collections import deque
+from multiprocessing import Pool
 import biom
+import h5py
 import numpy as np
 import pandas as pd
-from qiime2 import Metadata
+from scipy.sparse import csc_matrix
+from qurro._table_utils import (
+    SparseTable,
+    read_hdf5_ids,
+    read_hdf5_sample_block,
+)
+from qurro._taxonomy_index import TaxonomyIndex
 
+# Qarcoal can also be run outside of QIIME 2 (see qurro.scripts._qarcoal);
+# qiime2.Metadata is only needed for the QIIME 2 methods' type annotations.
+try:
+    from qiime2 import Metadata
+except ImportError:
+    Metadata = None
 
-def filter_and_join_taxonomy(feat_table, taxonomy, num_string, denom_string):
-    """Perform taxonomy searching and join with feature table.
+# Columns that a table of batch Qarcoal queries needs to have (in addition to
+# its index, which contains the queries' names)
+QUERY_COLUMNS = ("numerator", "denominator")
+
+# Default number of samples read at once by streamed Qarcoal
+DEFAULT_SAMPLE_BLOCK_SIZE = 10000
+
+# Statistics that pairwise Qarcoal can sort taxon pairs by (in descending
+# order) when choosing the top pairs. See get_pair_stats().
+PAIR_SORT_KEYS = ("mean", "std", "n_samples")
+
+# Default number of taxon pairs whose log-ratios are computed at once by
+# pairwise Qarcoal
+DEFAULT_PAIR_CHUNK_SIZE = 1000
+
+
+def get_taxonomy_index(taxonomy):
+    """Returns a TaxonomyIndex of a taxonomy.
+
+    (If taxonomy is already a TaxonomyIndex, it's just returned.)
+    """
+    if isinstance(taxonomy, TaxonomyIndex):
+        return taxonomy
+    return TaxonomyIndex.from_taxonomy(taxonomy)
+
+
+def get_taxonomy_masks(
+    taxonomy_index, taxon_codes, num_string, denom_string, match_mode="regex"
+):
+    """Finds the features whose taxonomy matches the numerator/denominator.
+
+    Parameters:
+    -----------
+        taxonomy_index: TaxonomyIndex of the taxonomy
+        taxon_codes: np.ndarray of the taxon code of each feature in a feature
+            table (see TaxonomyIndex.get_taxon_codes())
+        num_string: numerator string to search for in taxonomy
+        denom_string: denominator string to search for in taxonomy
+        match_mode: how to match the strings against the taxonomy; one of
+            _taxonomy_index.MATCH_MODES
+
+    Returns:
+    --------
+        num_mask: np.ndarray of bools, True for each feature whose taxonomy
+            contains num_string
+        denom_mask: np.ndarray of bools, same as num_mask but for
+            denom_string
+
+        Features that aren't in the taxonomy are in neither mask.
+
+    Raises:
+    -------
+        ValueError: if no features match num_string and/or denom_string
+    """
+    num_mask = taxonomy_index.feature_mask(num_string, taxon_codes, match_mode)
+    denom_mask = taxonomy_index.feature_mask(
+        denom_string, taxon_codes, match_mode
+    )
+
+    if not num_mask.any():
+        if not denom_mask.any():
+            raise ValueError(
+                "No feature(s) found matching either numerator or "
+                "denominator string!"
+            )
+        else:
+            raise ValueError("No feature(s) found matching numerator string!")
+    if not denom_mask.any():
+        raise ValueError("No feature(s) found matching denominator string!")
+    return num_mask, denom_mask
+
+
+def check_any_shared_samples(sample_mask):
+    """Raises an error if no samples contain both num and denom features."""
+    if not sample_mask.any():
+        raise ValueError(
+            "No samples contain both numerator and denominator features!"
+        )
+
+
+def filter_and_join_taxonomy(
+    feat_table, taxonomy, num_string, denom_string, match_mode="regex"
+):
+    """Perform taxonomy searching on a dense feature table.
+
+    (qarcoal() doesn't use this, since it works with the sparse counts
+    directly; this is mostly useful for inspecting which features and samples
+    would be used for a log-ratio.)
 
     Parameters:
     -----------
         feat_table: pd.DataFrame of features x samples
-        taxonomy: pd.DataFrame of features x [Taxon, ...]
+        taxonomy: pd.DataFrame of features x [Taxon, ...], or a TaxonomyIndex
         num_string: numerator string to search for in taxonomy
         denom_string: denominator string to search for in taxonomy
+        match_mode: see get_taxonomy_masks()
 
     Returns:
     --------
         num_df: pd.DataFrame of numerator features x samples
         denom_df: pd.DataFrame of denominator features x samples
     """
+    taxonomy_index = get_taxonomy_index(taxonomy)
+    num_mask, denom_mask = get_taxonomy_masks(
+        taxonomy_index,
+        taxonomy_index.get_taxon_codes(feat_table.index),
+        num_string,
+        denom_string,
+        match_mode,
+    )
+    tax_num_df = feat_table.loc[num_mask]
+    tax_denom_df = feat_table.loc[denom_mask]
 
-    # drop samples with total 0 features
-    # this is done here as well as later on based on samples w/o
-    # matching features because of some problems with filtering
-    # introducing NAs
-    feat_table_copy = feat_table.loc[:, (feat_table != 0).any(axis=0)]
+    # keep only samples in which both numerator and denominator features are
+    # present. (If feat_table has sparse columns, as biom's to_dataframe()
+    # returns, filtering rows can turn the entries of samples without any
+    # nonzero counts into NaNs -- so we treat NaNs as zeros here.)
+    samp_to_keep = (tax_num_df.fillna(0) != 0).any(axis=0).values & (
+        tax_denom_df.fillna(0) != 0
+    ).any(axis=0).values
+    check_any_shared_samples(samp_to_keep)
 
-    # need to keep Taxon temporarily to match up with feature table
-    # can immediately discard non-Taxon columns
-    taxonomy = taxonomy.copy()
-    taxonomy = taxonomy[["Taxon"]]
+    tax_num_df = tax_num_df.loc[:, samp_to_keep]
+    tax_denom_df = tax_denom_df.loc[:, samp_to_keep]
+    return tax_num_df, tax_denom_df
 
-    # retain only features that are in both feature table and taxonomy
-    # rsuffix provided in unlikely case that a sample is called Taxon
-    taxonomy_joined_df = taxonomy.join(
-        feat_table_copy, how="inner", rsuffix="_q"
-    )
 
-    num_indices = taxonomy_joined_df["Taxon"].str.contains(num_string)
-    denom_indices = taxonomy_joined_df["Taxon"].str.contains(denom_string)
+def _raise_query_error(err, query_name):
+    """Re-raises a ValueError about a query, mentioning the query's name.
 
-    tax_num_df = taxonomy_joined_df.loc[num_indices]
-    tax_denom_df = taxonomy_joined_df.loc[denom_indices]
+       (If query_name is None, the error is just re-raised as is: this is
+       the case for single-query Qarcoal.)
+    """
+    if query_name is None:
+        raise err
+    raise ValueError('Query "{}": {}'.format(query_name, err)) from err
 
-    # want to drop Taxon column because we want the dfs to be only numeric
-    tax_num_df.drop(columns="Taxon", inplace=True)
-    tax_denom_df.drop(columns="Taxon", inplace=True)
 
-    # if _q suffix was added due to sample called Taxon, change back to Taxon
-    if "Taxon_q" in taxonomy_joined_df:
-        tax_num_df.rename(columns={"Taxon_q": "Taxon"}, inplace=True)
-        tax_denom_df.rename(columns={"Taxon_q": "Taxon"}, inplace=True)
+def get_query_masks(feature_ids, taxonomy, queries, match_mode="regex"):
+    """Finds the numerator and denominator features of Qarcoal queries.
 
-    if tax_num_df.shape[0] == 0:
-        if tax_denom_df.shape[0] == 0:
-            raise ValueError(
-                "No feature(s) found matching either numerator or "
-                "denominator string!"
+    Parameters:
+    -----------
+        feature_ids: list-like of the IDs of the features in a feature table
+        taxonomy: pd.DataFrame with taxonomy information, or a TaxonomyIndex
+        queries: list of (name, num_string, denom_string) tuples. If name is
+            None, errors about this query won't mention its name.
+        match_mode: see get_taxonomy_masks()
+
+    Returns:
+    --------
+        num_masks: list of np.ndarrays of bools, one per query, denoting each
+            query's numerator features
+        denom_masks: list, same as num_masks but for denominator features
+    """
+    taxonomy_index = get_taxonomy_index(taxonomy)
+    taxon_codes = taxonomy_index.get_taxon_codes(feature_ids)
+    num_masks = []
+    denom_masks = []
+    for name, num_string, denom_string in queries:
+        try:
+            num_mask, denom_mask = get_taxonomy_masks(
+                taxonomy_index,
+                taxon_codes,
+                num_string,
+                denom_string,
+                match_mode,
             )
-        else:
-            raise ValueError("No feature(s) found matching numerator string!")
-    if tax_denom_df.shape[0] == 0:
-        raise ValueError("No feature(s) found matching denominator string!")
+        except ValueError as err:
+            _raise_query_error(err, name)
+        num_masks.append(num_mask)
+        denom_masks.append(denom_mask)
+    return num_masks, denom_masks
 
-    # drop columns (samples) in which no feature(s) matching string is present
-    tax_num_df = tax_num_df.loc[:, (tax_num_df != 0).any(axis=0)]
-    tax_denom_df = tax_denom_df.loc[:, (tax_denom_df != 0).any(axis=0)]
 
-    # keep only intersection of samples in which each feature string
-    #  is present
-    samp_to_keep = set(tax_num_df.columns).intersection(
-        set(tax_denom_df.columns)
+def get_indicator_matrix(num_masks, denom_masks):
+    """Returns a sparse matrix of features x (2 * # queries).
+
+    Column q of this matrix marks query q's numerator features, and column
+    (# queries + q) marks its denominator features. Multiplying a (samples x
+    features) matrix of counts by this matrix gives every query's numerator
+    and denominator sums in every sample.
+
+    The matrix is built directly from the masks' nonzero positions, so no
+    dense (features x queries) array is ever created.
+    """
+    masks = num_masks + denom_masks
+    indices = [np.flatnonzero(mask) for mask in masks]
+    indptr = np.zeros(len(masks) + 1, dtype=np.int64)
+    np.cumsum([len(i) for i in indices], out=indptr[1:])
+    return csc_matrix(
+        (np.ones(indptr[-1]), np.concatenate(indices), indptr),
+        shape=(len(masks[0]), len(masks)),
     )
 
-    if not samp_to_keep:
-        raise ValueError(
-            "No samples contain both numerator and denominator features!"
+
+def check_shared_features(
+    num_masks, denom_masks, queries, allow_shared_features
+):
+    """Raises an error if any query's numerator and denominator share
+    features (unless allow_shared_features is True).
+    """
+    # if shared features are disallowed, check to make sure they don't occur
+    # if allowed, can skip this step at user's risk
+    if not allow_shared_features:
+        for q, (name, _, _) in enumerate(queries):
+            if (num_masks[q] & denom_masks[q]).any():
+                _raise_query_error(
+                    ValueError("Shared features between num and denom!"), name
+                )
+
+
+def check_query_samples(query_has_samples, queries):
+    """Raises an error if any query doesn't have any samples containing both
+    its numerator and denominator features.
+    """
+    for q, (name, _, _) in enumerate(queries):
+        try:
+            check_any_shared_samples(query_has_samples[q : q + 1])
+        except ValueError as err:
+            _raise_query_error(err, name)
+
+
+def get_query_sums(
+    table,
+    taxonomy,
+    queries,
+    sample_ids=None,
+    allow_shared_features=False,
+    match_mode="regex",
+):
+    """Computes the numerator and denominator sums of Qarcoal queries.
+
+    All of the queries are evaluated at once, by multiplying the table's
+    sparse counts with a sparse matrix of numerator and denominator feature
+    indicators (see get_indicator_matrix()). The table is never converted to
+    a dense DataFrame.
+
+    Parameters:
+    -----------
+        table: biom.Table of features x samples
+        taxonomy: pd.DataFrame with taxonomy information (should have Taxon
+            column in which features will be searched), or a TaxonomyIndex
+        queries: list of (name, num_string, denom_string) tuples. If name is
+            None, errors about this query won't mention its name.
+        sample_ids: collection of sample IDs. If provided, only these samples
+            in the table will be used. (optional)
+        allow_shared_features: bool; see qarcoal().
+        match_mode: see get_taxonomy_masks()
+
+    Returns:
+    --------
+        sample_ids: pd.Index of the IDs of the samples in the table (after
+            filtering to sample_ids, if provided)
+        num_sums: np.ndarray of shape (# samples, # queries), containing the
+            numerator sum of each query in each sample
+        denom_sums: np.ndarray, same as num_sums but for the denominators
+
+    Raises:
+    -------
+        ValueError: if the table has negative counts, or if any query would
+            cause an error in single-query Qarcoal. Errors are checked for
+            in the same order as in single-query Qarcoal: negative counts,
+            then queries without matching features, then queries without
+            any samples containing both their numerator and denominator
+            features, then queries with shared features.
+    """
+    # biom table is features x samples
+    feat_table = SparseTable.from_biom(table)
+    if sample_ids is not None:
+        feat_table = feat_table.filter(
+            sample_mask=feat_table.sample_ids.isin(set(sample_ids))
         )
 
-    tax_num_df = tax_num_df[samp_to_keep]
-    tax_denom_df = tax_denom_df[samp_to_keep]
-    return tax_num_df, tax_denom_df
+    # raise error if there are any negative counts in the feature table
+    if (feat_table.matrix.data < 0).any():
+        raise ValueError("Feature table has negative counts!")
+
+    num_masks, denom_masks = get_query_masks(
+        feat_table.feature_ids, taxonomy, queries, match_mode
+    )
+
+    logging.debug(
+        "Computing the sums of {} Qarcoal quer{}.".format(
+            len(queries), "y" if len(queries) == 1 else "ies"
+        )
+    )
+    sums = feat_table.matrix.T.dot(
+        get_indicator_matrix(num_masks, denom_masks)
+    ).toarray()
+    num_sums = sums[:, : len(queries)]
+    denom_sums = sums[:, len(queries) :]
+
+    # Since there aren't any negative counts, a sample contains numerator
+    # (or denominator) features iff its numerator (or denominator) sum is
+    # positive.
+    samp_to_keep = (num_sums > 0) & (denom_sums > 0)
+    check_query_samples(samp_to_keep.any(axis=0), queries)
+    check_shared_features(
+        num_masks, denom_masks, queries, allow_shared_features
+    )
+
+    return feat_table.sample_ids, num_sums, denom_sums
 
 
 def qarcoal(
@@ -101,9 +345,13 @@ def qarcoal(
     denom_string: str,
     samples_to_use: Metadata = None,
     allow_shared_features: bool = False,
+    match_mode: str = "regex",
 ) -> pd.DataFrame:
     """Calculate sample-wise log-ratios of features based on taxonomy.
 
+    This works directly with the table's sparse counts (see
+    get_query_sums()), so the table is never converted to a dense DataFrame.
+
     Parameters:
     -----------
         table: biom file with which to calculate log ratios
@@ -118,47 +366,731 @@ def qarcoal(
             between numerator and denominator. If False, an error is raised
             if features are shared between numerator and denominator. If True,
             will allow shared features without throwing an error.
+        match_mode: how num_string and denom_string are matched against the
+            taxonomy. "regex" (the default) treats them as regular
+            expressions; "literal" looks for them as literal substrings (this
+            is faster); and "rank" looks for taxonomic ranks exactly equal to
+            them.
     Returns:
     --------
         comparison_df: pd DataFrame in the form:
 
             Sample-ID    Num_Sum    Denom_Sum   log_ratio
                    S1          7           15   -0.762140
+
+        Samples are in the same order as in the table.
     """
+    sample_ids = None
+    if samples_to_use is not None:
+        sample_ids = samples_to_use.to_dataframe().index
 
-    # biom table is features x samples
+    sample_ids, num_sums, denom_sums = get_query_sums(
+        table,
+        taxonomy,
+        [(None, num_string, denom_string)],
+        sample_ids,
+        allow_shared_features,
+        match_mode,
+    )
+    num_sums = num_sums[:, 0]
+    denom_sums = denom_sums[:, 0]
+    samp_to_keep = (num_sums > 0) & (denom_sums > 0)
+
+    comparison_df = pd.DataFrame(
+        {
+            "Num_Sum": num_sums[samp_to_keep],
+            "Denom_Sum": denom_sums[samp_to_keep],
+        },
+        index=sample_ids[samp_to_keep],
+    )
+    comparison_df["log_ratio"] = np.log(
+        comparison_df["Num_Sum"].values / comparison_df["Denom_Sum"].values
+    )
+    comparison_df.index.name = "Sample-ID"
+
+    return comparison_df
+
+
+def validate_queries(queries):
+    """Checks a DataFrame of batch Qarcoal queries.
+
+    Parameters:
+    -----------
+        queries: pd.DataFrame, indexed by the queries' names, with (at least)
+            the columns in QUERY_COLUMNS
+
+    Returns:
+    --------
+        list of (name, num_string, denom_string) tuples, one per query (in
+        the same order as in queries)
+
+    Raises:
+    -------
+        ValueError: if queries is empty, if a required column is missing, or
+            if any of the queries' names or strings are missing or duplicated
+    """
+    missing_cols = [c for c in QUERY_COLUMNS if c not in queries.columns]
+    if missing_cols:
+        raise ValueError(
+            "The Qarcoal queries are missing the following column(s): "
+            "{}".format(", ".join(missing_cols))
+        )
+    if len(queries.index) == 0:
+        raise ValueError("No Qarcoal queries were specified.")
+    if queries.index.has_duplicates:
+        raise ValueError(
+            "Qarcoal query names must be unique. Duplicate name(s): "
+            "{}".format(
+                ", ".join(map(str, queries.index[queries.index.duplicated()]))
+            )
+        )
+    query_strings = queries[list(QUERY_COLUMNS)]
+    missing_strings = query_strings.isna().any(axis=1)
+    if missing_strings.any():
+        raise ValueError(
+            "Missing numerator/denominator string(s) for the Qarcoal "
+            "quer(ies): {}".format(
+                ", ".join(map(str, queries.index[missing_strings]))
+            )
+        )
+    return [
+        (str(name), str(num_string), str(denom_string))
+        for name, num_string, denom_string in query_strings.itertuples()
+    ]
+
+
+def batch_log_ratios(
+    table,
+    taxonomy,
+    queries,
+    sample_ids=None,
+    allow_shared_features=False,
+    match_mode="regex",
+):
+    """Calculates the log-ratios of many Qarcoal queries at once.
+
+    This is the same as calling qarcoal() once per query, except that the
+    table and taxonomy only need to be processed once.
+
+    Parameters:
+    -----------
+        table: biom.Table of features x samples
+        taxonomy: pd.DataFrame with taxonomy information (should have Taxon
+            column in which features will be searched), or a TaxonomyIndex
+            of it (e.g. one loaded from disk)
+        queries: pd.DataFrame, indexed by the queries' names, with the columns
+            "numerator" and "denominator" (containing each query's numerator
+            and denominator strings to search for in the taxonomy)
+        sample_ids: collection of sample IDs. If provided, only these samples
+            in the table will be used. (optional)
+        allow_shared_features: bool; see qarcoal(). This applies to every
+            query.
+        match_mode: see qarcoal(). This applies to every query.
+
+    Returns:
+    --------
+        pd.DataFrame of samples x queries, in the form:
+
+            Sample-ID    Query1      Query2
+                   S1    -0.762140   1.203973
+                   S2    NaN         0.693147
+
+        Each query's column contains the log-ratios that qarcoal() would
+        return for this query; samples that qarcoal() would drop for a
+        query (since they don't contain both numerator and denominator
+        features) have a log-ratio of NaN for this query. Samples that would
+        be dropped for every query are omitted.
+
+        Samples are in the same order as in the table, and queries are in the
+        same order as in the queries DataFrame.
+
+    Raises:
+    -------
+        ValueError: if the queries are invalid (see validate_queries()), or
+            if any query would cause an error in qarcoal(). The error
+            message will mention the problematic query's name.
+    """
+    query_list = validate_queries(queries)
+    sample_ids, num_sums, denom_sums = get_query_sums(
+        table,
+        taxonomy,
+        query_list,
+        sample_ids,
+        allow_shared_features,
+        match_mode,
+    )
+    return get_query_log_ratios(
+        sample_ids, num_sums, denom_sums, [name for name, _, _ in query_list]
+    )
+
+
+def get_query_log_ratios(sample_ids, num_sums, denom_sums, query_names):
+    """Converts Qarcoal queries' sums to a samples x queries DataFrame of
+    log-ratios (see batch_log_ratios() for details).
+    """
+    samp_to_keep = (num_sums > 0) & (denom_sums > 0)
+
+    # Only compute log-ratios for the samples that qarcoal() wouldn't drop
+    ratios = np.divide(
+        num_sums,
+        denom_sums,
+        out=np.full(num_sums.shape, np.nan),
+        where=samp_to_keep,
+    )
+    log_ratios = np.log(ratios, out=ratios, where=samp_to_keep)
+
+    nonempty_samples = samp_to_keep.any(axis=1)
+    log_ratio_df = pd.DataFrame(
+        log_ratios[nonempty_samples],
+        index=sample_ids[nonempty_samples],
+        columns=query_names,
+    )
+    log_ratio_df.index.name = "Sample-ID"
+    return log_ratio_df
+
+
+def qarcoal_batch(
+    table: biom.Table,
+    taxonomy: pd.DataFrame,
+    queries: Metadata,
+    samples_to_use: Metadata = None,
+    allow_shared_features: bool = False,
+    match_mode: str = "regex",
+) -> pd.DataFrame:
+    """Calculate sample-wise log-ratios for many taxonomy queries at once.
+
+    This is the QIIME 2 interface to batch_log_ratios().
+
+    Parameters:
+    -----------
+        table: biom file with which to calculate log ratios
+        taxonomy: pd.DataFrame with taxonomy information (should have Taxon
+            column in which features will be searched)
+        queries: Q2 Metadata file of queries. Its IDs are the queries' names,
+            and it should have "numerator" and "denominator" columns.
+        samples_to_use: Q2 Metadata file with samples to use.
+            If provided, feature table will be filtered to only consider
+            samples present in this file. (optional)
+        allow_shared_features: see qarcoal().
+        match_mode: see qarcoal().
+    Returns:
+    --------
+        pd.DataFrame of samples x queries; see batch_log_ratios().
+    """
+    sample_ids = None
     if samples_to_use is not None:
-        filt_samples = set(samples_to_use.to_dataframe().index)
-        feat_table = table.filter(filt_samples, axis="sample", inplace=False)
-        feat_table = feat_table.to_dataframe()
-    else:
-        feat_table = table.to_dataframe()
+        sample_ids = samples_to_use.to_dataframe().index
+    return batch_log_ratios(
+        table,
+        taxonomy,
+        queries.to_dataframe(),
+        sample_ids,
+        allow_shared_features,
+        match_mode,
+    )
 
-    # raise error if there are any negative counts in the feature table
-    if feat_table.lt(0).any().any():
+
+def _sum_sample_block(h5grp, indicators, start, sample_mask):
+    """Computes the query sums of a block of samples in an HDF5 BIOM table.
+
+    Returns:
+    --------
+        sums: np.ndarray of shape (# samples in block, 2 * # queries)
+        has_negative: bool, True if the block contains any negative counts
+    """
+    block = read_hdf5_sample_block(h5grp, start, sample_mask)
+    return block.dot(indicators).toarray(), bool((block.data < 0).any())
+
+
+# The open table and indicator matrix used by each streaming worker process.
+# These are set once per worker by _init_block_worker(), so that they don't
+# need to be reopened or pickled for every block.
+_worker_state = {}
+
+
+def _init_block_worker(table_loc, indicators):
+    _worker_state["h5grp"] = h5py.File(table_loc, "r")
+    _worker_state["indicators"] = indicators
+
+
+def _sum_worker_block(start, sample_mask):
+    return _sum_sample_block(
+        _worker_state["h5grp"], _worker_state["indicators"], start, sample_mask
+    )
+
+
+def _iter_block_sums(table_loc, indicators, blocks, workers):
+    """Runs _sum_sample_block() on each of a sequence of (start, sample_mask)
+    tuples, yielding the results in order.
+
+    If workers > 1, blocks are processed in parallel. Each worker process
+    opens the table and receives the indicator matrix once, when it starts.
+    At most 2 * workers blocks are in progress (or waiting to be yielded) at
+    once, so memory use doesn't depend on the number of blocks.
+    """
+    if workers <= 1:
+        with h5py.File(table_loc, "r") as h5grp:
+            for start, sample_mask in blocks:
+                yield _sum_sample_block(h5grp, indicators, start, sample_mask)
+        return
+    with Pool(
+        workers,
+        initializer=_init_block_worker,
+        initargs=(table_loc, indicators),
+    ) as pool:
+        pending = deque()
+        for block in blocks:
+            pending.append(pool.apply_async(_sum_worker_block, block))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def iter_streamed_log_ratios(
+    table_loc,
+    taxonomy,
+    queries,
+    sample_ids=None,
+    allow_shared_features=False,
+    match_mode="regex",
+    block_size=DEFAULT_SAMPLE_BLOCK_SIZE,
+    workers=1,
+):
+    """Calculates the log-ratios of Qarcoal queries, one block of samples at
+    a time.
+
+    This is like batch_log_ratios(), but the table is never fully loaded:
+    it's read from an HDF5 BIOM file in blocks of block_size samples, so
+    memory use depends on the block size (and the number of features) rather
+    than on the number of samples. Blocks can be processed in parallel by
+    multiple worker processes.
+
+    Parameters:
+    -----------
+        table_loc: location of an HDF5 BIOM table
+        taxonomy, queries, sample_ids, allow_shared_features, match_mode:
+            see batch_log_ratios()
+        block_size: int, number of samples (in the table) per block
+        workers: int, number of processes to use for reading and summing
+            blocks
+
+    Yields:
+    -------
+        pd.DataFrame of samples x queries, for each block of samples (in
+        order). Concatenating these gives the same output as
+        batch_log_ratios().
+
+    Raises:
+    -------
+        ValueError: for the same reasons as batch_log_ratios(). Errors that
+            depend on the table's counts (negative counts, or a query
+            without any samples containing both its numerator and
+            denominator features) are only detected while or after reading
+            the table, so some blocks may already have been yielded. Since
+            shared features are checked for before reading the table, if
+            several queries are invalid the error raised may differ from
+            batch_log_ratios()'s.
+    """
+    query_list = validate_queries(queries)
+    query_ct = len(query_list)
+    if sample_ids is not None:
+        sample_ids = set(sample_ids)
+
+    with h5py.File(table_loc, "r") as h5grp:
+        feature_ids = read_hdf5_ids(h5grp, "observation")
+        sample_ct = int(h5grp.attrs["shape"][1])
+    num_masks, denom_masks = get_query_masks(
+        feature_ids, taxonomy, query_list, match_mode
+    )
+    check_shared_features(
+        num_masks, denom_masks, query_list, allow_shared_features
+    )
+    indicators = get_indicator_matrix(num_masks, denom_masks)
+    query_names = [name for name, _, _ in query_list]
+
+    # Sample IDs are read one block at a time, in this process, so that the
+    # full list of sample IDs is never held in memory
+    block_ids = deque()
+
+    def get_blocks(h5grp):
+        for start in range(0, sample_ct, block_size):
+            ids = read_hdf5_ids(h5grp, "sample", start, start + block_size)
+            if sample_ids is None:
+                sample_mask = np.ones(len(ids), dtype=bool)
+            else:
+                sample_mask = ids.isin(sample_ids)
+            block_ids.append(ids[sample_mask])
+            yield start, sample_mask
+
+    logging.debug(
+        "Streaming {} samples in blocks of {}, using {} worker(s).".format(
+            sample_ct, block_size, workers
+        )
+    )
+    query_has_samples = np.zeros(query_ct, dtype=bool)
+    with h5py.File(table_loc, "r") as h5grp:
+        for sums, has_negative in _iter_block_sums(
+            table_loc, indicators, get_blocks(h5grp), workers
+        ):
+            if has_negative:
+                raise ValueError("Feature table has negative counts!")
+            num_sums = sums[:, :query_ct]
+            denom_sums = sums[:, query_ct:]
+            query_has_samples |= ((num_sums > 0) & (denom_sums > 0)).any(
+                axis=0
+            )
+            yield get_query_log_ratios(
+                block_ids.popleft(), num_sums, denom_sums, query_names
+            )
+    check_query_samples(query_has_samples, query_list)
+
+
+def write_streamed_log_ratios(output_loc, *args, **kwargs):
+    """Writes the output of iter_streamed_log_ratios() to a TSV file.
+
+    Each block of log-ratios is written as soon as it's been computed. The
+    output is first written to a temporary file in the same directory as
+    output_loc, which is only moved to output_loc once all blocks have been
+    written (so an error partway through won't leave an incomplete output
+    file).
+
+    Parameters:
+    -----------
+        output_loc: location to write the log-ratios to
+        args, kwargs: passed to iter_streamed_log_ratios()
+
+    Returns:
+    --------
+        (sample_ct, query_ct): the number of samples and queries in the
+        output
+    """
+    out_dir = os.path.dirname(os.path.abspath(output_loc))
+    tmp_fd, tmp_loc = tempfile.mkstemp(prefix=".tmp-", dir=out_dir)
+    sample_ct = query_ct = 0
+    try:
+        with os.fdopen(tmp_fd, "w") as out_obj:
+            for i, block_df in enumerate(
+                iter_streamed_log_ratios(*args, **kwargs)
+            ):
+                block_df.to_csv(out_obj, sep="\t", header=(i == 0))
+                sample_ct += len(block_df.index)
+                query_ct = len(block_df.columns)
+        os.replace(tmp_loc, output_loc)
+    except BaseException:
+        os.remove(tmp_loc)
+        raise
+    return sample_ct, query_ct
+
+
+def aggregate_log_counts(table, taxonomy, level, sample_ids=None):
+    """Aggregates a table's counts to a level of the taxonomy, and takes the
+    natural log of the aggregated counts.
+
+    Counts are aggregated by multiplying the table's sparse counts with a
+    sparse (features x taxa) indicator matrix.
+
+    Parameters:
+    -----------
+        table: biom.Table of features x samples
+        taxonomy: pd.DataFrame with taxonomy information (should have Taxon
+            column), or a TaxonomyIndex
+        level: int, which level of the taxonomy to aggregate counts to (0 =
+            the first level; levels are separated by semicolons). Features
+            without a name at this level (see TaxonomyIndex.level_names())
+            aren't included in any taxon's counts.
+        sample_ids: collection of sample IDs. If provided, only these samples
+            in the table will be used. (optional)
+
+    Returns:
+    --------
+        pd.DataFrame of samples x taxa, indexed by sample ID, containing the
+        log of each taxon's total count in each sample (or NaN, if this total
+        is 0). Taxa are sorted by name, and samples are in the same order as
+        in the table.
+
+    Raises:
+    -------
+        ValueError: if the table has negative counts, or if no features in
+            the table have a name at this level
+    """
+    feat_table = SparseTable.from_biom(table)
+    if sample_ids is not None:
+        feat_table = feat_table.filter(
+            sample_mask=feat_table.sample_ids.isin(set(sample_ids))
+        )
+    if (feat_table.matrix.data < 0).any():
         raise ValueError("Feature table has negative counts!")
 
-    tax_num_df, tax_denom_df = filter_and_join_taxonomy(
-        feat_table, taxonomy, num_string, denom_string,
+    taxonomy_index = get_taxonomy_index(taxonomy)
+    taxon_codes = taxonomy_index.get_taxon_codes(feat_table.feature_ids)
+    level_names = pd.Series(
+        taxonomy_index.level_names(level) + [None], dtype=object
     )
+    # (Appending None means that a taxon code of -1 maps to None)
+    feature_names = level_names.values[taxon_codes]
+    has_name = pd.notna(feature_names)
+    if not has_name.any():
+        raise ValueError(
+            "No features in the table have a name at level {} of the "
+            "taxonomy.".format(level)
+        )
+    group_codes, group_names = pd.factorize(feature_names[has_name], sort=True)
+    indicators = csc_matrix(
+        (np.ones(len(group_codes)), (np.flatnonzero(has_name), group_codes),),
+        shape=(len(feature_names), len(group_names)),
+    )
+    logging.debug(
+        "Aggregating {} features to {} taxa at level {}.".format(
+            has_name.sum(), len(group_names), level
+        )
+    )
+    aggregated = feat_table.matrix.T.dot(indicators).toarray()
+    log_counts = np.log(
+        aggregated, out=np.full(aggregated.shape, np.nan), where=aggregated > 0
+    )
+    log_counts_df = pd.DataFrame(
+        log_counts, index=feat_table.sample_ids, columns=list(group_names)
+    )
+    log_counts_df.index.name = "Sample-ID"
+    return log_counts_df
 
-    # if shared features are disallowed, check to make sure they don't occur
-    # if allowed, can skip this step at user's risk
-    if not allow_shared_features:
-        shared_features = set(tax_num_df.index) & set(tax_denom_df.index)
-        if shared_features:
-            raise ValueError("Shared features between num and denom!")
 
-    tax_num_sample_sum = tax_num_df.sum(axis=0)
-    tax_denom_sample_sum = tax_denom_df.sum(axis=0)
+def get_pair_stats(log_counts):
+    """Computes summary statistics of the log-ratios of every pair of taxa.
+
+    The log-ratio of taxa a and b in a sample is log(a) - log(b); like in
+    qarcoal(), samples that don't contain both a and b are ignored. The
+    statistics of all pairs are computed at once with a few (taxa x taxa)
+    matrix products, so no per-sample log-ratios are computed.
+
+    Each taxon's log counts are centered (on the taxon's mean log count)
+    before these products, which avoids most of the cancellation error of
+    computing variances from sums of squares. Variances are still computed
+    from sums of squares, though, so the standard deviations of pairs whose
+    log-ratios vary very little relative to their mean are only accurate to
+    roughly sqrt(machine epsilon) (about 1e-8) times the mean.
+
+    Parameters:
+    -----------
+        log_counts: pd.DataFrame of samples x taxa (see
+            aggregate_log_counts())
+
+    Returns:
+    --------
+        (n_samples, mean, std): np.ndarrays of shape (# taxa, # taxa). For
+        the taxa at positions a and b in log_counts' columns, entry [a, b]
+        describes the log-ratios of a (as the numerator) and b (as the
+        denominator):
+
+            n_samples: number of samples containing both taxa
+            mean: mean log-ratio (NaN if n_samples is 0). This is
+                antisymmetric: mean[a, b] == -mean[b, a].
+            std: sample standard deviation of the log-ratios (NaN if
+                n_samples is less than 2)
+    """
+    values = log_counts.values
+    present = (~np.isnan(values)).astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        taxon_means = np.nansum(values, axis=0) / present.sum(axis=0)
+    taxon_means[~np.isfinite(taxon_means)] = 0
+    centered = np.where(np.isnan(values), 0, values - taxon_means)
+
+    # For a pair (a, b), sums over the samples containing both a and b
+    n_samples = present.T.dot(present)
+    a_sums = centered.T.dot(present)
+    centered_sums = a_sums - a_sums.T
+    del a_sums
+    a_sq_sums = (centered ** 2).T.dot(present)
+    sq_sums = a_sq_sums + a_sq_sums.T
+    del a_sq_sums
+    sq_sums -= 2 * centered.T.dot(centered)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        centered_mean = centered_sums / n_samples
+        del centered_sums
+        var = (sq_sums - n_samples * centered_mean ** 2) / (n_samples - 1)
+    del sq_sums
+    var[n_samples < 2] = np.nan
+    # Rounding error can make variances of (nearly) 0 negative
+    std = np.sqrt(np.maximum(var, 0, out=var))
+    # (Adding the difference of the taxa's means in one step keeps mean
+    # exactly antisymmetric)
+    mean = centered_mean
+    mean += np.subtract.outer(taxon_means, taxon_means)
+    return n_samples.astype(int), mean, std
+
+
+def select_top_pairs(log_counts, top_k=None, sort_by="mean", min_samples=1):
+    """Selects the top pairs of taxa, based on one of their statistics.
+
+    Each pair of taxa is only considered once, oriented so that its mean
+    log-ratio is positive (i.e. the numerator is the taxon that is more
+    abundant, on average, in samples containing both taxa). The top pairs
+    are picked using np.argpartition() on the (taxa x taxa) statistics from
+    get_pair_stats(), so only the selected pairs are sorted and stored in
+    a DataFrame.
+
+    Parameters:
+    -----------
+        log_counts: pd.DataFrame of samples x taxa (see
+            aggregate_log_counts())
+        top_k: int or None, the maximum number of pairs to keep. If None,
+            all pairs (with at least min_samples samples) are kept.
+        sort_by: one of PAIR_SORT_KEYS. Pairs are sorted by this statistic
+            in descending order; NaNs are sorted last, and ties are broken
+            by the positions of the pairs' taxa in log_counts' columns.
+        min_samples: int, only pairs of taxa that are both present in at
+            least this many samples are kept
+
+    Returns:
+    --------
+        pd.DataFrame with one row per selected pair, sorted by sort_by.
+        Columns:
+
+            Numerator, Denominator: the taxa's names
+            n_samples, mean, std: see get_pair_stats(). mean is never
+                negative.
+
+    Raises:
+    -------
+        ValueError: if sort_by isn't one of PAIR_SORT_KEYS, or if no pairs
+            have at least min_samples samples
+    """
+    if sort_by not in PAIR_SORT_KEYS:
+        raise ValueError(
+            "Unrecognized pair sort key: {}. Must be one of {}.".format(
+                sort_by, ", ".join(PAIR_SORT_KEYS)
+            )
+        )
+    n_samples, mean, std = get_pair_stats(log_counts)
+    stats = {"n_samples": n_samples, "mean": mean, "std": std}
+
+    # Pick one orientation of each pair: the one with a positive mean, or
+    # (if the mean is 0 or NaN) the one where the numerator comes first
+    num_taxa = len(log_counts.columns)
+    first = np.arange(num_taxa)[:, None] < np.arange(num_taxa)[None, :]
+    with np.errstate(invalid="ignore"):
+        is_candidate = (mean > 0) | (~(mean < 0) & first)
+    is_candidate &= n_samples >= min_samples
+    positions = np.flatnonzero(is_candidate)
+    del is_candidate
+    if len(positions) == 0:
+        raise ValueError(
+            "No pairs of taxa are both present in at least {} "
+            "sample(s).".format(min_samples)
+        )
 
-    comparison_df = pd.DataFrame.from_records(
-        [tax_num_sample_sum, tax_denom_sample_sum],
-        index=["Num_Sum", "Denom_Sum"],
-    ).T
-    comparison_df["log_ratio"] = comparison_df.apply(
-        lambda x: np.log(x.Num_Sum / x.Denom_Sum), axis=1
+    keys = stats[sort_by].ravel()[positions].astype(float)
+    keys[np.isnan(keys)] = -np.inf
+    if top_k is not None and top_k < len(positions):
+        # Keep every pair above the k-th largest key, then fill the rest
+        # with the (first) pairs tied with it
+        threshold = -np.partition(-keys, top_k - 1)[top_k - 1]
+        above = np.flatnonzero(keys > threshold)
+        tied = np.flatnonzero(keys == threshold)[: top_k - len(above)]
+        kept = np.concatenate([above, tied])
+        positions = positions[kept]
+        keys = keys[kept]
+    order = np.lexsort((positions, -keys))
+    positions = positions[order]
+
+    num_pos, denom_pos = np.unravel_index(positions, mean.shape)
+    taxa = np.array(log_counts.columns, dtype=object)
+    return pd.DataFrame(
+        {
+            "Numerator": taxa[num_pos],
+            "Denominator": taxa[denom_pos],
+            "n_samples": n_samples[num_pos, denom_pos],
+            "mean": mean[num_pos, denom_pos],
+            "std": std[num_pos, denom_pos],
+        },
+        columns=["Numerator", "Denominator", "n_samples", "mean", "std"],
     )
-    comparison_df.index.name = "Sample-ID"
 
-    return comparison_df
+
+def get_pair_names(pairs):
+    """Returns the name of each pair of taxa, "Numerator/Denominator"."""
+    return [
+        "{}/{}".format(num, denom)
+        for num, denom in zip(pairs["Numerator"], pairs["Denominator"])
+    ]
+
+
+def pairwise_log_ratios(
+    log_counts, pairs, chunk_size=DEFAULT_PAIR_CHUNK_SIZE, out=None
+):
+    """Computes the per-sample log-ratios of pairs of taxa.
+
+    Log-ratios are computed for chunk_size pairs at a time, so (if out is a
+    memory-mapped array, e.g. from np.lib.format.open_memmap()) the
+    log-ratios of far more pairs than would fit in memory can be computed.
+
+    Parameters:
+    -----------
+        log_counts: pd.DataFrame of samples x taxa (see
+            aggregate_log_counts())
+        pairs: pd.DataFrame with Numerator and Denominator columns (e.g. the
+            output of select_top_pairs())
+        chunk_size: int, number of pairs to compute log-ratios for at once
+        out: array-like of shape (# samples, # pairs), or None. If provided,
+            log-ratios are written to this.
+
+    Returns:
+    --------
+        np.ndarray (or out, if provided) of samples x pairs. Log-ratios are
+        NaN in samples that don't contain both taxa in a pair.
+    """
+    values = log_counts.values
+    num_pos = log_counts.columns.get_indexer(pairs["Numerator"])
+    denom_pos = log_counts.columns.get_indexer(pairs["Denominator"])
+    if out is None:
+        out = np.empty((values.shape[0], len(num_pos)))
+    for start in range(0, len(num_pos), chunk_size):
+        end = start + chunk_size
+        out[:, start:end] = (
+            values[:, num_pos[start:end]] - values[:, denom_pos[start:end]]
+        )
+    return out
+
+
+def qarcoal_pairwise(
+    table: biom.Table,
+    taxonomy: pd.DataFrame,
+    level: int,
+    top_k: int = 100,
+    sort_by: str = "mean",
+    min_samples: int = 1,
+    samples_to_use: Metadata = None,
+) -> pd.DataFrame:
+    """Calculate sample-wise log-ratios for the top pairs of taxa at a
+    taxonomy level.
+
+    Parameters:
+    -----------
+        table: biom file with which to calculate log ratios
+        taxonomy: pd.DataFrame with taxonomy information (should have Taxon
+            column)
+        level: taxonomy level to aggregate counts to (see
+            aggregate_log_counts())
+        top_k, sort_by, min_samples: see select_top_pairs()
+        samples_to_use: Q2 Metadata file with samples to use.
+            If provided, feature table will be filtered to only consider
+            samples present in this file. (optional)
+    Returns:
+    --------
+        pd.DataFrame of samples x pairs of taxa (named
+        "Numerator/Denominator"), in the same format as batch_log_ratios()'s
+        output. Samples without log-ratios for any of the pairs are omitted.
+    """
+    sample_ids = None
+    if samples_to_use is not None:
+        sample_ids = samples_to_use.to_dataframe().index
+    log_counts = aggregate_log_counts(table, taxonomy, level, sample_ids)
+    pairs = select_top_pairs(log_counts, top_k, sort_by, min_samples)
+    log_ratio_df = pd.DataFrame(
+        pairwise_log_ratios(log_counts, pairs),
+        index=log_counts.index,
+        columns=get_pair_names(pairs),
+    )
+    return log_ratio_df[log_ratio_df.notna().any(axis=1)]
@@ -6,5 +6,6 @@
 # The full license is in the file LICENSE.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 from ._plot import plot
+from ._qarcoal import qarcoal_batch, qarcoal_pairwise
 
-__all__ = ["plot"]
+__all__ = ["plot", "qarcoal_batch", "qarcoal_pairwise"]
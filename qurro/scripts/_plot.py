@@ -6,7 +6,6 @@
 # The full license is in the file LICENSE.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 import logging
-from biom import load_table
 import click
 from qurro._parameter_descriptions import (
     RANKS,
@@ -14,12 +13,25 @@ from qurro._parameter_descriptions import (
     SAMPLE_METADATA,
     FEATURE_METADATA,
     EXTREME_FEATURE_COUNT,
+    COUNT_SHARD_SIZE,
+    COMPRESS_DATA,
+    WORKERS,
+    MAX_OUTPUT_SIZE,
+    SAMPLE_METADATA_COLUMNS,
+    METADATA_ENGINE,
+    CACHE_DIR,
+    CACHE_MAX_SIZE,
     DEBUG,
 )
-from qurro.generate import process_and_generate
+from qurro.generate import (
+    check_filtering_options,
+    process_and_generate,
+    process_cached_and_generate,
+)
+from qurro._input_cache import InputCache, hash_file
 from qurro._rank_utils import read_rank_file
-from qurro._metadata_utils import read_metadata_file
-from qurro._df_utils import escape_columns
+from qurro._metadata_utils import read_metadata_file, METADATA_ENGINES
+from qurro._df_utils import escape_columns, load_matching_table
 from qurro.__init__ import __version__
 
 
@@ -49,6 +61,49 @@ from qurro.__init__ import __version__
     type=int,
     help=EXTREME_FEATURE_COUNT,
 )
+@click.option(
+    "--count-shard-size",
+    default=None,
+    type=click.IntRange(min=1),
+    help=COUNT_SHARD_SIZE,
+)
+@click.option("--compress-data", is_flag=True, help=COMPRESS_DATA)
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help=WORKERS,
+)
+@click.option(
+    "--max-output-size",
+    default=None,
+    type=click.IntRange(min=1),
+    help=MAX_OUTPUT_SIZE,
+)
+@click.option(
+    "-smc",
+    "--sample-metadata-column",
+    "sample_metadata_columns",
+    multiple=True,
+    help=SAMPLE_METADATA_COLUMNS
+    + " To specify multiple columns, use this option multiple times.",
+)
+@click.option(
+    "--metadata-engine",
+    default="pandas",
+    show_default=True,
+    type=click.Choice(METADATA_ENGINES),
+    help=METADATA_ENGINE,
+)
+@click.option("--cache-dir", default=None, help=CACHE_DIR)
+@click.option(
+    "--cache-max-size",
+    default=1024,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help=CACHE_MAX_SIZE,
+)
 @click.option("--debug", is_flag=True, help=DEBUG)
 @click.version_option(__version__, prog_name="Qurro")
 def plot(
@@ -58,6 +113,14 @@ def plot(
     feature_metadata: str,
     output_dir: str,
     extreme_feature_count: int,
+    count_shard_size: int,
+    compress_data: bool,
+    workers: int,
+    max_output_size: int,
+    sample_metadata_columns: tuple,
+    metadata_engine: str,
+    cache_dir: str,
+    cache_max_size: int,
     debug: bool,
 ) -> None:
     """Generates a visualization of feature rankings and log-ratios.
@@ -76,29 +139,55 @@ def plot(
         logging.basicConfig(level=logging.DEBUG)
 
     logging.debug("Starting the standalone Qurro script.")
-    loaded_biom = load_table(table)
-    logging.debug("Loaded BIOM table.")
-    df_sample_metadata = escape_columns(
-        read_metadata_file(sample_metadata), "sample metadata"
-    )
-    feature_ranks, rank_type = read_rank_file(ranks)
+    # Check this before spending time loading the input
+    check_filtering_options(extreme_feature_count, max_output_size)
+
+    def load_input():
+        df_sample_metadata = escape_columns(
+            read_metadata_file(sample_metadata, engine=metadata_engine),
+            "sample metadata",
+        )
+        feature_ranks, rank_type = read_rank_file(ranks)
+        # Now that we know which features and samples we need, we can avoid
+        # loading the rest of the BIOM table.
+        loaded_biom = load_matching_table(
+            table, feature_ranks, df_sample_metadata
+        )
+        logging.debug("Loaded BIOM table.")
+        return feature_ranks, rank_type, df_sample_metadata, loaded_biom
 
     df_feature_metadata = None
     if feature_metadata is not None:
         df_feature_metadata = escape_columns(
-            read_metadata_file(feature_metadata), "feature metadata"
+            read_metadata_file(feature_metadata, engine=metadata_engine),
+            "feature metadata",
         )
     logging.debug("Read in metadata.")
 
-    process_and_generate(
-        feature_ranks,
-        rank_type,
-        df_sample_metadata,
-        loaded_biom,
-        output_dir,
-        df_feature_metadata,
-        extreme_feature_count,
-    )
+    output_params = {
+        "extreme_feature_count": extreme_feature_count,
+        "count_shard_size": count_shard_size,
+        "compress_data": compress_data,
+        "workers": workers,
+        "max_output_size": max_output_size,
+        "sample_metadata_columns": sample_metadata_columns,
+    }
+    if cache_dir is None:
+        process_and_generate(
+            *load_input(), output_dir, df_feature_metadata, **output_params
+        )
+    else:
+        cache_key = InputCache.make_key(
+            hash_file(ranks), hash_file(table), hash_file(sample_metadata)
+        )
+        process_cached_and_generate(
+            load_input,
+            InputCache(cache_dir, cache_max_size * 1024 ** 2),
+            cache_key,
+            output_dir,
+            df_feature_metadata,
+            **output_params
+        )
     print(
         "Successfully generated a visualization in the folder {}.".format(
             output_dir
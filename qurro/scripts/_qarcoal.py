@@ -0,0 +1,252 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018--, Qurro development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+import logging
+import os
+import click
+import h5py
+import numpy as np
+from biom import load_table
+from qurro import _qarcoal_param_descriptions as QPD
+from qurro._parameter_descriptions import DEBUG
+from qurro._metadata_utils import read_metadata_file
+from qurro.qarcoal import (
+    batch_log_ratios,
+    write_streamed_log_ratios,
+    aggregate_log_counts,
+    select_top_pairs,
+    pairwise_log_ratios,
+    DEFAULT_SAMPLE_BLOCK_SIZE,
+    PAIR_SORT_KEYS,
+)
+from qurro._taxonomy_index import MATCH_MODES, load_or_build_taxonomy_index
+from qurro.__init__ import __version__
+
+
+@click.command()
+@click.option("-t", "--table", required=True, help=QPD.QARCOAL_TBL)
+@click.option(
+    "-tx",
+    "--taxonomy",
+    required=True,
+    help=QPD.QARCOAL_TAXONOMY
+    + ' This should be a tab-separated file with a "Taxon" column.',
+)
+@click.option("-q", "--queries", required=True, help=QPD.QARCOAL_QUERIES)
+@click.option(
+    "-o",
+    "--output",
+    required=True,
+    help=(
+        "Location to write the tab-separated table of log-ratios (samples x "
+        "queries) to."
+    ),
+)
+@click.option(
+    "-s", "--samples-to-use", default=None, help=QPD.QARCOAL_SMP_TO_USE
+)
+@click.option(
+    "--allow-shared-features",
+    is_flag=True,
+    help=QPD.QARCOAL_BATCH_SHARED_FEAT,
+)
+@click.option(
+    "--match-mode",
+    default="regex",
+    show_default=True,
+    type=click.Choice(MATCH_MODES),
+    help=QPD.QARCOAL_MATCH_MODE,
+)
+@click.option(
+    "--taxonomy-index", default=None, help=QPD.QARCOAL_TAXONOMY_INDEX
+)
+@click.option("--stream", is_flag=True, help=QPD.QARCOAL_STREAM)
+@click.option(
+    "--sample-block-size",
+    default=DEFAULT_SAMPLE_BLOCK_SIZE,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help=QPD.QARCOAL_SAMPLE_BLOCK_SIZE,
+)
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help=QPD.QARCOAL_WORKERS,
+)
+@click.option("--debug", is_flag=True, help=DEBUG)
+@click.version_option(__version__, prog_name="Qurro")
+def qarcoal_batch(
+    table: str,
+    taxonomy: str,
+    queries: str,
+    output: str,
+    samples_to_use: str,
+    allow_shared_features: bool,
+    match_mode: str,
+    taxonomy_index: str,
+    stream: bool,
+    sample_block_size: int,
+    workers: int,
+    debug: bool,
+) -> None:
+    """Computes many taxonomy-based log-ratios at once (batch Qarcoal).
+
+       The BIOM table and taxonomy are only loaded once, regardless of how
+       many queries are specified.
+    """
+    if debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    logging.debug("Starting the standalone batch Qarcoal script.")
+    df_queries = read_metadata_file(queries)
+    taxonomy_data = read_metadata_file(taxonomy)
+    if taxonomy_index is not None:
+        taxonomy_data = load_or_build_taxonomy_index(
+            taxonomy_index, taxonomy_data
+        )
+    sample_ids = None
+    if samples_to_use is not None:
+        sample_ids = read_metadata_file(samples_to_use).index
+    logging.debug("Read in input files.")
+
+    log_ratio_params = (
+        taxonomy_data,
+        df_queries,
+        sample_ids,
+        allow_shared_features,
+        match_mode,
+    )
+    if stream:
+        if not h5py.is_hdf5(table):
+            raise ValueError(
+                "Streaming requires the BIOM table to be in the HDF5 format."
+            )
+        sample_ct, query_ct = write_streamed_log_ratios(
+            output,
+            table,
+            *log_ratio_params,
+            block_size=sample_block_size,
+            workers=workers
+        )
+    else:
+        log_ratios = batch_log_ratios(load_table(table), *log_ratio_params)
+        log_ratios.to_csv(output, sep="\t", header=True)
+        sample_ct, query_ct = log_ratios.shape
+    print(
+        "Successfully wrote log-ratios for {} quer{} ({} samples) to "
+        "{}.".format(
+            query_ct, "y" if query_ct == 1 else "ies", sample_ct, output
+        )
+    )
+
+
+@click.command()
+@click.option("-t", "--table", required=True, help=QPD.QARCOAL_TBL)
+@click.option(
+    "-tx",
+    "--taxonomy",
+    required=True,
+    help=QPD.QARCOAL_TAXONOMY
+    + ' This should be a tab-separated file with a "Taxon" column.',
+)
+@click.option(
+    "-l",
+    "--level",
+    required=True,
+    type=click.IntRange(min=0),
+    help=QPD.QARCOAL_LEVEL,
+)
+@click.option(
+    "-o",
+    "--output-dir",
+    required=True,
+    help=(
+        "Directory to write the output to. The statistics of the selected "
+        "pairs of taxa are written to pair_stats.tsv in this directory."
+    ),
+)
+@click.option(
+    "-k",
+    "--top-k",
+    default=None,
+    type=click.IntRange(min=1),
+    help=QPD.QARCOAL_TOP_K + " If not specified, all pairs are used.",
+)
+@click.option(
+    "--sort-by",
+    default="mean",
+    show_default=True,
+    type=click.Choice(PAIR_SORT_KEYS),
+    help=QPD.QARCOAL_SORT_BY,
+)
+@click.option(
+    "--min-samples",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help=QPD.QARCOAL_MIN_SAMPLES,
+)
+@click.option(
+    "-s", "--samples-to-use", default=None, help=QPD.QARCOAL_SMP_TO_USE
+)
+@click.option(
+    "--write-log-ratios", is_flag=True, help=QPD.QARCOAL_WRITE_LOG_RATIOS
+)
+@click.option("--debug", is_flag=True, help=DEBUG)
+@click.version_option(__version__, prog_name="Qurro")
+def qarcoal_pairwise(
+    table: str,
+    taxonomy: str,
+    level: int,
+    output_dir: str,
+    top_k: int,
+    sort_by: str,
+    min_samples: int,
+    samples_to_use: str,
+    write_log_ratios: bool,
+    debug: bool,
+) -> None:
+    """Computes log-ratios for all pairs of taxa at a taxonomy level."""
+    if debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    logging.debug("Starting the standalone pairwise Qarcoal script.")
+    df_taxonomy = read_metadata_file(taxonomy)
+    sample_ids = None
+    if samples_to_use is not None:
+        sample_ids = read_metadata_file(samples_to_use).index
+    log_counts = aggregate_log_counts(
+        load_table(table), df_taxonomy, level, sample_ids
+    )
+    pairs = select_top_pairs(log_counts, top_k, sort_by, min_samples)
+
+    os.makedirs(output_dir, exist_ok=True)
+    pairs.to_csv(
+        os.path.join(output_dir, "pair_stats.tsv"), sep="\t", index=False
+    )
+    if write_log_ratios:
+        log_ratios = np.lib.format.open_memmap(
+            os.path.join(output_dir, "log_ratios.npy"),
+            mode="w+",
+            shape=(len(log_counts.index), len(pairs.index)),
+        )
+        pairwise_log_ratios(log_counts, pairs, out=log_ratios)
+        log_ratios.flush()
+        del log_ratios
+        with open(os.path.join(output_dir, "sample_ids.txt"), "w") as ids_obj:
+            ids_obj.write("".join(s + "\n" for s in log_counts.index))
+    print(
+        "Successfully wrote output for {} pair(s) of taxa to {}.".format(
+            len(pairs.index), output_dir
+        )
+    )
+
+
+if __name__ == "__main__":
+    qarcoal_batch()
@@ -0,0 +1,95 @@
+/* This file contains some functions for decompressing the data of a Qurro
+ * visualization.
+ *
+ * If a visualization was generated with compression enabled, each of its
+ * JSONs (and count shards, if present) is stored as an object of the form
+ * {qurro_compressed_json: "..."}, where the string is the base64-encoded
+ * DEFLATE-compressed (zlib format) JSON text: see
+ * _json_utils.compress_json() in Qurro's python code.
+ */
+define(function () {
+    var COMPRESSED_JSON_KEY = "qurro_compressed_json";
+
+    /* Decodes a base64-encoded string into a Uint8Array of its bytes. */
+    function base64ToBytes(encodedString) {
+        var binaryString = atob(encodedString);
+        var bytes = new Uint8Array(binaryString.length);
+        for (var i = 0; i < binaryString.length; i++) {
+            bytes[i] = binaryString.charCodeAt(i);
+        }
+        return bytes;
+    }
+
+    /* Returns true if a JSON is compressed, and false otherwise. */
+    function isCompressed(jsonObj) {
+        return (
+            jsonObj !== null &&
+            typeof jsonObj === "object" &&
+            typeof jsonObj[COMPRESSED_JSON_KEY] === "string" &&
+            Object.keys(jsonObj).length === 1
+        );
+    }
+
+    /* Decompresses zlib-format DEFLATE-compressed bytes into a string.
+     *
+     * Returns a Promise that resolves to the string.
+     */
+    function inflateToText(bytes) {
+        if (typeof DecompressionStream === "undefined") {
+            return Promise.reject(
+                new Error(
+                    "This browser doesn't support decompressing data. " +
+                        "Please open this visualization in a more recent " +
+                        "browser, or regenerate it without compression."
+                )
+            );
+        }
+        var stream = new Blob([bytes])
+            .stream()
+            .pipeThrough(new DecompressionStream("deflate"));
+        return new Response(stream).text();
+    }
+
+    /* Decompresses a JSON, if it's compressed.
+     *
+     * Returns a Promise that resolves to the decompressed JSON (or just to
+     * jsonObj, if it isn't compressed).
+     */
+    function decompressJSON(jsonObj) {
+        if (!isCompressed(jsonObj)) {
+            return Promise.resolve(jsonObj);
+        }
+        return inflateToText(base64ToBytes(jsonObj[COMPRESSED_JSON_KEY])).then(
+            JSON.parse
+        );
+    }
+
+    /* Decompresses an array of JSONs (see decompressJSON()).
+     *
+     * Returns a Promise that resolves to an array of the decompressed JSONs.
+     * If any of the JSONs were compressed, this also logs how long
+     * decompressing them took.
+     */
+    function decompressJSONs(jsonObjs) {
+        var startTime = Date.now();
+        return Promise.all(jsonObjs.map(decompressJSON)).then(function (
+            decompressedJSONs
+        ) {
+            if (jsonObjs.some(isCompressed)) {
+                console.log(
+                    "Decompressed Qurro's data in " +
+                        (Date.now() - startTime) +
+                        " ms."
+                );
+            }
+            return decompressedJSONs;
+        });
+    }
+
+    return {
+        base64ToBytes: base64ToBytes,
+        isCompressed: isCompressed,
+        decompressJSON: decompressJSON,
+        decompressJSONs: decompressJSONs,
+    };
+});
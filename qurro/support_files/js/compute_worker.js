@@ -0,0 +1,155 @@
+/* This file is the script for a Web Worker that does the expensive parts of
+ * selecting a log-ratio (filtering features and computing sample log-ratios)
+ * off of the main thread, so that the page stays responsive.
+ *
+ * See RRVDisplay.startComputeWorker() for the main thread's side of things.
+ * The worker accepts two types of messages:
+ *
+ * {type: "init", rankData: {...}, countData: {...}}
+ *     Sent once, right after the worker is created. rankData contains the
+ *     rank plot's feature rows and the feature field orderings; countData
+ *     contains the (typed) arrays of the count data (see count_data.js), or
+ *     is null if the count data is sharded.
+ *
+ * {type: "query", id: ..., queries: [topQuery, botQuery]}
+ *     Each query is of the form {inputText, featureField, searchType} (see
+ *     feature_computation.filterFeatures()). The worker responds with
+ *     {type: "result", id, topIndices, botIndices, balances}, where
+ *     topIndices and botIndices are Int32Arrays of the positions (in
+ *     rankData.rows) of the matching features and balances is the output of
+ *     feature_computation.computeSampleBalances() (or null, if the worker
+ *     wasn't given the count data). If a query is superseded
+ *     by a newer query before the worker gets around to it, the worker
+ *     responds with {type: "cancelled", id} instead; if something goes
+ *     wrong, the worker responds with {type: "error", id, message}.
+ */
+importScripts("../vendor/require.js");
+requirejs.config({
+    baseUrl: "../",
+    paths: {
+        vega: "vendor/vega.min",
+    },
+});
+
+// Messages received before the modules below are loaded are queued up.
+var messageQueue = [];
+self.onmessage = function (e) {
+    messageQueue.push(e.data);
+};
+
+requirejs(["js/feature_computation", "js/count_data"], function (
+    feature_computation,
+    count_data
+) {
+    var rankPlotJSON, rowIndex, countData;
+    var latestQueryID;
+
+    function init(msg) {
+        // Create a minimal "rank plot JSON" that filterFeatures() can work
+        // with.
+        var datasets = {
+            qurro_feature_metadata_ordering:
+                msg.rankData.featureMetadataOrdering,
+            qurro_rank_ordering: msg.rankData.rankOrdering,
+        };
+        datasets[msg.rankData.name] = msg.rankData.rows;
+        rankPlotJSON = {
+            data: { name: msg.rankData.name },
+            datasets: datasets,
+        };
+        // Since some filtering functions sort the feature rows in place, we
+        // keep track of each row's original position separately.
+        rowIndex = new Map();
+        for (var i = 0; i < msg.rankData.rows.length; i++) {
+            rowIndex.set(msg.rankData.rows[i], i);
+        }
+        countData = null;
+        if (msg.countData !== null) {
+            countData = count_data.makeCountData(
+                msg.countData.featureIDs,
+                msg.countData.sampleIDs,
+                msg.countData.indptr,
+                msg.countData.indices,
+                msg.countData.data
+            );
+        }
+    }
+
+    function runQuery(query) {
+        var featureRows = feature_computation.filterFeatures(
+            rankPlotJSON,
+            query.inputText,
+            query.featureField,
+            query.searchType
+        );
+        var rowIndices = new Int32Array(featureRows.length);
+        var countIndices = new Int32Array(featureRows.length);
+        for (var f = 0; f < featureRows.length; f++) {
+            rowIndices[f] = rowIndex.get(featureRows[f]);
+            if (countData !== null) {
+                countIndices[f] = countData.featureIndex.get(
+                    featureRows[f]["Feature ID"]
+                );
+            }
+        }
+        return { rowIndices: rowIndices, countIndices: countIndices };
+    }
+
+    function handleQuery(msg) {
+        if (msg.id !== latestQueryID) {
+            self.postMessage({ type: "cancelled", id: msg.id });
+            return;
+        }
+        try {
+            var top = runQuery(msg.queries[0]);
+            var bot = runQuery(msg.queries[1]);
+            var balances = null;
+            var transfer = [top.rowIndices.buffer, bot.rowIndices.buffer];
+            if (countData !== null) {
+                balances = feature_computation.computeSampleBalances(
+                    countData,
+                    top.countIndices,
+                    bot.countIndices
+                );
+                transfer.push(balances.buffer);
+            }
+            self.postMessage(
+                {
+                    type: "result",
+                    id: msg.id,
+                    topIndices: top.rowIndices,
+                    botIndices: bot.rowIndices,
+                    balances: balances,
+                },
+                transfer
+            );
+        } catch (err) {
+            self.postMessage({
+                type: "error",
+                id: msg.id,
+                message: err.message,
+            });
+        }
+    }
+
+    function handleMessage(msg) {
+        if (msg.type === "init") {
+            init(msg);
+        } else if (msg.type === "query") {
+            // Defer handling this query, so that if newer queries are already
+            // waiting to be received we can skip this one.
+            latestQueryID = msg.id;
+            setTimeout(function () {
+                handleQuery(msg);
+            }, 0);
+        }
+    }
+
+    self.onmessage = function (e) {
+        handleMessage(e.data);
+    };
+    for (var m = 0; m < messageQueue.length; m++) {
+        handleMessage(messageQueue[m]);
+    }
+    messageQueue = [];
+});
@@ -0,0 +1,390 @@
+/* This file contains some functions for loading and accessing the feature
+ * count data of a Qurro visualization.
+ *
+ * The count data is stored as a sparse matrix in compressed sparse column
+ * (CSC) format, where rows correspond to samples and columns correspond to
+ * features: the nonzero counts of the feature at position f in featureIDs
+ * are stored at positions indptr[f] through indptr[f + 1] - 1 of the indices
+ * and data arrays, where indices contains the position (in sampleIDs) of the
+ * sample each count belongs to. Within each feature, indices are sorted.
+ *
+ * For very large datasets, the count data can instead be split up into
+ * "shards" of consecutive features, each stored in a separate JS file (see
+ * _json_utils.get_sharded_count_json() in Qurro's python code). Only the
+ * shards containing the features whose counts are needed are loaded, using
+ * loadFeatureCounts(); a limited number of loaded shards are kept around.
+ * Each shard is stored in the same format as above, except that its first
+ * feature is at position "offset" in featureIDs. (Non-sharded count data
+ * acts as a single shard with an offset of 0.)
+ */
+define(["./compression"], function (compression) {
+    // The default number of shards to keep loaded at once. This can be
+    // changed for a given count data object by changing its maxLoadedShards
+    // property.
+    var MAX_LOADED_SHARDS = 64;
+
+    // Shard files call this function (which needs to be global, since the
+    // shard files are loaded as normal scripts) when they're loaded. We hold
+    // on to the shard JSON until the <script> tag's onload event fires.
+    var receivedShardJSONs = new Map();
+    if (typeof window !== "undefined") {
+        window.qurroAddCountShard = function (shardIndex, shardJSON) {
+            receivedShardJSONs.set(shardIndex, shardJSON);
+        };
+    }
+
+    /* Decodes a base64-encoded string into a typed array.
+     *
+     * The bytes are interpreted in the platform's byte order -- Qurro's
+     * python code writes these arrays as little-endian, which matches
+     * basically every machine that would be running a browser.
+     */
+    function decodeBase64(encodedString, TypedArray) {
+        var bytes = compression.base64ToBytes(encodedString);
+        return new TypedArray(bytes.buffer);
+    }
+
+    /* Returns a Map of each element in an array to its position. */
+    function indexArray(arr) {
+        var index = new Map();
+        for (var i = 0; i < arr.length; i++) {
+            index.set(arr[i], i);
+        }
+        return index;
+    }
+
+    /* Creates a count data object from arrays of feature and sample IDs and
+     * the typed arrays of a CSC matrix (see the top of this file).
+     */
+    function makeCountData(featureIDs, sampleIDs, indptr, indices, data) {
+        return {
+            featureIDs: featureIDs,
+            sampleIDs: sampleIDs,
+            featureIndex: indexArray(featureIDs),
+            sampleIndex: indexArray(sampleIDs),
+            offset: 0,
+            indptr: indptr,
+            indices: indices,
+            data: data,
+            sharded: false,
+        };
+    }
+
+    /* Creates a count data object from a sharded count JSON.
+     *
+     * No counts are loaded yet: use loadFeatureCounts() to load the shards
+     * containing some features.
+     */
+    function unpackShardedCountJSON(countJSON) {
+        return {
+            featureIDs: countJSON.feature_ids,
+            sampleIDs: countJSON.sample_ids,
+            featureIndex: indexArray(countJSON.feature_ids),
+            sampleIndex: indexArray(countJSON.sample_ids),
+            sharded: true,
+            DataArray:
+                countJSON.data_type === "Int32" ? Int32Array : Float64Array,
+            shardSize: countJSON.shard_size,
+            shardDir: countJSON.shard_dir,
+            // Map of shard index to loaded shard. A Map's keys are iterated
+            // through in insertion order, so we use this as an LRU cache by
+            // re-inserting shards whenever they're used.
+            shards: new Map(),
+            // Map of shard index to a Promise for the shard's loading
+            pendingShards: new Map(),
+            maxLoadedShards: MAX_LOADED_SHARDS,
+        };
+    }
+
+    /* Creates a count data object from a "packed" count JSON, as created by
+     * _json_utils.get_packed_count_json() in Qurro's python code.
+     */
+    function unpackCountJSON(countJSON) {
+        var DataArray =
+            countJSON.data_type === "Int32" ? Int32Array : Float64Array;
+        return makeCountData(
+            countJSON.feature_ids,
+            countJSON.sample_ids,
+            decodeBase64(countJSON.indptr, Int32Array),
+            decodeBase64(countJSON.indices, Int32Array),
+            decodeBase64(countJSON.data, DataArray)
+        );
+    }
+
+    /* Creates a count data object from a "sparse" count JSON, of the form
+     * {featureID: {sampleID: count, ...}, ...} (where zero counts may be
+     * omitted). This is the format older versions of Qurro used.
+     *
+     * Falsy counts (undefined, but also false, 0, "", null, or NaN -- none
+     * of these should ever occur in the count JSON, but if they do they
+     * should be interpreted as a zero count) are left out.
+     */
+    function countDataFromSparseJSON(countJSON) {
+        var featureIDs = Object.keys(countJSON);
+        var sampleIDs = [];
+        var sampleIndex = new Map();
+        var indptr = new Int32Array(featureIDs.length + 1);
+        var indices = [];
+        var data = [];
+        var f, s, sampleID, featureCounts, featureEntries;
+        for (f = 0; f < featureIDs.length; f++) {
+            featureCounts = countJSON[featureIDs[f]];
+            featureEntries = [];
+            for (sampleID in featureCounts) {
+                if (featureCounts[sampleID]) {
+                    if (!sampleIndex.has(sampleID)) {
+                        sampleIndex.set(sampleID, sampleIDs.length);
+                        sampleIDs.push(sampleID);
+                    }
+                    featureEntries.push([
+                        sampleIndex.get(sampleID),
+                        featureCounts[sampleID],
+                    ]);
+                }
+            }
+            featureEntries.sort(function (a, b) {
+                return a[0] - b[0];
+            });
+            for (s = 0; s < featureEntries.length; s++) {
+                indices.push(featureEntries[s][0]);
+                data.push(featureEntries[s][1]);
+            }
+            indptr[f + 1] = indices.length;
+        }
+        return makeCountData(
+            featureIDs,
+            sampleIDs,
+            indptr,
+            Int32Array.from(indices),
+            Float64Array.from(data)
+        );
+    }
+
+    /* Creates a count data object from either type of count JSON. */
+    function loadCountData(countJSON) {
+        if (countJSON.qurro_count_format === "csc") {
+            return unpackCountJSON(countJSON);
+        } else if (countJSON.qurro_count_format === "sharded") {
+            return unpackShardedCountJSON(countJSON);
+        } else {
+            return countDataFromSparseJSON(countJSON);
+        }
+    }
+
+    /* Loads a shard's JS file by adding a <script> tag to the page.
+     *
+     * Returns a Promise that resolves to the shard, once it's been loaded
+     * (and decompressed, if needed).
+     */
+    function loadShard(countData, shardIndex) {
+        var src = countData.shardDir + "/shard_" + shardIndex + ".js";
+        return new Promise(function (resolve, reject) {
+            var script = document.createElement("script");
+            var cleanUp = function () {
+                script.onload = script.onerror = null;
+                script.parentNode.removeChild(script);
+            };
+            script.onload = function () {
+                cleanUp();
+                var shardJSON = receivedShardJSONs.get(shardIndex);
+                receivedShardJSONs.delete(shardIndex);
+                if (shardJSON === undefined) {
+                    reject(new Error("Count shard file is invalid: " + src));
+                    return;
+                }
+                resolve(compression.decompressJSON(shardJSON));
+            };
+            script.onerror = function () {
+                cleanUp();
+                reject(new Error("Couldn't load count shard file: " + src));
+            };
+            script.src = src;
+            document.head.appendChild(script);
+        }).then(function (shardJSON) {
+            return {
+                offset: shardIndex * countData.shardSize,
+                indptr: decodeBase64(shardJSON.indptr, Int32Array),
+                indices: decodeBase64(shardJSON.indices, Int32Array),
+                data: decodeBase64(shardJSON.data, countData.DataArray),
+            };
+        });
+    }
+
+    /* Makes sure that the counts of some features are loaded, then calls
+     * callback() and returns a Promise that resolves to its return value.
+     *
+     * featureIndexArrays should be an array of arrays of feature positions
+     * (in the count data's featureIDs array). For non-sharded count data,
+     * all counts are always loaded, so this just calls callback(). For
+     * sharded count data, this loads all of the shards containing these
+     * features that aren't loaded already, then evicts the least recently
+     * used shards not needed by these features (if more than
+     * countData.maxLoadedShards shards are loaded).
+     *
+     * callback() is called right after this (without waiting for any other
+     * Promises), so it's safe for it to use getCount(), sumFeatureCounts(),
+     * etc. on these features -- other calls to this function can't evict
+     * these features' shards in the meantime.
+     */
+    function loadFeatureCounts(countData, featureIndexArrays, callback) {
+        if (!countData.sharded) {
+            return Promise.resolve().then(callback);
+        }
+        var neededShards = new Set();
+        var a, i;
+        for (a = 0; a < featureIndexArrays.length; a++) {
+            for (i = 0; i < featureIndexArrays[a].length; i++) {
+                neededShards.add(
+                    Math.floor(featureIndexArrays[a][i] / countData.shardSize)
+                );
+            }
+        }
+        var loads = [];
+        neededShards.forEach(function (shardIndex) {
+            if (countData.shards.has(shardIndex)) {
+                return;
+            }
+            var pending = countData.pendingShards.get(shardIndex);
+            if (pending === undefined) {
+                pending = loadShard(countData, shardIndex).then(
+                    function (loadedShard) {
+                        countData.pendingShards.delete(shardIndex);
+                        countData.shards.set(shardIndex, loadedShard);
+                    },
+                    function (err) {
+                        countData.pendingShards.delete(shardIndex);
+                        throw err;
+                    }
+                );
+                countData.pendingShards.set(shardIndex, pending);
+            }
+            loads.push(pending);
+        });
+        return Promise.all(loads).then(function () {
+            // Mark the needed shards as the most recently used. (Another
+            // call to this function might have evicted some of them while we
+            // were waiting, in which case we need to load them again.)
+            var stillNeeded = false;
+            neededShards.forEach(function (shardIndex) {
+                var shard = countData.shards.get(shardIndex);
+                if (shard !== undefined) {
+                    countData.shards.delete(shardIndex);
+                    countData.shards.set(shardIndex, shard);
+                } else {
+                    stillNeeded = true;
+                }
+            });
+            if (stillNeeded) {
+                return loadFeatureCounts(
+                    countData,
+                    featureIndexArrays,
+                    callback
+                );
+            }
+            evictShards(countData, neededShards);
+            return callback();
+        });
+    }
+
+    /* Evicts the least recently used shards of a count data object, until at
+     * most countData.maxLoadedShards shards (or neededShards.size shards, if
+     * that's larger) are loaded. Shards in neededShards are not evicted.
+     */
+    function evictShards(countData, neededShards) {
+        var maxShards = Math.max(countData.maxLoadedShards, neededShards.size);
+        var shardIter = countData.shards.keys();
+        var shardIndex;
+        while (countData.shards.size > maxShards) {
+            shardIndex = shardIter.next().value;
+            if (!neededShards.has(shardIndex)) {
+                countData.shards.delete(shardIndex);
+            }
+        }
+    }
+
+    /* Returns the shard containing a feature, given its position in the
+     * count data's featureIDs array.
+     *
+     * Throws an error if this feature's shard isn't loaded.
+     */
+    function getShard(countData, featureIndex) {
+        if (!countData.sharded) {
+            return countData;
+        }
+        var shard = countData.shards.get(
+            Math.floor(featureIndex / countData.shardSize)
+        );
+        if (shard === undefined) {
+            throw new Error(
+                "Counts of feature " +
+                    countData.featureIDs[featureIndex] +
+                    " haven't been loaded."
+            );
+        }
+        return shard;
+    }
+
+    /* Returns the count of a feature in a sample, given their positions in
+     * the count data's featureIDs and sampleIDs arrays.
+     *
+     * Since the sample indices of each feature are sorted, we can find a
+     * sample's entry (if present) using a binary search. If sampleIndex is
+     * undefined (i.e. the sample isn't present in the count data at all),
+     * this returns 0.
+     */
+    function getCount(countData, featureIndex, sampleIndex) {
+        if (sampleIndex === undefined) {
+            return 0;
+        }
+        var shard = getShard(countData, featureIndex);
+        var f = featureIndex - shard.offset;
+        var lo = shard.indptr[f];
+        var hi = shard.indptr[f + 1] - 1;
+        var mid;
+        while (lo <= hi) {
+            mid = (lo + hi) >>> 1;
+            if (shard.indices[mid] < sampleIndex) {
+                lo = mid + 1;
+            } else if (shard.indices[mid] > sampleIndex) {
+                hi = mid - 1;
+            } else {
+                return shard.data[mid];
+            }
+        }
+        return 0;
+    }
+
+    /* Sums up the counts of some features in every sample.
+     *
+     * featureIndices should be an array of feature positions (in the count
+     * data's featureIDs array). This only looks at the nonzero counts of
+     * these features, so it takes time proportional to the number of these
+     * counts (rather than to the number of samples times the number of
+     * features).
+     *
+     * Returns a Float64Array of the sums, in the same order as the count
+     * data's sampleIDs array.
+     */
+    function sumFeatureCounts(countData, featureIndices) {
+        var sums = new Float64Array(countData.sampleIDs.length);
+        var shard, f, i, end;
+        for (var t = 0; t < featureIndices.length; t++) {
+            shard = getShard(countData, featureIndices[t]);
+            f = featureIndices[t] - shard.offset;
+            end = shard.indptr[f + 1];
+            for (i = shard.indptr[f]; i < end; i++) {
+                sums[shard.indices[i]] += shard.data[i];
+            }
+        }
+        return sums;
+    }
+
+    return {
+        decodeBase64: decodeBase64,
+        makeCountData: makeCountData,
+        loadCountData: loadCountData,
+        loadFeatureCounts: loadFeatureCounts,
+        getCount: getCount,
+        sumFeatureCounts: sumFeatureCounts,
+    };
+});
@@ -7,9 +7,10 @@
 define([
     "./feature_computation",
     "./dom_utils",
+    "./count_data",
     "vega",
     "vega-embed",
-], function (feature_computation, dom_utils, vega, vegaEmbed) {
+], function (feature_computation, dom_utils, count_data, vega, vegaEmbed) {
     class RRVDisplay {
         /* Class representing a display in qurro (involving two plots:
          * one bar plot containing feature ranks, and one scatterplot
@@ -50,19 +51,29 @@ define([
             this.topFeatures = undefined;
             this.botFeatures = undefined;
 
-            // Used when looking up a feature's count.
-            this.featureCts = countJSON;
+            // Used when looking up a feature's count. See count_data.js for
+            // details on how this is structured.
+            this.countData = count_data.loadCountData(countJSON);
             // Used when searching through features.
             // Since we filtered out empty features in the python side of
             // things, we know that every feature should be represented in the
-            // count JSON's keys.
-            this.featureIDs = Object.keys(this.featureCts);
+            // count data's feature IDs.
+            this.featureIDs = this.countData.featureIDs;
 
             // Just a list of all sample IDs.
             this.sampleIDs = RRVDisplay.identifySampleIDs(samplePlotJSON);
+            // Used when checking if a sample ID is valid.
+            this.sampleIDSet = new Set(this.sampleIDs);
             // Used when letting the user know how many samples are present in
             // the sample plot.
             this.sampleCount = this.sampleIDs.length;
+            // Map of sample metadata field name to the list of values that
+            // this field's integer codes (in the sample plot's data) refer
+            // to. Fields are only decoded when they're first needed, at which
+            // point they're removed from this Map.
+            this.sampleMetadataDictionaries = RRVDisplay.extractSampleMetadataDictionaries(
+                samplePlotJSON
+            );
 
             // a mapping from "reason" (i.e. "balance", "xAxis", "color") to
             // list of dropped sample IDs.
@@ -100,6 +111,21 @@ define([
             this.rankPlotView = undefined;
             this.samplePlotView = undefined;
 
+            // The Web Worker used for computing log-ratios (see
+            // startComputeWorker()), and state used for keeping track of
+            // queries sent to this worker.
+            this.computeWorker = undefined;
+            this.workerRankRows = undefined;
+            this.latestQueryID = 0;
+            this.pendingQueries = new Map();
+
+            // Map of feature ID to the corresponding row in the rank plot's
+            // data, and Map of feature ID to the current log-ratio
+            // classification of every feature that isn't classified as
+            // "None". These are set in indexRankPlotFeatureRows().
+            this.rankPlotFeatureRows = undefined;
+            this.featureClassifications = undefined;
+
             // Save the JSONs that will be used to create the visualization.
             this.rankPlotJSON = rankPlotJSON;
             this.samplePlotJSON = samplePlotJSON;
@@ -118,11 +144,227 @@ define([
             await Promise.all([this.makeRankPlot(), this.makeSamplePlot()]);
 
             this.setUpDOM();
+            this.startComputeWorker();
             document
                 .getElementById("loadingMessage")
                 .classList.add("invisible");
         }
 
+        /* Starts a Web Worker (see compute_worker.js) that filters features
+         * and computes sample log-ratios for queryLogRatio(), so that the
+         * page doesn't freeze up while these computations are going on.
+         *
+         * The worker is sent the rank plot's feature rows and a copy of the
+         * count data once, here; the count data's typed arrays are copied
+         * and transferred to the worker (rather than being cloned). If the
+         * count data is sharded (see count_data.js), the worker only filters
+         * features, and log-ratios are computed on the main thread once the
+         * needed shards are loaded.
+         *
+         * Browsers generally don't allow creating Web Workers from pages
+         * opened through file:// URLs, so in that case (or if the browser
+         * doesn't support Web Workers at all) this doesn't do anything, and
+         * queryLogRatio() just does its computations on the main thread.
+         */
+        startComputeWorker() {
+            if (
+                typeof Worker === "undefined" ||
+                window.location.protocol === "file:"
+            ) {
+                return;
+            }
+            try {
+                this.computeWorker = new Worker("js/compute_worker.js");
+            } catch (err) {
+                console.log("Couldn't start the compute worker: " + err);
+                return;
+            }
+            var parentDisplay = this;
+            this.computeWorker.onmessage = function (e) {
+                parentDisplay.handleWorkerMessage(e.data);
+            };
+            this.computeWorker.onerror = function (e) {
+                console.log("Compute worker error: " + e.message);
+                parentDisplay.stopComputeWorker();
+            };
+
+            // The worker needs to be able to map the features it selects back
+            // to rows in the rank plot JSON, so we save the rows' order here.
+            // (filterFeatures() can sort the original array in place.)
+            var rankDataName = this.rankPlotJSON.data.name;
+            this.workerRankRows = this.rankPlotJSON.datasets[
+                rankDataName
+            ].slice();
+            var workerCountData = null;
+            var transfer = [];
+            if (!this.countData.sharded) {
+                workerCountData = {
+                    featureIDs: this.countData.featureIDs,
+                    sampleIDs: this.countData.sampleIDs,
+                    indptr: this.countData.indptr.slice(),
+                    indices: this.countData.indices.slice(),
+                    data: this.countData.data.slice(),
+                };
+                transfer = [
+                    workerCountData.indptr.buffer,
+                    workerCountData.indices.buffer,
+                    workerCountData.data.buffer,
+                ];
+            }
+            this.computeWorker.postMessage(
+                {
+                    type: "init",
+                    rankData: {
+                        name: rankDataName,
+                        rows: this.workerRankRows,
+                        featureMetadataOrdering: this.featureMetadataFields,
+                        rankOrdering: this.rankOrdering,
+                    },
+                    countData: workerCountData,
+                },
+                transfer
+            );
+        }
+
+        /* Stops the compute worker, if it's running. Any queries that were
+         * waiting on the worker are redone on the main thread.
+         */
+        stopComputeWorker() {
+            if (this.computeWorker === undefined) {
+                return;
+            }
+            this.computeWorker.terminate();
+            this.computeWorker = undefined;
+            this.workerRankRows = undefined;
+            var parentDisplay = this;
+            var pendingQueries = this.pendingQueries;
+            this.pendingQueries = new Map();
+            pendingQueries.forEach(function (pendingQuery) {
+                pendingQuery.resolve(
+                    parentDisplay.runLocalQuery(pendingQuery.queries)
+                );
+            });
+        }
+
+        /* Handles a message from the compute worker: see the top of
+         * compute_worker.js for details on the types of messages.
+         */
+        handleWorkerMessage(msg) {
+            var pendingQuery = this.pendingQueries.get(msg.id);
+            if (pendingQuery === undefined) {
+                // This query has already been superseded by a newer query.
+                return;
+            }
+            this.pendingQueries.delete(msg.id);
+            if (msg.type === "result") {
+                var rows = this.workerRankRows;
+                var getRow = function (i) {
+                    return rows[i];
+                };
+                var topFeatures = Array.from(msg.topIndices, getRow);
+                var botFeatures = Array.from(msg.botIndices, getRow);
+                var balancesPromise = Promise.resolve(msg.balances);
+                if (msg.balances === null) {
+                    // The worker doesn't have the counts (i.e. the count data
+                    // is sharded), so we have to compute the log-ratios here.
+                    balancesPromise = this.loadBalances(
+                        topFeatures,
+                        botFeatures
+                    );
+                }
+                pendingQuery.resolve(
+                    balancesPromise.then(function (balances) {
+                        return {
+                            topFeatures: topFeatures,
+                            botFeatures: botFeatures,
+                            balances: balances,
+                        };
+                    })
+                );
+            } else if (msg.type === "error") {
+                pendingQuery.reject(new Error(msg.message));
+            } else {
+                pendingQuery.resolve(null);
+            }
+        }
+
+        /* Finds the numerator and denominator features of a log-ratio, and
+         * computes all samples' log-ratios.
+         *
+         * queries should be an array of two queries (for the numerator and
+         * denominator, respectively) of the form
+         * {inputText: ..., featureField: ..., searchType: ...}; see
+         * feature_computation.filterFeatures() for details.
+         *
+         * Returns a Promise that resolves to an object of the form
+         * {topFeatures: [...], botFeatures: [...], balances: ...}, where
+         * balances is the output of computeBalances() for these features --
+         * or that resolves to null, if another query was made while this
+         * query was still being computed. (In that case, the newer query
+         * takes precedence.)
+         */
+        queryLogRatio(queries) {
+            // Any queries still waiting on the worker are now stale.
+            this.pendingQueries.forEach(function (pendingQuery) {
+                pendingQuery.resolve(null);
+            });
+            this.pendingQueries.clear();
+
+            this.latestQueryID++;
+            var queryID = this.latestQueryID;
+            var parentDisplay = this;
+            var resultPromise;
+            if (this.computeWorker === undefined) {
+                resultPromise = this.runLocalQuery(queries);
+            } else {
+                resultPromise = new Promise(function (resolve, reject) {
+                    parentDisplay.pendingQueries.set(queryID, {
+                        queries: queries,
+                        resolve: resolve,
+                        reject: reject,
+                    });
+                    parentDisplay.computeWorker.postMessage({
+                        type: "query",
+                        id: queryID,
+                        queries: queries,
+                    });
+                });
+            }
+            return resultPromise.then(function (result) {
+                // Loading count shards can take a while, so we check (again)
+                // that this query is still the latest one.
+                if (queryID !== parentDisplay.latestQueryID) {
+                    return null;
+                }
+                return result;
+            });
+        }
+
+        /* Like queryLogRatio(), but does everything on the main thread (and
+         * doesn't check if the query is stale).
+         */
+        async runLocalQuery(queries) {
+            var featureLists = [];
+            for (var q = 0; q < queries.length; q++) {
+                featureLists.push(
+                    feature_computation.filterFeatures(
+                        this.rankPlotJSON,
+                        queries[q].inputText,
+                        queries[q].featureField,
+                        queries[q].searchType
+                    )
+                );
+            }
+            return {
+                topFeatures: featureLists[0],
+                botFeatures: featureLists[1],
+                balances: await this.loadBalances(
+                    featureLists[0],
+                    featureLists[1]
+                ),
+            };
+        }
+
         setUpDOM() {
             // All DOM elements that we disable/enable when switching to/from
             // "boxplot mode." We disable these when in "boxplot mode" because
@@ -300,6 +542,9 @@ define([
                 tooltip: { theme: "custom" },
             }).then(function (result) {
                 parentDisplay.rankPlotView = result.view;
+                // Invalidate the rank plot's feature row index; see
+                // indexRankPlotFeatureRows().
+                parentDisplay.rankPlotFeatureRows = undefined;
                 parentDisplay.addClickEventToRankPlotView(parentDisplay);
             });
         }
@@ -342,6 +587,12 @@ define([
          * notFirstTime to true -- in which case this won't do that extra work.
          */
         makeSamplePlot(notFirstTime) {
+            this.decodeSampleMetadataField(
+                this.samplePlotJSON.encoding.x.field
+            );
+            this.decodeSampleMetadataField(
+                this.samplePlotJSON.encoding.color.field
+            );
             if (!notFirstTime) {
                 this.metadataCols = this.samplePlotJSON.datasets.qurro_sample_metadata_fields;
                 // Note that we set the default metadata fields based on whatever
@@ -433,56 +684,72 @@ define([
             this.droppedSamples[reason] = invalidSampleIDs;
         }
 
-        // Given a "row" of data about a rank, return its new classification depending
-        // on the new selection that just got made.
-        updateRankColorSingle(rankRow) {
-            if (rankRow["Feature ID"] === this.newFeatureHigh["Feature ID"]) {
+        /* Returns a Map of feature ID to log-ratio classification
+         * ("Numerator", "Denominator", or "Both") for the features in a
+         * selection. Features that aren't in the selection (and that should
+         * therefore be classified as "None") aren't included in the Map.
+         *
+         * This takes time proportional to the number of selected features,
+         * so it should only be called once per selection.
+         */
+        static classifyFeatures(topFeatures, botFeatures) {
+            var classifications = new Map();
+            var t, featureID, currClassification;
+            for (t = 0; t < topFeatures.length; t++) {
+                classifications.set(topFeatures[t]["Feature ID"], "Numerator");
+            }
+            for (t = 0; t < botFeatures.length; t++) {
+                featureID = botFeatures[t]["Feature ID"];
+                currClassification = classifications.get(featureID);
                 if (
-                    rankRow["Feature ID"] === this.newFeatureLow["Feature ID"]
+                    currClassification === "Numerator" ||
+                    currClassification === "Both"
                 ) {
-                    return "Both";
+                    classifications.set(featureID, "Both");
                 } else {
-                    return "Numerator";
+                    classifications.set(featureID, "Denominator");
                 }
-            } else if (
-                rankRow["Feature ID"] === this.newFeatureLow["Feature ID"]
-            ) {
-                return "Denominator";
-            } else {
-                return "None";
             }
+            return classifications;
         }
 
-        updateRankColorMulti(rankRow) {
-            var inTop = false;
-            var inBot = false;
-            for (var i = 0; i < this.topFeatures.length; i++) {
-                if (
-                    this.topFeatures[i]["Feature ID"] === rankRow["Feature ID"]
-                ) {
-                    inTop = true;
-                    break;
-                }
-            }
-            for (var j = 0; j < this.botFeatures.length; j++) {
-                if (
-                    this.botFeatures[j]["Feature ID"] === rankRow["Feature ID"]
-                ) {
-                    inBot = true;
-                    break;
+        /* Given two outputs of classifyFeatures(), returns a Map of feature
+         * ID to new classification for just the features whose
+         * classification differs between them. (Features that have been
+         * removed from the selection are mapped to "None".)
+         */
+        static diffClassifications(oldClassifications, newClassifications) {
+            var changes = new Map();
+            oldClassifications.forEach(function (oldClassification, fID) {
+                if (!newClassifications.has(fID)) {
+                    changes.set(fID, "None");
                 }
-            }
-            if (inTop) {
-                if (inBot) {
-                    return "Both";
-                } else {
-                    return "Numerator";
+            });
+            newClassifications.forEach(function (newClassification, fID) {
+                if (oldClassifications.get(fID) !== newClassification) {
+                    changes.set(fID, newClassification);
                 }
-            } else if (inBot) {
-                return "Denominator";
-            } else {
-                return "None";
-            }
+            });
+            return changes;
+        }
+
+        /* Return the classifications (see classifyFeatures()) for the new
+         * single-feature selection that just got made. This should be called
+         * once per update, not once per rank plot row.
+         */
+        classifySingleSelection() {
+            return RRVDisplay.classifyFeatures(
+                [this.newFeatureHigh],
+                [this.newFeatureLow]
+            );
+        }
+
+        // Same as classifySingleSelection(), but for multi-feature selections.
+        classifyMultiSelection() {
+            return RRVDisplay.classifyFeatures(
+                this.topFeatures,
+                this.botFeatures
+            );
         }
 
         async updateRankField() {
@@ -557,8 +824,12 @@ define([
          * 1) update sample log-ratios in the sample plot
          * 2) update the "classifications" of features in the rank plot
          * 3) update dropped sample information re: the new log-ratios
+         *
+         * balances should be the output of computeBalances() for the new
+         * log-ratio, and classifications should be the output of
+         * classifyFeatures() for the new log-ratio.
          * */
-        async updateLogRatio(updateBalanceFunc, updateRankColorFunc) {
+        async updateLogRatio(balances, classifications) {
             var dataName = this.samplePlotJSON.data.name;
             var parentDisplay = this;
             var nullBalanceSampleIDs = [];
@@ -579,9 +850,9 @@ define([
                     "qurro_balance",
                     // function to run to determine what the new balances are
                     function (sampleRow) {
-                        var sampleBalance = updateBalanceFunc.call(
-                            parentDisplay,
-                            sampleRow
+                        var sampleBalance = parentDisplay.getSampleBalance(
+                            balances,
+                            sampleRow["Sample ID"]
                         );
                         if (sampleBalance === null) {
                             nullBalanceSampleIDs.push(sampleRow["Sample ID"]);
@@ -595,29 +866,43 @@ define([
             // Doing this alongside the change to the sample plot is done so that
             // the "states" of the plot re: selected features + sample log
             // ratios are unified.
-            var rankDataName = this.rankPlotJSON.data.name;
+            //
+            // We only modify the rows of features whose classification has
+            // actually changed since the last log-ratio was selected, so the
+            // cost of this is proportional to the size of the change (not to
+            // the total number of features).
+            if (this.rankPlotFeatureRows === undefined) {
+                this.indexRankPlotFeatureRows();
+            }
+            var rankPlotChanges = vega.changeset();
+            RRVDisplay.diffClassifications(
+                this.featureClassifications,
+                classifications
+            ).forEach(function (newClassification, featureID) {
+                var rankRow = parentDisplay.rankPlotFeatureRows.get(featureID);
+                if (rankRow !== undefined) {
+                    rankPlotChanges.modify(
+                        rankRow,
+                        "qurro_classification",
+                        newClassification
+                    );
+                }
+            });
+            this.featureClassifications = classifications;
+            var rankPlotViewChanged = this.rankPlotView.change(
+                this.rankPlotJSON.data.name,
+                rankPlotChanges
+            );
             // While we're doing this, keep track of how many features have a
             // log-ratio classification of "Both" (i.e. they're in both the
             // numerator and denominator). Since this is Likely A Problem (TM),
             // we want to warn the user about these features.
             var bothFeatureCount = 0;
-            var rankPlotViewChanged = this.rankPlotView.change(
-                rankDataName,
-                vega
-                    .changeset()
-                    .modify(vega.truthy, "qurro_classification", function (
-                        rankRow
-                    ) {
-                        var color = updateRankColorFunc.call(
-                            parentDisplay,
-                            rankRow
-                        );
-                        if (color === "Both") {
-                            bothFeatureCount++;
-                        }
-                        return color;
-                    })
-            );
+            classifications.forEach(function (classification) {
+                if (classification === "Both") {
+                    bothFeatureCount++;
+                }
+            });
 
             // Change both the plots, and move on when these changes are done.
             await Promise.all([
@@ -665,6 +950,34 @@ define([
             }
         }
 
+        /* Creates a Map of feature ID to row in the rank plot's data, and
+         * sets this.featureClassifications based on the current
+         * classifications of these rows.
+         *
+         * This needs to be done (once) every time the rank plot is
+         * (re)created, since the rows in the plot's data may be different
+         * objects from those in the previous plot.
+         */
+        indexRankPlotFeatureRows() {
+            var rankPlotData = this.rankPlotView.data(
+                this.rankPlotJSON.data.name
+            );
+            this.rankPlotFeatureRows = new Map();
+            this.featureClassifications = new Map();
+            for (var i = 0; i < rankPlotData.length; i++) {
+                this.rankPlotFeatureRows.set(
+                    rankPlotData[i]["Feature ID"],
+                    rankPlotData[i]
+                );
+                if (rankPlotData[i].qurro_classification !== "None") {
+                    this.featureClassifications.set(
+                        rankPlotData[i]["Feature ID"],
+                        rankPlotData[i].qurro_classification
+                    );
+                }
+            }
+        }
+
         /* Updates the rank and sample plot based on "autoselection."
          *
          * By "autoselection," we just mean picking the top/bottom features for
@@ -681,25 +994,19 @@ define([
             // -autoLiteralBot
             var autoSelectType = document.getElementById("autoSelectType")
                 .value;
-            this.topFeatures = feature_computation.filterFeatures(
-                this.rankPlotJSON,
-                inputNumber,
-                this.rankPlotJSON.encoding.y.field,
-                autoSelectType + "Top"
-            );
-            this.botFeatures = feature_computation.filterFeatures(
-                this.rankPlotJSON,
-                inputNumber,
-                this.rankPlotJSON.encoding.y.field,
-                autoSelectType + "Bot"
-            );
-            // TODO: abstract below stuff to a helper function for use by
-            // regenerateFromAutoSelection() and RegenerateFromFiltering()
-            this.updateFeaturesDisplays();
-            await this.updateLogRatio(
-                this.updateBalanceMulti,
-                this.updateRankColorMulti
-            );
+            var rankField = this.rankPlotJSON.encoding.y.field;
+            await this.regenerateFromQueries([
+                {
+                    inputText: inputNumber,
+                    featureField: rankField,
+                    searchType: autoSelectType + "Top",
+                },
+                {
+                    inputText: inputNumber,
+                    featureField: rankField,
+                    searchType: autoSelectType + "Bot",
+                },
+            ]);
         }
 
         /* Updates the rank and sample plot based on the "filtering" controls.
@@ -718,22 +1025,37 @@ define([
             var botSearchType = document.getElementById("botSearchType").value;
             var topEnteredText = document.getElementById("topText").value;
             var botEnteredText = document.getElementById("botText").value;
-            this.topFeatures = feature_computation.filterFeatures(
-                this.rankPlotJSON,
-                topEnteredText,
-                topField,
-                topSearchType
-            );
-            this.botFeatures = feature_computation.filterFeatures(
-                this.rankPlotJSON,
-                botEnteredText,
-                botField,
-                botSearchType
-            );
+            await this.regenerateFromQueries([
+                {
+                    inputText: topEnteredText,
+                    featureField: topField,
+                    searchType: topSearchType,
+                },
+                {
+                    inputText: botEnteredText,
+                    featureField: botField,
+                    searchType: botSearchType,
+                },
+            ]);
+        }
+
+        /* Selects a new log-ratio based on a numerator and denominator query
+         * (see queryLogRatio()), and updates the plots accordingly.
+         *
+         * If this query is superseded by a newer one before it finishes, this
+         * doesn't do anything.
+         */
+        async regenerateFromQueries(queries) {
+            var result = await this.queryLogRatio(queries);
+            if (result === null) {
+                return;
+            }
+            this.topFeatures = result.topFeatures;
+            this.botFeatures = result.botFeatures;
             this.updateFeaturesDisplays();
             await this.updateLogRatio(
-                this.updateBalanceMulti,
-                this.updateRankColorMulti
+                result.balances,
+                this.classifyMultiSelection()
             );
         }
 
@@ -773,8 +1095,11 @@ define([
                         this.updateFeaturesDisplays(true);
                         // Time to update the plots re: the new log-ratio
                         await this.updateLogRatio(
-                            this.updateBalanceSingle,
-                            this.updateRankColorSingle
+                            await this.loadBalances(
+                                [this.newFeatureHigh],
+                                [this.newFeatureLow]
+                            ),
+                            this.classifySingleSelection()
                         );
                     }
                 }
@@ -1007,6 +1332,7 @@ define([
          *    examples of how Qurro's input handling is good in this way.)
          */
         getInvalidSampleIDs(fieldName, correspondingEncoding) {
+            this.decodeSampleMetadataField(fieldName);
             var dataName = this.samplePlotJSON.data.name;
             var currFieldVal;
             var currSampleID;
@@ -1209,6 +1535,49 @@ define([
             }
         }
 
+        /* Removes the qurro_sample_metadata_dictionaries dataset from the
+         * sample plot JSON (so that Vega-Lite doesn't see it), and returns
+         * its contents as a Map of field name to list of values.
+         *
+         * Sample plot JSONs generated by older versions of Qurro don't have
+         * this dataset, in which case this just returns an empty Map.
+         */
+        static extractSampleMetadataDictionaries(samplePlotSpec) {
+            var dictionaries =
+                samplePlotSpec.datasets.qurro_sample_metadata_dictionaries;
+            delete samplePlotSpec.datasets.qurro_sample_metadata_dictionaries;
+            if (dictionaries === undefined) {
+                return new Map();
+            }
+            return new Map(Object.entries(dictionaries));
+        }
+
+        /* Replaces the integer codes of a dictionary-encoded sample metadata
+         * field, in every row of the sample plot's data, with the values
+         * these codes refer to. (null values are left as is.)
+         *
+         * Does nothing if this field isn't dictionary-encoded, or if it's
+         * already been decoded. This should be called before a field is used
+         * in the sample plot (e.g. as the x-axis or color field).
+         */
+        decodeSampleMetadataField(fieldName) {
+            var dictionary = this.sampleMetadataDictionaries.get(fieldName);
+            if (dictionary === undefined) {
+                return;
+            }
+            var data = this.samplePlotJSON.datasets[
+                this.samplePlotJSON.data.name
+            ];
+            var code;
+            for (var i = 0; i < data.length; i++) {
+                code = data[i][fieldName];
+                if (code !== null) {
+                    data[i][fieldName] = dictionary[code];
+                }
+            }
+            this.sampleMetadataDictionaries.delete(fieldName);
+        }
+
         static identifySampleIDs(samplePlotSpec) {
             var sampleIDs = [];
             var dataName = samplePlotSpec.data.name;
@@ -1222,43 +1591,37 @@ define([
             return sampleIDs;
         }
 
-        /* Checks if a sample ID is actually supported by the count data we
-         * have. We do this by just looking at all the samples with count data
-         * for a feature ID, and checking to make sure that the sample ID is
-         * one of those.
-         *
-         * (This function makes the assumption that each feature will have the
-         * same number of samples associated with it -- this is why we only
-         * bother checking a single feature here. This is a safe assumption,
-         * since we construct the feature count JSON from a BIOM table on the
-         * python side of things.)
+        /* Checks if a sample ID is actually supported by the data we have
+         * (i.e. if it's one of the samples in the sample plot).
          */
         validateSampleID(sampleID) {
-            if (!this.sampleIDs.includes(sampleID)) {
+            if (!this.sampleIDSet.has(sampleID)) {
                 throw new Error("Invalid sample ID: " + sampleID);
             }
         }
 
-        /* Gets count data from the featureCts object. This uses a sparse
-         * storage method, so only samples with a nonzero count for a given
-         * feature are contained in that feature's entry.
-         *
-         * So, if the "entry" for a sample for a feature in featureCts is falsy
-         * (i.e. undefined, but could also be false, 0, "", null, or NaN --
-         * none of these should ever occur in the count JSON but if they do
-         * that should also be indicative of a zero count [1]), then we
-         * consider that sample's count to be 0. Otherwise, we just return the
-         * entry.
+        /* Gets the count of a feature in a sample from the count data.
          *
-         * [1] See https://developer.mozilla.org/en-US/docs/Glossary/Truthy
+         * The count data only stores nonzero counts, so if a sample doesn't
+         * have an entry for a feature then we consider that sample's count
+         * to be 0. (If the count data is sharded, the feature's counts need
+         * to have already been loaded.)
          */
         getCount(featureID, sampleID) {
-            var putativeCount = this.featureCts[featureID][sampleID];
-            if (putativeCount) {
-                return putativeCount;
-            } else {
-                return 0;
+            return count_data.getCount(
+                this.countData,
+                this.getFeatureIndex(featureID),
+                this.countData.sampleIndex.get(sampleID)
+            );
+        }
+
+        /* Returns the position of a feature in the count data. */
+        getFeatureIndex(featureID) {
+            var featureIndex = this.countData.featureIndex.get(featureID);
+            if (featureIndex === undefined) {
+                throw new Error("Invalid feature ID: " + featureID);
             }
+            return featureIndex;
         }
 
         /* Given a "row" of the sample plot's JSON for a sample, and given an array of
@@ -1268,13 +1631,82 @@ define([
         sumAbundancesForSampleFeatures(sampleRow, features) {
             var sampleID = sampleRow["Sample ID"];
             this.validateSampleID(sampleID);
+            var sampleIndex = this.countData.sampleIndex.get(sampleID);
             var abundance = 0;
             for (var t = 0; t < features.length; t++) {
-                abundance += this.getCount(features[t]["Feature ID"], sampleID);
+                abundance += count_data.getCount(
+                    this.countData,
+                    this.getFeatureIndex(features[t]["Feature ID"]),
+                    sampleIndex
+                );
             }
             return abundance;
         }
 
+        /* Returns an array of the positions in the count data of an array of
+         * features.
+         */
+        getFeatureIndices(features) {
+            var featureIndices = new Int32Array(features.length);
+            for (var t = 0; t < features.length; t++) {
+                featureIndices[t] = this.getFeatureIndex(
+                    features[t]["Feature ID"]
+                );
+            }
+            return featureIndices;
+        }
+
+        /* Computes the log-ratios of all samples for a selection of features.
+         *
+         * This is a wrapper around
+         * feature_computation.computeSampleBalances(): see that function for
+         * details. Use getSampleBalance() to look up a given sample's
+         * log-ratio in the output array.
+         */
+        computeBalances(topFeatures, botFeatures) {
+            return feature_computation.computeSampleBalances(
+                this.countData,
+                this.getFeatureIndices(topFeatures),
+                this.getFeatureIndices(botFeatures)
+            );
+        }
+
+        /* Like computeBalances(), but first makes sure that the counts of
+         * the selected features are loaded (see
+         * count_data.loadFeatureCounts()).
+         *
+         * Returns a Promise that resolves to the output of computeBalances().
+         */
+        loadBalances(topFeatures, botFeatures) {
+            var topFeatureIndices = this.getFeatureIndices(topFeatures);
+            var botFeatureIndices = this.getFeatureIndices(botFeatures);
+            var countData = this.countData;
+            return count_data.loadFeatureCounts(
+                countData,
+                [topFeatureIndices, botFeatureIndices],
+                function () {
+                    return feature_computation.computeSampleBalances(
+                        countData,
+                        topFeatureIndices,
+                        botFeatureIndices
+                    );
+                }
+            );
+        }
+
+        /* Looks up a sample's log-ratio in the output of computeBalances().
+         *
+         * Samples with a NaN log-ratio, or without any count data, are given
+         * a null log-ratio.
+         */
+        getSampleBalance(balances, sampleID) {
+            var sampleIndex = this.countData.sampleIndex.get(sampleID);
+            if (sampleIndex === undefined || isNaN(balances[sampleIndex])) {
+                return null;
+            }
+            return balances[sampleIndex];
+        }
+
         /* Use abundance data to compute the new log-ratio ("balance") values of
          * log(high feature abundance) - log(low feature abundance) for a given sample.
          *
@@ -1367,6 +1799,8 @@ define([
          * empty string.
          */
         getSamplePlotData(currXField, currColorField) {
+            this.decodeSampleMetadataField(currXField);
+            this.decodeSampleMetadataField(currColorField);
             var outputTSV =
                 '"Sample ID"\tCurrent_Natural_Log_Ratio\t' +
                 RRVDisplay.quoteTSVFieldIfNeeded(currXField) +
@@ -1449,6 +1883,7 @@ define([
                 dom_utils.clearDiv("samplePlot");
             }
             if (clearOtherStuff) {
+                this.stopComputeWorker();
                 // Remove the "qiimediscrete" color scheme from Vega
                 vega.scheme("qiimediscrete", undefined);
                 // Clear the bindings of bound DOM elements
@@ -1,4 +1,4 @@
-define(["./dom_utils"], function (dom_utils) {
+define(["./dom_utils", "./count_data"], function (dom_utils, count_data) {
     /* Converts a feature field value to a text-searchable value, if possible.
      *
      * If the input is a string, returns the input (in lower case).
@@ -484,10 +484,43 @@ define(["./dom_utils"], function (dom_utils) {
         return Math.log(topValue) - Math.log(botValue);
     }
 
+    /* Computes the log-ratios of all samples for a selection of features.
+     *
+     * countData should be a count data object (see count_data.js), and
+     * topFeatureIndices / botFeatureIndices should be arrays of the
+     * positions (in the count data) of the features in the numerator /
+     * denominator of the log-ratio.
+     *
+     * Rather than looking up every selected feature's count in every sample,
+     * this walks through the nonzero counts of each selected feature once
+     * (accumulating the numerator and denominator sums for every sample as it
+     * goes), and then computes all of the log-ratios in a single pass.
+     *
+     * Returns a Float64Array of log-ratios, in the same order as the count
+     * data's sample IDs. Samples with a null log-ratio (see computeBalance())
+     * are given a log-ratio of NaN.
+     */
+    function computeSampleBalances(
+        countData,
+        topFeatureIndices,
+        botFeatureIndices
+    ) {
+        var topSums = count_data.sumFeatureCounts(countData, topFeatureIndices);
+        var botSums = count_data.sumFeatureCounts(countData, botFeatureIndices);
+        var balances = new Float64Array(topSums.length);
+        var balance;
+        for (var s = 0; s < topSums.length; s++) {
+            balance = computeBalance(topSums[s], botSums[s]);
+            balances[s] = balance === null ? NaN : balance;
+        }
+        return balances;
+    }
+
     return {
         filterFeatures: filterFeatures,
         extremeFilterFeatures: extremeFilterFeatures,
         computeBalance: computeBalance,
+        computeSampleBalances: computeSampleBalances,
         textToRankArray: textToRankArray,
         operatorToCompareFunc: operatorToCompareFunc,
         existsIntersection: existsIntersection,
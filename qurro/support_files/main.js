@@ -29,6 +29,7 @@ requirejs(
     [
         "js/display",
         "js/feature_computation",
+        "js/compression",
         "vega",
         "vega-lite",
         "vega-embed",
@@ -37,7 +38,14 @@ requirejs(
         "datatables.net",
         "datatablesbs",
     ],
-    function (display, feature_computation, vega, vegaLite, vegaEmbed) {
+    function (
+        display,
+        feature_computation,
+        compression,
+        vega,
+        vegaLite,
+        vegaEmbed
+    ) {
         // DON'T CHANGE THESE LINES unless you know what you're doing -- the
         // "var *JSON = {};" lines are expected to contain that text by Qurro's
         // python code, which replaces the empty {}s with JSON objects that
@@ -45,10 +53,20 @@ requirejs(
         var rankPlotJSON = {};
         var samplePlotJSON = {};
         var countJSON = {};
-        new display.RRVDisplay(
-            rankPlotJSON,
-            samplePlotJSON,
-            countJSON
-        ).makePlots();
+        // If these JSONs were compressed, decompress them before starting.
+        compression
+            .decompressJSONs([rankPlotJSON, samplePlotJSON, countJSON])
+            .then(function (jsons) {
+                new display.RRVDisplay(
+                    jsons[0],
+                    jsons[1],
+                    jsons[2]
+                ).makePlots();
+            })
+            .catch(function (err) {
+                document.getElementById("loadingMessage").textContent =
+                    "Couldn't load the Qurro visualization: " + err.message;
+                throw err;
+            });
     }
 );
@@ -10,8 +10,8 @@ from qurro._df_utils import (
     print_if_dropped,
     match_table_and_data,
     merge_feature_metadata,
-    sparsify_count_dict,
     check_column_names,
+    select_sample_metadata_columns,
     add_sample_presence_count,
     vibe_check,
 )
@@ -466,35 +466,6 @@ def test_merge_feature_metadata():
         merge_feature_metadata(ranks, fm)
 
 
-def test_sparsify_count_dict():
-
-    # Test that it works in basic case
-    test_cts = {
-        "Feature 1": {"Sample 1": 0, "Sample 2": 3, "Sample 3": 0},
-        "Feature 2": {"Sample 1": 2, "Sample 2": 4, "Sample 3": 0},
-    }
-    assert sparsify_count_dict(test_cts) == {
-        "Feature 1": {"Sample 2": 3},
-        "Feature 2": {"Sample 1": 2, "Sample 2": 4},
-    }
-
-    # Test that it works even when the data is inherently dense (i.e. no zeros)
-    test_cts = {
-        "Feature 1": {"Sample 1": 1, "Sample 2": 3, "Sample 3": 5},
-        "Feature 2": {"Sample 1": 2, "Sample 2": 4, "Sample 3": 6},
-    }
-    assert sparsify_count_dict(test_cts) == test_cts
-
-    # Test that it works even when the data is totally sparse
-    # This should never happen, since we filter out empty features, but good to
-    # be sure
-    test_cts = {
-        "Feature 1": {"Sample 1": 0, "Sample 2": 0, "Sample 3": 0},
-        "Feature 2": {"Sample 1": 0, "Sample 2": 0, "Sample 3": 0},
-    }
-    assert sparsify_count_dict(test_cts) == {"Feature 1": {}, "Feature 2": {}}
-
-
 def test_check_column_names():
 
     _, sm, fr = get_test_data()
@@ -640,6 +611,26 @@ def test_check_column_names():
     assert "must be distinct" in str(exception_info.value)
 
 
+def test_select_sample_metadata_columns():
+    sm = DataFrame(
+        {"MD1": [1, 2], "MD:2": [3, 4], "MD3": [5, 6]}, index=["S1", "S2"]
+    )
+    assert select_sample_metadata_columns(sm) is sm
+    assert select_sample_metadata_columns(sm, ()) is sm
+
+    # Columns should be in the given order, and duplicates should be ignored
+    # (as should characters that escape_columns() would have escaped)
+    selected = select_sample_metadata_columns(sm, ["MD3", "MD.2", "MD3"])
+    assert list(selected.columns) == ["MD3", "MD:2"]
+    assert_frame_equal(selected, sm[["MD3", "MD:2"]])
+
+    with pytest.raises(ValueError) as exception_info:
+        select_sample_metadata_columns(sm, ["MD1", "MD4", "MD5"])
+    assert "aren't present in the sample metadata: MD4, MD5" in str(
+        exception_info.value
+    )
+
+
 def test_match_table_and_data_no_change(capsys):
     # In basic case, nothing should change
     table, metadata, ranks = get_test_data()
@@ -822,6 +813,23 @@ def test_match_table_and_data_complex(capsys):
     assert expected_message_3 in captured.out
 
 
+def test_match_table_and_data_different_orders():
+    """Checks that the output follows the table's order of features and
+       samples, regardless of the order of the feature ranks and metadata.
+    """
+    table, metadata, ranks = get_test_data()
+    # Reverse the ranks and metadata, and drop a feature and sample from the
+    # table's perspective
+    ranks = ranks.iloc[::-1].drop("F3")
+    metadata = metadata.iloc[::-1].drop("Sample2")
+
+    m_table, m_metadata = match_table_and_data(table, ranks, metadata)
+    expected_features = ["F1", "F2", "F4", "F5", "F6", "F7", "F8"]
+    expected_samples = ["Sample1", "Sample3", "Sample4"]
+    assert_frame_equal(m_table, table.loc[expected_features, expected_samples])
+    assert_frame_equal(m_metadata, metadata.loc[expected_samples])
+
+
 def verify_spc_data_integrity(output_feature_data, initial_feature_data):
     """Checks that add_sample_presence_count() doesn't change any of the
        initially input feature_data -- it just adds a qurro_spc column, and
@@ -883,6 +891,22 @@ def test_add_sample_presence_count_zeros():
     verify_spc_data_integrity(ofd_3, ranks)
 
 
+def test_add_sample_presence_count_negative():
+    """Checks that negative values (e.g. in a CLR-transformed table) count
+       as a feature being present in a sample, just like positive values.
+    """
+    table, metadata, ranks = get_test_data()
+    table = table.astype(float)
+    table.loc["F1", "Sample1"] = -1.5
+    table.loc["F2", "Sample3"] = -0.25
+    output_feature_data = add_sample_presence_count(ranks, table)
+    assert_series_equal(
+        output_feature_data["qurro_spc"],
+        Series([3, 3, 2, 3, 2, 2, 2, 2], index=ranks.index, name="qurro_spc"),
+    )
+    verify_spc_data_integrity(output_feature_data, ranks)
+
+
 def test_add_sample_presence_count_name_error():
     """Checks the case where the feature data already contains a column
        called qurro_spc.
@@ -3,8 +3,12 @@ from numpy import arange
 from pandas import DataFrame
 from pandas.testing import assert_frame_equal
 import pytest
-from qurro._rank_utils import filter_unextreme_features
-from qurro.generate import biom_table_to_sparse_df, process_input
+from qurro._rank_utils import (
+    filter_unextreme_features,
+    get_extreme_feature_mask,
+)
+from qurro._df_utils import biom_table_to_sparse_df
+from qurro.generate import process_input
 from qurro.tests.test_df_utils import get_test_data as get_test_data_2
 
 
@@ -78,6 +82,64 @@ def test_filtering_basic():
     )
 
 
+def test_filtering_preserves_order():
+    """Tests that filter_unextreme_features() keeps features in the order they
+       were in the input (and that the filtered table matches up with the
+       filtered ranks).
+    """
+    table, metadata, ranks = get_test_data_2()
+    # Shuffle the features around, and give them unordered IDs
+    new_order = ["F5", "F8", "F2", "F3", "F1", "F7", "F4", "F6"]
+    table = table.loc[new_order]
+    ranks = ranks.loc[new_order]
+    filtered_table, filtered_ranks = filter_unextreme_features(table, ranks, 2)
+    assert list(filtered_ranks.index) == ["F8", "F2", "F1", "F7"]
+    assert_frame_equal(filtered_ranks, ranks.loc[filtered_ranks.index])
+    assert_frame_equal(filtered_table, table.loc[filtered_ranks.index])
+
+    # The table's features don't have to be in the same order as the ranks';
+    # the filtered table should be put in the same order as the filtered
+    # ranks
+    table = table.iloc[::-1]
+    filtered_table, filtered_ranks = filter_unextreme_features(table, ranks, 2)
+    assert list(filtered_ranks.index) == ["F8", "F2", "F1", "F7"]
+    assert filtered_table.index.equals(filtered_ranks.index)
+    assert_frame_equal(filtered_table, table.loc[filtered_ranks.index])
+
+
+def test_get_extreme_feature_mask():
+    """Tests get_extreme_feature_mask() with multiple rankings and ties."""
+    ranks = DataFrame(
+        {
+            "Rank 0": [5, 1, 1, 2, 3, 4, 5, 0],
+            "Rank 1": [0, 0, 0, 0, 0, 0, 0, 1],
+            "Rank 2": [3, 2, 1, 9, 9, 9, 4, 2],
+        },
+        index=["F1", "F2", "F3", "F4", "F5", "F6", "F7", "F8"],
+    )
+    # Rank 0: F8 (smallest) and F1 (largest, since it occurs before F7)
+    # Rank 1: F1 (the first of the tied smallest features) and F8
+    # Rank 2: F3 and F4
+    assert list(get_extreme_feature_mask(ranks, 1)) == [
+        True,
+        False,
+        True,
+        True,
+        False,
+        False,
+        False,
+        True,
+    ]
+    # Should be the same as what nlargest() and nsmallest() would select
+    for efc in range(1, 9):
+        expected_features = set()
+        for col in ranks.columns:
+            expected_features |= set(ranks.nlargest(efc, col).index)
+            expected_features |= set(ranks.nsmallest(efc, col).index)
+        mask = get_extreme_feature_mask(ranks, efc)
+        assert set(ranks.index[mask]) == expected_features
+
+
 def test_filtering_large_efc():
     """Tests filter_unextreme_features() when (the extreme feature count * 2)
        is greater than or equal to the number of ranked features.
@@ -0,0 +1,145 @@
+import os
+import numpy as np
+from pandas import DataFrame, Index
+from pandas.testing import assert_frame_equal
+from qurro._input_cache import InputCache, hash_df, hash_file
+from qurro._json_utils import get_jsons, plot_jsons_equal
+from qurro._table_utils import SparseTable
+from qurro.generate import process_cached_and_generate
+from qurro.tests.test_df_utils import get_test_data
+
+MATCHING_TEST_DIR = os.path.join(
+    "qurro", "tests", "input", "matching_test", ""
+)
+
+
+def get_cache_test_data():
+    table, metadata, ranks = get_test_data()
+    # Add some columns with other dtypes to the sample metadata, to check that
+    # these dtypes (and missing values) are preserved
+    metadata["Strings"] = ["a", None, "c", "d"]
+    metadata["Ints"] = np.arange(4)
+    # Add an integer column to the feature ranks
+    ranks["Rank 2"] = np.arange(8)
+    return SparseTable.from_dataframe(table), metadata, ranks
+
+
+def test_input_cache_round_trip(tmp_path):
+    st, metadata, ranks = get_cache_test_data()
+    cache = InputCache(str(tmp_path))
+    key = InputCache.make_key("abc", "def")
+    assert cache.load(key) is None
+
+    cache.store(key, st, metadata, ranks, "differential", "Removed 1 thing.\n")
+    c_table, c_metadata, c_ranks, c_rank_type, c_messages = cache.load(key)
+    assert_frame_equal(c_table.to_dataframe(), st.to_dataframe())
+    assert_frame_equal(c_metadata, metadata)
+    assert_frame_equal(c_ranks, ranks)
+    assert c_rank_type == "differential"
+    assert c_messages == "Removed 1 thing.\n"
+    # No temporary directories should be left over
+    assert os.listdir(str(tmp_path)) == [key]
+
+
+def test_input_cache_make_key():
+    assert InputCache.make_key("a", "b") == InputCache.make_key("a", "b")
+    assert InputCache.make_key("a", "b") != InputCache.make_key("b", "a")
+    assert InputCache.make_key("a", "b") != InputCache.make_key("a", "c")
+
+
+def test_input_cache_corrupt_entry(tmp_path):
+    st, metadata, ranks = get_cache_test_data()
+    cache = InputCache(str(tmp_path))
+    cache.store("k", st, metadata, ranks, "feature_loading")
+    os.remove(str(tmp_path / "k" / "table.npz"))
+    assert cache.load("k") is None
+    # The broken entry should've been removed
+    assert not os.path.exists(str(tmp_path / "k"))
+
+
+def test_input_cache_eviction(tmp_path):
+    st, metadata, ranks = get_cache_test_data()
+    cache = InputCache(str(tmp_path))
+    for i, key in enumerate(("k1", "k2", "k3")):
+        cache.store(key, st, metadata, ranks, "differential")
+        entry_dir = str(tmp_path / key)
+        os.utime(entry_dir, (1000 + i, 1000 + i))
+    entry_size = sum(
+        os.path.getsize(str(tmp_path / "k1" / f))
+        for f in os.listdir(str(tmp_path / "k1"))
+    )
+
+    # Using k1 should make k2 the least recently used entry
+    cache.load("k1")
+    cache.max_size = 2 * entry_size
+    assert cache.evict() == ["k2"]
+    assert sorted(os.listdir(str(tmp_path))) == ["k1", "k3"]
+
+    cache.max_size = 0
+    assert cache.evict() == ["k3", "k1"]
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_hash_df():
+    _, metadata, ranks = get_cache_test_data()
+    assert hash_df(ranks) == hash_df(ranks.copy())
+    assert hash_df(ranks) != hash_df(metadata)
+    changed_ranks = ranks.copy()
+    changed_ranks.iloc[0, 0] += 1
+    assert hash_df(ranks) != hash_df(changed_ranks)
+    renamed_ranks = ranks.copy()
+    renamed_ranks.index = Index(["X"] * 8)
+    assert hash_df(ranks) != hash_df(renamed_ranks)
+
+
+def test_process_cached_and_generate(tmp_path, capsys):
+    """Checks that process_cached_and_generate() only loads the input on a
+       cache miss, and that it generates the same output (and prints the same
+       messages about dropped samples/features) either way.
+    """
+    from biom import load_table
+    from qurro._metadata_utils import read_metadata_file
+    from qurro._rank_utils import read_rank_file
+
+    load_count = []
+
+    def load_input():
+        load_count.append(1)
+        ranks, rank_type = read_rank_file(
+            MATCHING_TEST_DIR + "differentials.tsv"
+        )
+        sample_metadata = read_metadata_file(
+            MATCHING_TEST_DIR + "sample_metadata.txt"
+        )
+        table = load_table(MATCHING_TEST_DIR + "mt.biom")
+        return ranks, rank_type, sample_metadata, table
+
+    cache = InputCache(str(tmp_path / "cache"))
+    key = InputCache.make_key(
+        hash_file(MATCHING_TEST_DIR + "differentials.tsv")
+    )
+    outputs = []
+    printed = []
+    for i in range(2):
+        out_dir = str(tmp_path / "out{}".format(i))
+        process_cached_and_generate(load_input, cache, key, out_dir)
+        outputs.append(get_jsons(os.path.join(out_dir, "main.js")))
+        printed.append(capsys.readouterr().out)
+    assert len(load_count) == 1
+    assert "were not present in the" in printed[0]
+    assert printed[0] == printed[1]
+    assert plot_jsons_equal(outputs[0][0], outputs[1][0])
+    assert plot_jsons_equal(outputs[0][1], outputs[1][1])
+    assert outputs[0][2] == outputs[1][2]
+
+
+def test_input_cache_empty_metadata_columns(tmp_path):
+    """Checks that sample metadata without any columns can be cached."""
+    st, _, ranks = get_cache_test_data()
+    metadata = DataFrame(index=Index(list(st.sample_ids), name="Sample ID"))
+    cache = InputCache(str(tmp_path))
+    cache.store("k", st, metadata, ranks, "differential")
+    c_metadata = cache.load("k")[1]
+    assert list(c_metadata.index) == list(metadata.index)
+    assert c_metadata.index.name == "Sample ID"
+    assert len(c_metadata.columns) == 0
@@ -71,3 +71,36 @@ def test_differentials_to_df_bad_cases():
     )
     with pytest.raises(ValueError):
         differentials_to_df(ninf_val_diff)
+
+
+def test_differentials_to_df_chunks():
+    """Tests that parsing differentials in chunks doesn't change anything."""
+
+    diff_text = "\tIntercept\tRank 1\n#q2:types\tnumeric\tnumeric\n" + "".join(
+        "T{}\t{}\t{}\n".format(i, i, -i) for i in range(10)
+    )
+    full_df = differentials_to_df(StringIO(diff_text))
+    assert list(full_df.index) == ["T{}".format(i) for i in range(10)]
+    assert list(full_df["Rank 1"]) == [-float(i) for i in range(10)]
+    for chunk_size in (1, 3, 10):
+        assert_frame_equal(
+            full_df, differentials_to_df(StringIO(diff_text), chunk_size)
+        )
+
+    # Just a header: there aren't any features, but this shouldn't fail
+    empty_df = differentials_to_df(StringIO("\tIntercept\tRank 1\n"))
+    assert empty_df.shape == (0, 2)
+    assert list(empty_df.columns) == ["Intercept", "Rank 1"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 100])
+def test_differentials_to_df_error_names_first_feature(chunk_size):
+    bad_diff = StringIO(
+        "\tIntercept\tRank 1\nTaxon1\t1.0\t2.0\nTaxon2\t3.0\tabc\n"
+        "Taxon3\tNaN\t4.0\nTaxon4\t3.0\n"
+    )
+    with pytest.raises(ValueError) as exception_info:
+        differentials_to_df(bad_diff, chunk_size)
+    assert str(exception_info.value) == (
+        "Missing / nonnumeric differential(s) found for feature Taxon2"
+    )
@@ -1,3 +1,4 @@
+import os
 from qurro.tests.testing_utilities import run_integration_test
 
 
@@ -112,3 +113,79 @@ def test_feature_metadata_and_dropped_sample():
     for txid in count_json:
         # Assert that Sample4 was also dropped from the counts data in the JSON
         assert "Sample4" not in count_json[txid]
+
+
+def test_count_shards():
+    """Tests that splitting up the count data into shards doesn't change it."""
+    params = [
+        "matching_test",
+        "matching_test/count_shards",
+        "differentials.tsv",
+        "mt.biom",
+        "sample_metadata.txt",
+    ]
+    rank_json, sample_json, count_json = run_integration_test(
+        *params,
+        feature_metadata_name="feature_metadata.txt",
+        expected_unsupported_samples=1,
+        count_shard_size=2,
+    )
+    params[1] = "matching_test"
+    rank_json_2, sample_json_2, count_json_2 = run_integration_test(
+        *params,
+        feature_metadata_name="feature_metadata.txt",
+        expected_unsupported_samples=1,
+    )
+    assert count_json == count_json_2
+    assert rank_json == rank_json_2
+    assert sample_json == sample_json_2
+
+
+def test_compressed_data():
+    """Tests that compressing the visualization's data doesn't change it."""
+    params = [
+        "matching_test",
+        "matching_test/compressed",
+        "differentials.tsv",
+        "mt.biom",
+        "sample_metadata.txt",
+    ]
+    kwargs = {
+        "feature_metadata_name": "feature_metadata.txt",
+        "expected_unsupported_samples": 1,
+    }
+    jsons = run_integration_test(*params, compress_data=True, **kwargs)
+    sharded_jsons = run_integration_test(
+        *params, compress_data=True, count_shard_size=3, **kwargs
+    )
+    params[1] = "matching_test"
+    uncompressed_jsons = run_integration_test(*params, **kwargs)
+    assert jsons == uncompressed_jsons
+    assert sharded_jsons == uncompressed_jsons
+
+
+def test_workers():
+    """Tests that generating a visualization using multiple workers produces
+       exactly the same main.js file as generating it serially.
+    """
+    params = [
+        "matching_test",
+        "matching_test/workers",
+        "differentials.tsv",
+        "mt.biom",
+        "sample_metadata.txt",
+    ]
+    kwargs = {
+        "feature_metadata_name": "feature_metadata.txt",
+        "expected_unsupported_samples": 1,
+    }
+    main_js_loc = os.path.join("docs", "demos", params[1], "main.js")
+    for other_kwargs in ({}, {"compress_data": True, "count_shard_size": 2}):
+        main_jss = []
+        for workers in (1, 4):
+            run_integration_test(
+                *params, workers=workers, **other_kwargs, **kwargs
+            )
+            with open(main_js_loc, "r") as main_js_file:
+                main_jss.append(main_js_file.read())
+        assert main_jss[0] == main_jss[1]
@@ -8,14 +8,31 @@
 # ----------------------------------------------------------------------------
 
 from os.path import join
+import json
 import pytest
+import numpy as np
+import altair as alt
+from pandas import Categorical, DataFrame, Series
 from qurro._json_utils import (
     get_jsons,
     plot_jsons_equal,
     try_to_replace_line_json,
     replace_js_json_definitions,
+    write_main_js,
     check_json_dataset_names,
+    get_packed_count_json,
+    get_sharded_count_json,
+    write_count_shards,
+    compress_json,
+    decompress_json,
+    df_to_dataset,
+    get_dictionary_encoding,
+    dictionary_encode_columns,
 )
+from qurro._table_utils import SparseTable
+from qurro.generate import gen_rank_plot, gen_sample_plot, gen_spec
+from qurro.tests.test_df_utils import get_test_data
+from qurro.tests.testing_utilities import unpack_count_json
 
 
 def test_get_jsons():
@@ -386,3 +403,274 @@ def test_replace_js_json_definitions():
         assert output_lines[0] == "var rankPlotJSON = {};\n"
         assert output_lines[1] == 'var asdfsamplePlotJSON = {"test2": "s"};\n'
         assert output_lines[2] == 'var asdfcountJSON = {"test3": "c"};\n'
+
+
+def test_try_to_replace_line_json_chunks():
+    line = "var countJSON = {};\n"
+    new_line, r = try_to_replace_line_json(
+        line, "count", iter(['{"a": ', '{"b": 1}', "}"])
+    )
+    assert new_line == 'var countJSON = {"a": {"b": 1}};\n'
+    assert r
+
+
+def test_write_main_js(tmp_path):
+    idir = join("qurro", "tests", "input", "json_tests")
+    oloc = str(tmp_path / "main.js")
+    rank_json = {"test1": "r", "a": [1, 2]}
+    count_chunks = iter(['{"a": ', '{"b": 1}', "}"])
+
+    write_main_js(join(idir, "all.js"), oloc, rank_json, {}, count_chunks)
+    with open(oloc, "r") as output_fobj:
+        output_lines = output_fobj.readlines()
+    assert output_lines == [
+        'var rankPlotJSON = {"a": [1, 2], "test1": "r"};\n',
+        "var samplePlotJSON = {};\n",
+        'var countJSON = {"a": {"b": 1}};\n',
+    ]
+    # The output should match what replace_js_json_definitions() would write
+    oloc2 = str(tmp_path / "main2.js")
+    replace_js_json_definitions(
+        join(idir, "all.js"),
+        rank_json,
+        {},
+        {"a": {"b": 1}},
+        output_file_loc=oloc2,
+    )
+    with open(oloc2, "r") as output_fobj:
+        assert output_fobj.readlines() == output_lines
+
+    # If the template is missing any of the JSON declarations, we should
+    # raise an error
+    for bad_template in ("both.js", "only_c.js", "spcp_prefix.js"):
+        with pytest.raises(ValueError) as exception_info:
+            write_main_js(join(idir, bad_template), oloc, {}, {}, {})
+        assert "Wasn't able to find all JSON declarations" in str(
+            exception_info.value
+        )
+
+
+def test_get_packed_count_json():
+    table = SparseTable(
+        np.array([[0, 2, 1], [0, 0, 0], [7, 0, 3]]),
+        ["F2", "F3", "F1"],
+        ["S3", "S1", "S2"],
+    )
+    packed_json = get_packed_count_json(table)
+    assert packed_json["qurro_count_format"] == "csc"
+    assert packed_json["feature_ids"] == ["F2", "F3", "F1"]
+    assert packed_json["sample_ids"] == ["S3", "S1", "S2"]
+    assert packed_json["data_type"] == "Int32"
+    # Should be JSON-serializable
+    json.dumps(packed_json)
+    assert unpack_count_json(packed_json) == {
+        "F1": {"S3": 7, "S2": 3},
+        "F2": {"S1": 2, "S2": 1},
+        "F3": {},
+    }
+
+    # Non-integer counts should be stored as Float64s
+    table.matrix = table.matrix / 2
+    packed_json = get_packed_count_json(table)
+    assert packed_json["data_type"] == "Float64"
+    assert unpack_count_json(packed_json) == {
+        "F1": {"S3": 3.5, "S2": 1.5},
+        "F2": {"S1": 1, "S2": 0.5},
+        "F3": {},
+    }
+
+
+def test_sharded_count_json(tmp_path):
+    table = SparseTable(
+        np.array([[0, 2, 1], [0, 0, 0], [7, 0, 3], [0, 0, 4.5]]),
+        ["F2", "F3", "F1", "F4"],
+        ["S3", "S1", "S2"],
+    )
+    expected_counts = {
+        "F1": {"S3": 7, "S2": 3},
+        "F2": {"S1": 2, "S2": 1},
+        "F3": {},
+        "F4": {"S2": 4.5},
+    }
+    index_json, shards = get_sharded_count_json(table, 3)
+    assert index_json["qurro_count_format"] == "sharded"
+    assert index_json["feature_ids"] == ["F2", "F3", "F1", "F4"]
+    assert index_json["sample_ids"] == ["S3", "S1", "S2"]
+    assert index_json["data_type"] == "Float64"
+    assert index_json["shard_size"] == 3
+    assert index_json["num_shards"] == 2
+    json.dumps(index_json)
+
+    # Leftover shards from an earlier visualization should be removed
+    shard_dir = tmp_path / index_json["shard_dir"]
+    shard_dir.mkdir()
+    (shard_dir / "shard_5.js").write_text("oops")
+    assert write_count_shards(str(tmp_path), shards) == 2
+    assert sorted(p.name for p in shard_dir.iterdir()) == [
+        "shard_0.js",
+        "shard_1.js",
+    ]
+    shard_text = (shard_dir / "shard_1.js").read_text()
+    assert shard_text.startswith("qurroAddCountShard(1, {")
+    assert shard_text.endswith(");\n")
+    assert unpack_count_json(index_json, str(tmp_path)) == expected_counts
+
+    # Shard sizes larger than the number of features should also work
+    index_json, shards = get_sharded_count_json(table, 100)
+    assert index_json["num_shards"] == 1
+    assert write_count_shards(str(tmp_path), shards) == 1
+    assert unpack_count_json(index_json, str(tmp_path)) == expected_counts
+
+
+def test_sharded_count_json_bad_shard_size():
+    table = SparseTable(np.array([[1, 2]]), ["F1"], ["S1", "S2"])
+    with pytest.raises(ValueError) as exception_info:
+        get_sharded_count_json(table, 0)
+    assert "shard size must be at least 1" in str(exception_info.value)
+
+
+def test_compress_json():
+    json_obj = {"b": [1, 2.5, None], "a": "Qurro \u2713"}
+    compressed_json, uncompressed_size = compress_json(json_obj)
+    assert list(compressed_json) == ["qurro_compressed_json"]
+    assert uncompressed_size == len(json.dumps(json_obj, sort_keys=True))
+    assert decompress_json(compressed_json) == json_obj
+    # Iterables of JSON chunks should also work
+    compressed_json_2, _ = compress_json(iter(['{"a": ', "[1, 2]}"]))
+    assert decompress_json(compressed_json_2) == {"a": [1, 2]}
+    # Uncompressed JSONs should be left alone
+    assert decompress_json(json_obj) is json_obj
+    assert decompress_json({}) == {}
+
+
+def test_get_jsons_decompresses(tmp_path):
+    rank_json = {"data": {"name": "a"}, "datasets": {"a": [{"x": 1}]}}
+    count_json = {"qurro_count_format": "csc", "feature_ids": ["F1"]}
+    oloc = str(tmp_path / "main.js")
+    write_main_js(
+        join("qurro", "support_files", "main.js"),
+        oloc,
+        compress_json(rank_json)[0],
+        {},
+        compress_json(count_json)[0],
+    )
+    assert get_jsons(oloc) == (rank_json, {}, count_json)
+    # as_dict=False should give the raw (compressed) text
+    raw_rank_json = json.loads(get_jsons(oloc, as_dict=False)[0])
+    assert list(raw_rank_json) == ["qurro_compressed_json"]
+
+
+def test_df_to_dataset():
+    df = DataFrame(
+        {
+            "Ints": [1, 2, 3],
+            "Floats": [1.5, np.nan, np.inf],
+            "Bools": [True, False, True],
+            "Strings": ["a", None, "c"],
+            "Mixed": [1, "b", np.nan],
+            "Arrays": [np.array([1, 2]), "x", None],
+        }
+    )
+    name, records = df_to_dataset(df)
+    assert name.startswith("data-")
+    # The records should be exactly what Altair would produce
+    assert records == alt.utils.data.to_values(df)["values"]
+    assert records[1] == {
+        "Ints": 2,
+        "Floats": None,
+        "Bools": False,
+        "Strings": None,
+        "Mixed": "b",
+        "Arrays": "x",
+    }
+    assert type(records[0]["Ints"]) == int
+    # The name should only depend on the data
+    assert df_to_dataset(df.copy())[0] == name
+    df.iloc[0, 0] = 5
+    assert df_to_dataset(df)[0] != name
+
+
+def test_df_to_dataset_unsupported():
+    df = DataFrame({"Cat": Categorical(["a", "b"]), "Ints": [1, 2]})
+    assert df_to_dataset(df) is None
+    assert df_to_dataset(DataFrame({0: [1, 2]})) is None
+
+
+def test_get_dictionary_encoding():
+    col = Series(["Healthy", "Sick", None, "Healthy", "Sick", "Healthy"])
+    codes, dictionary = get_dictionary_encoding(col)
+    assert dictionary == ["Healthy", "Sick"]
+    assert codes == [0, 1, None, 0, 1, 0]
+    assert type(codes[0]) == int
+    assert [None if c is None else dictionary[c] for c in codes] == list(col)
+
+    # Columns with mostly unique values shouldn't be encoded
+    assert get_dictionary_encoding(Series(["a", "b", "c", "a"])) is None
+    # ...and neither should columns that don't just contain strings
+    assert get_dictionary_encoding(Series([1.5, 1.5, 1.5, 1.5])) is None
+    assert get_dictionary_encoding(Series(["abc", 1, "abc", 1])) is None
+    assert get_dictionary_encoding(Series([None, None], dtype=object)) is None
+
+
+def test_dictionary_encode_columns():
+    df = DataFrame(
+        {
+            "Repeated": ["Healthy", "Sick"] * 5,
+            "Unique": ["S{}".format(i) for i in range(10)],
+        }
+    )
+    encoded_df, dictionaries = dictionary_encode_columns(df, df.columns)
+    assert dictionaries == {"Repeated": ["Healthy", "Sick"]}
+    assert list(encoded_df["Repeated"]) == [0, 1] * 5
+    assert encoded_df["Unique"].equals(df["Unique"])
+    # The input DataFrame shouldn't be modified
+    assert list(df["Repeated"]) == ["Healthy", "Sick"] * 5
+    # Only the specified columns should be encoded
+    assert dictionary_encode_columns(df, ["Unique"])[1] == {}
+
+    # Encoded columns should be stored in the sample plot JSON
+    sample_json = gen_sample_plot(df)
+    dataset = sample_json["datasets"][sample_json["data"]["name"]]
+    assert sample_json["datasets"]["qurro_sample_metadata_dictionaries"] == (
+        dictionaries
+    )
+    assert [s["Repeated"] for s in dataset] == [0, 1] * 5
+    assert sample_json["datasets"]["qurro_sample_metadata_fields"] == [
+        "Repeated",
+        "Sample ID",
+        "Unique",
+    ]
+
+
+def test_fast_specs_match_altair():
+    """Checks that gen_rank_plot() and gen_sample_plot() create the same
+       specs using the "fast" spec mode as when just using Altair.
+    """
+    table, metadata, ranks = get_test_data()
+    st = SparseTable.from_dataframe(table)
+    ranks["Taxonomy"] = ["k__A;p__B", None, "x", "y", "z", "w", "v", "u"]
+    args = (ranks, "Differential", ranks.columns[:2], ["Taxonomy"], st)
+    fast_rank_json = gen_rank_plot(*args)
+    altair_rank_json = gen_rank_plot(*args, spec_mode="altair")
+    assert plot_jsons_equal(fast_rank_json, altair_rank_json)
+    # This raises an error if the specs differ
+    gen_rank_plot(*args, spec_mode="check")
+
+    fast_sample_json = gen_sample_plot(metadata)
+    altair_sample_json = gen_sample_plot(metadata, spec_mode="altair")
+    assert plot_jsons_equal(fast_sample_json, altair_sample_json)
+    gen_sample_plot(metadata, spec_mode="check")
+
+    # Field names that Altair would parse as something else should cause the
+    # "fast" spec mode to just use Altair (which, in this case, fails).
+    ranks.columns = ["Rank 0", "sum(x)", "Taxonomy"]
+    args = (ranks, "Differential", ranks.columns[:2], ["Taxonomy"], st)
+    with pytest.raises(ValueError) as exception_info:
+        gen_rank_plot(*args)
+    assert "sum(x) encoding field" in str(exception_info.value)
+
+
+def test_gen_spec_bad_spec_mode():
+    with pytest.raises(ValueError) as exception_info:
+        gen_spec(None, None, (), spec_mode="quick")
+    assert "spec_mode must be one of" in str(exception_info.value)
@@ -206,3 +206,53 @@ def test_read_metadata_file_nan_id():
 
     with pytest.raises(qiime2.metadata.MetadataFileError):
         qiime2.Metadata.load(ni)
+
+
+def test_read_metadata_file_q2_lines_stringio():
+    """Tests that #q2: lines are skipped only at the top of a metadata file,
+       including when the file is given as a StringIO.
+    """
+    from io import StringIO
+
+    md = StringIO(
+        "Sample ID\tMD1\n" "#q2:types\tcategorical\n" "S1\t a \n" "#q2:S2\tb\n"
+    )
+    df = read_metadata_file(md)
+    assert list(df.index) == ["S1", "#q2:S2"]
+    assert list(df["MD1"]) == ["a", "b"]
+
+
+@pytest.mark.parametrize(
+    "md_name", ["md1.tsv", "md3.tsv", "weird_metadata.tsv", "whitespace.tsv"]
+)
+def test_read_metadata_file_engines_equal(md_name):
+    """Tests that the pandas and pyarrow engines give the same output.
+
+       (For whitespace.tsv, which contains rows with fewer fields than the
+       header, the pyarrow engine should fall back to pandas.)
+    """
+    pytest.importorskip("pyarrow")
+    md = os.path.join("qurro", "tests", "input", "metadata_tests", md_name)
+    assert_frame_equal(
+        read_metadata_file(md, engine="pyarrow"),
+        read_metadata_file(md, engine="pandas"),
+    )
+
+
+def test_read_metadata_file_bad_engine():
+    md = os.path.join("qurro", "tests", "input", "metadata_tests", "md1.tsv")
+    with pytest.raises(ValueError) as exception_info:
+        read_metadata_file(md, engine="polars")
+    assert "polars" in str(exception_info.value)
+
+
+def test_read_metadata_file_utf8(tmp_path):
+    """Tests that metadata files are read as UTF-8, regardless of the
+       locale's preferred encoding.
+    """
+    md_loc = tmp_path / "md.tsv"
+    md_loc.write_bytes(
+        "Sample ID\tSite\n#q2:types\tcategorical\nS1\tMálaga\n".encode("utf-8")
+    )
+    df = read_metadata_file(str(md_loc))
+    assert list(df["Site"]) == ["Málaga"]
@@ -1,4 +1,7 @@
+import os
+from qiime2 import Artifact
 from qiime2.plugins import qurro as q2qurro
+from qurro.q2._visualizer_utils import get_artifact_uuid
 
 
 def test_citation_loaded():
@@ -17,3 +20,21 @@ def test_citation_loaded():
         "González, Antonio and Rahman, Gibraan and Marotz, Clarisse A and "
         "Minich, Jeremiah J and Allen, Eric E and Knight, Rob"
     )
+
+
+def test_get_artifact_uuid(tmp_path):
+    """Checks that get_artifact_uuid() finds the UUID of the artifact a BIOM
+       table view is from, and returns None for other files.
+    """
+    from q2_types.feature_table import BIOMV210Format
+
+    table_qza = Artifact.import_data(
+        "FeatureTable[Frequency]",
+        os.path.join("qurro", "tests", "input", "matching_test", "mt.biom"),
+        view_type="BIOMV100Format",
+    )
+    table_view = table_qza.view(BIOMV210Format)
+    assert get_artifact_uuid(table_view) == str(table_qza.uuid)
+
+    assert get_artifact_uuid(str(tmp_path / "data" / "table.biom")) is None
+    assert get_artifact_uuid(str(tmp_path / "table.biom")) is None
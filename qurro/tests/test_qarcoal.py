@@ -4,13 +4,32 @@ from collections import namedtuple
 import os
 
 import biom
+import h5py
 import numpy as np
 import pandas as pd
 import pytest
 from q2_types.sample_data import SampleData
 from qiime2 import Metadata
 from qiime2.plugin.testing import TestPluginBase
-from qurro.qarcoal import qarcoal, filter_and_join_taxonomy
+from click.testing import CliRunner
+from qurro.qarcoal import (
+    qarcoal,
+    qarcoal_batch,
+    batch_log_ratios,
+    iter_streamed_log_ratios,
+    write_streamed_log_ratios,
+    filter_and_join_taxonomy,
+    get_indicator_matrix,
+    aggregate_log_counts,
+    get_pair_stats,
+    select_top_pairs,
+    pairwise_log_ratios,
+    qarcoal_pairwise,
+)
+from qurro.scripts._qarcoal import (
+    qarcoal_batch as qarcoal_batch_cli,
+    qarcoal_pairwise as qarcoal_pairwise_cli,
+)
 from qurro.q2._type import LogRatios, LogRatiosDirFmt
 
 MP_URL = "qurro/tests/input/moving_pictures"
@@ -105,6 +124,30 @@ class TestQarcoalOutput:
 
         assert qarcoal_results - qurro_results == pytest.approx(0)
 
+    def test_matches_dense_sums(self, get_mp_data, get_mp_results):
+        """Checks that the sums computed from the sparse table are the same
+           as those computed from a dense version of the table.
+        """
+        num_df, denom_df = filter_and_join_taxonomy(
+            get_mp_data.table.to_dataframe(dense=True),
+            get_mp_data.taxonomy,
+            "g__Bacteroides",
+            "g__Streptococcus",
+        )
+        # Samples should be in the same order as in the table
+        assert list(get_mp_results.index) == list(num_df.columns)
+        assert get_mp_results.index.name == "Sample-ID"
+        np.testing.assert_equal(
+            get_mp_results["Num_Sum"].values, num_df.sum(axis=0).values
+        )
+        np.testing.assert_equal(
+            get_mp_results["Denom_Sum"].values, denom_df.sum(axis=0).values
+        )
+        np.testing.assert_allclose(
+            get_mp_results["log_ratio"].values,
+            np.log(num_df.sum(axis=0).values / denom_df.sum(axis=0).values),
+        )
+
 
 class TestErrors:
     def test_invalid_num(self, get_mp_data):
@@ -209,6 +252,37 @@ class TestErrors:
             qarcoal(table, taxonomy, "A", "C")
         assert "Feature table has negative counts!" == str(excinfo.value)
 
+    def test_error_order(self):
+        """Checks which error is raised when there are several problems.
+
+           Negative counts are checked for first, then features matching the
+           numerator/denominator, then shared samples, then shared features.
+        """
+        samps = ["S0", "S1"]
+        feats = ["F0", "F1", "F2"]
+        taxonomy = pd.DataFrame(
+            {"Taxon": ["AB", "CD", "ABC"]}, index=pd.Index(feats)
+        )
+
+        neg_table = biom.table.Table(
+            np.array([[-1, 2], [3, 4], [5, 6]]), feats, samps
+        )
+        with pytest.raises(ValueError) as excinfo:
+            qarcoal(neg_table, taxonomy, "Z", "C")
+        assert "Feature table has negative counts!" == str(excinfo.value)
+
+        # F2 is in both the numerator and denominator, but it isn't present
+        # in any samples -- so no samples contain both
+        table = biom.table.Table(
+            np.array([[1, 0], [0, 2], [0, 0]]), feats, samps
+        )
+        with pytest.raises(ValueError) as excinfo:
+            qarcoal(table, taxonomy, "A", "C")
+        assert (
+            "No samples contain both numerator and denominator features!"
+            == str(excinfo.value)
+        )
+
 
 class TestOptionalParams:
     def test_shared_features_allowed(self, get_mp_data):
@@ -443,3 +517,633 @@ class TestIrregularData:
 
         # differences are ~ 10^-6
         assert diff == pytest.approx(0, abs=1e-5)
+
+
+@pytest.fixture(scope="module")
+def get_mp_queries():
+    return pd.DataFrame(
+        {
+            "numerator": ["g__Bacteroides", "p__Bacteroidetes", "Proteo"],
+            "denominator": ["g__Streptococcus", "p__Firmicutes", "Actino"],
+        },
+        index=["bact_strep", "phyla", "prot_act"],
+    )
+
+
+class TestBatch:
+    def test_matches_single_queries(self, get_mp_data, get_mp_queries):
+        batch_df = batch_log_ratios(
+            get_mp_data.table, get_mp_data.taxonomy, get_mp_queries
+        )
+        assert list(batch_df.columns) == list(get_mp_queries.index)
+        assert batch_df.index.name == "Sample-ID"
+        for name, num, denom in get_mp_queries.itertuples():
+            q = qarcoal(get_mp_data.table, get_mp_data.taxonomy, num, denom)
+            # Samples that qarcoal() drops should have NaN log-ratios
+            query_ratios = batch_df[name].dropna()
+            assert list(query_ratios.index) == list(q.index)
+            np.testing.assert_equal(query_ratios.values, q["log_ratio"].values)
+        # Samples dropped for every query shouldn't be in the output
+        assert batch_df.notna().any(axis=1).all()
+
+    def test_samples_to_use(self, get_mp_data, get_mp_queries):
+        metadata_url = os.path.join(MP_URL, "sample-metadata.tsv")
+        sample_metadata = pd.read_csv(
+            metadata_url, sep="\t", index_col=0, skiprows=[1], header=0
+        )
+        gut_samples = sample_metadata[sample_metadata["BodySite"] == "gut"]
+        batch_df = qarcoal_batch(
+            get_mp_data.table,
+            get_mp_data.taxonomy,
+            Metadata(get_mp_queries.rename_axis("id")),
+            samples_to_use=Metadata(gut_samples),
+        )
+        assert set(batch_df.index) <= set(gut_samples.index)
+        assert list(batch_df.columns) == list(get_mp_queries.index)
+
+    def test_sample_dropping(self):
+        """Each query drops samples in the same way as qarcoal() does.
+
+           --------------------------------------
+          |                    S0    S1    S2    |
+          | F0/Charmander       0     1    10    |
+          | F1/Bulbasaur        5     0     3    |
+          | F2/Squirtle         2     4     0    |
+           --------------------------------------
+        """
+        mat = np.array([[0, 1, 10], [5, 0, 3], [2, 4, 0]])
+        table = biom.table.Table(mat, ["F0", "F1", "F2"], ["S0", "S1", "S2"])
+        taxonomy = pd.DataFrame(
+            {"Taxon": ["Charmander", "Bulbasaur", "Squirtle"]},
+            index=["F0", "F1", "F2"],
+        )
+        queries = pd.DataFrame(
+            {"numerator": ["Char", "Bulb"], "denominator": ["Bulb", "Squirt"]},
+            index=["CB", "BS"],
+        )
+        batch_df = batch_log_ratios(table, taxonomy, queries)
+        assert list(batch_df.index) == ["S0", "S2"]
+        np.testing.assert_equal(
+            batch_df["CB"].values, [np.nan, np.log(10 / 3)]
+        )
+        np.testing.assert_equal(batch_df["BS"].values, [np.log(5 / 2), np.nan])
+
+    def test_errors_mention_query(self, get_mp_data, get_mp_queries):
+        queries = get_mp_queries.copy()
+        queries.loc["bad", :] = ["beyblade", "Firm"]
+        with pytest.raises(ValueError) as excinfo:
+            batch_log_ratios(get_mp_data.table, get_mp_data.taxonomy, queries)
+        assert (
+            'Query "bad": No feature(s) found matching numerator string!'
+            == str(excinfo.value)
+        )
+
+        shared = pd.DataFrame(
+            {"numerator": ["Firmicutes"], "denominator": ["Bacilli"]},
+            index=["FB"],
+        )
+        with pytest.raises(ValueError) as excinfo:
+            batch_log_ratios(get_mp_data.table, get_mp_data.taxonomy, shared)
+        assert 'Query "FB": Shared features between num and denom!' == str(
+            excinfo.value
+        )
+        batch_log_ratios(
+            get_mp_data.table,
+            get_mp_data.taxonomy,
+            shared,
+            allow_shared_features=True,
+        )
+
+    def test_indicator_matrix(self):
+        num_masks = [np.array([1, 0, 1], dtype=bool), np.zeros(3, dtype=bool)]
+        denom_masks = [np.array([0, 1, 0], dtype=bool), np.ones(3, dtype=bool)]
+        indicators = get_indicator_matrix(num_masks, denom_masks)
+        assert indicators.format == "csc"
+        np.testing.assert_array_equal(
+            indicators.toarray(),
+            np.column_stack(num_masks + denom_masks).astype(float),
+        )
+
+    def test_invalid_queries(self, get_mp_data, get_mp_queries):
+        for queries, err in (
+            (
+                get_mp_queries.drop(columns="denominator"),
+                "missing the following column(s): denominator",
+            ),
+            (get_mp_queries.iloc[[0, 0]], "Duplicate name(s): bact_strep"),
+            (get_mp_queries.iloc[:0], "No Qarcoal queries were specified."),
+        ):
+            with pytest.raises(ValueError) as excinfo:
+                batch_log_ratios(
+                    get_mp_data.table, get_mp_data.taxonomy, queries
+                )
+            assert err in str(excinfo.value)
+
+    def test_cli(self, tmp_path, get_mp_data, get_mp_queries):
+        queries_loc = str(tmp_path / "queries.tsv")
+        output_loc = str(tmp_path / "log_ratios.tsv")
+        get_mp_queries.rename_axis("id").to_csv(queries_loc, sep="\t")
+        result = CliRunner().invoke(
+            qarcoal_batch_cli,
+            [
+                "-t",
+                os.path.join(MP_URL, "feature-table.biom"),
+                "-tx",
+                os.path.join(MP_URL, "taxonomy.tsv"),
+                "-q",
+                queries_loc,
+                "-o",
+                output_loc,
+            ],
+        )
+        assert result.exit_code == 0
+        output = pd.read_csv(output_loc, sep="\t", index_col=0)
+        expected = batch_log_ratios(
+            get_mp_data.table, get_mp_data.taxonomy, get_mp_queries
+        )
+        assert list(output.index) == list(expected.index)
+        np.testing.assert_allclose(output.values, expected.values)
+
+    def test_cli_taxonomy_index(self, tmp_path, get_mp_data, get_mp_queries):
+        queries_loc = str(tmp_path / "queries.tsv")
+        index_loc = str(tmp_path / "taxonomy_index")
+        get_mp_queries.rename_axis("id").to_csv(queries_loc, sep="\t")
+        args = [
+            "-t",
+            os.path.join(MP_URL, "feature-table.biom"),
+            "-tx",
+            os.path.join(MP_URL, "taxonomy.tsv"),
+            "-q",
+            queries_loc,
+            "--match-mode",
+            "literal",
+            "--taxonomy-index",
+            index_loc,
+        ]
+        outputs = []
+        # The first run builds the index, and the second run loads it
+        for i in range(2):
+            output_loc = str(tmp_path / "log_ratios{}.tsv".format(i))
+            result = CliRunner().invoke(
+                qarcoal_batch_cli, args + ["-o", output_loc]
+            )
+            assert result.exit_code == 0
+            assert os.path.exists(index_loc)
+            outputs.append(pd.read_csv(output_loc, sep="\t", index_col=0))
+        expected = batch_log_ratios(
+            get_mp_data.table, get_mp_data.taxonomy, get_mp_queries
+        )
+        for output in outputs:
+            assert list(output.index) == list(expected.index)
+            np.testing.assert_allclose(output.values, expected.values)
+
+
+class TestMatchModes:
+    def test_literal(self, get_mp_data, get_mp_results):
+        """For strings without any special regex characters, literal
+           matching should give the same results as regex matching.
+        """
+        q = qarcoal(
+            get_mp_data.table,
+            get_mp_data.taxonomy,
+            "g__Bacteroides",
+            "g__Streptococcus",
+            match_mode="literal",
+        )
+        _check_dataframe_equality(q, get_mp_results)
+
+        # "." is a wildcard in a regex, but not in a literal string
+        with pytest.raises(ValueError) as excinfo:
+            qarcoal(
+                get_mp_data.table,
+                get_mp_data.taxonomy,
+                "g__Bacteroide.",
+                "g__Streptococcus",
+                match_mode="literal",
+            )
+        assert "No feature(s) found matching numerator string!" == str(
+            excinfo.value
+        )
+
+    def test_rank(self):
+        """Rank matching only matches complete taxonomic ranks.
+
+           -----------------------------------------------
+          |                                S0    S1    S2 |
+          | F0/g__Staph                     1     2     0 |
+          | F1/g__Staph_A                   4     0     8 |
+          | F2/g__Strep                     5     3     2 |
+           -----------------------------------------------
+        """
+        mat = np.array([[1, 2, 0], [4, 0, 8], [5, 3, 2]])
+        table = biom.table.Table(mat, ["F0", "F1", "F2"], ["S0", "S1", "S2"])
+        taxonomy = pd.DataFrame(
+            {
+                "Taxon": [
+                    "k__B; g__Staph",
+                    "k__B; g__Staph_A",
+                    "k__B; g__Strep",
+                ]
+            },
+            index=["F0", "F1", "F2"],
+        )
+        q = qarcoal(table, taxonomy, "g__Staph", "g__Strep", match_mode="rank")
+        assert list(q.index) == ["S0", "S1"]
+        np.testing.assert_equal(q["Num_Sum"].values, [1, 2])
+
+        q = qarcoal(
+            table, taxonomy, "g__Staph", "g__Strep", match_mode="literal"
+        )
+        assert list(q.index) == ["S0", "S1", "S2"]
+        np.testing.assert_equal(q["Num_Sum"].values, [5, 2, 8])
+
+
+class TestStreaming:
+    table_loc = os.path.join(MP_URL, "feature-table.biom")
+
+    @pytest.mark.parametrize("block_size", [1, 7, 1000])
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_matches_batch(
+        self, get_mp_data, get_mp_queries, block_size, workers
+    ):
+        expected = batch_log_ratios(
+            get_mp_data.table, get_mp_data.taxonomy, get_mp_queries
+        )
+        blocks = list(
+            iter_streamed_log_ratios(
+                self.table_loc,
+                get_mp_data.taxonomy,
+                get_mp_queries,
+                block_size=block_size,
+                workers=workers,
+            )
+        )
+        assert len(blocks) == -(-get_mp_data.table.shape[1] // block_size)
+        streamed = pd.concat(blocks)
+        assert list(streamed.index) == list(expected.index)
+        assert streamed.index.name == "Sample-ID"
+        assert list(streamed.columns) == list(expected.columns)
+        np.testing.assert_equal(streamed.values, expected.values)
+
+    def test_sample_ids(self, get_mp_data, get_mp_queries):
+        sample_ids = list(get_mp_data.table.ids())[::3]
+        expected = batch_log_ratios(
+            get_mp_data.table,
+            get_mp_data.taxonomy,
+            get_mp_queries,
+            sample_ids=sample_ids,
+        )
+        streamed = pd.concat(
+            iter_streamed_log_ratios(
+                self.table_loc,
+                get_mp_data.taxonomy,
+                get_mp_queries,
+                sample_ids=sample_ids,
+                block_size=4,
+            )
+        )
+        assert list(streamed.index) == list(expected.index)
+        np.testing.assert_equal(streamed.values, expected.values)
+
+    def test_write(self, tmp_path, get_mp_data, get_mp_queries):
+        output_loc = str(tmp_path / "streamed.tsv")
+        assert write_streamed_log_ratios(
+            output_loc,
+            self.table_loc,
+            get_mp_data.taxonomy,
+            get_mp_queries,
+            block_size=5,
+        ) == (34, 3)
+        expected_loc = str(tmp_path / "batch.tsv")
+        batch_log_ratios(
+            get_mp_data.table, get_mp_data.taxonomy, get_mp_queries
+        ).to_csv(expected_loc, sep="\t")
+        with open(output_loc) as output, open(expected_loc) as expected:
+            assert output.read() == expected.read()
+
+        # If an error occurs, no output (and no temporary files) should be
+        # left behind
+        with pytest.raises(ValueError) as excinfo:
+            write_streamed_log_ratios(
+                str(tmp_path / "error.tsv"),
+                self.table_loc,
+                get_mp_data.taxonomy,
+                get_mp_queries,
+                sample_ids=["not a sample"],
+            )
+        assert (
+            'Query "bact_strep": No samples contain both numerator and '
+            "denominator features!"
+        ) == str(excinfo.value)
+        assert sorted(os.listdir(str(tmp_path))) == [
+            "batch.tsv",
+            "streamed.tsv",
+        ]
+
+    def test_negative_counts(self, tmp_path):
+        mat = np.array([[1, 2, 3], [4, -5, 6]])
+        table_loc = str(tmp_path / "table.biom")
+        with h5py.File(table_loc, "w") as h5grp:
+            biom.table.Table(mat, ["F0", "F1"], ["S0", "S1", "S2"]).to_hdf5(
+                h5grp, "Qurro tests"
+            )
+        taxonomy = pd.DataFrame({"Taxon": ["AB", "CD"]}, index=["F0", "F1"])
+        queries = pd.DataFrame(
+            {"numerator": ["A"], "denominator": ["C"]}, index=["AC"]
+        )
+        # The first block doesn't contain the negative count
+        blocks = iter_streamed_log_ratios(
+            table_loc, taxonomy, queries, block_size=1
+        )
+        assert list(next(blocks).index) == ["S0"]
+        with pytest.raises(ValueError) as excinfo:
+            next(blocks)
+        assert "Feature table has negative counts!" == str(excinfo.value)
+
+    def test_error_order(self, tmp_path):
+        """Checks the errors raised by streaming and batch Qarcoal when
+           several queries are invalid.
+        """
+        mat = np.array([[1, 0, 3], [0, 5, 0]])
+        table = biom.table.Table(mat, ["F0", "F1"], ["S0", "S1", "S2"])
+        table_loc = str(tmp_path / "table.biom")
+        with h5py.File(table_loc, "w") as h5grp:
+            table.to_hdf5(h5grp, "Qurro tests")
+        taxonomy = pd.DataFrame({"Taxon": ["AB", "CD"]}, index=["F0", "F1"])
+        # The first query has no samples containing both its numerator and
+        # denominator; the second query has shared features. Batch Qarcoal
+        # checks for errors in the same order as single-query Qarcoal, but
+        # streaming checks for shared features before reading the table.
+        queries = pd.DataFrame(
+            {"numerator": ["A", "A"], "denominator": ["C", "B"]},
+            index=["no_samples", "shared"],
+        )
+        with pytest.raises(ValueError) as batch_excinfo:
+            batch_log_ratios(table, taxonomy, queries)
+        assert str(batch_excinfo.value) == (
+            'Query "no_samples": No samples contain both numerator and '
+            "denominator features!"
+        )
+        with pytest.raises(ValueError) as stream_excinfo:
+            list(iter_streamed_log_ratios(table_loc, taxonomy, queries))
+        assert str(stream_excinfo.value) == (
+            'Query "shared": Shared features between num and denom!'
+        )
+
+        # With only one invalid query, the errors are the same
+        shared_query = queries.loc[["shared"]]
+        with pytest.raises(ValueError) as batch_excinfo:
+            batch_log_ratios(table, taxonomy, shared_query)
+        with pytest.raises(ValueError) as stream_excinfo:
+            list(iter_streamed_log_ratios(table_loc, taxonomy, shared_query))
+        assert str(batch_excinfo.value) == str(stream_excinfo.value)
+
+    def test_cli(self, tmp_path, get_mp_data, get_mp_queries):
+        queries_loc = str(tmp_path / "queries.tsv")
+        get_mp_queries.rename_axis("id").to_csv(queries_loc, sep="\t")
+        outputs = []
+        for i, extra_args in enumerate(
+            ([], ["--stream", "--sample-block-size", "3", "--workers", "2"])
+        ):
+            output_loc = str(tmp_path / "log_ratios{}.tsv".format(i))
+            result = CliRunner().invoke(
+                qarcoal_batch_cli,
+                [
+                    "-t",
+                    self.table_loc,
+                    "-tx",
+                    os.path.join(MP_URL, "taxonomy.tsv"),
+                    "-q",
+                    queries_loc,
+                    "-o",
+                    output_loc,
+                ]
+                + extra_args,
+            )
+            assert result.exit_code == 0
+            with open(output_loc) as output:
+                outputs.append(output.read())
+        assert outputs[0] == outputs[1]
+
+
+class TestPairwise:
+    def test_aggregate_log_counts(self):
+        table = biom.Table(
+            np.array([[1, 0, 3], [2, 0, 0], [4, 5, 6], [7, 8, 9]]),
+            ["F0", "F1", "F2", "F3"],
+            ["S0", "S1", "S2"],
+        )
+        taxonomy = pd.DataFrame(
+            {
+                "Taxon": [
+                    "k__A; p__B",
+                    "k__A; p__B",
+                    "k__A; p__C",
+                    "k__A; p__",
+                ]
+            },
+            index=["F0", "F1", "F2", "F3"],
+        )
+        log_counts = aggregate_log_counts(table, taxonomy, 1)
+        assert list(log_counts.columns) == ["p__B", "p__C"]
+        assert list(log_counts.index) == ["S0", "S1", "S2"]
+        assert log_counts.index.name == "Sample-ID"
+        np.testing.assert_equal(
+            log_counts.values, np.log([[3, 4], [np.nan, 5], [3, 6]]),
+        )
+        log_counts = aggregate_log_counts(table, taxonomy, 0, ["S2", "S1"])
+        assert list(log_counts.columns) == ["k__A"]
+        assert list(log_counts.index) == ["S1", "S2"]
+        np.testing.assert_equal(log_counts.values, np.log([[13], [18]]))
+
+        with pytest.raises(ValueError) as excinfo:
+            aggregate_log_counts(table, taxonomy, 2)
+        assert (
+            "No features in the table have a name at level 2 of the "
+            "taxonomy."
+        ) == str(excinfo.value)
+
+    def test_pair_stats_match_log_ratios(self, get_mp_data):
+        log_counts = aggregate_log_counts(
+            get_mp_data.table, get_mp_data.taxonomy, 4
+        )
+        num_taxa = len(log_counts.columns)
+        n_samples, mean, std = get_pair_stats(log_counts)
+        assert mean.shape == (num_taxa, num_taxa)
+        np.testing.assert_array_equal(mean, -mean.T)
+        np.testing.assert_array_equal(n_samples, n_samples.T)
+
+        # With min_samples=0, every pair should be selected (once)
+        stats = select_top_pairs(log_counts, min_samples=0)
+        assert len(stats.index) == num_taxa * (num_taxa - 1) // 2
+        pair_taxa = set(zip(stats["Numerator"], stats["Denominator"]))
+        assert not any((d, n) in pair_taxa for n, d in pair_taxa)
+        assert (stats["mean"].dropna() >= 0).all()
+
+        log_ratios = pairwise_log_ratios(log_counts, stats, chunk_size=7)
+        pair_n_samples = np.sum(~np.isnan(log_ratios), axis=0)
+        assert list(stats["n_samples"]) == list(pair_n_samples)
+        # Compare to the statistics of the log-ratios, computed directly
+        for min_n, col, func in (
+            (1, "mean", np.mean),
+            (2, "std", lambda x: np.std(x, ddof=1)),
+        ):
+            assert stats[col].isna().sum() == np.sum(pair_n_samples < min_n)
+            for i in np.flatnonzero(pair_n_samples >= min_n):
+                pair_lrs = log_ratios[:, i]
+                expected = func(pair_lrs[~np.isnan(pair_lrs)])
+                assert stats[col].iloc[i] == pytest.approx(expected, abs=1e-9)
+
+    def test_pair_stats_precision(self):
+        """Checks that the standard deviations of log-ratios with a large
+           mean and a small spread are computed accurately.
+        """
+        noise = np.random.RandomState(0).normal(scale=1e-4, size=(50, 2))
+        log_counts = pd.DataFrame(noise + [500, -500], columns=["a", "b"])
+        n_samples, mean, std = get_pair_stats(log_counts)
+        expected_lrs = (log_counts["a"] - log_counts["b"]).values
+        assert n_samples[0, 1] == 50
+        assert mean[0, 1] == pytest.approx(np.mean(expected_lrs), rel=1e-12)
+        assert std[0, 1] == pytest.approx(
+            np.std(expected_lrs, ddof=1), rel=1e-6
+        )
+
+    def test_log_ratios_match_qarcoal(self, get_mp_data):
+        result = qarcoal_pairwise(
+            get_mp_data.table, get_mp_data.taxonomy, 5, top_k=3
+        )
+        assert result.shape[1] == 3
+        for pair_name in result.columns:
+            num, denom = pair_name.split("/")
+            expected = qarcoal(
+                get_mp_data.table,
+                get_mp_data.taxonomy,
+                num,
+                denom,
+                match_mode="rank",
+            )
+            pair_log_ratios = result[pair_name].dropna()
+            assert list(pair_log_ratios.index) == list(expected.index)
+            np.testing.assert_allclose(
+                pair_log_ratios.values, expected["log_ratio"].values
+            )
+
+    def test_select_top_pairs(self):
+        log_counts = pd.DataFrame(
+            np.log(
+                [
+                    [1, 2, 8, np.nan],
+                    [1, 4, 8, 1],
+                    [1, 8, 8, np.nan],
+                    [1, 2, np.nan, np.nan],
+                ]
+            ),
+            columns=["a", "b", "c", "d"],
+        )
+
+        def get_pair_list(pairs):
+            return list(zip(pairs["Numerator"], pairs["Denominator"]))
+
+        # Pairs are oriented so that their means are positive, even if this
+        # means that the numerator comes after the denominator. (Here, the
+        # mean of d/a is 0, so this pair is oriented alphabetically.)
+        pairs = select_top_pairs(log_counts)
+        assert get_pair_list(pairs) == [
+            ("c", "a"),
+            ("c", "d"),
+            ("b", "d"),
+            ("b", "a"),
+            ("c", "b"),
+            ("a", "d"),
+        ]
+        assert pairs["mean"].iloc[0] == pytest.approx(np.log(8))
+        assert pairs["mean"].iloc[-1] == 0
+        assert list(pairs["n_samples"]) == [3, 1, 1, 4, 3, 1]
+        assert get_pair_list(select_top_pairs(log_counts, top_k=3)) == [
+            ("c", "a"),
+            ("c", "d"),
+            ("b", "d"),
+        ]
+        # n_samples has lots of ties: these should be broken by the taxa's
+        # positions, even when only some of the tied pairs are selected
+        assert get_pair_list(
+            select_top_pairs(log_counts, top_k=4, sort_by="n_samples")
+        ) == [("b", "a"), ("c", "a"), ("c", "b"), ("a", "d")]
+        # Pairs with a NaN std should be sorted last
+        assert get_pair_list(
+            select_top_pairs(log_counts, sort_by="std", min_samples=0)
+        )[:3] == [("c", "b"), ("b", "a"), ("c", "a")]
+        assert get_pair_list(select_top_pairs(log_counts, min_samples=2)) == [
+            ("c", "a"),
+            ("b", "a"),
+            ("c", "b"),
+        ]
+
+        with pytest.raises(ValueError) as excinfo:
+            select_top_pairs(log_counts, min_samples=5)
+        assert (
+            "No pairs of taxa are both present in at least 5 sample(s)."
+            == str(excinfo.value)
+        )
+        with pytest.raises(ValueError) as excinfo:
+            select_top_pairs(log_counts, sort_by="median")
+        assert "Unrecognized pair sort key: median." in str(excinfo.value)
+
+    def test_memmap_output(self, tmp_path, get_mp_data):
+        log_counts = aggregate_log_counts(
+            get_mp_data.table, get_mp_data.taxonomy, 5
+        )
+        pairs = select_top_pairs(log_counts, top_k=50)
+        expected = pairwise_log_ratios(log_counts, pairs)
+        out = np.lib.format.open_memmap(
+            str(tmp_path / "lr.npy"), mode="w+", shape=expected.shape
+        )
+        assert pairwise_log_ratios(log_counts, pairs, 9, out) is out
+        out.flush()
+        del out
+        np.testing.assert_equal(np.load(str(tmp_path / "lr.npy")), expected)
+
+    def test_cli(self, tmp_path, get_mp_data):
+        output_dir = str(tmp_path / "out")
+        result = CliRunner().invoke(
+            qarcoal_pairwise_cli,
+            [
+                "-t",
+                os.path.join(MP_URL, "feature-table.biom"),
+                "-tx",
+                os.path.join(MP_URL, "taxonomy.tsv"),
+                "-l",
+                "5",
+                "-o",
+                output_dir,
+                "-k",
+                "10",
+                "--sort-by",
+                "std",
+                "--min-samples",
+                "5",
+                "--write-log-ratios",
+            ],
+        )
+        assert result.exit_code == 0
+        assert sorted(os.listdir(output_dir)) == [
+            "log_ratios.npy",
+            "pair_stats.tsv",
+            "sample_ids.txt",
+        ]
+        log_counts = aggregate_log_counts(
+            get_mp_data.table, get_mp_data.taxonomy, 5
+        )
+        pairs = select_top_pairs(log_counts, 10, "std", 5)
+        pair_stats = pd.read_csv(
+            os.path.join(output_dir, "pair_stats.tsv"), sep="\t"
+        )
+        assert list(pair_stats["Numerator"]) == list(pairs["Numerator"])
+        assert list(pair_stats["Denominator"]) == list(pairs["Denominator"])
+        np.testing.assert_allclose(pair_stats["std"], pairs["std"])
+        with open(os.path.join(output_dir, "sample_ids.txt")) as ids_obj:
+            assert ids_obj.read().split() == list(log_counts.index)
+        np.testing.assert_equal(
+            np.load(os.path.join(output_dir, "log_ratios.npy")),
+            pairwise_log_ratios(log_counts, pairs),
+        )
@@ -0,0 +1,170 @@
+import os
+import numpy as np
+from pandas import DataFrame
+import pytest
+from click.testing import CliRunner
+from qurro._rank_utils import get_extreme_feature_mask
+from qurro._size_utils import (
+    get_extreme_ranks,
+    estimate_feature_sizes,
+    estimate_fixed_size,
+    choose_extreme_feature_count,
+)
+from qurro._table_utils import SparseTable
+from qurro.generate import finish_input, process_and_generate
+from qurro.scripts._plot import plot
+from qurro.tests.test_df_utils import get_test_data
+
+
+def get_size_test_data():
+    table, metadata, ranks = get_test_data()
+    return SparseTable.from_dataframe(table), metadata, ranks
+
+
+def test_get_extreme_ranks():
+    """Checks that get_extreme_ranks() is consistent with
+       get_extreme_feature_mask(), including when there are ties and NaNs.
+    """
+    ranks = DataFrame(
+        {
+            "Rank 0": [5, 1, 1, 2, 3, 4, 5, 0, np.nan],
+            "Rank 1": [0, 0, 0, 0, 0, 0, 0, 1, np.nan],
+            "Rank 2": [3, 2, 1, 9, 9, 9, 4, 2, np.nan],
+        },
+        index=["F1", "F2", "F3", "F4", "F5", "F6", "F7", "F8", "F9"],
+    )
+    extreme_ranks = get_extreme_ranks(ranks)
+    assert extreme_ranks[-1] == 10
+    for efc in range(1, 9):
+        mask = get_extreme_feature_mask(ranks, efc)
+        assert list(extreme_ranks <= efc) == list(mask)
+
+
+def test_estimate_sizes():
+    table, metadata, ranks = get_size_test_data()
+    sizes = estimate_feature_sizes(table, ranks)
+    assert len(sizes) == len(ranks.index)
+    assert np.all(sizes > 0)
+    # Features with more nonzero counts should take up more space
+    # (F1 has 3 nonzero counts, and F2 has 2 nonzero counts)
+    assert sizes[0] > sizes[1]
+
+    feature_metadata = DataFrame(
+        {"Taxonomy": ["a" * 100] * 8}, index=ranks.index
+    )
+    assert np.all(
+        estimate_feature_sizes(table, ranks, feature_metadata) > sizes + 100
+    )
+    assert estimate_fixed_size(metadata) > estimate_fixed_size(metadata[[]])
+
+
+def test_estimate_close_to_actual_size(tmp_path):
+    """Checks that the estimated size of a visualization's data is close to
+       the size of the main.js file that is actually generated.
+    """
+    from biom import load_table
+    from qurro._metadata_utils import read_metadata_file
+    from qurro._rank_utils import read_rank_file
+    from qurro.generate import match_input
+
+    in_dir = os.path.join("qurro", "tests", "input", "sleep_apnea", "")
+    ranks, rank_type = read_rank_file(in_dir + "ordination.txt")
+    sample_metadata = read_metadata_file(in_dir + "qiita_10422_metadata.tsv")
+    table = load_table(in_dir + "qiita_10422_table.biom")
+    m_table, m_sample_metadata = match_input(ranks, sample_metadata, table)
+    estimated_size = estimate_fixed_size(m_sample_metadata) + np.sum(
+        estimate_feature_sizes(m_table, ranks)
+    )
+
+    process_and_generate(
+        ranks, rank_type, sample_metadata, table, str(tmp_path)
+    )
+    actual_size = os.path.getsize(str(tmp_path / "main.js"))
+    assert abs(estimated_size - actual_size) / actual_size < 0.05
+
+
+def test_choose_extreme_feature_count(capsys):
+    table, metadata, ranks = get_size_test_data()
+    feature_sizes = estimate_feature_sizes(table, ranks)
+    fixed_size = estimate_fixed_size(metadata)
+    # In the test data, Rank 0 is sorted in ascending order, so an extreme
+    # feature count of k keeps the first and last k features
+    efc1_size = fixed_size + feature_sizes[[0, 7]].sum()
+    efc3_size = fixed_size + feature_sizes[[0, 1, 2, 5, 6, 7]].sum()
+
+    assert choose_extreme_feature_count(
+        table, metadata, ranks, None, efc1_size
+    ) == (1, efc1_size)
+    assert choose_extreme_feature_count(
+        table, metadata, ranks, None, efc3_size + 1
+    ) == (3, efc3_size)
+    assert "Chose an extreme feature count of 3" in capsys.readouterr().out
+
+    # If everything fits, no filtering should be done
+    total_size = fixed_size + feature_sizes.sum()
+    assert choose_extreme_feature_count(
+        table, metadata, ranks, None, total_size
+    ) == (None, total_size)
+    # Even if everything except for one feature fits, we can't filter out
+    # just one feature
+    assert choose_extreme_feature_count(
+        table, metadata, ranks, None, total_size - 1
+    ) == (3, efc3_size)
+
+    with pytest.raises(ValueError) as exception_info:
+        choose_extreme_feature_count(
+            table, metadata, ranks, None, efc1_size - 1
+        )
+    assert "Even with an extreme feature count of 1" in str(
+        exception_info.value
+    )
+
+
+def test_finish_input_max_output_size():
+    table, metadata, ranks = get_size_test_data()
+    feature_sizes = estimate_feature_sizes(table, ranks)
+    fixed_size = estimate_fixed_size(metadata)
+    output_ranks = finish_input(
+        table,
+        metadata,
+        ranks,
+        max_output_size=fixed_size + feature_sizes[[0, 7]].sum(),
+    )[1]
+    assert list(output_ranks.index) == ["F1", "F8"]
+
+    with pytest.raises(ValueError) as exception_info:
+        finish_input(
+            table,
+            metadata,
+            ranks,
+            extreme_feature_count=1,
+            max_output_size=100000,
+        )
+    assert "Only one of the extreme feature count" in str(exception_info.value)
+
+
+def test_plot_checks_filtering_options_before_loading(tmp_path):
+    """Checks that the standalone script rejects -x and --max-output-size
+       together before it tries to read any input files.
+    """
+    missing = str(tmp_path / "missing.tsv")
+    result = CliRunner().invoke(
+        plot,
+        [
+            "--ranks",
+            missing,
+            "--table",
+            missing,
+            "--sample-metadata",
+            missing,
+            "--output-dir",
+            str(tmp_path / "out"),
+            "-x",
+            "1",
+            "--max-output-size",
+            "100000",
+        ],
+    )
+    assert isinstance(result.exception, ValueError)
+    assert "Only one of the extreme feature count" in str(result.exception)
+    assert not os.path.exists(str(tmp_path / "out"))
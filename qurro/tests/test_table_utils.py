@@ -0,0 +1,322 @@
+import biom
+import h5py
+import pytest
+import numpy as np
+from pandas import DataFrame, Index, Series
+from pandas.testing import assert_frame_equal, assert_series_equal
+from scipy.sparse import csr_matrix
+import qurro._table_utils
+from qurro._table_utils import (
+    SparseTable,
+    TableStats,
+    as_sparse_table,
+    read_hdf5_ids,
+    read_hdf5_sample_block,
+)
+from qurro._df_utils import (
+    biom_table_to_sparse_table,
+    load_matching_table,
+    remove_empty_samples_and_features,
+    match_table_and_data,
+    add_sample_presence_count,
+    vibe_check,
+)
+from qurro._rank_utils import filter_unextreme_features
+from qurro.tests.test_df_utils import get_test_data
+
+
+def get_test_sparse_table():
+    table, metadata, ranks = get_test_data()
+    return SparseTable.from_dataframe(table), table, metadata, ranks
+
+
+def test_sparse_table_basic():
+    st, table, _, _ = get_test_sparse_table()
+    assert st.shape == (8, 4)
+    assert st.nnz == 18
+    assert list(st.index) == list(table.index)
+    assert list(st.columns) == list(table.columns)
+    assert_frame_equal(st.to_dataframe(), table)
+    assert list(st.feature_nnz()) == [3, 2, 2, 3, 2, 2, 2, 2]
+    assert list(st.sample_nnz()) == [8, 8, 1, 1]
+
+
+def test_sparse_table_removes_explicit_zeros():
+    matrix = csr_matrix(np.array([[1.0, 0.0], [0.0, 2.0]]))
+    # Manually store a zero in the matrix
+    matrix.data[0] = 0
+    st = SparseTable(matrix, ["F1", "F2"], ["S1", "S2"])
+    assert st.nnz == 1
+    assert list(st.feature_nnz()) == [0, 1]
+    # The input matrix shouldn't have been modified
+    assert matrix.nnz == 2
+
+
+def test_sparse_table_mismatched_ids():
+    with pytest.raises(ValueError) as exception_info:
+        SparseTable(np.ones((2, 3)), ["F1"], ["S1", "S2", "S3"])
+    assert "Number of feature IDs (1)" in str(exception_info.value)
+
+    with pytest.raises(ValueError) as exception_info:
+        SparseTable(np.ones((2, 3)), ["F1", "F2"], ["S1", "S2"])
+    assert "Number of sample IDs (2)" in str(exception_info.value)
+
+
+def test_sparse_table_take_and_filter():
+    st, table, _, _ = get_test_sparse_table()
+    taken = st.take([7, 0], [3, 1])
+    assert_frame_equal(
+        taken.to_dataframe(), table.iloc[[7, 0], [3, 1]],
+    )
+    filtered = st.filter(
+        feature_mask=np.array([True] + [False] * 7),
+        sample_mask=np.array([True, False, True, False]),
+    )
+    assert_frame_equal(filtered.to_dataframe(), table.iloc[[0], [0, 2]])
+
+
+def test_sparse_table_from_biom():
+    data = np.arange(12).reshape(4, 3)
+    fids = ["F1", "F2", "F3", "F4"]
+    sids = ["S1", "S2", "S3"]
+    st = biom_table_to_sparse_table(biom.Table(data, fids, sids))
+    assert list(st.feature_ids) == fids
+    assert list(st.sample_ids) == sids
+    assert_frame_equal(
+        st.to_dataframe(),
+        DataFrame(data, index=Index(fids), columns=Index(sids)),
+        check_dtype=False,
+    )
+
+
+def test_table_stats():
+    data = np.array(
+        [
+            [0, 0, 0, 0],
+            [-1.5, 0, 3, 0],
+            [0, 0, 0, 0],
+            [2, 0, 7, 1],
+            [0, 0, -4, 0],
+        ]
+    )
+    stats = TableStats.from_matrix(csr_matrix(data))
+    assert list(stats.feature_nnz) == [0, 2, 0, 3, 1]
+    assert list(stats.sample_nnz) == [2, 0, 3, 1]
+    assert_series_equal(
+        Series(stats.feature_min), Series([np.nan, -1.5, np.nan, 1, -4])
+    )
+    assert_series_equal(
+        Series(stats.feature_max), Series([np.nan, 3, np.nan, 7, -4])
+    )
+    assert stats.has_implicit_zeros
+    assert stats.min_value == -4
+    assert stats.max_value == 7
+
+    # The table's zeros should be accounted for in its min/max values
+    stats = TableStats.from_matrix(csr_matrix(np.array([[1, 0], [3, 2]])))
+    assert (stats.min_value, stats.max_value) == (0, 3)
+    stats = TableStats.from_matrix(csr_matrix(np.array([[1, 5], [3, 2]])))
+    assert (stats.min_value, stats.max_value) == (1, 5)
+    assert not stats.has_implicit_zeros
+
+
+def test_sparse_table_remove_empty():
+    """Checks that the stats of a table with its empty features/samples
+       removed (which are derived from the original table's stats) are the
+       same as if they had been computed from scratch.
+    """
+    data = np.array([[0, 0, 0], [1, 0, 2], [0, 0, 0], [5, 0, -3]])
+    st = SparseTable(data, ["F1", "F2", "F3", "F4"], ["S1", "S2", "S3"])
+    r_st = st.remove_empty()
+    assert list(r_st.feature_ids) == ["F2", "F4"]
+    assert list(r_st.sample_ids) == ["S1", "S3"]
+    derived_stats = r_st.stats()
+    computed_stats = TableStats.from_matrix(r_st.matrix)
+    for attr in (
+        "feature_nnz",
+        "sample_nnz",
+        "feature_min",
+        "feature_max",
+    ):
+        assert list(getattr(derived_stats, attr)) == list(
+            getattr(computed_stats, attr)
+        )
+    assert not derived_stats.has_implicit_zeros
+    assert not computed_stats.has_implicit_zeros
+
+
+def write_hdf5_test_table(tmp_path):
+    """Writes a sparse random BIOM table to an HDF5 file.
+
+       Returns the path to the file and a DataFrame version of the table.
+    """
+    rng = np.random.RandomState(0)
+    data = rng.randint(1, 10, size=(30, 20)) * (rng.rand(30, 20) < 0.3)
+    fids = ["F{}".format(i) for i in range(30)]
+    sids = ["S{}".format(i) for i in range(20)]
+    table_loc = str(tmp_path / "table.biom")
+    with h5py.File(table_loc, "w") as h5grp:
+        biom.Table(data, fids, sids).to_hdf5(h5grp, "Qurro tests")
+    return table_loc, DataFrame(data, index=Index(fids), columns=Index(sids))
+
+
+@pytest.mark.parametrize("max_read_gap", [0, 5, 65536])
+def test_sparse_table_from_hdf5(tmp_path, monkeypatch, max_read_gap):
+    """Checks that SparseTable.from_hdf5() reads the right parts of a table,
+       regardless of which of the file's matrices it reads from and how many
+       reads it takes.
+    """
+    monkeypatch.setattr(qurro._table_utils, "HDF5_MAX_READ_GAP", max_read_gap)
+    table_loc, table = write_hdf5_test_table(tmp_path)
+    fids = ["F3", "F4", "F5", "F10", "F29", "F0", "not in the table"]
+    sids = ["S19", "S2", "S3", "S7", "S8"]
+    expected_fids = ["F0", "F3", "F4", "F5", "F10", "F29"]
+    expected_sids = ["S2", "S3", "S7", "S8", "S19"]
+    with h5py.File(table_loc, "r") as h5grp:
+        # Subsetting features and samples, just features (so it's cheaper to
+        # read the sample-major matrix), and just samples (vice versa)
+        for f_ids, s_ids, exp_f_ids, exp_s_ids in (
+            (fids, sids, expected_fids, expected_sids),
+            (fids, None, expected_fids, list(table.columns)),
+            (None, sids, list(table.index), expected_sids),
+            (None, None, list(table.index), list(table.columns)),
+            ([], sids, [], expected_sids),
+        ):
+            st = SparseTable.from_hdf5(h5grp, f_ids, s_ids)
+            assert_frame_equal(
+                st.to_dataframe(),
+                table.loc[exp_f_ids, exp_s_ids],
+                check_dtype=False,
+                check_index_type=False,
+            )
+            assert st.matrix.has_sorted_indices
+
+
+@pytest.mark.parametrize("max_read_gap", [0, 65536])
+def test_read_hdf5_sample_block(tmp_path, monkeypatch, max_read_gap):
+    monkeypatch.setattr(qurro._table_utils, "HDF5_MAX_READ_GAP", max_read_gap)
+    table_loc, table = write_hdf5_test_table(tmp_path)
+    with h5py.File(table_loc, "r") as h5grp:
+        for start, sample_mask in (
+            (0, np.ones(20, dtype=bool)),
+            (5, np.array([True, False, False, True, True, False])),
+            (18, np.array([False, True])),
+            (3, np.zeros(4, dtype=bool)),
+        ):
+            block = read_hdf5_sample_block(h5grp, start, sample_mask)
+            sample_positions = start + np.flatnonzero(sample_mask)
+            assert block.shape == (len(sample_positions), 30)
+            np.testing.assert_array_equal(
+                block.toarray(), table.values[:, sample_positions].T
+            )
+
+
+def test_read_hdf5_ids(tmp_path):
+    table_loc, table = write_hdf5_test_table(tmp_path)
+    with h5py.File(table_loc, "r") as h5grp:
+        ids = read_hdf5_ids(h5grp, "sample")
+        assert list(ids) == list(table.columns)
+        assert all(isinstance(i, str) for i in ids)
+        assert list(read_hdf5_ids(h5grp, "observation", 28)) == list(
+            table.index[28:]
+        )
+        assert list(read_hdf5_ids(h5grp, "sample", 5, 8)) == list(
+            table.columns[5:8]
+        )
+
+
+def test_load_matching_table(tmp_path, capsys):
+    table_loc, table = write_hdf5_test_table(tmp_path)
+    ranks = DataFrame({"Rank 0": [1, 2, 3]}, index=["F1", "F2", "F3"])
+    metadata = DataFrame(
+        {"Metadata1": [1, 2, 3]}, index=["S1", "S5", "not in the table"]
+    )
+    st = load_matching_table(table_loc, ranks, metadata)
+    assert_frame_equal(
+        st.to_dataframe(),
+        table.loc[["F1", "F2", "F3"], ["S1", "S5"]],
+        check_dtype=False,
+    )
+    # The same messages match_table_and_data() would print about the BIOM
+    # table should've been printed
+    assert capsys.readouterr().out == (
+        "27 feature(s) in the BIOM table were not present in the feature "
+        "rankings.\n"
+        "These feature(s) have been removed from the visualization.\n"
+        "18 sample(s) in the BIOM table were not present in the sample "
+        "metadata file.\n"
+        "These sample(s) have been removed from the visualization.\n"
+    )
+    # Matching this table with the sample metadata should just drop the extra
+    # sample in the metadata
+    m_table, m_metadata = match_table_and_data(st, ranks, metadata)
+    assert_frame_equal(m_metadata, metadata.iloc[:2])
+
+    ranks.index = ["F1", "F2", "F300"]
+    with pytest.raises(ValueError) as exception_info:
+        load_matching_table(table_loc, ranks, metadata)
+    assert "Of the 3 ranked features, 1 was not present" in str(
+        exception_info.value
+    )
+    ranks.index = ["F1", "F2", "F3"]
+    metadata.index = ["A", "B", "C"]
+    with pytest.raises(ValueError) as exception_info:
+        load_matching_table(table_loc, ranks, metadata)
+    assert "No samples are shared" in str(exception_info.value)
+
+
+def test_load_matching_table_json():
+    """Non-HDF5 BIOM tables should just be loaded as usual."""
+    table_loc = "qurro/tests/input/matching_test/mt.biom"
+    ranks = DataFrame({"Rank 0": [1, 2]}, index=["Feature1", "Feature2"])
+    metadata = DataFrame({"Metadata1": [1]}, index=["Sample1"])
+    loaded_table = load_matching_table(table_loc, ranks, metadata)
+    assert isinstance(loaded_table, biom.Table)
+    assert loaded_table == biom.load_table(table_loc)
+
+
+def test_as_sparse_table():
+    st, table, _, _ = get_test_sparse_table()
+    assert as_sparse_table(st) == (st, False)
+    converted, was_converted = as_sparse_table(table)
+    assert was_converted
+    assert_frame_equal(converted.to_dataframe(), table)
+
+
+def test_df_utils_functions_keep_sparse_tables_sparse():
+    """Checks that passing a SparseTable to the table-processing functions
+       gives back a SparseTable (with the same contents that a DataFrame
+       would've produced).
+    """
+    st, table, metadata, ranks = get_test_sparse_table()
+
+    m_table, m_metadata = match_table_and_data(st, ranks, metadata)
+    assert isinstance(m_table, SparseTable)
+    assert_frame_equal(m_table.to_dataframe(), table)
+    assert_frame_equal(m_metadata, metadata)
+
+    f_table, f_ranks = filter_unextreme_features(st, ranks, 1)
+    assert isinstance(f_table, SparseTable)
+    assert set(f_table.index) == set(["F1", "F8"])
+
+    # Zero out Sample3 and F8
+    table["Sample3"] = 0
+    table.loc["F8"] = 0
+    st = SparseTable.from_dataframe(table)
+    r_table, r_metadata, r_ranks = remove_empty_samples_and_features(
+        st, metadata, ranks
+    )
+    assert isinstance(r_table, SparseTable)
+    assert_frame_equal(
+        r_table.to_dataframe(), table.drop("Sample3", axis=1).drop("F8")
+    )
+    assert_frame_equal(r_metadata, metadata.drop("Sample3"))
+    assert_frame_equal(r_ranks, ranks.drop("F8"))
+
+    spc = add_sample_presence_count(ranks, st)["qurro_spc"]
+    assert_series_equal(
+        spc, add_sample_presence_count(ranks, table)["qurro_spc"],
+    )
+    vibe_check(ranks, st)
+    with pytest.raises(OverflowError):
+        vibe_check(ranks, st, safe_range=[1, 8])
@@ -0,0 +1,190 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from qurro._taxonomy_index import (
+    TaxonomyIndex,
+    build_suffix_array,
+    hash_taxonomy,
+    load_or_build_taxonomy_index,
+    split_ranks,
+)
+
+MP_TAXONOMY = os.path.join(
+    "qurro", "tests", "input", "moving_pictures", "taxonomy.tsv"
+)
+
+QUERIES = (
+    "g__Bacteroides",
+    "Firmicutes",
+    "p__",
+    "k__Bacteria; p__Proteobacteria",
+    "s__",
+    "; c__",
+    "beyblade",
+    "",
+)
+
+
+def get_taxonomy():
+    taxonomy = pd.read_csv(MP_TAXONOMY, sep="\t", index_col=0)
+    # Include a feature without a taxonomy string
+    taxonomy.iloc[3, 0] = np.nan
+    return taxonomy
+
+
+def test_build_suffix_array():
+    for text in ("", "a", "banana", "abab\x00ab", "aaaaaaaa", "mississippi"):
+        codes = np.array([ord(c) for c in text], dtype=np.int64)
+        expected = sorted(range(len(text)), key=lambda i: text[i:])
+        assert list(build_suffix_array(codes)) == expected
+
+
+def test_split_ranks():
+    assert split_ranks(" k__Bacteria; p__Firmicutes,,c__A  B ") == [
+        "k__Bacteria",
+        "p__Firmicutes",
+        "c__A",
+        "B",
+    ]
+    assert split_ranks(" ;, ") == []
+
+
+def test_taxonomy_index_match_modes():
+    """Checks each match mode against a simple (linear) implementation."""
+    taxonomy = get_taxonomy()
+    index = TaxonomyIndex.from_taxonomy(taxonomy)
+    # Taxa should be deduplicated
+    assert len(index.taxa) == taxonomy["Taxon"].nunique()
+
+    feature_ids = list(taxonomy.index) + ["not in taxonomy"]
+    codes = index.get_taxon_codes(feature_ids)
+    assert codes[3] == -1 and codes[-1] == -1
+    taxa = taxonomy["Taxon"].reindex(feature_ids)
+    for query in QUERIES:
+        np.testing.assert_array_equal(
+            index.feature_mask(query, codes, "regex"),
+            taxa.str.contains(query, na=False).values,
+        )
+        np.testing.assert_array_equal(
+            index.feature_mask(query, codes, "literal"),
+            taxa.str.contains(query, regex=False, na=False).values,
+        )
+        query_ranks = set(split_ranks(query))
+        np.testing.assert_array_equal(
+            index.feature_mask(query, codes, "rank"),
+            [
+                isinstance(t, str)
+                and len(query_ranks & set(split_ranks(t))) > 0
+                for t in taxa
+            ],
+        )
+
+
+def test_taxonomy_index_rank_level():
+    taxonomy = pd.DataFrame(
+        {"Taxon": ["k__A; p__B; c__B", "k__A; p__C", "k__B", "k__A; p__B_x"]},
+        index=["F0", "F1", "F2", "F3"],
+    )
+    index = TaxonomyIndex.from_taxonomy(taxonomy)
+    codes = index.get_taxon_codes(taxonomy.index)
+    assert list(index.feature_mask("p__B", codes, "rank")) == [
+        True,
+        False,
+        False,
+        False,
+    ]
+    assert list(index.feature_mask("p__B", codes, "rank", level=1)) == [
+        True,
+        False,
+        False,
+        False,
+    ]
+    assert not index.feature_mask("p__B", codes, "rank", level=0).any()
+    assert not index.feature_mask("p__B", codes, "rank", level=5).any()
+    # Multiple ranks in a query are OR'd together
+    assert list(index.feature_mask("k__B p__C", codes, "rank")) == [
+        False,
+        True,
+        True,
+        False,
+    ]
+
+    with pytest.raises(ValueError) as exception_info:
+        index.taxon_mask("p__B", "fuzzy")
+    assert "Unrecognized match mode: fuzzy" in str(exception_info.value)
+
+
+def test_taxonomy_index_level_names():
+    taxonomy = pd.DataFrame(
+        {"Taxon": ["k__A; p__B ;c__C", "k__A; p__", "k__B", " ;k__A"]},
+        index=["F0", "F1", "F2", "F3"],
+    )
+    index = TaxonomyIndex.from_taxonomy(taxonomy)
+    names = dict(zip(index.taxa, index.level_names(1)))
+    assert names == {
+        "k__A; p__B ;c__C": "p__B",
+        "k__A; p__": None,
+        "k__B": None,
+        " ;k__A": "k__A",
+    }
+    assert index.level_names(0)[index.taxa.index("k__B")] == "k__B"
+
+
+def test_taxonomy_index_lazy_structures():
+    index = TaxonomyIndex.from_taxonomy(get_taxonomy())
+    # Nothing should be hashed or built until it's needed
+    assert index.taxonomy_hash is None
+    assert index._text is None
+    index.taxon_mask("p__Firmicutes", "regex")
+    index.taxon_mask("p__Firmicutes", "rank")
+    assert index._text is None
+    assert index._suffix_array is None
+    index.taxon_mask("p__Firmicutes", "literal")
+    assert index._text is not None
+    assert index._suffix_array is not None
+
+
+def test_taxonomy_index_save_load(tmp_path):
+    taxonomy = get_taxonomy()
+    index = TaxonomyIndex.from_taxonomy(taxonomy, hash_taxonomy(taxonomy))
+    index_loc = str(tmp_path / "taxonomy_index")
+    index.save(index_loc)
+    # np.savez() shouldn't have added an extension
+    assert os.listdir(str(tmp_path)) == ["taxonomy_index"]
+
+    loaded_index = TaxonomyIndex.load(index_loc)
+    assert loaded_index.taxonomy_hash == index.taxonomy_hash
+    assert list(loaded_index.feature_ids) == list(index.feature_ids)
+    assert loaded_index.taxa == index.taxa
+    codes = index.get_taxon_codes(taxonomy.index)
+    np.testing.assert_array_equal(
+        loaded_index.get_taxon_codes(taxonomy.index), codes
+    )
+    for query in QUERIES:
+        for match_mode in ("regex", "literal", "rank"):
+            np.testing.assert_array_equal(
+                loaded_index.feature_mask(query, codes, match_mode),
+                index.feature_mask(query, codes, match_mode),
+            )
+
+
+def test_load_or_build_taxonomy_index(tmp_path):
+    taxonomy = get_taxonomy()
+    index_loc = str(tmp_path / "taxonomy_index")
+    index = load_or_build_taxonomy_index(index_loc, taxonomy)
+    assert os.path.exists(index_loc)
+    mtime = os.path.getmtime(index_loc)
+    os.utime(index_loc, (mtime - 100, mtime - 100))
+
+    # The saved index should be reused...
+    loaded_index = load_or_build_taxonomy_index(index_loc, taxonomy)
+    assert loaded_index.taxonomy_hash == index.taxonomy_hash
+    assert os.path.getmtime(index_loc) == mtime - 100
+
+    # ...unless the taxonomy changed
+    taxonomy.iloc[0, 0] = "k__Changed"
+    changed_index = load_or_build_taxonomy_index(index_loc, taxonomy)
+    assert changed_index.taxonomy_hash != index.taxonomy_hash
+    assert "k__Changed" in changed_index.taxa
+    assert os.path.getmtime(index_loc) != mtime - 100
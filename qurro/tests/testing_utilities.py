@@ -1,6 +1,9 @@
+import base64
 import copy
 from itertools import zip_longest
+import json
 import os
+import numpy as np
 from pytest import approx
 from click.testing import CliRunner
 from biom import load_table
@@ -14,7 +17,11 @@ from qurro._df_utils import (
     match_table_and_data,
     biom_table_to_sparse_df,
 )
-from qurro._json_utils import get_jsons
+from qurro._json_utils import (
+    get_jsons,
+    decompress_json,
+    get_count_shard_filename,
+)
 
 
 def run_integration_test(
@@ -31,6 +38,9 @@ def run_integration_test(
     expect_all_unsupported_samples=False,
     q2_table_biom_format="BIOMV210Format",
     extreme_feature_count=None,
+    count_shard_size=None,
+    compress_data=False,
+    workers=1,
 ):
     """Runs qurro, and validates the output somewhat.
 
@@ -79,6 +89,9 @@ def run_integration_test(
             sample_metadata=sample_metadata,
             feature_metadata=feature_metadata,
             extreme_feature_count=extreme_feature_count,
+            count_shard_size=count_shard_size,
+            compress_data=compress_data,
+            workers=workers,
         )
         # Output the contents of the visualization to out_dir.
         rrv_qzv.visualization.export_data(out_dir)
@@ -99,6 +112,12 @@ def run_integration_test(
             args += ["--feature-metadata", floc]
         if extreme_feature_count is not None:
             args += ["--extreme-feature-count", extreme_feature_count]
+        if count_shard_size is not None:
+            args += ["--count-shard-size", count_shard_size]
+        if compress_data:
+            args.append("--compress-data")
+        if workers != 1:
+            args += ["--workers", workers]
         result = runner.invoke(rrvp.plot, args)
         # Validate that the correct exit code and output were recorded
         validate_standalone_result(
@@ -212,6 +231,10 @@ def validate_main_js(out_dir, rloc, tloc, sloc, validate_jsons=True):
 
     main_loc = os.path.join(out_dir, "main.js")
     rank_json, sample_json, count_json = get_jsons(main_loc)
+    decode_sample_plot_json(sample_json)
+    # Convert the packed count JSON to a {feature: {sample: count}} dict,
+    # which is a lot easier to check.
+    count_json = unpack_count_json(count_json, out_dir)
 
     # Validate plot JSONs
     if validate_jsons:
@@ -221,6 +244,23 @@ def validate_main_js(out_dir, rloc, tloc, sloc, validate_jsons=True):
     return rank_json, sample_json, count_json
 
 
+def decode_sample_plot_json(sample_json):
+    """Decodes all of the dictionary-encoded sample metadata fields in a
+       sample plot JSON, and removes the qurro_sample_metadata_dictionaries
+       dataset from it. This modifies sample_json in place.
+
+       This is analogous to what RRVDisplay.decodeSampleMetadataField() does
+       in the JS code, just for every field at once.
+    """
+    dictionaries = sample_json["datasets"].pop(
+        "qurro_sample_metadata_dictionaries", {}
+    )
+    for sample in sample_json["datasets"][sample_json["data"]["name"]]:
+        for field, dictionary in dictionaries.items():
+            if sample[field] is not None:
+                sample[field] = dictionary[sample[field]]
+
+
 def validate_samples_supported_output(output, expected_unsupported_samples):
     """Checks that the correct message has been based on BIOM sample support.
 
@@ -461,3 +501,55 @@ def validate_sample_stats_test_sample_plot_json(sample_json):
             assert sample["Metadata3"] == "21"
         else:
             raise ValueError("Invalid sample ID found in S.S.T. JSON")
+
+
+def read_count_shard(shard_loc):
+    """Reads in a count shard JSON from a file written by write_count_shards().
+    """
+    with open(shard_loc, "r") as shard_file_obj:
+        text = shard_file_obj.read().strip()
+    # Remove "qurroAddCountShard([i], " from the start and ");" from the end
+    return json.loads(text[text.index("{") : -2])
+
+
+def unpack_count_json(packed_json, main_js_dir=None):
+    """Converts a packed count JSON to a "sparse" count dict.
+
+       This is the inverse of get_packed_count_json(): the output is of the
+       form {feature ID: {sample ID: count, ...}, ...}, omitting zero counts.
+
+       If packed_json is a sharded count JSON (see get_sharded_count_json()),
+       main_js_dir should be the directory containing the main.js file this
+       JSON was taken from; the shards will be read in from there.
+    """
+    dtype = "<i4" if packed_json["data_type"] == "Int32" else "<f8"
+    if packed_json["qurro_count_format"] == "sharded":
+        if main_js_dir is None:
+            raise ValueError(
+                "The directory containing the count shards must be specified."
+            )
+        shard_dir = os.path.join(main_js_dir, packed_json["shard_dir"])
+        shards = [
+            decompress_json(
+                read_count_shard(
+                    os.path.join(shard_dir, get_count_shard_filename(i))
+                )
+            )
+            for i in range(packed_json["num_shards"])
+        ]
+    else:
+        shards = [packed_json]
+
+    sample_ids = packed_json["sample_ids"]
+    feature_ids = iter(packed_json["feature_ids"])
+    count_dict = {}
+    for shard in shards:
+        indptr = np.frombuffer(base64.b64decode(shard["indptr"]), "<i4")
+        indices = np.frombuffer(base64.b64decode(shard["indices"]), "<i4")
+        data = np.frombuffer(base64.b64decode(shard["data"]), dtype)
+        for f in range(len(indptr) - 1):
+            count_dict[next(feature_ids)] = {
+                sample_ids[indices[i]]: data[i].item()
+                for i in range(indptr[f], indptr[f + 1])
+            }
+    return count_dict
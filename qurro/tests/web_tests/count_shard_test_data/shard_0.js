@@ -0,0 +1 @@
+qurroAddCountShard(0, {"data": "AQAAAAIAAAAEAAAABQAAAAYAAAAGAAAABQAAAAQAAAACAAAAAQAAAA==", "indices": "AQAAAAIAAAADAAAABAAAAAUAAAAAAAAAAQAAAAIAAAADAAAABAAAAA==", "indptr": "AAAAAAUAAAAKAAAA"});
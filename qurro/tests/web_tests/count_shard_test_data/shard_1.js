@@ -0,0 +1 @@
+qurroAddCountShard(1, {"data": "AgAAAAMAAAAEAAAABAAAAAMAAAACAAAAAQAAAAEAAAABAAAAAQAAAAEAAAABAAAA", "indices": "AAAAAAEAAAACAAAAAwAAAAQAAAAFAAAAAAAAAAEAAAACAAAAAwAAAAQAAAAFAAAA", "indptr": "AAAAAAYAAAAMAAAA"});
@@ -0,0 +1 @@
+qurroAddCountShard(2, {"data": "AQAAAAIAAAA=", "indices": "AgAAAAMAAAA=", "indptr": "AAAAAAIAAAA="});
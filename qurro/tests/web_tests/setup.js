@@ -2,6 +2,8 @@ requirejs.config({
     paths: {
         display: "instrumented_js/display",
         dom_utils: "instrumented_js/dom_utils",
+        count_data: "instrumented_js/count_data",
+        compression: "instrumented_js/compression",
         feature_computation: "instrumented_js/feature_computation",
         vega: "../../support_files/vendor/vega.min",
         "vega-lite": "../../support_files/vendor/vega-lite.min",
@@ -12,7 +14,9 @@ requirejs.config({
         mocha: "vendor/mocha",
         chai: "vendor/chai",
         testing_utilities: "testing_utilities",
+        test_compression: "tests/test_compression",
         test_compute_balance: "tests/test_compute_balance",
+        test_count_data: "tests/test_count_data",
         test_dom_utils: "tests/test_dom_utils",
         test_filter_features: "tests/test_filter_features",
         test_identify_sample_ids: "tests/test_identify_sample_ids",
@@ -29,6 +33,8 @@ requirejs.config({
         test_rrvdisplay_getinvalidsampleids_samplestatstest:
             "tests/test_rrvdisplay_getinvalidsampleids_samplestatstest",
         test_rrvdisplay_destroy: "tests/test_rrvdisplay_destroy",
+        test_sample_metadata_dictionaries:
+            "tests/test_sample_metadata_dictionaries",
     },
     shim: {
         // Mocha shim based on
@@ -50,6 +56,8 @@ requirejs(
     [
         "display",
         "dom_utils",
+        "count_data",
+        "compression",
         "feature_computation",
         "vega",
         "vega-lite",
@@ -60,7 +68,9 @@ requirejs(
         "mocha",
         "chai",
         "testing_utilities",
+        "test_compression",
         "test_compute_balance",
+        "test_count_data",
         "test_dom_utils",
         "test_filter_features",
         "test_identify_sample_ids",
@@ -72,10 +82,13 @@ requirejs(
         "test_rrvdisplay_getinvalidsampleids",
         "test_rrvdisplay_getinvalidsampleids_samplestatstest",
         "test_rrvdisplay_destroy",
+        "test_sample_metadata_dictionaries",
     ],
     function (
         display,
         dom_utils,
+        count_data,
+        compression,
         feature_computation,
         vega,
         vegaLite,
@@ -86,7 +99,9 @@ requirejs(
         mocha,
         chai,
         testing_utilities,
+        test_compression,
         test_compute_balance,
+        test_count_data,
         test_dom_utils,
         test_filter_features,
         test_identify_sample_ids,
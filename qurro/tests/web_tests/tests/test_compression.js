@@ -0,0 +1,50 @@
+define(["compression", "mocha", "chai"], function (compression, mocha, chai) {
+    // {"a": [1, 2.5, null], "b": "Qurro ✓"}, compressed using
+    // _json_utils.compress_json()
+    var compressedJSON = {
+        qurro_compressed_json:
+            "eJyrVkpUslKINtRRMNIz1VHIK83JidVRUEoCCioFlhYV5SvElBqZGxor1QIA5u8LMA==",
+    };
+    var expectedJSON = { a: [1, 2.5, null], b: "Qurro ✓" };
+
+    describe("Decompressing JSONs", function () {
+        it("Identifies compressed JSONs", function () {
+            chai.assert.isTrue(compression.isCompressed(compressedJSON));
+            chai.assert.isFalse(compression.isCompressed(expectedJSON));
+            chai.assert.isFalse(compression.isCompressed({}));
+            chai.assert.isFalse(compression.isCompressed(null));
+            chai.assert.isFalse(
+                compression.isCompressed({
+                    qurro_compressed_json: "abc",
+                    otherKey: 5,
+                })
+            );
+        });
+        it("Decodes base64-encoded bytes", function () {
+            chai.assert.deepEqual(
+                Array.from(compression.base64ToBytes("AAH/")),
+                [0, 1, 255]
+            );
+        });
+        it("Decompresses compressed JSONs", async function () {
+            chai.assert.deepEqual(
+                await compression.decompressJSON(compressedJSON),
+                expectedJSON
+            );
+        });
+        it("Leaves uncompressed JSONs alone", async function () {
+            chai.assert.strictEqual(
+                await compression.decompressJSON(expectedJSON),
+                expectedJSON
+            );
+        });
+        it("Decompresses arrays of JSONs", async function () {
+            var jsons = await compression.decompressJSONs([
+                compressedJSON,
+                {},
+                compressedJSON,
+            ]);
+            chai.assert.deepEqual(jsons, [expectedJSON, {}, expectedJSON]);
+        });
+    });
+});
@@ -1,5 +1,6 @@
-define(["feature_computation", "mocha", "chai"], function (
+define(["feature_computation", "count_data", "mocha", "chai"], function (
     feature_computation,
+    count_data,
     mocha,
     chai
 ) {
@@ -77,6 +78,41 @@ define(["feature_computation", "mocha", "chai"], function (
             });
         });
     });
+    describe("Computing log-ratios of all samples at once", function () {
+        // Features F0, F1, F2; samples S0, S1, S2, S3. Counts:
+        //      S0  S1  S2  S3
+        // F0    1   0   4   0
+        // F1    2   3   0   0
+        // F2    0   5   0   0
+        var countData = count_data.makeCountData(
+            ["F0", "F1", "F2"],
+            ["S0", "S1", "S2", "S3"],
+            Int32Array.from([0, 2, 4, 5]),
+            Int32Array.from([0, 2, 0, 1, 1]),
+            Float64Array.from([1, 4, 2, 3, 5])
+        );
+        it("Computes the log-ratio of each sample", function () {
+            var balances = feature_computation.computeSampleBalances(
+                countData,
+                [0, 2],
+                [1]
+            );
+            chai.assert.instanceOf(balances, Float64Array);
+            chai.assert.equal(balances.length, 4);
+            chai.assert.approximately(balances[0], Math.log(1 / 2), 0.00001);
+            chai.assert.approximately(balances[1], Math.log(5 / 3), 0.00001);
+        });
+        it("Uses NaN for samples with a null log-ratio", function () {
+            var balances = feature_computation.computeSampleBalances(
+                countData,
+                [0, 2],
+                [1]
+            );
+            // S2 has a denominator of 0; S3 has both parts equal to 0
+            chai.assert.isNaN(balances[2]);
+            chai.assert.isNaN(balances[3]);
+        });
+    });
 });
 
 //describe("Computing balance for a given sample", function() {
@@ -0,0 +1,188 @@
+define(["count_data", "mocha", "chai"], function (count_data, mocha, chai) {
+    // The count JSON from the python "matching" integration test, in both
+    // the old "sparse" format and the packed format (as created by
+    // _json_utils.get_packed_count_json()).
+    // prettier-ignore
+    var sparseCountJSON = {"Taxon1": {"Sample2": 1.0, "Sample3": 2.0, "Sample5": 4.0, "Sample6": 5.0, "Sample7": 6.0}, "Taxon2": {"Sample1": 6.0, "Sample2": 5.0, "Sample3": 4.0, "Sample5": 2.0, "Sample6": 1.0}, "Taxon3": {"Sample1": 2.0, "Sample2": 3.0, "Sample3": 4.0, "Sample5": 4.0, "Sample6": 3.0, "Sample7": 2.0}, "Taxon4": {"Sample1": 1.0, "Sample2": 1.0, "Sample3": 1.0, "Sample5": 1.0, "Sample6": 1.0, "Sample7": 1.0}, "Taxon5": {"Sample3": 1.0, "Sample5": 2.0}};
+    // prettier-ignore
+    var packedCountJSON = {"data": "AQAAAAIAAAAEAAAABQAAAAYAAAAGAAAABQAAAAQAAAACAAAAAQAAAAIAAAADAAAABAAAAAQAAAADAAAAAgAAAAEAAAABAAAAAQAAAAEAAAABAAAAAQAAAAEAAAACAAAA", "data_type": "Int32", "feature_ids": ["Taxon1", "Taxon2", "Taxon3", "Taxon4", "Taxon5"], "indices": "AQAAAAIAAAADAAAABAAAAAUAAAAAAAAAAQAAAAIAAAADAAAABAAAAAAAAAABAAAAAgAAAAMAAAAEAAAABQAAAAAAAAABAAAAAgAAAAMAAAAEAAAABQAAAAIAAAADAAAA", "indptr": "AAAAAAUAAAAKAAAAEAAAABYAAAAYAAAA", "qurro_count_format": "csc", "sample_ids": ["Sample1", "Sample2", "Sample3", "Sample5", "Sample6", "Sample7"]};
+    // Same as packedCountJSON, but with every count divided by 2 (so the
+    // counts have to be stored as Float64s).
+    // prettier-ignore
+    var packedFloatCountJSON = {"data": "AAAAAAAA4D8AAAAAAADwPwAAAAAAAABAAAAAAAAABEAAAAAAAAAIQAAAAAAAAAhAAAAAAAAABEAAAAAAAAAAQAAAAAAAAPA/AAAAAAAA4D8AAAAAAADwPwAAAAAAAPg/AAAAAAAAAEAAAAAAAAAAQAAAAAAAAPg/AAAAAAAA8D8AAAAAAADgPwAAAAAAAOA/AAAAAAAA4D8AAAAAAADgPwAAAAAAAOA/AAAAAAAA4D8AAAAAAADgPwAAAAAAAPA/", "data_type": "Float64", "feature_ids": ["Taxon1", "Taxon2", "Taxon3", "Taxon4", "Taxon5"], "indices": "AQAAAAIAAAADAAAABAAAAAUAAAAAAAAAAQAAAAIAAAADAAAABAAAAAAAAAABAAAAAgAAAAMAAAAEAAAABQAAAAAAAAABAAAAAgAAAAMAAAAEAAAABQAAAAIAAAADAAAA", "indptr": "AAAAAAUAAAAKAAAAEAAAABYAAAAYAAAA", "qurro_count_format": "csc", "sample_ids": ["Sample1", "Sample2", "Sample3", "Sample5", "Sample6", "Sample7"]};
+    // The same count data, split up into shards of 2 features each (as
+    // created by _json_utils.get_sharded_count_json()). The shard files are
+    // stored in web_tests/count_shard_test_data/.
+    // prettier-ignore
+    var shardedCountJSON = {"data_type": "Int32", "feature_ids": ["Taxon1", "Taxon2", "Taxon3", "Taxon4", "Taxon5"], "num_shards": 3, "qurro_count_format": "sharded", "sample_ids": ["Sample1", "Sample2", "Sample3", "Sample5", "Sample6", "Sample7"], "shard_dir": "count_shard_test_data", "shard_size": 2};
+    var sampleIDs = packedCountJSON.sample_ids;
+
+    /* Returns the count of a feature in a sample, by feature / sample ID. */
+    function getCountByIDs(countData, featureID, sampleID) {
+        return count_data.getCount(
+            countData,
+            countData.featureIndex.get(featureID),
+            countData.sampleIndex.get(sampleID)
+        );
+    }
+
+    describe("Loading and accessing count data", function () {
+        it("Decodes base64-encoded typed arrays", function () {
+            chai.assert.deepEqual(
+                Array.from(
+                    count_data.decodeBase64(packedCountJSON.indptr, Int32Array)
+                ),
+                [0, 5, 10, 16, 22, 24]
+            );
+            chai.assert.isEmpty(count_data.decodeBase64("", Float64Array));
+        });
+        it("Loads packed count JSONs", function () {
+            var countData = count_data.loadCountData(packedCountJSON);
+            chai.assert.deepEqual(countData.featureIDs, [
+                "Taxon1",
+                "Taxon2",
+                "Taxon3",
+                "Taxon4",
+                "Taxon5",
+            ]);
+            chai.assert.deepEqual(countData.sampleIDs, sampleIDs);
+            chai.assert.instanceOf(countData.data, Int32Array);
+            chai.assert.instanceOf(
+                count_data.loadCountData(packedFloatCountJSON).data,
+                Float64Array
+            );
+        });
+        it("Gives the same counts for packed and sparse count JSONs", function () {
+            var packedData = count_data.loadCountData(packedCountJSON);
+            var floatData = count_data.loadCountData(packedFloatCountJSON);
+            var sparseData = count_data.loadCountData(sparseCountJSON);
+            chai.assert.sameMembers(
+                sparseData.featureIDs,
+                packedData.featureIDs
+            );
+            chai.assert.sameMembers(sparseData.sampleIDs, sampleIDs);
+            var fID, sID, expectedCount;
+            for (var f = 0; f < packedData.featureIDs.length; f++) {
+                fID = packedData.featureIDs[f];
+                for (var s = 0; s < sampleIDs.length; s++) {
+                    sID = sampleIDs[s];
+                    expectedCount = sparseCountJSON[fID][sID] || 0;
+                    chai.assert.equal(
+                        getCountByIDs(packedData, fID, sID),
+                        expectedCount
+                    );
+                    chai.assert.equal(
+                        getCountByIDs(floatData, fID, sID),
+                        expectedCount / 2
+                    );
+                    chai.assert.equal(
+                        getCountByIDs(sparseData, fID, sID),
+                        expectedCount
+                    );
+                }
+            }
+        });
+        it("Sums the counts of features in every sample", function () {
+            var countData = count_data.loadCountData(packedCountJSON);
+            // Taxon2 and Taxon5
+            chai.assert.deepEqual(
+                Array.from(count_data.sumFeatureCounts(countData, [1, 4])),
+                [6, 5, 5, 4, 1, 0]
+            );
+            chai.assert.deepEqual(
+                Array.from(count_data.sumFeatureCounts(countData, [])),
+                [0, 0, 0, 0, 0, 0]
+            );
+        });
+        it("Returns 0 for samples not in the count data", function () {
+            var countData = count_data.loadCountData(packedCountJSON);
+            chai.assert.equal(getCountByIDs(countData, "Taxon4", "Sample4"), 0);
+        });
+    });
+    describe("Loading sharded count data", function () {
+        /* Returns the indices of a sharded count data object's loaded shards,
+         * from least to most recently used.
+         */
+        function loadedShards(countData) {
+            return Array.from(countData.shards.keys());
+        }
+        it("Doesn't load any shards up front", function () {
+            var countData = count_data.loadCountData(shardedCountJSON);
+            chai.assert.isTrue(countData.sharded);
+            chai.assert.deepEqual(countData.featureIDs, [
+                "Taxon1",
+                "Taxon2",
+                "Taxon3",
+                "Taxon4",
+                "Taxon5",
+            ]);
+            chai.assert.deepEqual(countData.sampleIDs, sampleIDs);
+            chai.assert.isEmpty(loadedShards(countData));
+            chai.assert.throws(function () {
+                getCountByIDs(countData, "Taxon1", "Sample2");
+            }, /Counts of feature Taxon1 haven't been loaded/);
+        });
+        it("Loads only the shards containing the requested features", async function () {
+            var countData = count_data.loadCountData(shardedCountJSON);
+            // Taxon2 (in shard 0) and Taxon5 (in shard 2)
+            var sums = await count_data.loadFeatureCounts(
+                countData,
+                [[1], [4]],
+                function () {
+                    return count_data.sumFeatureCounts(countData, [1, 4]);
+                }
+            );
+            chai.assert.deepEqual(Array.from(sums), [6, 5, 5, 4, 1, 0]);
+            chai.assert.sameMembers(loadedShards(countData), [0, 2]);
+        });
+        it("Gives the same counts as packed count JSONs", async function () {
+            var packedData = count_data.loadCountData(packedCountJSON);
+            var countData = count_data.loadCountData(shardedCountJSON);
+            await count_data.loadFeatureCounts(
+                countData,
+                [[0, 1, 2, 3, 4]],
+                function () {}
+            );
+            for (var f = 0; f < countData.featureIDs.length; f++) {
+                for (var s = 0; s < countData.sampleIDs.length; s++) {
+                    chai.assert.equal(
+                        count_data.getCount(countData, f, s),
+                        count_data.getCount(packedData, f, s)
+                    );
+                }
+            }
+        });
+        it("Evicts the least recently used shards", async function () {
+            var countData = count_data.loadCountData(shardedCountJSON);
+            countData.maxLoadedShards = 2;
+            var noop = function () {};
+            await count_data.loadFeatureCounts(countData, [[0]], noop);
+            await count_data.loadFeatureCounts(countData, [[2]], noop);
+            // Re-using shard 0 makes shard 1 the least recently used shard
+            await count_data.loadFeatureCounts(countData, [[1]], noop);
+            await count_data.loadFeatureCounts(countData, [[4]], noop);
+            chai.assert.deepEqual(loadedShards(countData), [0, 2]);
+            // If more shards are needed at once than the maximum, they should
+            // all be kept
+            await count_data.loadFeatureCounts(countData, [[0, 2], [4]], noop);
+            chai.assert.sameMembers(loadedShards(countData), [0, 1, 2]);
+            await count_data.loadFeatureCounts(countData, [[3]], noop);
+            chai.assert.sameMembers(loadedShards(countData), [1, 2]);
+        });
+        it("Rejects if a shard file can't be loaded", async function () {
+            var badJSON = Object.assign({}, shardedCountJSON, {
+                shard_dir: "nonexistent_directory",
+            });
+            var countData = count_data.loadCountData(badJSON);
+            var errorMessage;
+            try {
+                await count_data.loadFeatureCounts(countData, [[0]], Object);
+            } catch (err) {
+                errorMessage = err.message;
+            }
+            chai.assert.include(errorMessage, "Couldn't load count shard file");
+            chai.assert.isEmpty(loadedShards(countData));
+            chai.assert.equal(countData.pendingShards.size, 0);
+        });
+    });
+});
@@ -135,6 +135,75 @@ define(["mocha", "chai", "testing_utilities"], function (
                 });
             });
         });
+        describe("Computing log-ratios of all samples at once", function () {
+            it("Matches the log-ratios computed for individual samples", function () {
+                var topFeatures = [
+                    { "Feature ID": "Taxon1" },
+                    { "Feature ID": "Taxon3" },
+                ];
+                var botFeatures = [
+                    { "Feature ID": "Taxon2" },
+                    { "Feature ID": "Taxon5" },
+                ];
+                var balances = rrv.computeBalances(topFeatures, botFeatures);
+                rrv.topFeatures = topFeatures;
+                rrv.botFeatures = botFeatures;
+                var sampleRow;
+                for (var s = 0; s < rrv.sampleIDs.length; s++) {
+                    sampleRow = { "Sample ID": rrv.sampleIDs[s] };
+                    chai.assert.equal(
+                        rrv.getSampleBalance(balances, rrv.sampleIDs[s]),
+                        rrv.updateBalanceMulti(sampleRow)
+                    );
+                }
+                // Sample7 doesn't have any counts for Taxon2 or Taxon5, so
+                // its log-ratio should be null
+                chai.assert.isNull(rrv.getSampleBalance(balances, "Sample7"));
+                chai.assert.equal(
+                    rrv.getSampleBalance(balances, "Sample1"),
+                    Math.log(2) - Math.log(6)
+                );
+            });
+            it("Returns all nulls when a feature list is empty", function () {
+                var balances = rrv.computeBalances(
+                    [],
+                    [{ "Feature ID": "Taxon2" }]
+                );
+                for (var s = 0; s < rrv.sampleIDs.length; s++) {
+                    chai.assert.isNull(
+                        rrv.getSampleBalance(balances, rrv.sampleIDs[s])
+                    );
+                }
+            });
+            it("Returns null for samples without count data", function () {
+                var balances = rrv.computeBalances(
+                    [{ "Feature ID": "Taxon3" }],
+                    [{ "Feature ID": "Taxon4" }]
+                );
+                chai.assert.isNull(
+                    rrv.getSampleBalance(balances, "lolthisisntreal")
+                );
+            });
+            it("Throws an error if a feature ID isn't present in data", function () {
+                chai.assert.throws(function () {
+                    rrv.computeBalances(
+                        [{ "Feature ID": "lolthisisntreal" }],
+                        [{ "Feature ID": "Taxon4" }]
+                    );
+                });
+            });
+            it("Gives the same log-ratios when loading counts first", async function () {
+                var top = [{ "Feature ID": "Taxon1" }];
+                var bot = [
+                    { "Feature ID": "Taxon2" },
+                    { "Feature ID": "Taxon4" },
+                ];
+                chai.assert.deepEqual(
+                    await rrv.loadBalances(top, bot),
+                    rrv.computeBalances(top, bot)
+                );
+            });
+        });
         describe("Summing feature abundances in a sample", function () {
             it("Correctly sums feature abundances in a sample", function () {
                 // Check case when number of features is just one
@@ -1,4 +1,5 @@
-define(["mocha", "chai", "testing_utilities"], function (
+define(["display", "mocha", "chai", "testing_utilities"], function (
+    display,
     mocha,
     chai,
     testing_utilities
@@ -27,23 +28,18 @@ define(["mocha", "chai", "testing_utilities"], function (
         it("Works for single-feature selections", function () {
             rrv.newFeatureHigh = { "Feature ID": "FH" };
             rrv.newFeatureLow = { "Feature ID": "FL" };
-            chai.assert.equal(
-                "Numerator",
-                rrv.updateRankColorSingle({ "Feature ID": "FH" })
-            );
-            chai.assert.equal(
-                "Denominator",
-                rrv.updateRankColorSingle({ "Feature ID": "FL" })
-            );
-            chai.assert.equal(
-                "None",
-                rrv.updateRankColorSingle({ "Feature ID": "FN" })
+            chai.assert.sameDeepMembers(
+                Array.from(rrv.classifySingleSelection()),
+                [
+                    ["FH", "Numerator"],
+                    ["FL", "Denominator"],
+                ]
             );
             // Test "both" case
             rrv.newFeatureLow = { "Feature ID": "FH" };
-            chai.assert.equal(
-                "Both",
-                rrv.updateRankColorSingle({ "Feature ID": "FH" })
+            chai.assert.sameDeepMembers(
+                Array.from(rrv.classifySingleSelection()),
+                [["FH", "Both"]]
             );
         });
 
@@ -57,21 +53,59 @@ define(["mocha", "chai", "testing_utilities"], function (
                 { "Feature ID": "Feature3" },
                 { "Feature ID": "Feature4" },
             ];
-            chai.assert.equal(
-                "Numerator",
-                rrv.updateRankColorMulti({ "Feature ID": "Feature1" })
+            var classifications = rrv.classifyMultiSelection();
+            chai.assert.equal("Numerator", classifications.get("Feature1"));
+            chai.assert.equal("Denominator", classifications.get("Feature4"));
+            chai.assert.equal("Both", classifications.get("Feature3"));
+            // Features that aren't in the log-ratio aren't included
+            chai.assert.isFalse(classifications.has("FeatureN"));
+            chai.assert.equal("Numerator", classifications.get("Feature2"));
+            chai.assert.equal(classifications.size, 4);
+        });
+        it("Classifies the features in a selection", function () {
+            var classifications = display.RRVDisplay.classifyFeatures(
+                [{ "Feature ID": "F1" }, { "Feature ID": "F2" }],
+                [{ "Feature ID": "F2" }, { "Feature ID": "F3" }]
             );
+            chai.assert.sameDeepMembers(Array.from(classifications), [
+                ["F1", "Numerator"],
+                ["F2", "Both"],
+                ["F3", "Denominator"],
+            ]);
             chai.assert.equal(
-                "Denominator",
-                rrv.updateRankColorMulti({ "Feature ID": "Feature4" })
+                display.RRVDisplay.classifyFeatures([], []).size,
+                0
             );
-            chai.assert.equal(
-                "None",
-                rrv.updateRankColorMulti({ "Feature ID": "FeatureN" })
+        });
+        it("Identifies features with changed classifications", function () {
+            var oldClassifications = display.RRVDisplay.classifyFeatures(
+                [{ "Feature ID": "F1" }, { "Feature ID": "F2" }],
+                [{ "Feature ID": "F3" }, { "Feature ID": "F4" }]
+            );
+            var newClassifications = display.RRVDisplay.classifyFeatures(
+                [{ "Feature ID": "F1" }, { "Feature ID": "F3" }],
+                [{ "Feature ID": "F4" }, { "Feature ID": "F5" }]
+            );
+            // F1 and F4 haven't changed, so they shouldn't be included
+            chai.assert.sameDeepMembers(
+                Array.from(
+                    display.RRVDisplay.diffClassifications(
+                        oldClassifications,
+                        newClassifications
+                    )
+                ),
+                [
+                    ["F2", "None"],
+                    ["F3", "Numerator"],
+                    ["F5", "Denominator"],
+                ]
             );
             chai.assert.equal(
-                "Both",
-                rrv.updateRankColorMulti({ "Feature ID": "Feature3" })
+                display.RRVDisplay.diffClassifications(
+                    newClassifications,
+                    newClassifications
+                ).size,
+                0
             );
         });
     });
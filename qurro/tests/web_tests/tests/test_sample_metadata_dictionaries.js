@@ -0,0 +1,92 @@
+define(["display", "mocha", "chai", "testing_utilities"], function (
+    display,
+    mocha,
+    chai,
+    testing_utilities
+) {
+    // Just the output from the python "matching" integration test
+    // prettier-ignore
+    var rankPlotJSON = {"$schema": "https://vega.github.io/schema/vega-lite/v3.3.0.json", "autosize": {"resize": true}, "background": "#FFFFFF", "config": {"axis": {"gridColor": "#f2f2f2", "labelBound": true}, "mark": {"tooltip": null}, "view": {"height": 300, "width": 400}}, "data": {"name": "data-ceb3e53dd82dc2b785cc2ba76931c96b"}, "datasets": {"data-ceb3e53dd82dc2b785cc2ba76931c96b": [{"Feature ID": "Taxon1", "FeatureMetadata1": null, "FeatureMetadata2": null, "Intercept": 5.0, "Rank 1": 6.0, "Rank 2": 7.0, "Rank 3": 0.0, "Rank 4": 4.0, "qurro_classification": "None", "qurro_spc": 5.0}, {"Feature ID": "Taxon2", "FeatureMetadata1": null, "FeatureMetadata2": null, "Intercept": 1.0, "Rank 1": 2.0, "Rank 2": 3.0, "Rank 3": 0.0, "Rank 4": 4.0, "qurro_classification": "None", "qurro_spc": 5.0}, {"Feature ID": "Taxon3", "FeatureMetadata1": "Yeet", "FeatureMetadata2": "100", "Intercept": 4.0, "Rank 1": 5.0, "Rank 2": 6.0, "Rank 3": 0.0, "Rank 4": 4.0, "qurro_classification": "None", "qurro_spc": 6.0}, {"Feature ID": "Taxon4", "FeatureMetadata1": null, "FeatureMetadata2": null, "Intercept": 9.0, "Rank 1": 8.0, "Rank 2": 7.0, "Rank 3": 0.0, "Rank 4": 4.0, "qurro_classification": "None", "qurro_spc": 6.0}, {"Feature ID": "Taxon5", "FeatureMetadata1": "null", "FeatureMetadata2": "lol", "Intercept": 6.0, "Rank 1": 5.0, "Rank 2": 4.0, "Rank 3": 0.0, "Rank 4": 4.0, "qurro_classification": "None", "qurro_spc": 2.0}], "qurro_feature_metadata_ordering": ["FeatureMetadata1", "FeatureMetadata2"], "qurro_rank_ordering": ["Intercept", "Rank 1", "Rank 2", "Rank 3", "Rank 4"], "qurro_rank_type": "Differential"}, "encoding": {"color": {"field": "qurro_classification", "scale": {"domain": ["None", "Numerator", "Denominator", "Both"], "range": ["#e0e0e0", "#f00", "#00f", "#949"]}, "title": "Log-Ratio Classification", "type": "nominal"}, "tooltip": [{"field": "qurro_x", "title": "Current Ranking", "type": "quantitative"}, {"field": "qurro_classification", "title": "Log-Ratio Classification", "type": "nominal"}, {"field": "qurro_spc", "title": "Sample Presence Count", "type": "quantitative"}, {"field": "Feature ID", "type": "nominal"}, {"field": "FeatureMetadata1", "type": "nominal"}, {"field": "FeatureMetadata2", "type": "nominal"}, {"field": "Intercept", "type": "quantitative"}, {"field": "Rank 1", "type": "quantitative"}, {"field": "Rank 2", "type": "quantitative"}, {"field": "Rank 3", "type": "quantitative"}, {"field": "Rank 4", "type": "quantitative"}], "x": {"axis": {"labelAngle": 0, "ticks": false}, "field": "qurro_x", "scale": {"paddingInner": 0, "paddingOuter": 1, "rangeStep": 1}, "title": "Feature Rankings", "type": "ordinal"}, "y": {"field": "Intercept", "type": "quantitative"}}, "mark": "bar", "selection": {"selector005": {"bind": "scales", "encodings": ["x", "y"], "type": "interval"}}, "title": "Features", "transform": [{"sort": [{"field": "Intercept", "order": "ascending"}], "window": [{"as": "qurro_x", "op": "row_number"}]}]};
+    // prettier-ignore
+    var samplePlotJSON = {"$schema": "https://vega.github.io/schema/vega-lite/v3.3.0.json", "autosize": {"resize": true}, "background": "#FFFFFF", "config": {"axis": {"labelBound": true}, "mark": {"tooltip": null}, "range": {"category": {"scheme": "tableau10"}, "ramp": {"scheme": "blues"}}, "view": {"height": 300, "width": 400}}, "data": {"name": "data-17ad6d7eb8d11fdb67d65d9f4abd5654"}, "datasets": {"data-17ad6d7eb8d11fdb67d65d9f4abd5654": [{"Metadata1": "1", "Metadata2": "2", "Metadata3": "3", "Sample ID": "Sample1", "qurro_balance": null}, {"Metadata1": "4", "Metadata2": "5", "Metadata3": "6", "Sample ID": "Sample2", "qurro_balance": null}, {"Metadata1": "7", "Metadata2": "8", "Metadata3": "9", "Sample ID": "Sample3", "qurro_balance": null}, {"Metadata1": "13", "Metadata2": "14", "Metadata3": "15", "Sample ID": "Sample5", "qurro_balance": null}, {"Metadata1": "16", "Metadata2": "17", "Metadata3": "18", "Sample ID": "Sample6", "qurro_balance": null}, {"Metadata1": "19", "Metadata2": "20", "Metadata3": "21", "Sample ID": "Sample7", "qurro_balance": null}], "qurro_sample_metadata_fields": ["Metadata1", "Metadata2", "Metadata3", "Sample ID"]}, "encoding": {"color": {"field": "Metadata1", "type": "nominal"}, "tooltip": [{"field": "Sample ID", "type": "nominal"}, {"field": "qurro_balance", "type": "quantitative"}], "x": {"axis": {"labelAngle": -45}, "field": "Metadata1", "scale": {"zero": false}, "type": "nominal"}, "y": {"field": "qurro_balance", "scale": {"zero": false}, "title": "Current Natural Log-Ratio", "type": "quantitative"}}, "mark": {"type": "circle"}, "selection": {"selector006": {"bind": "scales", "encodings": ["x", "y"], "type": "interval"}}, "title": "Samples"};
+    // prettier-ignore
+    var countJSON = {"Taxon1": {"Sample2": 1.0, "Sample3": 2.0, "Sample5": 4.0, "Sample6": 5.0, "Sample7": 6.0}, "Taxon2": {"Sample1": 6.0, "Sample2": 5.0, "Sample3": 4.0, "Sample5": 2.0, "Sample6": 1.0}, "Taxon3": {"Sample1": 2.0, "Sample2": 3.0, "Sample3": 4.0, "Sample5": 4.0, "Sample6": 3.0, "Sample7": 2.0}, "Taxon4": {"Sample1": 1.0, "Sample2": 1.0, "Sample3": 1.0, "Sample5": 1.0, "Sample6": 1.0, "Sample7": 1.0}, "Taxon5": {"Sample3": 1.0, "Sample5": 2.0}};
+    describe("Decoding dictionary-encoded sample metadata fields", function () {
+        var rrv, dataName, encodedSamplePlotJSON;
+        before(async function () {
+            // Dictionary-encode the Metadata1 and Metadata3 fields (replacing
+            // Metadata1's values with "a" / "b" and Metadata3's values with
+            // "x" / null, so that the decoded values are easy to check)
+            encodedSamplePlotJSON = JSON.parse(JSON.stringify(samplePlotJSON));
+            dataName = encodedSamplePlotJSON.data.name;
+            var data = encodedSamplePlotJSON.datasets[dataName];
+            for (var i = 0; i < data.length; i++) {
+                data[i].Metadata1 = i % 2;
+                data[i].Metadata3 = i < 3 ? 0 : null;
+            }
+            encodedSamplePlotJSON.datasets.qurro_sample_metadata_dictionaries = {
+                Metadata1: ["a", "b"],
+                Metadata3: ["x"],
+            };
+            rrv = testing_utilities.getNewRRVDisplay(
+                rankPlotJSON,
+                encodedSamplePlotJSON,
+                countJSON
+            );
+            await rrv.makePlots();
+        });
+        after(async function () {
+            await rrv.destroy(true, true, true);
+        });
+        it("Removes the dictionaries from the sample plot JSON", function () {
+            chai.assert.notProperty(
+                rrv.samplePlotJSON.datasets,
+                "qurro_sample_metadata_dictionaries"
+            );
+        });
+        it("Decodes the default x-axis / color field when making the plot", function () {
+            var data = rrv.samplePlotJSON.datasets[dataName];
+            chai.assert.deepEqual(
+                data.map(function (row) {
+                    return row.Metadata1;
+                }),
+                ["a", "b", "a", "b", "a", "b"]
+            );
+            chai.assert.isFalse(
+                rrv.sampleMetadataDictionaries.has("Metadata1")
+            );
+        });
+        it("Only decodes other fields when they're needed", function () {
+            var data = rrv.samplePlotJSON.datasets[dataName];
+            chai.assert.equal(data[0].Metadata3, 0);
+            chai.assert.isTrue(
+                rrv.sampleMetadataDictionaries.has("Metadata3")
+            );
+
+            // Null values should stay null, and should still be treated as
+            // invalid
+            chai.assert.sameMembers(
+                rrv.getInvalidSampleIDs("Metadata3", "color"),
+                ["Sample5", "Sample6", "Sample7"]
+            );
+            chai.assert.deepEqual(
+                data.map(function (row) {
+                    return row.Metadata3;
+                }),
+                ["x", "x", "x", null, null, null]
+            );
+            chai.assert.isFalse(
+                rrv.sampleMetadataDictionaries.has("Metadata3")
+            );
+
+            // Decoding a field again shouldn't change anything
+            rrv.decodeSampleMetadataField("Metadata3");
+            chai.assert.equal(data[0].Metadata3, "x");
+        });
+        it("Leaves fields that aren't encoded as is", function () {
+            var data = rrv.samplePlotJSON.datasets[dataName];
+            rrv.decodeSampleMetadataField("Metadata2");
+            chai.assert.equal(data[0].Metadata2, "2");
+        });
+    });
+});
@@ -80,6 +80,7 @@ setup(
         "numpy >= 1.12.0",
         "pandas >= 0.24.0, <1",
         "scikit-bio > 0.5.3",
+        "scipy",
     ],
     # Based on how Altair splits up its requirements:
     # https://github.com/altair-viz/altair/blob/master/setup.py
@@ -95,7 +96,11 @@ setup(
     classifiers=classifiers,
     entry_points={
         "qiime2.plugins": ["q2-qurro=qurro.q2.plugin_setup:plugin"],
-        "console_scripts": ["qurro=qurro.scripts._plot:plot"],
+        "console_scripts": [
+            "qurro=qurro.scripts._plot:plot",
+            "qurro-qarcoal-batch=qurro.scripts._qarcoal:qarcoal_batch",
+            "qurro-qarcoal-pairwise=qurro.scripts._qarcoal:qarcoal_pairwise",
+        ],
     },
     zip_safe=False,
     python_requires=">=3.6,<3.8",